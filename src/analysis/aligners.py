@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 """Aligner interfaces."""
 
+import collections
 import os
 import datetime
+import io
+import itertools
 import logging
+import math
+import multiprocessing
+import numpy as np
+import pysam
 import re
 import subprocess
 import tempfile
 
+from analysis.alignment_cache import AlignmentCache
 import analysis.seq_utils as su
 import core_utils.file_utils as fu
+from core_utils.sort_planner import SortOrder
 from satmut_utils.definitions import DEFAULT_QUALITY_OFFSET, PRE_V1p8_QUALITY_OFFSET, DEFAULT_TEMPDIR
 
 __author__ = "Ian Hoskins"
@@ -23,6 +32,81 @@ __status__ = "Development"
 tempfile.tempdir = DEFAULT_TEMPDIR
 logger = logging.getLogger(__name__)
 
+ALIGNER_BOWTIE2 = "bowtie2"
+ALIGNER_BANDED = "banded"
+VALID_ALIGNERS = {ALIGNER_BOWTIE2, ALIGNER_BANDED}
+DEFAULT_ALIGNER = ALIGNER_BOWTIE2
+
+
+def get_output_names(f1, f2=None, output_dir=".", output_bam=None):
+    r"""Gets the output BAM and read group ID of an alignment.
+
+    :param str | None f1: path to FASTA or FASTQ 1, or None for streamed read pairs
+    :param str | None f2: optional path to FASTA or FASTQ 2
+    :param str output_dir: output directory to write the output BAM to
+    :param str | None output_bam: optional output BAM filename. Default None, use f1 basename. Required for \
+    streamed read pairs.
+    :return tuple: (str, str) output BAM and read group ID
+    :raises RuntimeError: if neither input files nor an output BAM are provided
+    """
+
+    if f1 is None:
+        if output_bam is None:
+            raise RuntimeError("An output BAM must be provided when aligning streamed read pairs.")
+        return output_bam, os.path.basename(fu.remove_extension(output_bam))
+
+    out_bam = output_bam
+    if output_bam is None:
+        if f2 is None:
+            out_name = fu.replace_extension(os.path.basename(f1), su.BAM_SUFFIX)
+        else:
+            out_name = fu.add_extension(os.path.basename(os.path.commonprefix([f1, f2])), su.BAM_SUFFIX)
+
+        out_bam = os.path.join(output_dir, out_name)
+
+    if f2 is None:
+        rg_id = os.path.basename(fu.remove_extension(f1))
+    else:
+        rg_id = os.path.basename(os.path.commonprefix([fu.remove_extension(f1), fu.remove_extension(f2)]))
+
+    return out_bam, rg_id
+
+
+def iterate_fastq_pairs(f1, f2=None):
+    """Generates read pairs from FASTQs.
+
+    :param str f1: path to FASTA or FASTQ 1
+    :param str | None f2: optional path to FASTA or FASTQ 2
+    :return generator: (pysam.FastxRecord, pysam.FastxRecord | None) R1 and R2 records
+    """
+
+    with pysam.FastxFile(f1) as f1_ff:
+
+        if f2 is None:
+            for r1 in f1_ff:
+                yield r1, None
+            return
+
+        with pysam.FastxFile(f2) as f2_ff:
+            for r1, r2 in zip(f1_ff, f2_ff):
+                yield r1, r2
+
+
+def peek_read_pairs(read_pairs):
+    """Determines if streamed reads are paired without consuming them.
+
+    :param iterable read_pairs: (R1, R2 | None) records with name, sequence, quality, and comment attributes
+    :return tuple: (iterator, bool) read pairs and whether the reads are paired
+    """
+
+    read_pairs_iter = iter(read_pairs)
+    first = next(read_pairs_iter, None)
+    if first is None:
+        return iter(()), True
+
+    res = itertools.chain((first,), read_pairs_iter), first[1] is not None
+    return res
+
 
 class BowtieConfig(object):
     """Class for configuring bowtie2 call."""
@@ -32,6 +116,7 @@ class BowtieConfig(object):
     INDEX_EXTENSIONS_RE = re.compile(r".[0-9].bt2")
     DEFAULT_FLAGS = ["--maxins", "1000", "--no-discordant", "--fr"]
     DEFAULT_SCORES = ["--mp", "4", "--rdg", "6,4", "--rfg", "6,4"]
+    APPEND_COMMENT_FLAG = "-sam-append-comment"  # the - prefix is added to args
 
     def __init__(self, ref, local=DEFAULT_LOCAL, nthreads=DEFAULT_NTHREADS, quality_encoding=DEFAULT_QUALITY_OFFSET,
                  *args, **kwargs):
@@ -79,43 +164,109 @@ class Bowtie2(object):
 
     DEFAULT_OUTDIR = "."
     DEFAULT_OUTBAM = None
+    DEFAULT_COORD_SORT = True
+    DEFAULT_CACHE_DIR = None
+    MATE_SUFFIXES = ("/1", "/2")
 
-    def __init__(self, config, f1, f2=None, output_dir=DEFAULT_OUTDIR, output_bam=DEFAULT_OUTBAM):
-        """Constructor for Bowtie2.
+    def __init__(self, config, f1, f2=None, output_dir=DEFAULT_OUTDIR, output_bam=DEFAULT_OUTBAM,
+                 coordinate_sort=DEFAULT_COORD_SORT, sort_planner=None, cache_dir=DEFAULT_CACHE_DIR, read_pairs=None):
+        r"""Constructor for Bowtie2.
 
         :param aligners.BowtieConfig config: config object
-        :param str f1: path to FASTA or FASTQ 1
+        :param str | None f1: path to FASTA or FASTQ 1, or None if read_pairs is provided
         :param str | None f2: optional path to FASTA or FASTQ 2
         :param str output_dir: optional output directory to write the output BAM to. Default current working directory.
         :param str | None output_bam: optional output BAM filename. Default None, use f1 basename.
+        :param bool coordinate_sort: coordinate sort and index the output? Default True. Otherwise, write the native \
+        bowtie2 output, in which mates are adjacent.
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner to register the output order with
+        :param str | None cache_dir: optional directory of a persistent alignment cache. Only read pairs missing from \
+        the cache are aligned. The cache is invalidated if the reference or alignment parameters change.
+        :param iterable | None read_pairs: optional (R1, R2 | None) records to align instead of FASTQs, e.g. from \
+        analysis.seq_utils.iterate_bam_read_pairs. Records are streamed to bowtie2 on stdin, so no intermediate \
+        FASTQs are written. output_bam must be provided.
         """
 
         self.config = config
         self.f1 = f1
         self.f2 = f2
         self.output_dir = output_dir
+        self.coordinate_sort = coordinate_sort
+        self.sort_planner = sort_planner
+
+        self.read_pairs = None
+        self.paired = f2 is not None
+        if read_pairs is not None:
+            self.read_pairs, self.paired = peek_read_pairs(read_pairs)
 
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
 
-        self.output_bam = output_bam
-        if output_bam is None:
-            if f2 is None:
-                out_name = fu.replace_extension(self.f1, su.BAM_SUFFIX)
-            else:
-                out_name = fu.add_extension(os.path.basename(os.path.commonprefix([f1, f2])), su.BAM_SUFFIX)
-
-            self.output_bam = os.path.join(output_dir, out_name)
-
-        if f2 is None:
-            rg_id = os.path.basename(fu.remove_extension(f1))
-        else:
-            rg_id = os.path.basename(os.path.commonprefix([fu.remove_extension(f1), fu.remove_extension(f2)]))
+        self.output_bam, rg_id = get_output_names(f1, f2, output_dir, output_bam)
+        if output_bam is None and f1 is not None and f2 is None:
+            # Unpaired output has been written relative to the path of f1
+            self.output_bam = os.path.join(output_dir, fu.replace_extension(self.f1, su.BAM_SUFFIX))
 
+        self.rg_id = rg_id
         self.alignment_kwargs = {"rg-id": rg_id}
         self.alignment_kwargs.update(config.kwargs)
+
+        self.alignment_cache = None
+        if cache_dir is not None:
+            self.alignment_cache = AlignmentCache(
+                cache_dir, AlignmentCache.get_config_digest(self.config.ref, self._get_params()))
+
         self.workflow()
 
+    def _get_params(self):
+        """Gets the bowtie2 parameters that affect the alignment records.
+
+        :return list: parameters, excluding inputs, threads, and the read group
+        """
+
+        params = self.config.DEFAULT_FLAGS + self.config.DEFAULT_SCORES
+
+        if self.config.quality_encoding == PRE_V1p8_QUALITY_OFFSET:
+            params.append("--phred64")
+
+        if self.config.local:
+            params.append("--local")
+        else:
+            params.append("--end-to-end")
+
+        # Add the configuration parameters
+        for f in self.config.args:
+            params.extend(["-" + str(f)])
+
+        for k, i in self.alignment_kwargs.items():
+            if k != "rg-id":
+                params.extend(["--{} {}".format(k, i)])
+
+        return params
+
+    def _get_call(self, f1, f2=None):
+        """Gets the bowtie2 call.
+
+        :param str | None f1: path to FASTA or FASTQ 1, or None to read FASTQ records from stdin
+        :param str | None f2: optional path to FASTA or FASTQ 2
+        :return list: call arguments
+        """
+
+        call = ["bowtie2", "-p", str(self.config.nthreads)]
+        call.extend(self._get_params())
+        call.extend(["--{} {}".format("rg-id", self.rg_id)])
+
+        call.extend(["-x", self.config.ref])
+        if f1 is None:
+            # Mates are interleaved on stdin
+            call.extend(["--interleaved", "-"] if self.paired else ["-U", "-"])
+        elif f2 is not None:
+            call.extend(["-1", f1, "-2", f2])
+        else:
+            call.extend(["-U", f1])
+
+        return call
+
     def _align(self):
         """Aligns reads.
 
@@ -126,29 +277,7 @@ class Bowtie2(object):
                 open(os.path.join(os.path.dirname(os.path.abspath(self.output_bam)),
                                   "Bowtie2.stderr.log"), "a") as bowtie2_stderr:
 
-            call = ["bowtie2", "-p", str(self.config.nthreads)]
-            call.extend(self.config.DEFAULT_FLAGS + self.config.DEFAULT_SCORES)
-
-            if self.config.quality_encoding == PRE_V1p8_QUALITY_OFFSET:
-                call.append("--phred64")
-
-            if self.config.local:
-                call.append("--local")
-            else:
-                call.append("--end-to-end")
-
-            # Add the configuration parameters
-            for f in self.config.args:
-                call.extend(["-" + str(f)])
-
-            for k, i in self.alignment_kwargs.items():
-                call.extend(["--{} {}".format(k, i)])
-
-            call.extend(["-x", self.config.ref])
-            if self.f2 is not None:
-                call.extend(["-1", self.f1, "-2", self.f2])
-            else:
-                call.extend(["-U", self.f1])
+            call = self._get_call(self.f1, self.f2)
 
             # Record a time stamp for each new alignment
             bowtie2_stderr.write(
@@ -157,30 +286,913 @@ class Bowtie2(object):
 
             bowtie2_stderr.write(" ".join(call) + fu.FILE_NEWLINE)
 
-            align_p = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=bowtie2_stderr)
+            align_stdin = subprocess.PIPE if self.read_pairs is not None else None
+            align_p = subprocess.Popen(call, stdin=align_stdin, stdout=subprocess.PIPE, stderr=bowtie2_stderr)
+
+            if not self.coordinate_sort:
+                tobam_p = subprocess.Popen(("samtools", "view", "-b", "-"),
+                                           stdin=align_p.stdout, stdout=out_file, stderr=bowtie2_stderr)
+                self._stream_read_pairs(align_p)
+                tobam_p.wait()
+                align_p.stdout.close()
+
+                return align_p.wait(), tobam_p.poll()
 
             tobam_p = subprocess.Popen(("samtools", "view", "-u", "-"),
                                        stdin=align_p.stdout, stdout=subprocess.PIPE, stderr=bowtie2_stderr)
 
             sort_p = subprocess.Popen(("samtools", "sort", "-"),
                                       stdin=tobam_p.stdout, stdout=out_file, stderr=bowtie2_stderr)
+            self._stream_read_pairs(align_p)
             sort_p.wait()
             align_p.stdout.close()
             tobam_p.stdout.close()
 
-            return align_p.poll(), tobam_p.poll(), sort_p.poll()
+            return align_p.wait(), tobam_p.wait(), sort_p.poll()
+
+    def _stream_read_pairs(self, align_p):
+        """Writes streamed read pairs to the stdin of bowtie2.
+
+        :param subprocess.Popen align_p: bowtie2 process, whose output is consumed by downstream processes
+        """
+
+        if self.read_pairs is None:
+            return
+
+        try:
+            with io.TextIOWrapper(align_p.stdin) as align_stdin:
+                for r1, r2 in self.read_pairs:
+                    align_stdin.write(su.format_fastq_record(r1))
+                    if r2 is not None:
+                        align_stdin.write(su.format_fastq_record(r2))
+        except BrokenPipeError:
+            # bowtie2 exited early; its return code and stderr log report the failure
+            logger.error("bowtie2 stopped reading streamed read pairs.")
+
+    def _trim_mate_suffix(self, qname):
+        """Trims a /1 or /2 mate suffix from a read name, as bowtie2 does.
+
+        :param str qname: read name
+        :return str: read name without the mate suffix
+        """
+
+        if self.paired and qname.endswith(self.MATE_SUFFIXES):
+            return qname[:-len(self.MATE_SUFFIXES[0])]
+
+        return qname
+
+    def _partition_cached(self, hits_sam, miss_f1, miss_f2=None):
+        r"""Writes the cached alignments of read pairs and the read pairs missing from the cache.
+
+        :param file | None hits_sam: open file to write the SAM records of cache hits to, or None to treat all read \
+        pairs as misses, e.g. when no header has been cached
+        :param file miss_f1: open file to write the R1s of cache misses to
+        :param file | None miss_f2: open file to write the R2s of cache misses to
+        :return dict: {read name: cache key} of the cache misses
+        """
+
+        misses = {}
+
+        def _write_batch(batch):
+            """Looks up a batch of read pairs in the cache."""
+
+            keys = [self.alignment_cache.get_pair_key(r1, r2) for r1, r2 in batch]
+
+            cached = {}
+            if hits_sam is not None:
+                cached = self.alignment_cache.get_many(keys)
+            else:
+                self.alignment_cache.misses += len(keys)
+
+            for (r1, r2), key in zip(batch, keys):
+                qname = self._trim_mate_suffix(r1.name)
+                if key in cached:
+                    hits_sam.write(self.alignment_cache.unpack_records(cached[key], qname, self.rg_id))
+                    continue
+
+                misses[qname] = key
+                miss_f1.write(su.format_fastq_record(r1))
+                if r2 is not None:
+                    miss_f2.write(su.format_fastq_record(r2))
+
+        read_pairs = self.read_pairs if self.read_pairs is not None else iterate_fastq_pairs(self.f1, self.f2)
+
+        batch = []
+        for read_pair in read_pairs:
+            batch.append(read_pair)
+            if len(batch) == self.alignment_cache.BATCH_SIZE:
+                _write_batch(batch)
+                batch = []
+
+        if len(batch) > 0:
+            _write_batch(batch)
+
+        return misses
+
+    def _cache_alignments(self, align_p, misses, out_sam, write_header=False):
+        r"""Streams the alignments of the cache misses to the output and stores them.
+
+        :param subprocess.Popen align_p: bowtie2 process aligning the cache misses, with text SAM on stdout
+        :param dict misses: {read name: cache key} of the cache misses
+        :param file out_sam: open SAM stream to write the alignments to
+        :param bool write_header: write the bowtie2 header to the output? Default False, as the cached header \
+        has been written.
+        :return int: return code of bowtie2
+
+        A read pair is stored only once the records of the next pair begin, and the last pair and the header only if \
+        bowtie2 succeeds, so a failed alignment never leaves truncated records in the cache.
+        """
+
+        header_lines = []
+        items = []
+        qname_lines = []
+        last_qname = None
+
+        for line in align_p.stdout:
+
+            if line.startswith(su.SAM_HEADER_CHAR):
+                if write_header:
+                    out_sam.write(line)
+                header_lines.append(line.rstrip(fu.FILE_NEWLINE))
+                continue
+
+            out_sam.write(line)
+            line = line.rstrip(fu.FILE_NEWLINE)
+
+            # bowtie2 keeps mates adjacent
+            qname = line.split(fu.FILE_DELIM, 1)[0]
+            if qname != last_qname and last_qname is not None:
+                if last_qname in misses:
+                    items.append((misses[last_qname], self.alignment_cache.pack_records(qname_lines)))
+                qname_lines = []
+
+            qname_lines.append(line)
+            last_qname = qname
+
+            if len(items) >= self.alignment_cache.BATCH_SIZE:
+                self.alignment_cache.put_many(items)
+                items = []
+
+        align_p.stdout.close()
+        align_rc = align_p.wait()
+        if align_rc != 0:
+            return align_rc
+
+        if last_qname in misses:
+            items.append((misses[last_qname], self.alignment_cache.pack_records(qname_lines)))
+
+        self.alignment_cache.put_many(items)
+        self.alignment_cache.set_header(header_lines)
+        return align_rc
+
+    def _align_cached(self):
+        r"""Aligns read pairs missing from the alignment cache and combines them with the cached alignments.
+
+        :return tuple: return codes of each process in the pipeline
+
+        Cached alignments are streamed to the output ahead of the newly aligned pairs, so mates remain adjacent and \
+        no intermediate SAM is written.
+        """
+
+        tempdir = tempfile.mkdtemp(suffix=".alignment_cache", dir=self.output_dir)
+        miss_f1 = os.path.join(tempdir, "misses.R1.fq")
+        miss_f2 = os.path.join(tempdir, "misses.R2.fq") if self.paired else None
+
+        if self.coordinate_sort:
+            out_call = ("samtools", "sort", "-o", self.output_bam, "-")
+        else:
+            out_call = ("samtools", "view", "-b", "-o", self.output_bam, "-")
+
+        # Without a cached header for this configuration, all pairs are aligned to obtain one
+        header = self.alignment_cache.get_header()
+        rg_header = fu.FILE_DELIM.join(
+            (su.SAM_HEADER_CHAR + su.SAM_RG_TAG, "%s:%s" % (su.SAM_RG_ID_TAG, self.rg_id))) + fu.FILE_NEWLINE
+
+        res = ()
+        with open(os.path.join(os.path.dirname(os.path.abspath(self.output_bam)),
+                               "Bowtie2.stderr.log"), "a") as bowtie2_stderr:
+
+            out_p = subprocess.Popen(out_call, stdin=subprocess.PIPE, stderr=bowtie2_stderr, universal_newlines=True)
+            align_p = None
+
+            try:
+                if header is not None:
+                    out_p.stdin.write(header + rg_header)
+
+                miss_f2_fh = open(miss_f2, "w") if miss_f2 is not None else None
+                with open(miss_f1, "w") as miss_f1_fh:
+                    misses = self._partition_cached(out_p.stdin if header is not None else None,
+                                                    miss_f1_fh, miss_f2_fh)
+
+                if miss_f2_fh is not None:
+                    miss_f2_fh.close()
+
+                if len(misses) > 0 or header is None:
+                    call = self._get_call(miss_f1, miss_f2)
+                    bowtie2_stderr.write(" ".join(call) + fu.FILE_NEWLINE)
+                    bowtie2_stderr.flush()
+
+                    align_p = subprocess.Popen(
+                        call, stdout=subprocess.PIPE, stderr=bowtie2_stderr, universal_newlines=True)
+                    res += (self._cache_alignments(align_p, misses, out_p.stdin, write_header=header is None),)
+
+            except BrokenPipeError:
+                # samtools exited early; its return code and stderr log report the failure
+                logger.error("samtools stopped reading cached and aligned records.")
+
+            finally:
+                if align_p is not None and align_p.returncode is None:
+                    align_p.stdout.close()
+                    res += (align_p.wait(),)
+
+                try:
+                    out_p.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+                res += (out_p.wait(),)
+
+        self.alignment_cache.log_summary()
+        fu.safe_remove((tempdir,), force_remove=True)
+
+        return res
 
     def workflow(self):
         """Runs the bowtie2 alignment workflow.
 
         :return str: name of the output BAM.
+        :raises RuntimeError: if bowtie2 or samtools fail
         """
 
         logger.info("Started bowtie2 aligner workflow.")
 
         logger.info("Writing output BAM %s" % self.output_bam)
-        _ = self._align()
+        if self.alignment_cache is not None:
+            return_codes = self._align_cached()
+            self.alignment_cache.close()
+        else:
+            return_codes = self._align()
+
+        if any([rc != 0 for rc in return_codes]):
+            raise RuntimeError("Alignment to %s failed with return codes %s. See Bowtie2.stderr.log." %
+                               (self.config.ref, ", ".join(map(str, return_codes))))
+
+        if self.coordinate_sort:
+            su.index_bam(self.output_bam)
+
+        if self.sort_planner is not None:
+            order = SortOrder.COORDINATE if self.coordinate_sort else SortOrder.NAME_GROUPED
+            self.sort_planner.register(self.output_bam, order)
+
+        logger.info("Completed bowtie2 aligner workflow.")
+
+
+# BandedAligner of an alignment worker process, set by _init_align_worker
+_worker_aligner = None
+
+
+def _init_align_worker(aligner):
+    """Initializes an alignment worker process with the aligner, so its k-mer index is not pickled for each chunk.
+
+    :param analysis.aligners.BandedAligner aligner: aligner holding the reference and its k-mer index
+    """
+
+    global _worker_aligner
+    _worker_aligner = aligner
+
+
+def _align_chunk(chunk):
+    """Aligns a chunk of reads or read pairs with the aligner of the worker process.
+
+    :param list chunk: list of (R1 fields, R2 fields or None), where fields are (name, sequence, qualities, comment)
+    :return list: SAM lines
+    """
+
+    return _worker_aligner.align_chunk(chunk)
+
+
+class BandedAligner(object):
+    """In-process aligner for short references, using k-mer seeds and a banded dynamic programming extension."""
+
+    DEFAULT_OUTDIR = "."
+    DEFAULT_OUTBAM = None
+    DEFAULT_COORD_SORT = True
+    DEFAULT_LOCAL = True
+    DEFAULT_NTHREADS = 1
+    KMER_LEN = 12
+    SEED_STRIDE = 4
+    BAND = 15
+    MAX_CANDIDATES = 2
+    CHUNK_SIZE = 2000
+    PG_ID = "satmut_utils_banded"
+
+    # Scoring follows BowtieConfig.DEFAULT_SCORES and the bowtie2 defaults for the remaining parameters
+    LOCAL_MATCH_BONUS = 2
+    MM_PENALTY_MAX = 4
+    MM_PENALTY_MIN = 2
+    N_PENALTY = 1
+    GAP_OPEN = 6
+    GAP_EXTEND = 4
+    MAX_INSERT = 1000
+    MAX_MAPQ = 42
+    LOCAL_MIN_SCORE = (20, 8)  # G,20,8
+    GLOBAL_MIN_SCORE = (-0.6, -0.6)  # L,-0.6,-0.6
+    BQ_CAP = 40
+    NEG_INF = -(10 ** 6)
+
+    OP_MATCH = 0
+    OP_INS = 1
+    OP_DEL = 2
+    N_CODE = ord(su.UNKNOWN_BASE)
+
+    def __init__(self, ref, f1, f2=None, output_dir=DEFAULT_OUTDIR, output_bam=DEFAULT_OUTBAM, local=DEFAULT_LOCAL,
+                 nthreads=DEFAULT_NTHREADS, coordinate_sort=DEFAULT_COORD_SORT, sort_planner=None,
+                 append_comment=False, read_pairs=None):
+        r"""Constructor for BandedAligner.
+
+        :param str ref: reference FASTA. No index is required.
+        :param str | None f1: path to FASTQ 1, or None if read_pairs is provided
+        :param str | None f2: optional path to FASTQ 2
+        :param str output_dir: optional output directory to write the output BAM to. Default current working directory.
+        :param str | None output_bam: optional output BAM filename. Default None, use f1 basename.
+        :param bool local: should a local alignment be done instead of end-to-end alignment (default True)
+        :param int nthreads: number of worker processes to align read chunks with. Default 1.
+        :param bool coordinate_sort: coordinate sort and index the output? Default True. Otherwise, write the \
+        alignments in input order, in which mates are adjacent.
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner to register the output order with
+        :param bool append_comment: append FASTQ comments, which must be SAM-formatted tags, to the alignments? \
+        Default False.
+        :param iterable | None read_pairs: optional (R1, R2 | None) records to align instead of FASTQs. output_bam \
+        must be provided.
+
+        Intended for the single transcript or amplicon references of satmut_utils; the k-mer index is held in memory.
+        """
+
+        self.ref = ref
+        self.f1 = f1
+        self.f2 = f2
+        self.output_dir = output_dir
+        self.local = local
+        self.nthreads = nthreads
+        self.coordinate_sort = coordinate_sort
+        self.sort_planner = sort_planner
+        self.append_comment = append_comment
+        self.read_pairs = read_pairs
+
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+
+        self.output_bam, self.rg_id = get_output_names(f1, f2, output_dir, output_bam)
+
+        self.contigs = []
+        self.contig_seqs = []
+        with pysam.FastxFile(ref) as ref_ff:
+            for rec in ref_ff:
+                self.contigs.append(rec.name)
+                self.contig_seqs.append(np.frombuffer(rec.sequence.upper().encode(), dtype=np.uint8))
+
+        self.kmer_index = self._index_kmers()
+        self.workflow()
+
+    def __getstate__(self):
+        """Gets the state sent to worker processes, excluding streamed read pairs consumed by the parent.
+
+        :return dict: instance attributes
+        """
+
+        state = self.__dict__.copy()
+        state["read_pairs"] = None
+        return state
+
+    def _index_kmers(self):
+        """Indexes the reference k-mers.
+
+        :return dict: {k-mer: list of (contig index, 0-based position)}
+        """
+
+        kmer_index = collections.defaultdict(list)
+        for contig_index, contig_seq in enumerate(self.contig_seqs):
+            contig_bytes = contig_seq.tobytes()
+            for pos in range(len(contig_bytes) - self.KMER_LEN + 1):
+                kmer_index[contig_bytes[pos:pos + self.KMER_LEN]].append((contig_index, pos))
+
+        return dict(kmer_index)
+
+    def _get_candidates(self, read_seqs):
+        """Finds candidate diagonals for a read from k-mer seed hits.
+
+        :param tuple read_seqs: (forward, reverse complement) read bases as bytes
+        :return list: (votes, contig index, is reverse, diagonal) for distinct candidates, best first
+        """
+
+        votes = collections.Counter()
+        for is_reverse, read_bytes in enumerate(read_seqs):
+            for read_pos in range(0, len(read_bytes) - self.KMER_LEN + 1, self.SEED_STRIDE):
+                for contig_index, ref_pos in self.kmer_index.get(read_bytes[read_pos:read_pos + self.KMER_LEN], ()):
+                    votes[(contig_index, bool(is_reverse), ref_pos - read_pos)] += 1
+
+        # Keep the best diagonal within each band, as nearby diagonals are explored by the extension
+        candidates = []
+        for (contig_index, is_reverse, diagonal), n_votes in votes.most_common():
+            if any(c[1] == contig_index and c[2] == is_reverse and abs(c[3] - diagonal) <= self.BAND
+                   for c in candidates):
+                continue
+
+            candidates.append((n_votes, contig_index, is_reverse, diagonal))
+            if len(candidates) == self.MAX_CANDIDATES:
+                break
+
+        return candidates
+
+    def _get_mismatch_penalties(self, quals):
+        """Gets quality-aware mismatch penalties, as in bowtie2 --mp.
+
+        :param numpy.ndarray quals: Phred base qualities
+        :return numpy.ndarray: penalty for a mismatch at each read position
+        """
+
+        capped = np.minimum(quals, self.BQ_CAP)
+        res = self.MM_PENALTY_MIN + np.floor(
+            (self.MM_PENALTY_MAX - self.MM_PENALTY_MIN) * capped / self.BQ_CAP).astype(np.int32)
+        return res
+
+    def _extend_ungapped(self, read, mm_pens, contig_index, diagonal):
+        r"""Aligns a read without gaps if no gapped alignment within the band can score as well.
+
+        :param numpy.ndarray read: read bases as uint8, in reference orientation
+        :param numpy.ndarray mm_pens: mismatch penalties for each read base
+        :param int contig_index: index of the reference contig
+        :param int diagonal: reference position of the read start implied by the seed
+        :return tuple | None: (score, read start, read stop, reference start, ops) as from _extend, or None if the \
+        band is not within the reference or a gapped alignment may score at least as well
+
+        All diagonals of the band are scored at once. The best single-gap alignment is found exactly from the best \
+        segments ending and starting at each read base on each pair of diagonals. Alignments with more gaps are \
+        bounded by their first and last segments and the best scores between them. If the best ungapped alignment \
+        scores higher than these, it is the alignment found by _extend.
+        """
+
+        ref_seq = self.contig_seqs[contig_index]
+        read_len = len(read)
+        width = 2 * self.BAND + 1
+
+        ws = diagonal - self.BAND
+        if ws < 0 or diagonal + read_len + self.BAND > len(ref_seq):
+            return None
+
+        ref_bases = np.lib.stride_tricks.sliding_window_view(ref_seq[ws:diagonal + read_len + self.BAND], read_len)
+        match_bonus = self.LOCAL_MATCH_BONUS if self.local else 0
+        scores = np.where(ref_bases == read, match_bonus, -mm_pens).astype(np.int64)
+        scores[(ref_bases == self.N_CODE) | (read == self.N_CODE)] = -self.N_PENALTY
+
+        # A segment from read base i up to j scores cum[:, j] - cum[:, i]
+        cum = np.zeros((width, read_len + 1), dtype=np.int64)
+        np.cumsum(scores, axis=1, out=cum[:, 1:])
+
+        # Best scores of segments ending before and starting at each read base
+        if self.local:
+            ending = cum - np.minimum.accumulate(cum, axis=1)
+            starting = np.maximum.accumulate(cum[:, ::-1], axis=1)[:, ::-1] - cum
+            end_i, end_d = np.unravel_index(np.argmax(ending.T), (read_len + 1, width))
+        else:
+            ending = cum
+            starting = cum[:, -1:] - cum
+            end_i, end_d = read_len, int(np.argmax(ending[:, read_len]))
+
+        score = int(ending[end_d, end_i])
+
+        if self.local and score == 0:
+            return None
+
+        # The ungapped alignment is optimal only if it beats bounds on every gapped alignment in the band; check the
+        # cheapest bounds first as most failing candidates are spurious seeds that a single deletion already beats
+        min_gap = self.GAP_OPEN + self.GAP_EXTEND
+
+        # A deletion of n reference bases moves from diagonal d to d + n before the same read base
+        steps = self.GAP_EXTEND * np.arange(width, dtype=np.int64)[:, None]
+        from_lower = np.maximum.accumulate(ending + steps, axis=0)
+        if int((from_lower[:-1] + starting[1:] - steps[1:]).max()) - self.GAP_OPEN >= score:
+            return None
+
+        # More than two gaps score at most the first and last segments plus the best score of each read base between
+        ending_max = ending.max(axis=0)
+        starting_max = starting.max(axis=0)
+        between = np.concatenate(([0], np.cumsum(np.maximum(scores.max(axis=0), 0))))
+        first = np.maximum.accumulate(ending_max - between)
+        if int((first + between + starting_max).max()) - 3 * min_gap >= score:
+            return None
+
+        # Two gaps leave a middle segment on one diagonal between the best first and last segments
+        ending_best = np.maximum.accumulate(ending_max)
+        starting_best = np.maximum.accumulate(starting_max[::-1])[::-1]
+        middle = np.maximum.accumulate(ending_best - cum, axis=1) + cum
+        if int((middle + starting_best).max()) - 2 * min_gap >= score:
+            return None
+
+        # An insertion of n read bases moves from diagonal d to d - n, so index segments by read base plus diagonal
+        shift_index = np.arange(read_len + width)[None, :] - np.arange(width)[:, None]
+        shift_valid = (shift_index >= 0) & (shift_index <= read_len)
+        shift_index = np.clip(shift_index, 0, read_len)
+        ending_shifted = np.where(shift_valid, np.take_along_axis(ending, shift_index, axis=1), self.NEG_INF)
+        starting_shifted = np.where(shift_valid, np.take_along_axis(starting, shift_index, axis=1), self.NEG_INF)
+        from_upper = np.maximum.accumulate((ending_shifted - steps)[::-1], axis=0)[::-1]
+        if int((from_upper[1:] + starting_shifted[:-1] + steps[:-1]).max()) - self.GAP_OPEN >= score:
+            return None
+
+        # Local alignments start after the last read base at which the running score drops to zero
+        read_start = int(np.flatnonzero(ending[end_d, :end_i] == 0)[-1]) if self.local else 0
+        ref_start = ws + int(end_d) + read_start
+        ops = [(self.OP_MATCH, i, ref_start + i - read_start) for i in range(read_start, int(end_i))]
+
+        res = (score, read_start, int(end_i), ref_start, ops)
+        return res
+
+    def _extend(self, read, mm_pens, contig_index, diagonal):
+        """Aligns a read within a band about a seed diagonal.
+
+        :param numpy.ndarray read: read bases as uint8, in reference orientation
+        :param numpy.ndarray mm_pens: mismatch penalties for each read base
+        :param int contig_index: index of the reference contig
+        :param int diagonal: reference position of the read start implied by the seed
+        :return tuple | None: (score, read start, read stop, reference start, ops) or None if no alignment
+
+        Rows are read positions and the columns are the 2 * BAND + 1 diagonals about the seed, so each row is \
+        computed in a few vectorized operations. Horizontal gaps are resolved with a prefix maximum, which is exact \
+        for affine gaps as consecutive gaps never score better than a single gap.
+        """
+
+        ref_seq = self.contig_seqs[contig_index]
+        read_len = len(read)
+        width = 2 * self.BAND + 1
+
+        ws = max(0, diagonal - self.BAND)
+        we = min(len(ref_seq), diagonal + read_len + self.BAND)
+        ref_win = ref_seq[ws:we]
+        win_len = len(ref_win)
+        if win_len == 0:
+            return None
+
+        offsets = np.arange(width, dtype=np.int64) + (diagonal - ws) - self.BAND
+        gap_first = self.GAP_OPEN + self.GAP_EXTEND
+        ext_ramp = self.GAP_EXTEND * np.arange(width, dtype=np.int64)
+        match_bonus = self.LOCAL_MATCH_BONUS if self.local else 0
+
+        h_mat = np.full((read_len + 1, width), self.NEG_INF, dtype=np.int64)
+        e_mat = np.full((read_len + 1, width), self.NEG_INF, dtype=np.int64)
+        f_mat = np.full((read_len + 1, width), self.NEG_INF, dtype=np.int64)
+
+        # Row 0 is before the first read base; both modes may start anywhere in the reference
+        h_mat[0, (offsets >= 0) & (offsets <= win_len)] = 0
+
+        # Score all cells of the band at once, so only the recurrence is computed for each row
+        cols = offsets[None, :] + np.arange(1, read_len + 1)[:, None]
+        invalid = np.ones((read_len + 1, width), dtype=bool)
+        invalid[1:] = (cols < 1) | (cols > win_len)
+        ref_bases = ref_win[np.clip(cols - 1, 0, win_len - 1)]
+
+        s_mat = np.zeros((read_len + 1, width), dtype=np.int64)
+        s_mat[1:] = np.where(ref_bases == read[:, None], match_bonus, -mm_pens[:, None])
+        s_mat[1:][(ref_bases == self.N_CODE) | (read[:, None] == self.N_CODE)] = -self.N_PENALTY
+
+        for i in range(1, read_len + 1):
+
+            h_prev = h_mat[i - 1]
+            row_invalid = invalid[i]
+
+            # Vertical moves consume a read base (insertion) and come from the next diagonal of the previous row
+            f_row = f_mat[i]
+            np.maximum(h_prev[1:] - gap_first, f_mat[i - 1, 1:] - self.GAP_EXTEND, out=f_row[:-1])
+
+            h_row = np.maximum(h_prev + s_mat[i], f_row)
+            if self.local:
+                np.maximum(h_row, 0, out=h_row)
+            h_row[row_invalid] = self.NEG_INF
+
+            # Horizontal moves consume a reference base (deletion) and come from the previous diagonal of this row
+            prefix = np.maximum.accumulate(h_row + ext_ramp)
+            e_row = e_mat[i]
+            np.subtract(prefix[:-1] - self.GAP_OPEN, ext_ramp[1:], out=e_row[1:])
+            e_row[row_invalid] = self.NEG_INF
+
+            np.maximum(h_row, e_row, out=h_mat[i])
+            f_row[row_invalid] = self.NEG_INF
+
+        if self.local:
+            end_i, end_d = np.unravel_index(np.argmax(h_mat), h_mat.shape)
+        else:
+            end_i, end_d = read_len, int(np.argmax(h_mat[read_len]))
+
+        score = int(h_mat[end_i, end_d])
+        if score <= self.NEG_INF // 2 or (self.local and score == 0):
+            return None
+
+        # Trace back from the end cell
+        ops = []
+        i, d, state = int(end_i), int(end_d), "H"
+        while i > 0:
+            if state == "H":
+                if self.local and h_mat[i, d] == 0:
+                    break
+                if h_mat[i, d] == h_mat[i - 1, d] + s_mat[i, d]:
+                    ops.append((self.OP_MATCH, i - 1, ws + int(offsets[d]) + i - 1))
+                    i -= 1
+                elif h_mat[i, d] == f_mat[i, d]:
+                    state = "F"
+                else:
+                    state = "E"
+            elif state == "F":
+                ops.append((self.OP_INS, i - 1, None))
+                state = "F" if i > 1 and f_mat[i, d] == f_mat[i - 1, d + 1] - self.GAP_EXTEND else "H"
+                i -= 1
+                d += 1
+            else:
+                ops.append((self.OP_DEL, None, ws + int(offsets[d]) + i - 1))
+                state = "E" if e_mat[i, d] == e_mat[i, d - 1] - self.GAP_EXTEND else "H"
+                d -= 1
+
+        ops.reverse()
+        read_start = i
+        ref_start = ws + int(offsets[d]) + i
+
+        res = (score, read_start, int(end_i), ref_start, ops)
+        return res
+
+    def _get_tags(self, read, ops, ref_seq):
+        """Gets the CIGAR, MD, and NM of an alignment.
+
+        :param numpy.ndarray read: read bases as uint8, in reference orientation
+        :param list ops: (op, read index, reference index) for each aligned column
+        :param numpy.ndarray ref_seq: reference contig bases as uint8
+        :return tuple: (CIGAR without clipping, MD, NM)
+        """
+
+        cigar_chars = {self.OP_MATCH: "M", self.OP_INS: su.SAM_CIGAR_INS, self.OP_DEL: su.SAM_CIGAR_DEL}
+        cigar = "".join(["%i%s" % (len(list(run)), cigar_chars[op]) for op, run in
+                         itertools.groupby([o[0] for o in ops])])
+
+        md = []
+        nm = 0
+        n_match = 0
+        last_op = None
+        for op, read_index, ref_index in ops:
+            if op == self.OP_MATCH:
+                if read[read_index] == ref_seq[ref_index]:
+                    n_match += 1
+                else:
+                    md.append("%i%s" % (n_match, chr(ref_seq[ref_index])))
+                    n_match = 0
+                    nm += 1
+            elif op == self.OP_INS:
+                nm += 1
+            else:
+                if last_op != self.OP_DEL:
+                    md.append("%i%s" % (n_match, su.MD_DEL))
+                    n_match = 0
+                md.append(chr(ref_seq[ref_index]))
+                nm += 1
+            last_op = op
+
+        md.append(str(n_match))
+        return cigar, "".join(md), nm
+
+    def _align_read(self, seq, qual):
+        """Aligns a read to the best candidate.
+
+        :param str seq: read sequence
+        :param str | None qual: read ASCII base qualities
+        :return tuple | None: (contig index, is reverse, ref start, ref end, CIGAR, MD, NM, score, MAPQ) or None
+        """
+
+        read_fwd = np.frombuffer(seq.upper().encode(), dtype=np.uint8)
+        read_rev = np.frombuffer(su.reverse_complement(seq.upper()).encode(), dtype=np.uint8)
+
+        quals = np.frombuffer(qual.encode(), dtype=np.uint8).astype(np.int64) - DEFAULT_QUALITY_OFFSET \
+            if qual is not None else np.full(len(seq), self.BQ_CAP, dtype=np.int64)
+        mm_pens = (self._get_mismatch_penalties(quals), self._get_mismatch_penalties(quals[::-1]))
+
+        read_len = len(read_fwd)
+        if self.local:
+            min_score = self.LOCAL_MIN_SCORE[0] + self.LOCAL_MIN_SCORE[1] * math.log(max(read_len, 1))
+        else:
+            min_score = self.GLOBAL_MIN_SCORE[0] + self.GLOBAL_MIN_SCORE[1] * read_len
+
+        extensions = []
+        for _, contig_index, is_reverse, diagonal in self._get_candidates((read_fwd.tobytes(), read_rev.tobytes())):
+            read = read_rev if is_reverse else read_fwd
+
+            # Most reads differ from the reference by a few substitutions and need no dynamic programming
+            ext = self._extend_ungapped(read, mm_pens[int(is_reverse)], contig_index, diagonal)
+            if ext is None:
+                ext = self._extend(read, mm_pens[int(is_reverse)], contig_index, diagonal)
+            if ext is not None and ext[0] >= min_score:
+                extensions.append((ext, contig_index, is_reverse, read))
+
+        if len(extensions) == 0:
+            return None
+
+        extensions.sort(key=lambda e: e[0][0], reverse=True)
+        (score, read_start, read_stop, ref_start, ops), contig_index, is_reverse, read = extensions[0]
+
+        mapq = self.MAX_MAPQ
+        if len(extensions) > 1:
+            second = extensions[1][0][0]
+            mapq = 1 if second == score else min(
+                self.MAX_MAPQ, int(self.MAX_MAPQ * (score - second) / max(abs(score), 1)))
+
+        cigar, md, nm = self._get_tags(read, ops, self.contig_seqs[contig_index])
+
+        left_clip = "%iS" % read_start if read_start > 0 else ""
+        right_clip = "%iS" % (read_len - read_stop) if read_stop < read_len else ""
+        ref_end = ref_start + sum([1 for op in ops if op[0] != self.OP_INS])
+
+        res = (contig_index, is_reverse, ref_start, ref_end, left_clip + cigar + right_clip, md, nm, score, mapq)
+        return res
+
+    def _format_record(self, name, seq, qual, comment, aln, mate_aln, flag):
+        """Formats a SAM record.
+
+        :param str name: read name
+        :param str seq: read sequence
+        :param str | None qual: read ASCII base qualities
+        :param str | None comment: FASTQ comment
+        :param tuple | None aln: alignment of the read, from _align_read
+        :param tuple | None mate_aln: alignment of the mate, from _align_read
+        :param int flag: SAM flag bits for the pairing and mate
+        :return str: SAM line
+        """
+
+        fields_aln = aln if aln is not None else mate_aln
+        rname = self.contigs[fields_aln[0]] if fields_aln is not None else "*"
+        pos = fields_aln[2] + 1 if fields_aln is not None else 0
+
+        if aln is None:
+            flag |= su.SAM_FLAG_UNMAP
+
+        if aln is not None and aln[1]:
+            flag |= su.SAM_FLAG_REVERSE
+            seq = su.reverse_complement(seq)
+            qual = qual[::-1] if qual is not None else None
+
+        rnext, pnext, tlen = "*", 0, 0
+        if flag & su.SAM_FLAG_PAIRED and fields_aln is not None:
+            # An unmapped mate is placed at the read; mates may align to different contigs of a panel
+            rnext, pnext = "=", pos
+            if mate_aln is not None:
+                pnext = mate_aln[2] + 1
+                if mate_aln[0] != fields_aln[0]:
+                    rnext = self.contigs[mate_aln[0]]
+
+            if aln is not None and mate_aln is not None and aln[0] == mate_aln[0]:
+                frag_start = min(aln[2], mate_aln[2])
+                frag_end = max(aln[3], mate_aln[3])
+                tlen = frag_end - frag_start
+
+                # As in bowtie2, mates with identical extents both get a negative TLEN
+                if (aln[2], aln[3]) >= (mate_aln[2], mate_aln[3]):
+                    tlen = -tlen
+
+        fields = [name, str(flag), rname, str(pos),
+                  str(aln[8]) if aln is not None else "0", aln[4] if aln is not None else "*",
+                  rnext, str(pnext), str(tlen), seq, qual if qual is not None else "*"]
+
+        if aln is not None:
+            fields.extend(["AS:i:%i" % aln[7], "NM:i:%i" % aln[6], "%s:Z:%s" % (su.SAM_MD_TAG, aln[5])])
+
+        fields.append("%s:Z:%s" % (su.SAM_RG_TAG, self.rg_id))
+
+        if self.append_comment and comment is not None:
+            fields.extend(comment.split())
+
+        return fu.FILE_DELIM.join(fields)
+
+    def _is_concordant(self, aln1, aln2):
+        """Determines if mate alignments are concordant, i.e. on the same contig, in FR orientation, within MAX_INSERT.
+
+        :param tuple aln1: R1 alignment
+        :param tuple aln2: R2 alignment
+        :return bool: whether the mates are concordant
+        """
+
+        if aln1[0] != aln2[0] or aln1[1] == aln2[1]:
+            return False
+
+        fwd, rev = (aln2, aln1) if aln1[1] else (aln1, aln2)
+        res = fwd[2] <= rev[3] and max(aln1[3], aln2[3]) - min(aln1[2], aln2[2]) <= self.MAX_INSERT
+        return res
+
+    def align_chunk(self, chunk):
+        """Aligns a chunk of reads or read pairs.
+
+        :param list chunk: list of (R1 fields, R2 fields or None), where fields are (name, sequence, qualities, comment)
+        :return list: SAM lines
+        """
+
+        sam_lines = []
+        for r1, r2 in chunk:
+
+            aln1 = self._align_read(r1[1], r1[2])
+            if r2 is None:
+                sam_lines.append(self._format_record(r1[0], r1[1], r1[2], r1[3], aln1, None, 0))
+                continue
+
+            aln2 = self._align_read(r2[1], r2[2])
+
+            flag = su.SAM_FLAG_PAIRED
+            if aln1 is not None and aln2 is not None and self._is_concordant(aln1, aln2):
+                flag |= su.SAM_FLAG_PROPER_PAIR
+
+            r1_flag = flag | su.SAM_FLAG_R1
+            r2_flag = flag | su.SAM_FLAG_R2
+
+            if aln2 is None:
+                r1_flag |= su.SAM_FLAG_MUNMAP
+            elif aln2[1]:
+                r1_flag |= su.SAM_FLAG_PLUS
+
+            if aln1 is None:
+                r2_flag |= su.SAM_FLAG_MUNMAP
+            elif aln1[1]:
+                r2_flag |= su.SAM_FLAG_PLUS
+
+            sam_lines.append(self._format_record(r1[0], r1[1], r1[2], r1[3], aln1, aln2, r1_flag))
+            sam_lines.append(self._format_record(r2[0], r2[1], r2[2], r2[3], aln2, aln1, r2_flag))
+
+        return sam_lines
+
+    def _iterate_chunks(self):
+        """Generates chunks of reads or read pairs from the input FASTQs or streamed read pairs.
+
+        :return generator: lists of (R1 fields, R2 fields or None)
+        """
+
+        def _fields(rec):
+            """Gets the picklable fields of a record."""
+            return rec.name, rec.sequence, rec.quality, rec.comment
+
+        read_pairs = self.read_pairs if self.read_pairs is not None else iterate_fastq_pairs(self.f1, self.f2)
+
+        chunk = []
+        for r1, r2 in read_pairs:
+            chunk.append((_fields(r1), _fields(r2) if r2 is not None else None))
+            if len(chunk) == self.CHUNK_SIZE:
+                yield chunk
+                chunk = []
+
+        if len(chunk) > 0:
+            yield chunk
+
+    def _get_header(self):
+        """Gets the SAM header.
+
+        :return dict: header for pysam
+        """
+
+        header = {
+            su.SAM_HD_HEADER: {"VN": "1.0", "SO": "unsorted", "GO": "query"},
+            su.SAM_SQ_HEADER: [{"SN": contig, "LN": len(contig_seq)}
+                               for contig, contig_seq in zip(self.contigs, self.contig_seqs)],
+            su.SAM_RG_TAG: [{su.SAM_RG_ID_TAG: self.rg_id}],
+            "PG": [{"ID": self.PG_ID, "PN": self.PG_ID}]
+        }
+
+        return header
+
+    def workflow(self):
+        """Runs the banded alignment workflow."""
+
+        logger.info("Started banded aligner workflow.")
+        logger.info("Writing output BAM %s" % self.output_bam)
+
+        unsorted_bam = self.output_bam
+        if self.coordinate_sort:
+            unsorted_bam = tempfile.NamedTemporaryFile(suffix=".banded.bam", delete=False, dir=self.output_dir).name
+
+        with pysam.AlignmentFile(unsorted_bam, "wb", header=self._get_header()) as out_af:
+
+            # Daemonic workers (e.g. per-tile workers) may not start their own pool
+            if self.nthreads <= 1 or multiprocessing.current_process().daemon:
+                chunk_results = map(self.align_chunk, self._iterate_chunks())
+                pool = None
+            else:
+                # Each worker receives the k-mer index once, and only the chunks are sent with each task
+                pool = multiprocessing.Pool(processes=self.nthreads, initializer=_init_align_worker, initargs=(self,))
+                chunk_results = pool.imap(_align_chunk, self._iterate_chunks())
+
+            try:
+                for sam_lines in chunk_results:
+                    for sam_line in sam_lines:
+                        out_af.write(pysam.AlignedSegment.fromstring(sam_line, out_af.header))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+        if self.coordinate_sort:
+            su.sort_and_index(unsorted_bam, self.output_bam)
+            fu.safe_remove((unsorted_bam,))
 
-        su.index_bam(self.output_bam)
+        if self.sort_planner is not None:
+            order = SortOrder.COORDINATE if self.coordinate_sort else SortOrder.NAME_GROUPED
+            self.sort_planner.register(self.output_bam, order)
 
-        logger.info("Completed bowtie2 aligner workflow.")
\ No newline at end of file
+        logger.info("Completed banded aligner workflow.")
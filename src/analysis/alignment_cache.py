@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""On-disk cache of alignments shared across samples."""
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+import analysis.seq_utils as su
+import core_utils.file_utils as fu
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+
+class AlignmentCache(object):
+    """SQLite cache mapping read pairs to their alignment records, per reference and aligner configuration."""
+
+    DB_NAME = "alignment_cache.sqlite"
+    PAIR_KEY_SIZE = 16
+    BATCH_SIZE = 900  # below the SQLite host parameter limit of older versions
+    RECORD_DELIM = fu.FILE_NEWLINE
+    KEY_FIELD_DELIM = "\0"
+    SAM_NFIELDS = 11
+    DB_TIMEOUT = 600  # seconds to wait on writes from concurrent tile workers
+
+    def __init__(self, cache_dir, config_digest):
+        r"""Constructor for AlignmentCache.
+
+        :param str cache_dir: directory holding the cache database. Created if it does not exist.
+        :param str config_digest: digest of the reference and aligner parameters, see get_config_digest. Entries \
+        are keyed by it, so runs with different configurations can share the cache.
+        """
+
+        self.cache_dir = cache_dir
+        self.config_digest = config_digest
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.db = os.path.join(cache_dir, self.DB_NAME)
+        self.conn = sqlite3.connect(self.db, timeout=self.DB_TIMEOUT)
+        self._init_db()
+
+    def _init_db(self):
+        """Creates the cache tables."""
+
+        # Entries of every configuration are kept, so concurrent runs never invalidate each other's alignments
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS config_alignments (config_digest TEXT, pair_key BLOB, records TEXT, "
+                "PRIMARY KEY (config_digest, pair_key))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS config_headers (config_digest TEXT PRIMARY KEY, header TEXT)")
+
+    @classmethod
+    def get_config_digest(cls, ref, params):
+        """Gets a digest of the reference contents and the aligner parameters.
+
+        :param str ref: path of the reference FASTA
+        :param list params: aligner parameters that affect the alignment records
+        :return str: hex digest
+        """
+
+        config_hash = hashlib.sha256(fu.get_file_digest(ref).encode())
+        config_hash.update(fu.FILE_SPACE.join(map(str, params)).encode())
+        return config_hash.hexdigest()
+
+    @classmethod
+    def get_pair_key(cls, r1, r2=None):
+        """Gets the cache key of a read pair.
+
+        :param pysam.FastxRecord r1: R1 record
+        :param pysam.FastxRecord | None r2: R2 record, or None for unpaired reads
+        :return bytes: key
+
+        Base qualities and comments are included as they may affect the alignment and the appended tags.
+        """
+
+        fields = [r1.sequence, r1.quality, r1.comment]
+        if r2 is not None:
+            fields.extend([r2.sequence, r2.quality, r2.comment])
+
+        pair_hash = hashlib.blake2b(digest_size=cls.PAIR_KEY_SIZE)
+        pair_hash.update(cls.KEY_FIELD_DELIM.join([str(f) for f in fields]).encode())
+        return pair_hash.digest()
+
+    @classmethod
+    def pack_records(cls, sam_lines):
+        """Packs the SAM records of a read pair for storage, without the read name and read group.
+
+        :param list sam_lines: SAM records of the read pair, without newlines
+        :return str: packed records
+        """
+
+        packed = []
+        for sam_line in sam_lines:
+            fields = sam_line.split(fu.FILE_DELIM)
+            tags = [tag for tag in fields[cls.SAM_NFIELDS:] if not tag.startswith(su.SAM_RG_TAG + ":")]
+            packed.append(fu.FILE_DELIM.join(fields[su.SAM_QNAME_INDEX + 1:cls.SAM_NFIELDS] + tags))
+
+        return cls.RECORD_DELIM.join(packed)
+
+    @classmethod
+    def unpack_records(cls, records, qname, rg_id=None):
+        """Unpacks stored records into SAM lines for a read pair.
+
+        :param str records: packed records
+        :param str qname: read name
+        :param str | None rg_id: optional read group ID to tag the records with
+        :return str: SAM lines, each terminated by a newline
+        """
+
+        rg_suffix = fu.FILE_DELIM + "%s:Z:%s" % (su.SAM_RG_TAG, rg_id) if rg_id is not None else ""
+        res = "".join([qname + fu.FILE_DELIM + record + rg_suffix + fu.FILE_NEWLINE
+                       for record in records.split(cls.RECORD_DELIM)])
+        return res
+
+    def get_many(self, pair_keys):
+        """Looks up cached records and updates the hit and miss counts.
+
+        :param list pair_keys: keys from get_pair_key
+        :return dict: {key: packed records} for the cached keys
+        """
+
+        res = {}
+        unique_keys = list(set(pair_keys))
+        for i in range(0, len(unique_keys), self.BATCH_SIZE):
+            batch = unique_keys[i:i + self.BATCH_SIZE]
+            query = "SELECT pair_key, records FROM config_alignments WHERE config_digest = ? AND pair_key IN (%s)" % \
+                    ",".join("?" * len(batch))
+            res.update(self.conn.execute(query, [self.config_digest] + batch).fetchall())
+
+        n_hits = sum([1 for pair_key in pair_keys if pair_key in res])
+        self.hits += n_hits
+        self.misses += len(pair_keys) - n_hits
+        return res
+
+    def put_many(self, items):
+        """Stores the records of aligned read pairs.
+
+        :param list items: list of (key, packed records)
+        """
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO config_alignments VALUES (?, ?, ?)",
+                [(self.config_digest, pair_key, records) for pair_key, records in items])
+
+    def get_header(self):
+        """Gets the cached SAM header, without read group lines.
+
+        :return str | None: SAM header lines or None if no alignments were cached
+        """
+
+        row = self.conn.execute(
+            "SELECT header FROM config_headers WHERE config_digest = ?", (self.config_digest,)).fetchone()
+        res = row[0] if row is not None else None
+        return res
+
+    def set_header(self, header_lines):
+        """Caches the SAM header, without read group lines.
+
+        :param list header_lines: SAM header lines, without newlines
+        """
+
+        rg_prefix = su.SAM_HEADER_CHAR + su.SAM_RG_TAG
+        header = "".join([line + fu.FILE_NEWLINE for line in header_lines if not line.startswith(rg_prefix)])
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO config_headers VALUES (?, ?)", (self.config_digest, header))
+
+    def log_summary(self):
+        """Logs the cache hit and miss rates."""
+
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        logger.info("Alignment cache %s: %i hits, %i misses (%.1f%% hit rate)." %
+                    (self.db, self.hits, self.misses, 100 * hit_rate))
+
+    def close(self):
+        """Closes the cache database."""
+
+        self.conn.close()
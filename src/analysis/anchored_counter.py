@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Alignment-free counting of SNPs and MNPs in primer-anchored amplicon read pairs."""
+
+import collections
+import logging
+import numpy as np
+import os
+import pysam
+
+from analysis.read_preprocessor import ReadMasker
+import analysis.seq_utils as su
+from analysis.variant_caller import VariantCaller, MM_TUPLE
+import core_utils.feature_file_utils as ffu
+import core_utils.file_utils as fu
+from satmut_utils.definitions import DEFAULT_QUALITY_OFFSET
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+ANCHOR_TUPLE = collections.namedtuple("ANCHOR_TUPLE", "contig_index, pos, strand, primer_start, primer_stop")
+ANCHORED_EDITS_TUPLE = collections.namedtuple(
+    "ANCHORED_EDITS_TUPLE", "r1_mms, r2_mms, r1_nm, r2_nm, r1_strand, r2_strand")
+
+
+class PrimerAnchoredCounter(object):
+    """Counts mismatches of amplicon read pairs placed at the reference offsets of their primers, without alignment."""
+
+    DEFAULT_OUTDIR = "."
+    FALLBACK_SUFFIX = "fallback.fq"
+    ANCHOR_LEN = 12  # number of 5' read bases matched exactly to the reference at an allowable read start
+    MIN_OVERLAP = 10  # min mate overlap for detecting indels by mate discordance
+    MAX_DISCORDANT = 2  # max high-quality mate disagreements in the overlap; more suggests an indel
+    BATCH_SIZE = 10000
+    NO_BASE = 0
+
+    def __init__(self, f1, f2, ref, primers, outdir=DEFAULT_OUTDIR, min_bq=VariantCaller.VARIANT_CALL_MIN_BQ,
+                 max_nm=VariantCaller.VARIANT_CALL_MAX_NM):
+        r"""Constructor for PrimerAnchoredCounter.
+
+        :param str f1: path of the R1 FASTQ
+        :param str f2: path of the R2 FASTQ
+        :param str ref: reference FASTA
+        :param str primers: BED or GFF file of primers, with strand. Amplicon reads are expected to start at one.
+        :param str outdir: output directory to write the fallback FASTQs to
+        :param int min_bq: min base quality for a mismatch to be counted
+        :param int max_nm: max mismatches of either mate for a pair to be counted
+
+        Pairs with one mate starting at a (+) primer and the other starting at a (-) primer are placed at their \
+        reference offsets, and their bases compared to the reference in batches. Pairs that cannot be anchored, or \
+        whose mates disagree in their overlap as expected for an indel, are written to fallback FASTQs for alignment.
+        """
+
+        self.f1 = f1
+        self.f2 = f2
+        self.ref = ref
+        self.primers = primers
+        self.outdir = outdir
+        self.min_bq = min_bq
+        self.max_nm = max_nm
+
+        if not os.path.exists(outdir):
+            os.mkdir(outdir)
+
+        self.fallback_f1 = os.path.join(outdir, fu.replace_extension(os.path.basename(f1), self.FALLBACK_SUFFIX))
+        self.fallback_f2 = os.path.join(outdir, fu.replace_extension(os.path.basename(f2), self.FALLBACK_SUFFIX))
+
+        self.contigs = []
+        contig_seqs = []
+        with pysam.FastxFile(ref) as ref_ff:
+            for rec in ref_ff:
+                self.contigs.append(rec.name)
+                contig_seqs.append(rec.sequence.upper())
+
+        # Concatenate the contigs so bases of a batch can be gathered in one indexing operation
+        self.contig_offsets = np.cumsum([0] + [len(contig_seq) for contig_seq in contig_seqs])
+        self.ref_bases = np.frombuffer("".join(contig_seqs).encode(), dtype=np.uint8)
+
+        self.anchors = self._index_anchors(contig_seqs)
+
+        self.n_input = 0
+        self.n_anchored = 0
+        self.n_fallback = 0
+        self.n_filtered = 0
+
+        # Fragment depth over unmasked positions, and the mate-concordant edits of pairs with any
+        self.coverage = [np.zeros(len(contig_seq), dtype=np.int64) for contig_seq in contig_seqs]
+        self.anchored_edits = []
+
+        self.workflow()
+
+    def _index_anchors(self, contig_seqs):
+        """Indexes the reference bases at the allowable read starts of each primer.
+
+        :param list contig_seqs: reference contig sequences
+        :return dict: {5' read bases: ANCHOR_TUPLE}. Bases shared by more than one start map to None.
+
+        Allowable starts are those ReadMasker associates with the primer.
+        """
+
+        contig_indices = {contig: i for i, contig in enumerate(self.contigs)}
+        anchors = {}
+
+        primer_info = ffu.store_coords(
+            feature_file=self.primers, use_name=False, start_buffer=ReadMasker.DEFAULT_AMPLICON_START_BUFFER)
+
+        for primer in primer_info.values():
+
+            if primer.contig not in contig_indices:
+                continue
+
+            contig_index = contig_indices[primer.contig]
+            contig_seq = contig_seqs[contig_index]
+
+            # Allowable coordinates are 1-based read 5' ends: starts for (+) primers and stops for (-) primers
+            for coord in primer.allowable_coords:
+
+                if primer.strand == su.Strand.PLUS:
+                    pos = coord - 1
+                    anchor_bases = contig_seq[pos:pos + self.ANCHOR_LEN]
+                else:
+                    pos = coord
+                    anchor_bases = su.reverse_complement(contig_seq[max(pos - self.ANCHOR_LEN, 0):pos])
+
+                if len(anchor_bases) < self.ANCHOR_LEN or pos < 0 or pos > len(contig_seq):
+                    continue
+
+                anchor = ANCHOR_TUPLE(contig_index, pos, primer.strand, primer.start, primer.stop)
+                anchors[anchor_bases] = anchor if anchor_bases not in anchors else None
+
+        return anchors
+
+    def _anchor_pair(self, r1, r2):
+        """Finds the reference offsets of a read pair from its primers.
+
+        :param pysam.FastxRecord r1: R1 record
+        :param pysam.FastxRecord r2: R2 record
+        :return tuple | None: ((+) ANCHOR_TUPLE, (-) ANCHOR_TUPLE, is R1 the (+) mate) or None if not anchored
+        """
+
+        r1_anchor = self.anchors.get(r1.sequence[:self.ANCHOR_LEN].upper())
+        r2_anchor = self.anchors.get(r2.sequence[:self.ANCHOR_LEN].upper())
+
+        if r1_anchor is None or r2_anchor is None or r1_anchor.contig_index != r2_anchor.contig_index or \
+                r1_anchor.strand == r2_anchor.strand:
+            return None
+
+        r1_is_plus = r1_anchor.strand == su.Strand.PLUS
+        plus_anchor, minus_anchor = (r1_anchor, r2_anchor) if r1_is_plus else (r2_anchor, r1_anchor)
+
+        if plus_anchor.pos >= minus_anchor.pos:
+            return None
+
+        return plus_anchor, minus_anchor, r1_is_plus
+
+    @staticmethod
+    def _scatter(seqs, rows, col_starts, shape, dtype=np.uint8):
+        """Places variable-length sequences into the rows of a matrix.
+
+        :param list seqs: bytes for each sequence
+        :param numpy.ndarray rows: row of each sequence
+        :param numpy.ndarray col_starts: first column of each sequence
+        :param tuple shape: matrix shape
+        :param type dtype: matrix type
+        :return numpy.ndarray: matrix, zero where no sequence was placed
+        """
+
+        res = np.zeros(shape, dtype=dtype)
+        lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        if lens.sum() == 0:
+            return res
+
+        flat = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        seq_starts = np.repeat(np.cumsum(lens) - lens, lens)
+        cols = np.arange(len(flat), dtype=np.int64) - seq_starts + np.repeat(col_starts, lens)
+        res[np.repeat(rows, lens), cols] = flat
+        return res
+
+    def _get_mms(self, contig, frag_start, cols, bases, ref_bases, quals, read_positions):
+        """Creates MM_TUPLEs for the mismatches of a mate.
+
+        :param str contig: contig name
+        :param int frag_start: 0-based reference start of the fragment
+        :param numpy.ndarray cols: fragment columns of the mismatches, in increasing order
+        :param numpy.ndarray bases: mate bases in reference orientation, by fragment column
+        :param numpy.ndarray ref_bases: reference bases by fragment column
+        :param numpy.ndarray quals: mate Phred qualities by fragment column
+        :param numpy.ndarray read_positions: 1-based positions from the mate 5' end by fragment column
+        :return list: MM_TUPLEs
+        """
+
+        res = [MM_TUPLE(contig=contig, pos=frag_start + int(col) + 1, ref=chr(ref_bases[col]), alt=chr(bases[col]),
+                        bq=int(quals[col]), read_pos=int(read_positions[col])) for col in cols]
+        return res
+
+    def _count_batch(self, batch, fallback_fhs):
+        """Counts a batch of anchored read pairs.
+
+        :param list batch: list of (R1, R2, (+) ANCHOR_TUPLE, (-) ANCHOR_TUPLE, is R1 the (+) mate)
+        :param tuple fallback_fhs: R1 and R2 fallback FASTQ file handles
+        """
+
+        nrows = len(batch)
+        rows = np.arange(nrows, dtype=np.int64)
+
+        contig_indices = np.array([b[2].contig_index for b in batch], dtype=np.int64)
+        frag_starts = np.array([b[2].pos for b in batch], dtype=np.int64)
+        frag_lens = np.array([b[3].pos for b in batch], dtype=np.int64) - frag_starts
+        width = int(frag_lens.max())
+        cols = np.arange(width, dtype=np.int64)
+        in_frag = cols < frag_lens[:, np.newaxis]
+
+        # Bases beyond the opposite primer are adapter read-through and are clipped
+        plus_seqs, plus_quals, minus_seqs, minus_quals = [], [], [], []
+        for r1, r2, _, _, r1_is_plus in batch:
+            plus_mate, minus_mate = (r1, r2) if r1_is_plus else (r2, r1)
+            plus_seqs.append(plus_mate.sequence.upper().encode())
+            plus_quals.append(plus_mate.quality.encode())
+            minus_seqs.append(su.reverse_complement(minus_mate.sequence.upper()).encode())
+            minus_quals.append(minus_mate.quality[::-1].encode())
+
+        plus_lens = np.minimum([len(s) for s in plus_seqs], frag_lens)
+        minus_lens = np.minimum([len(s) for s in minus_seqs], frag_lens)
+        plus_seqs = [s[:n] for s, n in zip(plus_seqs, plus_lens)]
+        plus_quals = [q[:n] for q, n in zip(plus_quals, plus_lens)]
+        minus_seqs = [s[len(s) - n:] for s, n in zip(minus_seqs, minus_lens)]
+        minus_quals = [q[len(q) - n:] for q, n in zip(minus_quals, minus_lens)]
+
+        shape = (nrows, width)
+        minus_starts = frag_lens - minus_lens
+        plus_bases = self._scatter(plus_seqs, rows, np.zeros(nrows, dtype=np.int64), shape)
+        minus_bases = self._scatter(minus_seqs, rows, minus_starts, shape)
+        plus_bqs = self._scatter(plus_quals, rows, np.zeros(nrows, dtype=np.int64), shape).astype(np.int64) - \
+            DEFAULT_QUALITY_OFFSET
+        minus_bqs = self._scatter(minus_quals, rows, minus_starts, shape).astype(np.int64) - DEFAULT_QUALITY_OFFSET
+
+        ref_indices = np.minimum(self.contig_offsets[contig_indices][:, np.newaxis] + frag_starts[:, np.newaxis] + cols,
+                                 len(self.ref_bases) - 1)
+        ref_bases = np.where(in_frag, self.ref_bases[ref_indices], self.NO_BASE)
+
+        # Mask the synthetic primer bases of both mates, as ReadMasker does for Tile-seq libraries
+        plus_primer_stops = np.array([b[2].primer_stop for b in batch], dtype=np.int64) - frag_starts
+        minus_primer_starts = np.array([b[3].primer_start for b in batch], dtype=np.int64) - frag_starts
+        unmasked = in_frag & (cols >= plus_primer_stops[:, np.newaxis]) & (cols < minus_primer_starts[:, np.newaxis])
+
+        plus_covered = plus_bases != self.NO_BASE
+        minus_covered = minus_bases != self.NO_BASE
+        n_code = ord(su.UNKNOWN_BASE)
+
+        plus_mm = plus_covered & (plus_bases != ref_bases)
+        minus_mm = minus_covered & (minus_bases != ref_bases)
+        plus_nm = plus_mm.sum(axis=1)
+        minus_nm = minus_mm.sum(axis=1)
+
+        # Indels shift the bases of one mate relative to the other across the overlap
+        overlap = plus_covered & minus_covered
+        discordant = overlap & (plus_bases != minus_bases) & (plus_bqs >= self.min_bq) & (minus_bqs >= self.min_bq)
+        fallback = (overlap.sum(axis=1) < self.MIN_OVERLAP) | (discordant.sum(axis=1) > self.MAX_DISCORDANT)
+        counted = ~fallback & (plus_nm <= self.max_nm) & (minus_nm <= self.max_nm)
+
+        for row in np.flatnonzero(fallback):
+            r1, r2 = batch[row][0], batch[row][1]
+            fallback_fhs[0].write(str(r1) + fu.FILE_NEWLINE)
+            fallback_fhs[1].write(str(r2) + fu.FILE_NEWLINE)
+
+        self.n_fallback += int(fallback.sum())
+        self.n_anchored += int(counted.sum())
+        self.n_filtered += int((~fallback & ~counted).sum())
+
+        # Fragment depth spans the first to last unmasked base of either mate
+        dp_cols = (plus_covered | minus_covered) & unmasked
+        has_dp = counted & dp_cols.any(axis=1)
+        dp_first = np.argmax(dp_cols, axis=1)
+        dp_last = width - 1 - np.argmax(dp_cols[:, ::-1], axis=1)
+        for contig_index in np.unique(contig_indices[has_dp]):
+            contig_rows = has_dp & (contig_indices == contig_index)
+            diff = np.zeros(len(self.coverage[contig_index]) + 1, dtype=np.int64)
+            np.add.at(diff, frag_starts[contig_rows] + dp_first[contig_rows], 1)
+            np.add.at(diff, frag_starts[contig_rows] + dp_last[contig_rows] + 1, -1)
+            self.coverage[contig_index] += np.cumsum(diff[:-1])
+
+        plus_calls = plus_mm & unmasked & (plus_bases != n_code) & (plus_bqs >= self.min_bq)
+        minus_calls = minus_mm & unmasked & (minus_bases != n_code) & (minus_bqs >= self.min_bq)
+        plus_read_pos = cols + 1
+        minus_read_pos = frag_lens[:, np.newaxis] - cols
+
+        for row in np.flatnonzero(counted & plus_calls.any(axis=1) & minus_calls.any(axis=1)):
+
+            _, _, plus_anchor, _, r1_is_plus = batch[row]
+            contig = self.contigs[plus_anchor.contig_index]
+
+            plus_mms = self._get_mms(contig, plus_anchor.pos, np.flatnonzero(plus_calls[row]), plus_bases[row],
+                                     ref_bases[row], plus_bqs[row], plus_read_pos)
+            minus_mms = self._get_mms(contig, plus_anchor.pos, np.flatnonzero(minus_calls[row]), minus_bases[row],
+                                      ref_bases[row], minus_bqs[row], minus_read_pos[row])
+
+            filt_plus_mms, filt_minus_mms = VariantCaller._intersect_edits(plus_mms, minus_mms)
+            if len(filt_plus_mms) == 0:
+                continue
+
+            if r1_is_plus:
+                edits = ANCHORED_EDITS_TUPLE(filt_plus_mms, filt_minus_mms, int(plus_nm[row]), int(minus_nm[row]),
+                                             su.Strand.PLUS, su.Strand.MINUS)
+            else:
+                edits = ANCHORED_EDITS_TUPLE(filt_minus_mms, filt_plus_mms, int(minus_nm[row]), int(plus_nm[row]),
+                                             su.Strand.MINUS, su.Strand.PLUS)
+
+            self.anchored_edits.append(edits)
+
+    def workflow(self):
+        """Runs the anchored counting workflow."""
+
+        logger.info("Started primer-anchored counting workflow.")
+
+        with pysam.FastxFile(self.f1) as r1_ff, pysam.FastxFile(self.f2) as r2_ff, \
+                open(self.fallback_f1, "w") as fallback_r1_fh, open(self.fallback_f2, "w") as fallback_r2_fh:
+
+            fallback_fhs = (fallback_r1_fh, fallback_r2_fh,)
+            batch = []
+
+            for r1, r2 in zip(r1_ff, r2_ff):
+
+                self.n_input += 1
+                anchor_res = self._anchor_pair(r1, r2)
+
+                if anchor_res is None:
+                    self.n_fallback += 1
+                    fallback_r1_fh.write(str(r1) + fu.FILE_NEWLINE)
+                    fallback_r2_fh.write(str(r2) + fu.FILE_NEWLINE)
+                    continue
+
+                batch.append((r1, r2) + anchor_res)
+                if len(batch) == self.BATCH_SIZE:
+                    self._count_batch(batch, fallback_fhs)
+                    batch = []
+
+            if len(batch) > 0:
+                self._count_batch(batch, fallback_fhs)
+
+        logger.info("Counted %i of %i read pairs without alignment; %i pairs fall back to alignment and %i were "
+                    "filtered." % (self.n_anchored, self.n_input, self.n_fallback, self.n_filtered))
+        logger.info("Completed primer-anchored counting workflow.")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Persistent store of per-transcript CDS annotations shared across runs."""
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import zlib
+
+import core_utils.file_utils as fu
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+
+class CdsStore(object):
+    """SQLite store of compressed CDS annotations, keyed by a transcript's GFF records and the reference contents."""
+
+    DB_NAME = "cds_store.sqlite"
+    DB_TIMEOUT = 600  # seconds to wait on writes from concurrent runs
+    COMPRESSION_LEVEL = 6
+    KEY_FIELD_DELIM = "\0"
+
+    def __init__(self, store_dir):
+        """Constructor for CdsStore.
+
+        :param str store_dir: directory holding the store database. Created if it does not exist.
+        """
+
+        self.store_dir = store_dir
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.db = os.path.join(store_dir, self.DB_NAME)
+        self.conn = sqlite3.connect(self.db, timeout=self.DB_TIMEOUT)
+        self._init_db()
+
+    def _init_db(self):
+        """Creates the store tables."""
+
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cds (key TEXT PRIMARY KEY, record BLOB)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS ref_digests (ref TEXT PRIMARY KEY, signature TEXT, digest TEXT)")
+
+    def get_ref_digest(self, ref):
+        r"""Gets the digest of a reference FASTA's contents.
+
+        :param str ref: path of the reference FASTA
+        :return str: hex digest
+
+        Digests are remembered by path, size, and modification time, so a large genome is only hashed once.
+        """
+
+        ref_path = os.path.abspath(ref)
+        ref_stat = os.stat(ref_path)
+        signature = "%i:%i" % (ref_stat.st_size, ref_stat.st_mtime_ns)
+
+        row = self.conn.execute("SELECT signature, digest FROM ref_digests WHERE ref = ?", (ref_path,)).fetchone()
+        if row is not None and row[0] == signature:
+            return row[1]
+
+        logger.info("Computing the digest of %s for the CDS store." % ref_path)
+        digest = fu.get_file_digest(ref_path)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO ref_digests VALUES (?, ?, ?)", (ref_path, signature, digest))
+
+        return digest
+
+    @classmethod
+    def get_key(cls, gff_records, ref_digest):
+        """Gets the store key of a transcript.
+
+        :param str gff_records: GFF records of the transcript
+        :param str ref_digest: digest of the reference FASTA corresponding to the GFF features
+        :return str: hex digest
+        """
+
+        key_hash = hashlib.sha256(ref_digest.encode())
+        key_hash.update((cls.KEY_FIELD_DELIM + gff_records).encode())
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        """Looks up the CDS annotations of a transcript.
+
+        :param str key: key from get_key
+        :return tuple | None: (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq), or None if not stored
+        """
+
+        row = self.conn.execute("SELECT record FROM cds WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, key, cds_info):
+        """Stores the CDS annotations of a transcript.
+
+        :param str key: key from get_key
+        :param tuple cds_info: (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq)
+        """
+
+        record = zlib.compress(pickle.dumps(cds_info), self.COMPRESSION_LEVEL)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cds VALUES (?, ?)", (key, record))
+
+    def close(self):
+        """Closes the store database."""
+
+        self.conn.close()
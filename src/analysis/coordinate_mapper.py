@@ -5,14 +5,15 @@ import collections
 import gzip
 import logging
 import pickle
-import pybedtools
 import re
 import tempfile
 import warnings
 
+from analysis.cds_store import CdsStore
 import analysis.seq_utils as su
 import core_utils.feature_file_utils as ffu
 import core_utils.file_utils as fu
+from core_utils.gff_index import GffIndex
 import core_utils.vcf_utils as vu
 from satmut_utils.definitions import *
 
@@ -171,22 +172,25 @@ class AminoAcidMapper(MapperBase):
     DEFAULT_ARGS = MUT_INFO_TUPLE._fields[1:]
     DEFAULT_KWARGS = dict(zip(DEFAULT_ARGS, [su.R_COMPAT_NA] * len(DEFAULT_ARGS)))
     NONSTOP_CHAR = "X"
+    PKL_EXTENSION = "cds.pkl.gz"
 
-    def __init__(self, gff, ref, outdir=DEFAULT_OUTDIR, use_pickle=True, make_pickle=True, overwrite_pickle=False,
-                 mut_sig=MUT_SIG_ANY, filter_unexpected=False):
+    def __init__(self, gff, ref, outdir=DEFAULT_OUTDIR, use_pickle=True, make_pickle=False, overwrite_pickle=False,
+                 mut_sig=MUT_SIG_ANY, filter_unexpected=False, cds_store_dir=None):
         r"""Constructor for AminoAcidMapper.
 
         :param str gff: GFF/GTF to create a mapper for; must have "transcript_id" and "CDS", "stop_codon" features.
         :param str ref: reference FASTA corresponding to GFF features
-        :param str outdir: output directory to write pickles to, if make_pickle=True.
+        :param str outdir: output directory to write pickles to, if make_pickle=True, and of the CDS store by default.
         :param bool use_pickle: Use a previously generated pickle for annotations if one exists? Default True. Otherwise \
-        re-create the data structure.
-        :param bool make_pickle: Should a new pickle be made? Default True.
+        load the annotations of each transcript from the CDS store on first use.
+        :param bool make_pickle: Should a new pickle of all transcripts be made? Default False.
         :param bool overwrite_pickle: if make_pickle=True and use_pickle=True, should the existing pickle be \
         overwritten? Default False. This is useful if one makes dynamic edits to an existing GFF. Otherwise, the older \
         pickle will be used.
         :param str mut_sig: mutagenesis signature- one of {NNN, NNK, NNS}. Default NNN.
         :param bool filter_unexpected: Filter changes that did not match an expected mutagenesis signature? Default False.
+        :param str | None cds_store_dir: directory of the persistent CDS store shared across runs. Default None, \
+        outdir.
 
         Warning! The exon feature GFF attributes must have transcript_id and exon_number or exon_ID, key-value pairs, and \
         features should be from 5' to 3', regardless of strand! For example, a transcript on the (-) will NOT be sorted \
@@ -213,18 +217,25 @@ class AminoAcidMapper(MapperBase):
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
-        self.pkl_filepath = os.path.join(self.output_dir, fu.replace_extension(os.path.basename(self.gff), "cds.pkl.gz"))
+        self.pkl_filepath = os.path.join(
+            self.output_dir, fu.replace_extension(os.path.basename(self.gff), self.PKL_EXTENSION))
         pkl_exists = os.path.exists(self.pkl_filepath)
 
+        self.gff_index = None
+        self.cds_store = None
+        self.ref_digest = None
+
         if self.use_pickle and pkl_exists:
             logger.info("Loading pickled transcript CDS annotations.")
-            with open(self.pkl_filepath, "rb") as info_pkl:
-                self.cds_info = pickle.load(info_pkl)
+            self.cds_info = self._load_pickle()
         else:
-            self.gff_bedtool = pybedtools.BedTool(self.gff)
+            self.gff_index = GffIndex(self.gff)
 
-            logger.info("Collecting transcript CDS annotations.")
-            self.cds_info = self._get_cds_info()
+            self.cds_store_dir = self.output_dir if cds_store_dir is None else cds_store_dir
+
+            # Transcript CDS annotations are loaded from the store, or collected, on first use
+            self.cds_store = CdsStore(self.cds_store_dir)
+            self.cds_info = {}
 
         if (self.make_pickle and not pkl_exists) or self.overwrite_pickle:
             logger.info("Pickling transcript CDS annotations to %s for %s" % (self.pkl_filepath, self.gff))
@@ -253,61 +264,96 @@ class AminoAcidMapper(MapperBase):
 
         transcript_cds_info[trx_id] = (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq)
 
-    def _get_cds_info(self):
-        """Stores CDS information for each transcript."""
+    def _add_transcript_cds_info(self, trx_id, features, transcript_cds_info):
+        """Adds CDS information for a transcript from its features.
+
+        :param str trx_id: transcript ID
+        :param list features: pybedtools.Interval features of the transcript, from 5'-3'
+        :param dict transcript_cds_info: dict for storing information on each transcript
+        """
 
-        transcript_cds_info = {}
-        trx_id = None
-        last_trx_id = None
         trx_seq = ""
         cds_seq = ""
+        has_features = False
 
-        # feature will be a pybedtools.Interval object
-        for feature in self.gff_bedtool:
+        for feature in features:
 
             # Filter the feature file of certain features so we have exon, CDS, and stop codon features only
             if self.FEATURES_TO_OMIT.match(feature.fields[ffu.GFF_FEATURE_TYPE_FIELD]):
                 continue
 
-            # Assuming we can identify the transcript, store the CDS data
-            trx_id = feature.attrs[ffu.GFF_ATTR_TRANSCRIPT_ID] if ffu.GFF_ATTR_TRANSCRIPT_ID in feature.attrs else None
-            if trx_id is not None and trx_id not in ffu.PYBEDTOOLS_NULL_CHARS:
+            has_features = True
+            feature_strand = su.Strand(feature.strand)
+
+            # Get the sequence of the entire transcript; we might normally just extract this from the transcriptome
+            # reference FASTA, but we want this to be as extensible as possible (e.g. to store novel isoforms)
+            if feature.fields[ffu.GFF_FEATURE_TYPE_FIELD] == self.EXON_ID:
+
+                exon_seq = su.extract_seq(
+                    contig=str(feature.chrom), start=feature.start + 1, stop=feature.stop, ref=self.ref)
+                exon_seq = su.reverse_complement(exon_seq) if feature_strand == su.Strand.MINUS else exon_seq
+                trx_seq += exon_seq
+
+            elif feature.fields[ffu.GFF_FEATURE_TYPE_FIELD] in self.VALID_CDS_FEATURES:
+
+                cds_exon_seq = su.extract_seq(
+                    contig=str(feature.chrom), start=feature.start + 1, stop=feature.stop, ref=self.ref)
+                cds_exon_seq = su.reverse_complement(cds_exon_seq) if feature_strand == su.Strand.MINUS else cds_exon_seq
+                cds_seq += cds_exon_seq
+
+        if has_features:
+            self._add_cds_info(trx_id=trx_id, transcript_cds_info=transcript_cds_info, trx_seq=trx_seq, cds_seq=cds_seq)
+
+    def get_cds_info(self, trx_id):
+        r"""Gets the CDS information of a transcript, loading it from the CDS store or collecting it on first use.
+
+        :param str trx_id: transcript ID
+        :return tuple | None: (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq), or None if the \
+        transcript has no exon or CDS features in the GFF
+        """
+
+        if trx_id in self.cds_info or self.gff_index is None or trx_id not in self.gff_index.ranges:
+            return self.cds_info.get(trx_id)
+
+        if self.ref_digest is None:
+            self.ref_digest = self.cds_store.get_ref_digest(self.ref)
 
-                feature_strand = su.Strand(feature.strand)
+        # Records are keyed by content, so edits to a transcript's features or the reference are never stale
+        gff_records = self.gff_index.read_transcript(trx_id)
+        cds_key = CdsStore.get_key(gff_records, self.ref_digest)
+        trx_cds_info = self.cds_store.get(cds_key)
 
-                # Store the results of the last transcript and reset the sequences every time we switch between
-                # blocks of features belonging to the same transcript
-                if last_trx_id is not None and trx_id != last_trx_id:
+        if trx_cds_info is None:
+            self._add_transcript_cds_info(
+                trx_id=trx_id, features=self.gff_index.parse_records(gff_records), transcript_cds_info=self.cds_info)
 
-                    self._add_cds_info(
-                        trx_id=last_trx_id, transcript_cds_info=transcript_cds_info, trx_seq=trx_seq, cds_seq=cds_seq)
+            if trx_id not in self.cds_info:
+                return None
 
-                    # Once we have added the information for the transcript in question, reset the sequence strings
-                    trx_seq = ""
-                    cds_seq = ""
+            self.cds_store.put(cds_key, self.cds_info[trx_id])
+        else:
+            self.cds_info[trx_id] = trx_cds_info
+
+        return self.cds_info[trx_id]
 
-                # Get the sequence of the entire transcript; we might normally just extract this from the transcriptome
-                # reference FASTA, but we want this to be as extensible as possible (e.g. to store novel isoforms)
-                if feature.fields[ffu.GFF_FEATURE_TYPE_FIELD] == self.EXON_ID:
+    def _get_cds_info(self):
+        """Gets CDS information for each transcript.
 
-                    exon_seq = su.extract_seq(
-                        contig=str(feature.chrom), start=feature.start + 1, stop=feature.stop, ref=self.ref)
-                    exon_seq = su.reverse_complement(exon_seq) if feature_strand == su.Strand.MINUS else exon_seq
-                    trx_seq += exon_seq
+        :return dict: {trx_id: (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq)}
+        """
 
-                elif feature.fields[ffu.GFF_FEATURE_TYPE_FIELD] in self.VALID_CDS_FEATURES:
+        if self.gff_index is None:
+            return self.cds_info
 
-                    cds_exon_seq = su.extract_seq(
-                        contig=str(feature.chrom), start=feature.start + 1, stop=feature.stop, ref=self.ref)
-                    cds_exon_seq = su.reverse_complement(cds_exon_seq) if feature_strand == su.Strand.MINUS else cds_exon_seq
-                    cds_seq += cds_exon_seq
+        transcript_cds_info = {}
+        for trx_id in self.gff_index.get_transcript_ids():
 
-                last_trx_id = trx_id
+            if trx_id in ffu.PYBEDTOOLS_NULL_CHARS:
+                continue
 
-        # Make sure to add the information for the last transcript block
-        if trx_id is not None:
-            self._add_cds_info(
-                trx_id=trx_id, transcript_cds_info=transcript_cds_info, trx_seq=trx_seq, cds_seq=cds_seq)
+            trx_cds_info = self.get_cds_info(trx_id)
+            if trx_cds_info is not None:
+                transcript_cds_info[trx_id] = trx_cds_info
 
         return transcript_cds_info
 
@@ -1379,12 +1425,13 @@ class AminoAcidMapper(MapperBase):
         :raises RuntimeError: if the REF field of the variant does not match the reference sequence
         """
 
-        if trx_id not in self.cds_info:
+        trx_cds_info = self.get_cds_info(trx_id)
+        if trx_cds_info is None:
             raise TranscriptNotFound("No transcript %s found in the annotations." % trx_id)
 
         # cds_start_offset is 0-based offset of the first base of the start codon
         # cds_stop_offset is 0-based offset of the base _after_ the stop codon
-        trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq = self.cds_info[trx_id]
+        trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq = trx_cds_info
 
         if pos > trx_len or pos < 1:
             # Support for intergenic variants is not implemented
@@ -1442,13 +1489,25 @@ class AminoAcidMapper(MapperBase):
 
         return mut_info_tuple
 
-    def generate_pickle(self):
-        """Makes a pickle of the object."""
+    def _load_pickle(self):
+        """Loads the pickled CDS information of all transcripts.
+
+        :return dict: {trx_id: (trx_len, cds_start_offset, cds_stop_offset, trx_seq, cds_seq)}
+        """
+
+        try:
+            with gzip.open(self.pkl_filepath, "rb") as info_pkl:
+                return pickle.load(info_pkl)
+        except gzip.BadGzipFile:
+            # Pickles from earlier versions were not compressed despite their extension
+            with open(self.pkl_filepath, "rb") as info_pkl:
+                return pickle.load(info_pkl)
 
-        with open(self.pkl_filepath, "wb") as info_pkl:
-            pickle.dump(obj=self.cds_info, file=info_pkl)
+    def generate_pickle(self):
+        """Makes a gzipped pickle of the CDS information of all transcripts."""
 
-        gzip.GzipFile(self.pkl_filepath)
+        with gzip.open(self.pkl_filepath, "wb") as info_pkl:
+            pickle.dump(obj=self._get_cds_info(), file=info_pkl)
 
 
 def translate(codon):
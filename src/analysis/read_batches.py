@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Columnar batches of read pairs for vectorized filtering and mismatch enumeration."""
+
+import itertools
+import logging
+import numpy as np
+
+import analysis.seq_utils as su
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+NO_TAG_VALUE = -1
+UNKNOWN_BASE_BYTE = ord(su.UNKNOWN_BASE)
+UPPERCASE_MASK = 0xDF
+DIGIT_ZERO_BYTE = ord("0")
+DIGIT_NINE_BYTE = ord("9")
+
+# Only alignments without InDels, reference skips, or hard clips are decoded into columns
+SIMPLE_CIGAR_OPS = su.PYSAM_CIGARTUPLES_ALIGNED | {su.PYSAM_CIGARTUPLES_SOFTCLIP}
+
+
+def gather_ranges(starts, lens):
+    """Expands a set of ranges into their concatenated values.
+
+    :param numpy.ndarray starts: start of each range
+    :param numpy.ndarray lens: length of each range
+    :return tuple: (range index, value) int64 arrays for every element of the ranges
+    """
+
+    lens = lens.astype(np.int64)
+    range_index = np.repeat(np.arange(len(lens)), lens)
+    range_offsets = np.arange(int(lens.sum())) - np.repeat(np.cumsum(lens) - lens, lens)
+    return range_index, starts[range_index] + range_offsets
+
+
+class AlignmentColumns(object):
+    """Flat numpy columns for a set of alignments."""
+
+    def __init__(self, segments):
+        r"""Constructor for AlignmentColumns.
+
+        :param list segments: pysam.AlignedSegment objects
+
+        Sequence, quality, and MD buffers are only filled for simple alignments, which have only aligned and \
+        soft-clipped CIGAR operations and NM and MD tags. Other alignments have empty fields and is_simple False.
+        """
+
+        n = len(segments)
+        self.segments = segments
+        self.flags = np.zeros(n, dtype=np.int64)
+        self.reference_ids = np.full(n, NO_TAG_VALUE, dtype=np.int64)
+        self.reference_starts = np.zeros(n, dtype=np.int64)
+        self.nms = np.full(n, NO_TAG_VALUE, dtype=np.int64)
+        self.left_clips = np.zeros(n, dtype=np.int64)
+        self.aligned_lens = np.zeros(n, dtype=np.int64)
+        self.is_simple = np.zeros(n, dtype=bool)
+
+        cigar_ops = []
+        cigar_lens = []
+        cigar_counts = np.zeros(n, dtype=np.int64)
+        seqs = []
+        quals = []
+        mds = []
+
+        for i, align_seg in enumerate(segments):
+
+            self.flags[i] = align_seg.flag
+            self.reference_ids[i] = align_seg.reference_id
+            self.reference_starts[i] = align_seg.reference_start
+
+            cigartuples = align_seg.cigartuples
+            if cigartuples is not None:
+                cigar_counts[i] = len(cigartuples)
+                cigar_ops.extend(op for op, _ in cigartuples)
+                cigar_lens.extend(length for _, length in cigartuples)
+
+            if align_seg.has_tag(su.SAM_EDIT_DIST_TAG):
+                self.nms[i] = align_seg.get_tag(su.SAM_EDIT_DIST_TAG)
+
+            query_sequence = align_seg.query_sequence
+            query_qualities = align_seg.query_qualities
+
+            if align_seg.is_unmapped or cigartuples is None or query_sequence is None or query_qualities is None or \
+                    self.nms[i] == NO_TAG_VALUE or not align_seg.has_tag(su.SAM_MD_TAG) or \
+                    any(op not in SIMPLE_CIGAR_OPS for op, _ in cigartuples):
+                seqs.append(b"")
+                quals.append(b"")
+                mds.append(b"")
+                continue
+
+            self.is_simple[i] = True
+            self.left_clips[i] = cigartuples[0][1] if cigartuples[0][0] == su.PYSAM_CIGARTUPLES_SOFTCLIP else 0
+            self.aligned_lens[i] = sum(length for op, length in cigartuples if op in su.PYSAM_CIGARTUPLES_ALIGNED)
+
+            seqs.append(query_sequence.encode())
+            quals.append(bytes(query_qualities))
+            mds.append(align_seg.get_tag(su.SAM_MD_TAG).encode())
+
+        self.cigar_ops = np.array(cigar_ops, dtype=np.uint8)
+        self.cigar_lens = np.array(cigar_lens, dtype=np.int64)
+        self.cigar_offsets = np.concatenate(([0], np.cumsum(cigar_counts)))
+
+        self.sequences = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        self.qualities = np.frombuffer(b"".join(quals), dtype=np.uint8)
+        self.seq_offsets = np.concatenate(([0], np.cumsum([len(seq) for seq in seqs], dtype=np.int64)))
+
+        self.mds = np.frombuffer(b"".join(mds), dtype=np.uint8)
+        self.md_offsets = np.concatenate(([0], np.cumsum([len(md) for md in mds], dtype=np.int64)))
+
+    def __len__(self):
+        """Gets the number of alignments.
+
+        :return int: number of alignments
+        """
+
+        return len(self.flags)
+
+    @property
+    def query_lens(self):
+        """Gets the query lengths of the simple alignments.
+
+        :return numpy.ndarray: query lengths, 0 for alignments that are not simple
+        """
+
+        return np.diff(self.seq_offsets)
+
+    @property
+    def reference_ends(self):
+        """Gets the 0-based exclusive reference end of the simple alignments.
+
+        :return numpy.ndarray: reference ends
+        """
+
+        return self.reference_starts + self.aligned_lens
+
+    @property
+    def is_reverse(self):
+        """Gets the strand of each alignment.
+
+        :return numpy.ndarray: bool array, True for reverse-strand alignments
+        """
+
+        return (self.flags & su.SAM_FLAG_REVERSE) != 0
+
+    def get_unmasked_spans(self):
+        """Gets the first and last aligned reference positions with a non-masked base quality.
+
+        :return tuple: (first, last) 0-based int64 arrays; first is greater than last if no bases are unmasked
+        """
+
+        n = len(self)
+        first = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        last = np.full(n, np.iinfo(np.int64).min, dtype=np.int64)
+
+        read_index, aligned_offsets = gather_ranges(np.zeros(n, dtype=np.int64), self.aligned_lens)
+        bqs = self.qualities[self.seq_offsets[read_index] + self.left_clips[read_index] + aligned_offsets]
+        unmasked = bqs != su.MASKED_BQ
+
+        ref_positions = self.reference_starts[read_index[unmasked]] + aligned_offsets[unmasked]
+        np.minimum.at(first, read_index[unmasked], ref_positions)
+        np.maximum.at(last, read_index[unmasked], ref_positions)
+        return first, last
+
+    def get_mismatches(self, min_bq, mask=None):
+        r"""Enumerates the mismatches of simple alignments from their MD tags.
+
+        :param int min_bq: min base quality for a mismatch to be kept
+        :param numpy.ndarray | None mask: optional bool array selecting the alignments to enumerate
+        :return tuple: (read index, 0-based reference position, REF byte, ALT byte, BQ, 1-based read position) arrays, \
+        ordered by read and position
+
+        Mismatches with an N ALT are excluded. Read positions are relative to the 5' end of the read.
+        """
+
+        select = self.is_simple if mask is None else self.is_simple & mask
+        md_read_index = np.repeat(np.arange(len(self)), np.diff(self.md_offsets))
+        keep = select[md_read_index]
+        md = self.mds[keep]
+        md_read_index = md_read_index[keep]
+
+        # Split the MD bytes into tokens; each digit run is a match length and each base is a one-base mismatch
+        is_digit = (md >= DIGIT_ZERO_BYTE) & (md <= DIGIT_NINE_BYTE)
+        token_start = np.ones(len(md), dtype=bool)
+        token_start[1:] = ~(is_digit[1:] & is_digit[:-1] & (md_read_index[1:] == md_read_index[:-1]))
+        token_starts = np.flatnonzero(token_start)
+        token_index = np.cumsum(token_start) - 1
+        token_ends = np.append(token_starts[1:], len(md)) - 1
+
+        digit_exps = token_ends[token_index] - np.arange(len(md))
+        digit_values = np.where(is_digit, (md.astype(np.int64) - DIGIT_ZERO_BYTE) * np.power(10, digit_exps), 0)
+        token_is_base = ~is_digit[token_starts]
+        token_lens = np.where(token_is_base, 1, np.add.reduceat(digit_values, token_starts) if len(md) else 0)
+
+        # Offsets of each token from the alignment start
+        token_read_index = md_read_index[token_starts]
+        token_cumsum = np.cumsum(token_lens) - token_lens
+        read_start = np.ones(len(token_starts), dtype=bool)
+        read_start[1:] = token_read_index[1:] != token_read_index[:-1]
+        read_first_tokens = np.flatnonzero(read_start)
+        token_offsets = token_cumsum - token_cumsum[read_first_tokens][np.cumsum(read_start) - 1]
+
+        read_index = token_read_index[token_is_base]
+        aligned_offsets = token_offsets[token_is_base]
+        refs = md[token_starts[token_is_base]] & UPPERCASE_MASK
+
+        query_positions = self.left_clips[read_index] + aligned_offsets
+        alts = self.sequences[self.seq_offsets[read_index] + query_positions] & UPPERCASE_MASK
+        bqs = self.qualities[self.seq_offsets[read_index] + query_positions]
+
+        passing = (bqs >= min_bq) & (alts != UNKNOWN_BASE_BYTE)
+        read_index = read_index[passing]
+        query_positions = query_positions[passing]
+
+        read_positions = np.where(
+            self.is_reverse[read_index], self.query_lens[read_index] - query_positions, query_positions + 1)
+
+        return read_index, self.reference_starts[read_index] + aligned_offsets[passing], refs[passing], \
+            alts[passing], bqs[passing], read_positions
+
+
+class ReadPairBatch(object):
+    """Columns for a batch of read pairs."""
+
+    def __init__(self, read_pairs):
+        r"""Constructor for ReadPairBatch.
+
+        :param list read_pairs: (R1, R2) tuples of pysam.AlignedSegment. Merged fragments are provided as \
+        (fragment, None) and are never simple.
+        """
+
+        self.read_pairs = read_pairs
+        self.r1 = AlignmentColumns([r1 for r1, _ in read_pairs])
+
+        # Fragments stand in for their own R2 so that the columns of mates share an index
+        self.r2 = AlignmentColumns([r1 if r2 is None else r2 for r1, r2 in read_pairs])
+        is_pair = np.array([r2 is not None for _, r2 in read_pairs], dtype=bool)
+
+        # Pairs that can be handled entirely with the columns
+        self.is_simple = is_pair & self.r1.is_simple & self.r2.is_simple & \
+            (self.r1.reference_ids == self.r2.reference_ids)
+
+    def __len__(self):
+        """Gets the number of pairs.
+
+        :return int: number of pairs
+        """
+
+        return len(self.read_pairs)
+
+    def get_overlapping(self):
+        """Determines which simple pairs have mates with >= 1 nt of reference overlap.
+
+        :return numpy.ndarray: bool array
+        """
+
+        return self.is_simple & (self.r1.aligned_lens > 0) & (self.r2.aligned_lens > 0) & \
+            (self.r1.reference_starts < self.r2.reference_ends) & (self.r2.reference_starts < self.r1.reference_ends)
+
+    def filter_pairs(self, max_nm=None):
+        """Filters the simple pairs with overlapping mates.
+
+        :param int | None max_nm: max edit distance of either mate
+        :return numpy.ndarray: bool array of passing pairs
+        """
+
+        passing = self.get_overlapping()
+
+        if max_nm is not None:
+            passing &= (self.r1.nms <= max_nm) & (self.r2.nms <= max_nm)
+
+        return passing
+
+
+def iterate_read_pair_batches(read_pairs, batch_size=DEFAULT_BATCH_SIZE):
+    """Iterates over batches of read pairs.
+
+    :param iter read_pairs: iterable of (R1, R2) tuples of pysam.AlignedSegment
+    :param int batch_size: number of pairs per batch
+    :return generator: ReadPairBatch objects
+    """
+
+    read_pairs = iter(read_pairs)
+
+    while True:
+        batch = list(itertools.islice(read_pairs, batch_size))
+        if len(batch) == 0:
+            return
+        yield ReadPairBatch(batch)
@@ -2,18 +2,22 @@
 """Read editing objects."""
 
 import abc
+import array
 import collections
 import logging
+import numpy as np
 import os
 import pysam
 import random
 import tempfile
 
-from analysis.read_preprocessor import QnameVerification, ReadMasker
+from analysis.read_preprocessor import ReadMasker
 from analysis import seq_utils as su
+from core_utils import fastq_utils as fqu
 from core_utils import file_utils as fu
+from core_utils import io_policy as iop
 from core_utils import vcf_utils as vu
-from satmut_utils.definitions import QNAME_SORTS, DEFAULT_TEMPDIR
+from satmut_utils.definitions import DEFAULT_TEMPDIR
 from scripts.run_bowtie2_aligner import workflow as align_workflow
 
 __author__ = "Ian_Hoskins"
@@ -43,17 +47,19 @@ class ReadEditorPreprocessor(object):
     QNAME_INPUT_SUFFIX = "qname.sort.bam"
 
     def __init__(self, bam, ref, race_like=DEFAULT_RACE_LIKE, primers=DEFAULT_PRIMERS, outdir=DEFAULT_OUTDIR,
-                 nthreads=DEFAULT_NTHREADS):
+                 nthreads=DEFAULT_NTHREADS, io_policy=None):
         r"""Constructor for ReadEditorPreprocessor.
 
-        :param str bam: alignments to edit into
-        :param str ref: samtools faidx indexed reference FASTA
+        :param str bam: BAM or CRAM alignments to edit into
+        :param str ref: samtools faidx indexed reference FASTA, also used to decode a CRAM input
         :param bool race_like: is the data produced by RACE-like (e.g. AMP) data? Default False.
         :param str | None primers: BED, GFF, or GTF file containing primers; for masking synthetic sequences for \
         accurate AF of variants under primer regions. This feature file should contain the strand of the primer. \
         Set to None for no masking.
         :param str outdir: Optional output directory. Default current directory.
         :param int nthreads: Number of threads to use for SAM/BAM operations. Default 0 (autodetect).
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression and \
+        location of the sorted inputs, which are registered for release after editing
         """
 
         self.input_bam = bam
@@ -62,19 +68,20 @@ class ReadEditorPreprocessor(object):
         self.primers = primers
         self.outdir = outdir
         self.nthreads = nthreads
-        self.tempdir = tempfile.mkdtemp(suffix=".editor.preprocessor.tmp")
+        self.io_policy = io_policy
+
+        if self.io_policy is not None:
+            self.tempdir = self.io_policy.make_tempdir(suffix=".editor.preprocessor.tmp", input_files=(bam,))
+        else:
+            self.tempdir = tempfile.mkdtemp(suffix=".editor.preprocessor.tmp")
 
         # We consider masking synthetic primer regions to enable facile detection of variants "under" primers. In these
         # cases we want to ensure we don't edit into a read such that the variant appears to be a synthesis error
         input_masked_bam = self.input_bam
         if self.primers is not None:
 
-            # Determine if the read names are compatible with masking
-            qv = QnameVerification(bam=self.input_bam)
-            sort_cmd = QNAME_SORTS[qv.format_index]
-
-            rm = ReadMasker(in_bam=self.input_bam, feature_file=self.primers, race_like=race_like, sort_cmd=sort_cmd,
-                            outdir=self.tempdir, nthreads=self.nthreads)
+            rm = ReadMasker(in_bam=self.input_bam, feature_file=self.primers, race_like=race_like,
+                            outdir=self.tempdir, nthreads=self.nthreads, io_policy=self.io_policy, ref=self.ref)
             rm.workflow()
             input_masked_bam = rm.out_bam
 
@@ -85,16 +92,24 @@ class ReadEditorPreprocessor(object):
         # Filter supplementary and secondary alignments
         # This must occur because if we choose the primary alignment for editing and writing, we should not try to edit
         # or write the supplement or secondary alignment
+        # A CRAM input is decoded with the reference, and the preprocessed alignments are BAM
+        view_kwargs = {"T": self.ref} if su.is_cram(input_masked_bam) else {}
         preprocessed_input_bam = su.sam_view(
-            input_masked_bam, None, "BAM", self.nthreads, F=su.SAM_FLAG_SUPPL + su.SAM_FLAG_SECONDARY)
+            input_masked_bam, None, "BAM", self.nthreads, F=su.SAM_FLAG_SUPPL + su.SAM_FLAG_SECONDARY, **view_kwargs)
 
         # We will need a coordinate- and qname- sorted BAM for the pileup and then the editing
         self.edit_background = os.path.join(self.tempdir, fu.replace_extension(am_basename, self.EDIT_INPUT_SUFFIX))
-        su.sort_and_index(am=preprocessed_input_bam, output_am=self.edit_background, nthreads=nthreads)
+        compresslevel = iop.get_compresslevel(self.io_policy)
+        su.sort_and_index(
+            am=preprocessed_input_bam, output_am=self.edit_background, nthreads=nthreads, compresslevel=compresslevel)
 
         self.qname_bam = os.path.join(self.tempdir, fu.replace_extension(am_basename, self.QNAME_INPUT_SUFFIX))
+        sort_kwargs = {} if compresslevel is None else {"l": str(compresslevel)}
         self.qname_sorted_bam = su.sort_bam(
-            bam=self.edit_background, output_am=self.qname_bam, by_qname=True, nthreads=nthreads)
+            bam=self.edit_background, output_am=self.qname_bam, by_qname=True, nthreads=nthreads, **sort_kwargs)
+
+        if self.io_policy is not None:
+            self.io_policy.register(self.edit_background, self.qname_sorted_bam)
 
         temp_files = [preprocessed_input_bam]
         if self.primers is not None:
@@ -125,6 +140,7 @@ class ReadEditor(object):
     DEFAULT_FORCE = False
     DEFAULT_SEED = 9
     DEFAULT_NTHREADS = 0
+    DEFAULT_OUTPUT_CRAM = False
     MAX_DP = 100000000
     MIN_BQ = 1  # omit primer-masked bases where BQ = 0
     VAR_TAG_DELIM = "_"
@@ -136,14 +152,15 @@ class ReadEditor(object):
     TRUTH_VCF_SUFFIX = "truth.vcf"
     NORM_VCF_SUFFIX = "norm.sort.vcf"
     EDIT_BAM_SUFFIX = "edit.realign.bam"
+    EDIT_CRAM_SUFFIX = "edit.realign.cram"
 
     def __init__(self, bam, variants, ref, race_like=ReadEditorPreprocessor.DEFAULT_RACE_LIKE,
                  primers=DEFAULT_PRIMERS, output_dir=DEFAULT_OUTDIR, output_prefix=DEFAULT_PREFIX,
                  buffer=DEFAULT_BUFFER, max_nm=DEFAULT_MAX_NM, min_bq=DEFAULT_MIN_BQ, random_seed=DEFAULT_SEED,
-                 force_edit=DEFAULT_FORCE, nthreads=DEFAULT_NTHREADS):
+                 force_edit=DEFAULT_FORCE, nthreads=DEFAULT_NTHREADS, io_policy=None, output_cram=DEFAULT_OUTPUT_CRAM):
         r"""Constructor for ReadEditor.
 
-        :param str bam: alignments to edit into.
+        :param str bam: BAM or CRAM alignments to edit into.
         :param str variants: VCF/BCF specifying variants to edit; use the AF tag to specify AF, e.g. AF=0.1.
         :param str ref: reference FASTA. Default APPRIS primary annotation transcriptome.
         :param bool race_like: is the data produced by RACE-like (e.g. AMP) data? Default False.
@@ -159,6 +176,10 @@ class ReadEditor(object):
         :param bool force_edit: flag to attempt editing of variants despite a NonconfiguredVariant exception.
         :param int nthreads: Number of threads to use for SAM/BAM operations and alignment. Default 0 (autodetect) \
         for samtools operations. If 0, will pass 1 to bowtie2 --threads.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression, \
+        location, and lifetime of the intermediate BAMs. The output FASTQs and BAM are not affected.
+        :param bool output_cram: write the edited and realigned alignments as reference-compressed CRAM instead of \
+        BAM. Default False.
         """
 
         self.bam = bam
@@ -174,6 +195,8 @@ class ReadEditor(object):
         self.random_seed = random_seed
         self.force_edit = force_edit
         self.nthreads = nthreads
+        self.io_policy = io_policy
+        self.output_cram = output_cram
 
         logger.info("Validating variant configurations.")
         self._verify_variant_freqs()
@@ -189,7 +212,8 @@ class ReadEditor(object):
 
         logger.info("Pre-processing input files for editing.")
         self.editor_preprocessor = ReadEditorPreprocessor(
-            bam=self.bam, primers=primers, ref=ref, race_like=race_like, outdir=output_dir, nthreads=nthreads)
+            bam=self.bam, primers=primers, ref=ref, race_like=race_like, outdir=output_dir, nthreads=nthreads,
+            io_policy=io_policy)
 
         logger.info("Getting variant configs.")
         self.variant_configs = self._get_variant_configs()
@@ -208,7 +232,8 @@ class ReadEditor(object):
             self.output_prefix = fu.remove_extension(os.path.basename(self.bam))
 
         self.out_path = os.path.join(self.output_dir, self.output_prefix)
-        self.temp_edit_bam = tempfile.NamedTemporaryFile(mode="wb", suffix=".temp.edit.bam", delete=False).name
+        self.temp_edit_bam = tempfile.NamedTemporaryFile(
+            mode="wb", suffix=".temp.edit.bam", dir=self.editor_preprocessor.tempdir, delete=False).name
         self.output_bam = fu.add_extension(self.out_path, self.EDIT_BAM_SUFFIX)
         self.truth_vcf = fu.add_extension(self.out_path, self.TRUTH_VCF_SUFFIX)
 
@@ -568,11 +593,14 @@ class ReadEditor(object):
     def _unmask_quals(quals):
         """Reassigns masked primer regions to non-zero BQs so the reads do not undergo 3' quality trimming.
 
-        :param list quals: list of BQs to unmask
-        :return list: list of BQs, all non-zero
+        :param array.array | list quals: BQs to unmask; an array is updated in place
+        :return array.array: BQs, all non-zero
         """
 
-        unmasked_quals = [su.DEFAULT_MAX_BQ if bq == su.MASKED_BQ else bq for bq in quals]
+        unmasked_quals = quals if isinstance(quals, array.array) else array.array("B", quals)
+
+        quals_view = np.frombuffer(unmasked_quals, dtype=np.uint8)
+        quals_view[quals_view == su.MASKED_BQ] = su.DEFAULT_MAX_BQ
         return unmasked_quals
 
     def _edit(self, align_seg, variant):
@@ -602,7 +630,7 @@ class ReadEditor(object):
         :param dict edit_configs: dict with list of variants to edit at a specific read and position."""
 
         with pysam.AlignmentFile(self.editor_preprocessor.qname_sorted_bam, "rb") as in_af, \
-                pysam.AlignmentFile(self.temp_edit_bam, mode="wb", header=in_af.header) as out_af:
+                iop.open_bam(self.temp_edit_bam, self.io_policy, header=in_af.header) as out_af:
 
             # Iterate over the qname-sorted reads, that way we write the BAM in that order for FASTQ conversion
             for align_seg in in_af.fetch(until_eof=True):
@@ -624,17 +652,44 @@ class ReadEditor(object):
                 align_seg.cigarstring = None
                 out_af.write(align_seg)
 
-    def _write_fastqs(self):
-        r"""Writes and gzips FASTQs for re-alignment.
+    def _get_fastq_names(self):
+        """Gets the names of the gzipped output FASTQs.
 
         :return tuple: (str, str) paths of the R1 and R2 FASTQ files
         """
 
-        r1_fastq, r2_fastq = su.bam_to_fastq(self.temp_edit_bam, self.out_path, True, self.nthreads)
-        zipped_r1_fastq = fu.gzip_file(r1_fastq, force=True)
-        zipped_r2_fastq = fu.gzip_file(r2_fastq, force=True)
+        zipped_r1_fastq = fu.add_extension(
+            fu.add_extension(fu.add_extension(self.out_path, "R1"), su.FASTQ_SUFFIX), fu.GZ_EXTENSION)
+        zipped_r2_fastq = fu.add_extension(
+            fu.add_extension(fu.add_extension(self.out_path, "R2"), su.FASTQ_SUFFIX), fu.GZ_EXTENSION)
         return zipped_r1_fastq, zipped_r2_fastq
 
+    def _write_read_pairs(self, r1_writer, r2_writer):
+        """Writes the edited read pairs to FASTQ in batches as they are streamed to the aligner.
+
+        :param core_utils.fastq_utils.FastqWriter r1_writer: writer for the R1 records
+        :param core_utils.fastq_utils.FastqWriter r2_writer: writer for the R2 records
+        :return generator: (R1, R2) FASTQ_RECORD_TUPLEs
+        """
+
+        def _write_batch(batch):
+            """Writes a batch of read pairs."""
+
+            for mate_index, writer in enumerate((r1_writer, r2_writer)):
+                records = [read_pair[mate_index] for read_pair in batch]
+                writer.write(fqu.FastqBatch.from_records(
+                    [r.name for r in records], [r.sequence for r in records], [r.quality for r in records]))
+
+        batch = []
+        for r1, r2 in su.iterate_bam_read_pairs(self.temp_edit_bam, is_paired=True):
+            batch.append((r1, r2))
+            if len(batch) == fqu.DEFAULT_BATCH_SIZE:
+                _write_batch(batch)
+                batch = []
+            yield r1, r2
+
+        _write_batch(batch)
+
     @staticmethod
     def _write_variant_to_truth_vcf(truth_vcf_fh, vc, expected_cao, expected_caf):
         """Writes a variant to the truth VCF containing the expected frequencies for input variants.
@@ -656,7 +711,7 @@ class ReadEditor(object):
     def workflow(self):
         """Runs the ReadEditor workflow.
 
-        :return tuple: (str, str, str) paths of the edited and realigned BAM, R1 FASTQ, R2 FASTQ
+        :return tuple: (str, str, str) paths of the edited and realigned BAM or CRAM, R1 FASTQ, R2 FASTQ
         """
 
         logger.info("Getting edit configs. This could take time if the number of target positions and/or the depth "
@@ -666,18 +721,32 @@ class ReadEditor(object):
         logger.info("Editing variants.")
         self._iterate_over_reads(edit_configs)
 
-        logger.info("Writing and gzipping FASTQs.")
-        zipped_r1_fastq, zipped_r2_fastq = self._write_fastqs()
+        # The sorted inputs are not needed once the edited reads are written
+        if self.io_policy is not None:
+            self.io_policy.release(self.editor_preprocessor.edit_background, self.editor_preprocessor.qname_sorted_bam)
 
         # We need to realign to re-generate CIGAR and MD tags and for proper visualization of alignments in browsers
-        logger.info("Globally re-aligning edited reads.")
+        # The gzipped FASTQs are written in the same pass that streams the read pairs to the aligner
+        logger.info("Writing gzipped FASTQs and globally re-aligning edited reads.")
+        zipped_r1_fastq, zipped_r2_fastq = self._get_fastq_names()
         nthreads = self.nthreads if self.nthreads != 0 else 1
-        align_workflow(f1=zipped_r1_fastq, f2=zipped_r2_fastq, ref=self.ref, outdir=self.output_dir,
-                       outbam=self.output_bam, local=False, nthreads=nthreads)
+
+        with fqu.FastqWriter(zipped_r1_fastq, nthreads=self.nthreads) as r1_writer, \
+                fqu.FastqWriter(zipped_r2_fastq, nthreads=self.nthreads) as r2_writer:
+            align_workflow(f1=None, f2=None, ref=self.ref, outdir=self.output_dir, outbam=self.output_bam,
+                           local=False, nthreads=nthreads, read_pairs=self._write_read_pairs(r1_writer, r2_writer))
 
         # Remove temp files
         fu.safe_remove((self.editor_preprocessor.tempdir, self.temp_edit_bam,), force_remove=True)
 
+        if self.output_cram:
+            logger.info("Compressing edited alignments to CRAM.")
+            output_cram = su.bam_to_cram(bam=self.output_bam, ref=self.ref,
+                                         output_cram=fu.add_extension(self.out_path, self.EDIT_CRAM_SUFFIX),
+                                         nthreads=self.nthreads)
+            fu.safe_remove((self.output_bam, su.get_index_name(self.output_bam),))
+            return output_cram, zipped_r1_fastq, zipped_r2_fastq
+
         return self.output_bam, zipped_r1_fastq, zipped_r2_fastq
 
 
@@ -2,19 +2,25 @@
 """Objects for read pre-processing."""
 
 import collections
-import gzip
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import numpy as np
-import pybedtools
 import pysam
+import random
 import regex
+import shutil
 import subprocess
 import tempfile
 
 import analysis.seq_utils as su
+import core_utils.fastq_utils as fqu
 import core_utils.feature_file_utils as ffu
 import core_utils.file_utils as fu
+import core_utils.io_policy as iop
+from core_utils.sort_planner import SortOrder, SAM_HD_GO_TAG, SAM_HD_GO_QUERY_VAL
 import core_utils.vcf_utils as vu
 from satmut_utils.definitions import *
 from scripts.run_bowtie2_aligner import workflow as baw
@@ -43,6 +49,37 @@ UMI_SEP = "_"
 UMI_DELIM = "."
 
 
+def get_primer_patterns(primer_fasta, primer_nm_allow):
+    """Gets primer sequences and fuzzy-matching patterns for matching the start of reads.
+
+    :param str primer_fasta: primer FASTA
+    :param int primer_nm_allow: edit distance allowance for primer matching
+    :return dict: {primer_name: (primer_len, primer_seq, compiled regex)}
+    """
+
+    with pysam.FastxFile(primer_fasta) as primer_fa:
+        primer_dict = {rec.name: (
+            len(rec.sequence), str(rec.sequence).upper(),
+            regex.compile("(%s){e<=%i}" % (str(rec.sequence).upper(), primer_nm_allow))
+        ) for rec in primer_fa}
+
+    return primer_dict
+
+
+def get_umi_args(umi_tag=None):
+    """Gets the umi_tools arguments locating the UMI of each read.
+
+    :param str | None umi_tag: optional tag holding the UMI. Default None, the UMI is appended to the read name.
+    :return tuple: umi_tools arguments
+    """
+
+    if umi_tag is None:
+        return ("--umi-separator=%s" % UMI_SEP,)
+
+    res = "--extract-umi-method=tag", "--umi-tag=%s" % umi_tag
+    return res
+
+
 class QnameVerification(object):
     """Class for checking and validating read name formats, which may affect processing."""
 
@@ -88,24 +125,18 @@ class QnameVerification(object):
         :raises NotImplementedError: if the read name is not a recognizable format.
         """
 
-        open_func = open
-        file_mode = "r"
-        if self.fastq.endswith(fu.GZ_EXTENSION):
-            open_func = gzip.open
-            file_mode = "rt"
+        # Only the first record is needed
+        with fqu.FastqReader(self.fastq, batch_size=1) as reader:
+            first_batch = next(reader, None)
 
-        with open_func(self.fastq, mode=file_mode) as fh:
-            for i, line in enumerate(fh):
-                if i == 0:
-                    compatible, format_index = self.verify_qname_format(
-                        line.strip(su.SAM_HEADER_CHAR + fu.FILE_NEWLINE).split(ILLUMINA_QNAME_INDEX_DELIM)[0])
+        if first_batch is None:
+            return None
 
-                    if not compatible:
-                        fh.seek(0)
-                        raise NotImplementedError(self.error_msg)
+        compatible, format_index = self.verify_qname_format(first_batch.get_names()[0])
+        if not compatible:
+            raise NotImplementedError(self.error_msg)
 
-                    fh.seek(0)
-                    return compatible, format_index
+        return compatible, format_index
 
     def _verify_bam(self):
         """Verifies qname format for a BAM.
@@ -286,6 +317,403 @@ class FastqPreprocessor(object):
         logger.info("Completed FASTQ preprocessor workflow.")
 
 
+class MateMerger(object):
+    """Class for merging overlapping mates into single fragments prior to alignment."""
+
+    DEFAULT_OUTDIR = "."
+    MIN_OVERLAP = 20
+    MAX_MISMATCH_FRAC = 0.1
+    MERGED_SUFFIX = "merged.fq"
+    UNMERGED_SUFFIX = "unmerged.fq"
+    CONCORDANCE_TAG = "XC"
+    SINGLE_MATE = "S"  # base is covered by only one mate
+    CONCORDANT = "C"  # both mates have the same base call
+    DISCORDANT = "D"  # the mates have different base calls
+    CONCORDANCE_RE = regex.compile(r"(\d+)([%s%s%s])" % (SINGLE_MATE, CONCORDANT, DISCORDANT))
+
+    def __init__(self, f1, f2, outdir=DEFAULT_OUTDIR, min_overlap=MIN_OVERLAP, max_mismatch_frac=MAX_MISMATCH_FRAC):
+        r"""Constructor for MateMerger.
+
+        :param str f1: path of the R1 FASTQ
+        :param str f2: path of the R2 FASTQ
+        :param str outdir: Output directory to write merged and unmerged FASTQs to
+        :param int min_overlap: min number of bases the mates must overlap to be merged. Default 20.
+        :param float max_mismatch_frac: max fraction of mismatched bases in the overlap to merge the mates. \
+        Default 0.1.
+
+        Merged fragments are in R1 orientation and carry a run-length encoded per-base concordance string in the read \
+        comment as a SAM tag, e.g. XC:Z:30S110C1D9S, so that it can be appended to the alignment.
+        """
+
+        self.f1 = f1
+        self.f2 = f2
+        self.outdir = outdir
+        self.min_overlap = min_overlap
+        self.max_mismatch_frac = max_mismatch_frac
+
+        if not os.path.exists(outdir):
+            os.mkdir(outdir)
+
+        self.merged_fastq = os.path.join(outdir, fu.replace_extension(
+            os.path.basename(os.path.commonprefix((f1, f2,))), self.MERGED_SUFFIX))
+        self.unmerged_f1 = os.path.join(outdir, fu.replace_extension(os.path.basename(f1), self.UNMERGED_SUFFIX))
+        self.unmerged_f2 = os.path.join(outdir, fu.replace_extension(os.path.basename(f2), self.UNMERGED_SUFFIX))
+
+        self.n_merged = 0
+        self.n_unmerged = 0
+
+        self.workflow()
+
+    @staticmethod
+    def encode_concordance(codes):
+        """Run-length encodes per-base concordance codes.
+
+        :param str codes: one concordance code per fragment base
+        :return str: run-length encoded codes, e.g. 30S110C
+        """
+
+        res = "".join(["%i%s" % (len(list(run)), code) for code, run in itertools.groupby(codes)])
+        return res
+
+    @classmethod
+    def decode_concordance(cls, concordance_rle):
+        """Decodes run-length encoded concordance codes.
+
+        :param str concordance_rle: run-length encoded codes
+        :return str: one concordance code per fragment base, in R1 orientation
+        """
+
+        res = "".join([code * int(length) for length, code in cls.CONCORDANCE_RE.findall(concordance_rle)])
+        return res
+
+    def _find_overlap(self, r1_seq, r2_rc_seq):
+        r"""Finds the offset of the reverse-complemented R2 in R1 with the fewest mismatches.
+
+        :param numpy.ndarray r1_seq: R1 bases as uint8
+        :param numpy.ndarray r2_rc_seq: reverse-complemented R2 bases as uint8
+        :return int | None: 0-based start of the R2 in R1 coordinates, or None if no overlap passes the thresholds
+
+        All candidate offsets are compared at once. Ties favor the longer overlap.
+        """
+
+        r1_len = len(r1_seq)
+        r2_len = len(r2_rc_seq)
+        min_overlap = max(self.min_overlap, 1)
+
+        # Mates shorter than the min overlap, e.g. after trimming, cannot be merged
+        if min(r1_len, r2_len) < min_overlap:
+            return None
+
+        # The insert is at least as long as either mate, so R2 cannot start before len(R1) - len(R2)
+        offsets = np.arange(max(0, r1_len - r2_len), r1_len - min_overlap + 1)
+        overlap_lens = np.minimum(r1_len - offsets, r2_len)
+
+        # Compare R2 to an R1 window at each offset; the padding past the end of R1 is masked out
+        r1_padded = np.concatenate((r1_seq, np.zeros(r2_len, dtype=r1_seq.dtype)))
+        r1_windows = np.lib.stride_tricks.sliding_window_view(r1_padded, r2_len)[offsets]
+        in_overlap = np.arange(r2_len) < overlap_lens[:, np.newaxis]
+        n_mismatches = np.count_nonzero((r1_windows != r2_rc_seq) & in_overlap, axis=1)
+        mismatch_fracs = n_mismatches / overlap_lens
+
+        # argmin returns the first, longest, overlap among ties
+        best_index = int(np.argmin(mismatch_fracs))
+        if mismatch_fracs[best_index] > self.max_mismatch_frac:
+            return None
+
+        return int(offsets[best_index])
+
+    def merge_mates(self, r1_seq, r1_quals, r2_seq, r2_quals):
+        """Merges a read pair into a fragment if the mates overlap.
+
+        :param str r1_seq: R1 sequence
+        :param str r1_quals: R1 ASCII base qualities
+        :param str r2_seq: R2 sequence
+        :param str r2_quals: R2 ASCII base qualities
+        :return tuple | None: (sequence, ASCII qualities, encoded concordance) of the fragment, or None if not merged
+
+        Concordant bases get the lower of the two base qualities, so a min BQ filter requires both mates to pass it.
+        """
+
+        r1_bases = np.frombuffer(r1_seq.upper().encode(), dtype=np.uint8)
+        r2_rc_bases = np.frombuffer(su.reverse_complement(r2_seq.upper()).encode(), dtype=np.uint8)
+
+        offset = self._find_overlap(r1_bases, r2_rc_bases)
+        if offset is None:
+            return None
+
+        r1_bqs = np.frombuffer(r1_quals.encode(), dtype=np.uint8)
+        r2_rc_bqs = np.frombuffer(r2_quals[::-1].encode(), dtype=np.uint8)
+
+        r1_len = len(r1_bases)
+        frag_len = max(r1_len, offset + len(r2_rc_bases))
+        overlap_stop = min(r1_len, offset + len(r2_rc_bases))
+
+        frag_bases = np.zeros(frag_len, dtype=np.uint8)
+        frag_bqs = np.zeros(frag_len, dtype=np.uint8)
+        frag_bases[:r1_len] = r1_bases
+        frag_bqs[:r1_len] = r1_bqs
+        frag_bases[r1_len:] = r2_rc_bases[r1_len - offset:]
+        frag_bqs[r1_len:] = r2_rc_bqs[r1_len - offset:]
+
+        ov_r1_bases = r1_bases[offset:overlap_stop]
+        ov_r2_bases = r2_rc_bases[:overlap_stop - offset]
+        ov_r1_bqs = r1_bqs[offset:overlap_stop]
+        ov_r2_bqs = r2_rc_bqs[:overlap_stop - offset]
+        concordant = ov_r1_bases == ov_r2_bases
+
+        # Discordant bases take the call of the higher quality mate; they are never called as variants
+        use_r2 = ~concordant & (ov_r2_bqs > ov_r1_bqs)
+        frag_bases[offset:overlap_stop] = np.where(use_r2, ov_r2_bases, ov_r1_bases)
+        frag_bqs[offset:overlap_stop] = np.where(
+            concordant, np.minimum(ov_r1_bqs, ov_r2_bqs), np.maximum(ov_r1_bqs, ov_r2_bqs))
+
+        codes = [self.SINGLE_MATE] * frag_len
+        codes[offset:overlap_stop] = [self.CONCORDANT if c else self.DISCORDANT for c in concordant]
+
+        res = (frag_bases.tobytes().decode(), frag_bqs.tobytes().decode(), self.encode_concordance(codes))
+        return res
+
+    def workflow(self):
+        """Runs the mate merging workflow."""
+
+        logger.info("Started mate merging workflow.")
+
+        with pysam.FastxFile(self.f1) as r1_ff, \
+                pysam.FastxFile(self.f2) as r2_ff, \
+                open(self.merged_fastq, "w") as merged_fh, \
+                open(self.unmerged_f1, "w") as r1_out, \
+                open(self.unmerged_f2, "w") as r2_out:
+
+            for r1, r2 in zip(r1_ff, r2_ff):
+
+                merge_res = self.merge_mates(r1.sequence, r1.quality, r2.sequence, r2.quality)
+
+                if merge_res is None:
+                    r1_out.write(str(r1) + fu.FILE_NEWLINE)
+                    r2_out.write(str(r2) + fu.FILE_NEWLINE)
+                    self.n_unmerged += 1
+                    continue
+
+                frag_seq, frag_quals, concordance_rle = merge_res
+
+                # The comment is appended to the alignment as a tag by bowtie2 --sam-append-comment
+                merged_fh.write(fu.FILE_NEWLINE.join((
+                    "%s%s %s:Z:%s" % (su.FASTQ_QNAME_CHAR, r1.name, self.CONCORDANCE_TAG, concordance_rle),
+                    frag_seq, su.FASTQ_SPACER_CHAR, frag_quals)) + fu.FILE_NEWLINE)
+                self.n_merged += 1
+
+        logger.info("Merged %i read pairs; %i were not merged." % (self.n_merged, self.n_unmerged))
+        logger.info("Completed mate merging workflow.")
+
+
+class DuplicateCollapser(object):
+    """Class for collapsing exact-duplicate read pairs into representatives prior to alignment."""
+
+    DEFAULT_OUTDIR = "."
+    COLLAPSED_SUFFIX = "collapsed.fq"
+    MULTIPLICITY_SUFFIX = "multiplicity.txt"
+    COPY_QUALS_SUFFIX = "copy_quals.txt"
+    QUAL_COLLAPSE_MAX = "max"
+    QUAL_COLLAPSE_MEAN = "mean"
+    VALID_QUAL_COLLAPSE = {QUAL_COLLAPSE_MAX, QUAL_COLLAPSE_MEAN}
+    DEFAULT_QUAL_COLLAPSE = QUAL_COLLAPSE_MEAN
+    DEFAULT_USE_UMI = False
+    DEFAULT_COPY_QUALS = False
+    MULTIPLICITY_HEADER = ("qname", "multiplicity")
+    COPY_QUALS_HEADER = ("qname", "copy_qname", "r1_quals", "r2_quals")
+    PAIR_KEY_SIZE = 16
+    KEY_FIELD_DELIM = "\0"
+
+    def __init__(self, f1, f2, outdir=DEFAULT_OUTDIR, qual_collapse=DEFAULT_QUAL_COLLAPSE, use_umi=DEFAULT_USE_UMI,
+                 copy_quals=DEFAULT_COPY_QUALS, umi_tag=None):
+        r"""Constructor for DuplicateCollapser.
+
+        :param str f1: path of the R1 FASTQ
+        :param str f2: path of the R2 FASTQ
+        :param str outdir: Output directory to write collapsed FASTQs and side tables to
+        :param str qual_collapse: how to collapse the base qualities of duplicates, one of {max, mean}. Default mean.
+        :param bool use_umi: include the UMI appended to the read name by umi_tools in the duplicate key? \
+        Default False.
+        :param bool copy_quals: write the base qualities of every copy to a side table? Default False.
+        :param str | None umi_tag: if use_umi, read the UMI from this tag in the read comment instead of the read \
+        name, e.g. for names encoded by QnameEncoder. Default None.
+        :raises NotImplementedError: if qual_collapse is not one of max, mean
+
+        Only one representative of each unique (R1 sequence, R2 sequence[, UMI]) is written. Multiplicities of \
+        representatives with duplicates are written to a side table for weighting during variant calling. Only a \
+        digest and count of each unique pair, and the quality aggregates of duplicated pairs, are held in memory.
+        """
+
+        if qual_collapse not in self.VALID_QUAL_COLLAPSE:
+            raise NotImplementedError("qual_collapse must be one of {%s}." % ",".join(sorted(self.VALID_QUAL_COLLAPSE)))
+
+        self.f1 = f1
+        self.f2 = f2
+        self.outdir = outdir
+        self.qual_collapse = qual_collapse
+        self.use_umi = use_umi
+        self.copy_quals = copy_quals
+        self.umi_tag = umi_tag
+
+        if not os.path.exists(outdir):
+            os.mkdir(outdir)
+
+        self.collapsed_f1 = os.path.join(outdir, fu.replace_extension(os.path.basename(f1), self.COLLAPSED_SUFFIX))
+        self.collapsed_f2 = os.path.join(outdir, fu.replace_extension(os.path.basename(f2), self.COLLAPSED_SUFFIX))
+
+        prefix = os.path.basename(os.path.commonprefix((f1, f2,)))
+        self.multiplicity_table = os.path.join(outdir, fu.replace_extension(prefix, self.MULTIPLICITY_SUFFIX))
+        self.copy_quals_table = os.path.join(outdir, fu.replace_extension(prefix, self.COPY_QUALS_SUFFIX)) \
+            if copy_quals else None
+
+        self.n_input = 0
+        self.n_unique = 0
+
+        self.workflow()
+
+    def _get_key(self, r1, r2):
+        """Gets the duplicate key of a read pair.
+
+        :param pysam.FastxRecord r1: R1 record
+        :param pysam.FastxRecord r2: R2 record
+        :return bytes: digest shared by exact duplicates
+        """
+
+        umi = ""
+        if self.use_umi:
+            umi = r1.name.split(UMI_SEP)[-1] if self.umi_tag is None else \
+                QnameEncoder.get_comment_tag(r1.comment, self.umi_tag)
+
+        key_hash = hashlib.blake2b(digest_size=self.PAIR_KEY_SIZE)
+        key_hash.update(self.KEY_FIELD_DELIM.join((r1.sequence, r2.sequence, str(umi))).encode())
+        return key_hash.digest()
+
+    def _collapse_quals(self, qual_agg, count):
+        """Collapses the aggregated base qualities of a representative into an ASCII quality string.
+
+        :param numpy.ndarray qual_agg: elementwise sum or max of the ASCII-encoded qualities of all copies
+        :param int count: number of copies
+        :return str: collapsed ASCII qualities
+        """
+
+        if self.qual_collapse == self.QUAL_COLLAPSE_MEAN:
+            qual_agg = np.rint(qual_agg / count)
+
+        res = qual_agg.astype(np.uint8).tobytes().decode()
+        return res
+
+    @classmethod
+    def load_multiplicities(cls, multiplicity_table):
+        """Loads the multiplicities of representatives that had duplicates.
+
+        :param str multiplicity_table: side table written by DuplicateCollapser
+        :return dict: {qname: multiplicity}
+        """
+
+        with open(multiplicity_table, "r") as in_fh:
+            _ = in_fh.readline()
+            res = {}
+            for line in in_fh:
+                qname, multiplicity = line.rstrip(fu.FILE_NEWLINE).split(fu.FILE_DELIM)
+                res[qname] = int(multiplicity)
+
+        return res
+
+    def _iterate_pairs(self):
+        """Iterates over the input read pairs.
+
+        :return generator: (R1, R2) tuples of pysam.FastxRecord
+        """
+
+        with pysam.FastxFile(self.f1) as r1_ff, pysam.FastxFile(self.f2) as r2_ff:
+            yield from zip(r1_ff, r2_ff)
+
+    @staticmethod
+    def _write_record(out_fh, record):
+        """Writes a FASTQ record to a file opened in binary mode.
+
+        :param file out_fh: output FASTQ
+        :param pysam.FastxRecord record: FASTQ record
+        :return int: offset of the base qualities in the file
+        """
+
+        record_bytes = (str(record) + fu.FILE_NEWLINE).encode()
+        qual_offset = out_fh.tell() + len(record_bytes) - len(record.quality) - len(fu.FILE_NEWLINE)
+        out_fh.write(record_bytes)
+        return qual_offset
+
+    def workflow(self):
+        """Runs the duplicate collapsing workflow."""
+
+        logger.info("Started duplicate collapsing workflow.")
+
+        # The first pass only counts the copies of each pair, by digest
+        counts = collections.Counter(self._get_key(r1, r2) for r1, r2 in self._iterate_pairs())
+
+        # {key: [R1 quality offset, R2 quality offset, count, R1 quality aggregate, R2 quality aggregate, name]}
+        # for pairs with duplicates, in order of their representative
+        duplicates = {}
+        agg_func = np.add if self.qual_collapse == self.QUAL_COLLAPSE_MEAN else np.maximum
+
+        copy_fh = open(self.copy_quals_table, "w") if self.copy_quals else None
+        if copy_fh is not None:
+            copy_fh.write(fu.FILE_DELIM.join(self.COPY_QUALS_HEADER) + fu.FILE_NEWLINE)
+
+        try:
+            # Representatives are written at their first copy; the collapsed qualities are filled in afterwards
+            with open(self.collapsed_f1, "wb") as r1_out, open(self.collapsed_f2, "wb") as r2_out:
+
+                for r1, r2 in self._iterate_pairs():
+
+                    self.n_input += 1
+                    key = self._get_key(r1, r2)
+                    rep_name = r1.name
+
+                    if counts[key] == 1:
+                        self._write_record(r1_out, r1)
+                        self._write_record(r2_out, r2)
+
+                    else:
+                        r1_bqs = np.frombuffer(r1.quality.encode(), dtype=np.uint8).astype(np.uint32)
+                        r2_bqs = np.frombuffer(r2.quality.encode(), dtype=np.uint8).astype(np.uint32)
+
+                        if key not in duplicates:
+                            duplicates[key] = [self._write_record(r1_out, r1), self._write_record(r2_out, r2), 1,
+                                               r1_bqs, r2_bqs, rep_name]
+                        else:
+                            dup = duplicates[key]
+                            dup[2] += 1
+                            dup[3] = agg_func(dup[3], r1_bqs)
+                            dup[4] = agg_func(dup[4], r2_bqs)
+                            rep_name = dup[5]
+
+                    if copy_fh is not None:
+                        copy_fh.write(fu.FILE_DELIM.join(
+                            (rep_name, r1.name, r1.quality, r2.quality)) + fu.FILE_NEWLINE)
+        finally:
+            if copy_fh is not None:
+                copy_fh.close()
+
+        # Collapsed qualities have the length of the originals, so they are written in place
+        with open(self.collapsed_f1, "r+b") as r1_out, \
+                open(self.collapsed_f2, "r+b") as r2_out, \
+                open(self.multiplicity_table, "w") as mult_out:
+
+            # Singletons keep their original qualities and are implied to have a multiplicity of 1
+            mult_out.write(fu.FILE_DELIM.join(self.MULTIPLICITY_HEADER) + fu.FILE_NEWLINE)
+
+            for r1_offset, r2_offset, count, r1_agg, r2_agg, rep_name in duplicates.values():
+                for out_fh, offset, qual_agg in ((r1_out, r1_offset, r1_agg), (r2_out, r2_offset, r2_agg)):
+                    out_fh.seek(offset)
+                    out_fh.write(self._collapse_quals(qual_agg, count).encode())
+
+                mult_out.write(fu.FILE_DELIM.join((rep_name, str(count))) + fu.FILE_NEWLINE)
+
+        self.n_unique = len(counts)
+        logger.info("Collapsed %i read pairs into %i unique pairs." % (self.n_input, self.n_unique))
+        logger.info("Completed duplicate collapsing workflow.")
+
+
 class UMIExtractor(object):
     """Class for extracting UMIs from reads, and optionally appending primer tags for RACE-like (e.g. AMP) data."""
 
@@ -338,12 +766,7 @@ class UMIExtractor(object):
         :return dict: gsp2_name and sequence
         """
 
-        with pysam.FastxFile(self.primer_fasta) as primer_fa:
-            primer_dict = {rec.name: (
-                len(rec.sequence), str(rec.sequence).upper(),
-                regex.compile("(%s){e<=%i}" % (str(rec.sequence).upper(), self.primer_nm_allow))
-            ) for rec in primer_fa}
-
+        primer_dict = get_primer_patterns(self.primer_fasta, self.primer_nm_allow)
         return primer_dict
 
     def get_orig_r2_primer(self, r2_seq):
@@ -377,25 +800,22 @@ class UMIExtractor(object):
         :return tuple: output FASTQ filenames
         """
 
-        with pysam.FastxFile(self.r1_fastq) as r1_ff, \
-                pysam.FastxFile(self.r2_fastq) as r2_ff:
+        r1_out = tempfile.NamedTemporaryFile(suffix=self.R1_PRIMER_SUFFIX, delete=False).name
+        r2_out = tempfile.NamedTemporaryFile(suffix=self.R2_PRIMER_SUFFIX, delete=False).name
+        max_primer_len = max([primer_len for primer_len, _, _ in self.primer_patterns.values()])
 
-            zipped_reads = zip(r1_ff, r2_ff)
+        with fqu.FastqWriter(r1_out) as r1_writer, fqu.FastqWriter(r2_out) as r2_writer:
+            for r1_batch, r2_batch in fqu.iterate_paired_batches(self.r1_fastq, self.r2_fastq):
 
-            with tempfile.NamedTemporaryFile(suffix=self.R1_PRIMER_SUFFIX, mode="w", delete=False) as r1_out, \
-                    tempfile.NamedTemporaryFile(suffix=self.R2_PRIMER_SUFFIX, mode="w", delete=False) as r2_out:
+                # Only the start of R2 is matched to the primers
+                new_qnames = [r2_name + UMI_DELIM + self.get_orig_r2_primer(r2_prefix.upper()) for r2_name, r2_prefix
+                              in zip(r2_batch.get_names(), r2_batch.get_prefix_strings(max_primer_len))]
 
-                for r1, r2 in zipped_reads:
-                    primer_seq = self.get_orig_r2_primer(r2.sequence.upper())
-                    new_qname = r2.name + UMI_DELIM + primer_seq
+                # Paired FASTQs should always have the same names
+                r1_writer.write(r1_batch.with_names(new_qnames))
+                r2_writer.write(r2_batch.with_names(new_qnames))
 
-                    # Paired FASTQs should always have the same names
-                    r1.name = new_qname
-                    r2.name = new_qname
-                    r1_out.write(str(r1) + fu.FILE_NEWLINE)
-                    r2_out.write(str(r2) + fu.FILE_NEWLINE)
-
-                return r1_out.name, r2_out.name
+        return r1_out, r2_out
 
     def _umitools_extract(self, r1_fastq, r2_fastq):
         """Extracts the molecular barcode from R1 and appends to the qname.
@@ -434,6 +854,372 @@ class UMIExtractor(object):
         logger.info("Completed UMI extraction workflow.")
 
 
+class QnameEncoder(object):
+    """Class for replacing read names with compact integers, keeping the original names in a side table."""
+
+    DEFAULT_OUTDIR = "."
+    DEFAULT_NTHREADS = 0
+    ENCODED_FQ_SUFFIX = "qname.fq"
+    QNAME_TABLE_SUFFIX = "qnames.txt.gz"
+    QNAME_TABLE_HEADER = ("qname_id", "qname")
+    RESTORED_SUFFIX = "restored.bam"
+    UMI_TAG = "RX"
+    FIRST_ID = 1
+
+    def __init__(self, r1_fastq, r2_fastq, has_umi=False, outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS):
+        r"""Constructor for QnameEncoder.
+
+        :param str r1_fastq: R1 FASTQ
+        :param str r2_fastq: R2 FASTQ
+        :param bool has_umi: do the read names end with a UMI appended by UMIExtractor? Default False.
+        :param str outdir: Optional output directory. Default current working directory.
+        :param int nthreads: number of threads to compress the side table with. Default 0 (autodetect).
+
+        Read pairs are numbered from 1 in input order. The UMI is moved to the read comments as a SAM tag (RX) so that \
+        it may be appended to the alignments; any other comments are dropped. The original names, including any \
+        primer appended by UMIExtractor, are written to a gzipped side table for restore_qnames.
+        """
+
+        self.r1_fastq = r1_fastq
+        self.r2_fastq = r2_fastq
+        self.has_umi = has_umi
+        self.outdir = outdir
+        self.nthreads = nthreads
+
+        if not os.path.exists(outdir):
+            os.mkdir(outdir)
+
+        self.r1_out_fastq = os.path.join(
+            outdir, fu.replace_extension(os.path.basename(r1_fastq), self.ENCODED_FQ_SUFFIX))
+        self.r2_out_fastq = os.path.join(
+            outdir, fu.replace_extension(os.path.basename(r2_fastq), self.ENCODED_FQ_SUFFIX))
+
+        prefix = os.path.basename(os.path.commonprefix((r1_fastq, r2_fastq,)))
+        self.qname_table = os.path.join(outdir, fu.replace_extension(prefix, self.QNAME_TABLE_SUFFIX))
+        self.n_pairs = 0
+
+        self.workflow()
+
+    @staticmethod
+    def get_comment_tag(comment, tag):
+        """Gets the value of a SAM-formatted tag from a FASTQ comment.
+
+        :param str | None comment: read comment, e.g. RX:Z:ACGT
+        :param str tag: two-character tag
+        :return str | None: tag value, or None if the tag is absent
+        """
+
+        if comment is None:
+            return None
+
+        for field in comment.split(fu.FILE_SPACE):
+            if field.startswith(tag + ":"):
+                return field.split(":", 2)[-1]
+
+        return None
+
+    def _get_comment(self, qname):
+        """Gets the tags to carry in the comment of an encoded read.
+
+        :param str qname: original read name
+        :return str | None: SAM-formatted tags, or None if there are none
+        """
+
+        if not self.has_umi:
+            return None
+
+        res = "%s:Z:%s" % (self.UMI_TAG, qname.rsplit(UMI_SEP, 1)[-1])
+        return res
+
+    @classmethod
+    def load_qname_table(cls, qname_table):
+        """Loads the original read names.
+
+        :param str qname_table: side table written by QnameEncoder
+        :return list: original read names, indexed by read name ID minus FIRST_ID
+        """
+
+        with fu.open_gzip(qname_table, "rt") as in_fh:
+            next(in_fh)
+            res = [line.rstrip(fu.FILE_NEWLINE).split(fu.FILE_DELIM, 1)[1] for line in in_fh]
+
+        return res
+
+    @classmethod
+    def restore_qnames(cls, in_bam, qname_table, out_bam=None):
+        r"""Restores the original read names of an alignment file.
+
+        :param str in_bam: BAM with encoded read names
+        :param str qname_table: side table written by QnameEncoder
+        :param str | None out_bam: optional output BAM. Default None, replace the in_bam extension.
+        :return str: output BAM
+
+        Read names that are not encoded IDs, such as consensus read names, are kept.
+        """
+
+        out_name = out_bam if out_bam is not None else fu.replace_extension(in_bam, cls.RESTORED_SUFFIX)
+        qnames = cls.load_qname_table(qname_table)
+
+        with pysam.AlignmentFile(in_bam, "rb") as in_af, \
+                pysam.AlignmentFile(out_name, "wb", header=in_af.header) as out_af:
+
+            for align_seg in in_af.fetch(until_eof=True):
+                qname = align_seg.query_name
+                if qname.isdigit() and cls.FIRST_ID <= int(qname) < len(qnames) + cls.FIRST_ID:
+                    align_seg.query_name = qnames[int(qname) - cls.FIRST_ID]
+                out_af.write(align_seg)
+
+        return out_name
+
+    def workflow(self):
+        """Runs the read name encoding workflow."""
+
+        logger.info("Started read name encoding workflow.")
+
+        with fqu.FastqWriter(self.r1_out_fastq) as r1_writer, \
+                fqu.FastqWriter(self.r2_out_fastq) as r2_writer, \
+                fu.open_gzip(self.qname_table, "wt", self.nthreads) as table_out:
+
+            table_out.write(fu.FILE_DELIM.join(self.QNAME_TABLE_HEADER) + fu.FILE_NEWLINE)
+
+            for r1_batch, r2_batch in fqu.iterate_paired_batches(self.r1_fastq, self.r2_fastq):
+
+                # Paired FASTQs should always have the same names
+                qnames = r1_batch.get_names()
+                qname_ids = [str(qname_id) for qname_id in
+                             range(self.n_pairs + self.FIRST_ID, self.n_pairs + self.FIRST_ID + len(qnames))]
+
+                headers = []
+                for qname_id, qname in zip(qname_ids, qnames):
+                    comment = self._get_comment(qname)
+                    headers.append(qname_id if comment is None else fu.FILE_SPACE.join((qname_id, comment)))
+
+                table_out.write("".join([fu.FILE_DELIM.join((qname_id, qname)) + fu.FILE_NEWLINE
+                                         for qname_id, qname in zip(qname_ids, qnames)]))
+
+                r1_writer.write(r1_batch.with_headers(headers))
+                r2_writer.write(r2_batch.with_headers(headers))
+                self.n_pairs += len(qnames)
+
+        logger.info("Encoded the read names of %i read pairs." % self.n_pairs)
+        logger.info("Completed read name encoding workflow.")
+
+
+class TileDemultiplexer(object):
+    """Class for splitting read pairs into per-tile FASTQs based on their originating primer."""
+
+    DEFAULT_OUTDIR = "."
+    PRIMER_NM_ALLOW = UMIExtractor.PRIMER_NM_ALLOW
+    UNASSIGNED_TILE = "unassigned"
+    TILE_QNAME_DELIM = ":"
+
+    def __init__(self, r1_fastq, r2_fastq, primer_fasta, primer_nm_allow=PRIMER_NM_ALLOW, outdir=DEFAULT_OUTDIR):
+        """Constructor for TileDemultiplexer.
+
+        :param str r1_fastq: R1 FASTQ
+        :param str r2_fastq: R2 FASTQ
+        :param str primer_fasta: primer FASTA. Each primer name is used as a tile ID.
+        :param int primer_nm_allow: Edit distance allowance for primer matching. Default 3.
+        :param str outdir: Optional output directory. Default current working directory.
+        """
+
+        self.r1_fastq = r1_fastq
+        self.r2_fastq = r2_fastq
+        self.primer_fasta = primer_fasta
+        self.primer_nm_allow = primer_nm_allow
+        self.outdir = outdir
+
+        self.primer_patterns = get_primer_patterns(self.primer_fasta, self.primer_nm_allow)
+        self.primer_names = list(self.primer_patterns.keys())
+        self.max_primer_len = max([primer_len for primer_len, _, _ in self.primer_patterns.values()])
+        self.seed_len, self.primer_seeds, self.unseeded_primers = self._index_primer_seeds()
+
+        # {tile: (R1 FASTQ, R2 FASTQ)} for tiles with at least one read pair
+        self.tile_fastqs = collections.OrderedDict()
+        self.tile_counts = collections.Counter()
+
+        self.workflow()
+
+    def _index_primer_seeds(self):
+        r"""Indexes exact seeds of the primers so that each read is fuzzy-matched only to primers sharing a seed.
+
+        :return tuple: (seed length, {seed: [(primer index, primer length)]}, primer indices that are always \
+        candidates)
+
+        Each primer is split into primer_nm_allow + 1 blocks, and the start of each block is a seed. A match with at \
+        most primer_nm_allow edits leaves at least one block intact, so no match is lost by the narrowing.
+        """
+
+        n_blocks = self.primer_nm_allow + 1
+        block_lens = [primer_len // n_blocks for primer_len, _, _ in self.primer_patterns.values()]
+        seed_len = min(block_lens)
+
+        primer_seeds = collections.defaultdict(list)
+        unseeded_primers = []
+        for primer_index, ((primer_len, primer_seq, _), block_len) in enumerate(
+                zip(self.primer_patterns.values(), block_lens)):
+
+            # Primers too short to seed are matched against every read
+            if seed_len == 0:
+                unseeded_primers.append(primer_index)
+                continue
+
+            for seed_start in range(0, n_blocks * block_len, block_len):
+                primer_seeds[primer_seq[seed_start:seed_start + seed_len]].append((primer_index, primer_len))
+
+        return seed_len, primer_seeds, unseeded_primers
+
+    def _get_candidate_primers(self, read_prefix):
+        """Gets the primers that share a seed with the start of a read.
+
+        :param str read_prefix: uppercase start of the read, at least as long as the longest primer if possible
+        :return list: primer indices, in primer FASTA order
+        """
+
+        candidates = set(self.unseeded_primers)
+        for read_start in range(len(read_prefix) - self.seed_len + 1):
+            seed = read_prefix[read_start:read_start + self.seed_len]
+            for primer_index, primer_len in self.primer_seeds.get(seed, ()):
+                # Primers are only matched to the read bases they span
+                if read_start + self.seed_len <= primer_len:
+                    candidates.add(primer_index)
+
+        return sorted(candidates)
+
+    def get_tile(self, r1_seq, r2_seq):
+        """Gets the tile of a read pair by the primer found at the start of R2, or else R1.
+
+        :param str r1_seq: R1 sequence
+        :param str r2_seq: R2 sequence
+        :return str: name of the first matching primer, or the unassigned tile ID
+        """
+
+        for read_seq in (r2_seq, r1_seq):
+            read_prefix = read_seq[:self.max_primer_len].upper()
+
+            for primer_index in self._get_candidate_primers(read_prefix):
+                primer_name = self.primer_names[primer_index]
+                primer_len, _, primer_re = self.primer_patterns[primer_name]
+                if primer_re.search(read_prefix[:primer_len]):
+                    return primer_name
+
+        return self.UNASSIGNED_TILE
+
+    def _get_tile_fastqs(self, tile):
+        """Gets the per-tile FASTQ names.
+
+        :param str tile: tile ID
+        :return tuple: (R1 FASTQ, R2 FASTQ)
+        """
+
+        tile_id = tile.replace(os.sep, UMI_SEP)
+
+        r1_tile_fastq = os.path.join(self.outdir, fu.replace_extension(
+            os.path.basename(self.r1_fastq), fu.add_extension(tile_id, su.FASTQ_SUFFIX)))
+
+        r2_tile_fastq = os.path.join(self.outdir, fu.replace_extension(
+            os.path.basename(self.r2_fastq), fu.add_extension(tile_id, su.FASTQ_SUFFIX)))
+
+        return r1_tile_fastq, r2_tile_fastq
+
+    @classmethod
+    def merge_tile_bams(cls, tile_bams, output_bam, grouped=False):
+        """Merges per-tile alignments, prefixing read names with the tile ID so they remain unique across tiles.
+
+        :param collections.OrderedDict tile_bams: {tile: BAM} of alignments to the same reference
+        :param str output_bam: output BAM name
+        :param bool grouped: are the reads of each tile grouped by read name? Default False.
+        :return str: output BAM name
+
+        The merged BAM keeps the read order within and between tiles, and its header is marked unsorted.
+        """
+
+        headers = []
+        for tile_bam in tile_bams.values():
+            with pysam.AlignmentFile(tile_bam, "rb", check_sq=False) as tile_af:
+                headers.append(tile_af.header.to_dict())
+
+        # Keep the read groups of all tiles, as each tile was aligned separately
+        merged_header = headers[0]
+        read_groups = collections.OrderedDict()
+        for header in headers:
+            for rg in header.get(su.SAM_RG_TAG, []):
+                read_groups[rg[su.SAM_RG_ID_TAG]] = rg
+
+        if len(read_groups) > 0:
+            merged_header[su.SAM_RG_TAG] = list(read_groups.values())
+
+        # The concatenated tiles are not sorted as a whole, but mates remain adjacent if they were within each tile
+        hd = dict(merged_header.get(su.SAM_HD_TAG, {"VN": "1.0"}))
+        hd[su.SAM_HD_SO_TAG] = su.SAM_HD_SO_UNSORTED_VAL
+        hd.pop(SAM_HD_GO_TAG, None)
+        if grouped:
+            hd[SAM_HD_GO_TAG] = SAM_HD_GO_QUERY_VAL
+
+        merged_header[su.SAM_HD_TAG] = hd
+
+        with pysam.AlignmentFile(output_bam, "wb", header=merged_header) as out_af:
+            for tile, tile_bam in tile_bams.items():
+                with pysam.AlignmentFile(tile_bam, "rb", check_sq=False) as tile_af:
+                    for align_seg in tile_af.fetch(until_eof=True):
+                        align_seg.query_name = cls.TILE_QNAME_DELIM.join((tile, align_seg.query_name))
+                        out_af.write(align_seg)
+
+        return output_bam
+
+    @classmethod
+    def merge_tile_multiplicities(cls, tile_tables, output_table):
+        """Merges per-tile duplicate multiplicity tables, prefixing read names as in merge_tile_bams.
+
+        :param collections.OrderedDict tile_tables: {tile: multiplicity table} written by DuplicateCollapser
+        :param str output_table: output table name
+        :return str: output table name
+        """
+
+        with open(output_table, "w") as out_fh:
+            out_fh.write(fu.FILE_DELIM.join(DuplicateCollapser.MULTIPLICITY_HEADER) + fu.FILE_NEWLINE)
+
+            for tile, tile_table in tile_tables.items():
+                with open(tile_table, "r") as in_fh:
+                    _ = in_fh.readline()
+                    for line in in_fh:
+                        out_fh.write(cls.TILE_QNAME_DELIM.join((tile, line)))
+
+        return output_table
+
+    def workflow(self):
+        """Runs the tile demultiplexing workflow."""
+
+        logger.info("Started tile demultiplexing workflow.")
+
+        tile_fhs = {}
+
+        try:
+            with pysam.FastxFile(self.r1_fastq) as r1_ff, \
+                    pysam.FastxFile(self.r2_fastq) as r2_ff:
+
+                for r1, r2 in zip(r1_ff, r2_ff):
+                    tile = self.get_tile(r1.sequence, r2.sequence)
+
+                    if tile not in tile_fhs:
+                        self.tile_fastqs[tile] = self._get_tile_fastqs(tile)
+                        tile_fhs[tile] = tuple(open(tile_fastq, "w") for tile_fastq in self.tile_fastqs[tile])
+
+                    r1_out, r2_out = tile_fhs[tile]
+                    r1_out.write(str(r1) + fu.FILE_NEWLINE)
+                    r2_out.write(str(r2) + fu.FILE_NEWLINE)
+                    self.tile_counts[tile] += 1
+        finally:
+            for fhs in tile_fhs.values():
+                for fh in fhs:
+                    fh.close()
+
+        for tile, count in self.tile_counts.items():
+            logger.info("Assigned %i read pairs to tile %s." % (count, tile))
+
+        logger.info("Completed tile demultiplexing workflow.")
+
+
 class ReadGrouper(object):
     """Class for grouping UMIs in a BAM by addition of alignment tags."""
 
@@ -443,15 +1229,17 @@ class ReadGrouper(object):
     STDERR_SUFFIX = "umitools_group.stderr"
     UMI_NM_ALLOW = 1
 
-    def __init__(self, in_bam, outdir=DEFAULT_OUTDIR):
+    def __init__(self, in_bam, outdir=DEFAULT_OUTDIR, umi_tag=None):
         """Constructor for ReadGrouper.
 
         :param str in_bam: input BAM with extracted UMIs
         :param str outdir: Optional output directory. Default current working directory.
+        :param str | None umi_tag: optional tag holding the UMI, if it is not appended to the read name. Default None.
         """
 
         self.in_bam = in_bam
         self.outdir = outdir
+        self.umi_tag = umi_tag
         self.group_bam = os.path.join(outdir, fu.replace_extension(os.path.basename(in_bam), self.GROUP_BAM_SUFFIX))
         self.stderr = os.path.join(outdir, fu.replace_extension(os.path.basename(in_bam), self.STDERR_SUFFIX))
         self._workflow()
@@ -463,9 +1251,8 @@ class ReadGrouper(object):
         # No option to set tag containing group ID
         group_call = ("umi_tools", "group", "-I", self.in_bam, "--paired", "--no-sort-output",
                       "--output-bam", "-S", self.group_bam,
-                      "--edit-distance-threshold=%i" % self.UMI_NM_ALLOW,
-                      "--umi-separator=%s" % UMI_SEP, "--ignore-tlen",
-                      "--unpaired-reads=discard", "--unmapped-reads=discard",
+                      "--edit-distance-threshold=%i" % self.UMI_NM_ALLOW) + get_umi_args(self.umi_tag) + \
+                     ("--ignore-tlen", "--unpaired-reads=discard", "--unmapped-reads=discard",
                       "--multimapping-detection-method", su.SAM_MULTIMAP_TAG,
                       "-E", self.stderr, "--log2stderr",
                       "--temp-dir=%s" % DEFAULT_TEMPDIR)
@@ -488,16 +1275,18 @@ class ReadDeduplicator(object):
     DEDUP_BAM_SUFFIX = "dedup.bam"
     DEDUP_STDERR_SUFFIX = "umitools_dedup.stderr"
 
-    def __init__(self, group_bam, outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS):
+    def __init__(self, group_bam, outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS, umi_tag=None):
         """Constructor for ReadDeduplicator.
 
         :param str group_bam: grouped input BAM
         :param str ref: reference FASTA
         :param str outdir: Optional output directory. Default current working directory.
         :param int nthreads: number threads for sort operations
+        :param str | None umi_tag: optional tag holding the UMI, if it is not appended to the read name. Default None.
         """
 
         self.group_bam = group_bam
+        self.umi_tag = umi_tag
         self.outdir = outdir
         self.nthreads = nthreads
         self.dedup_stderr = os.path.join(outdir, fu.add_extension(self.group_bam, self.DEDUP_STDERR_SUFFIX))
@@ -516,10 +1305,11 @@ class ReadDeduplicator(object):
         with tempfile.NamedTemporaryFile(suffix=".dedup.bam", delete=False) as dedup_temp:
 
             dedup_call = ["umi_tools", "dedup", "-I", self.group_bam, "--paired", "-S", dedup_temp.name,
-                          "--edit-distance-threshold=%i" % ReadGrouper.UMI_NM_ALLOW, "--umi-separator=%s" % UMI_SEP,
-                          "--unpaired-reads=discard", "--unmapped-reads=discard", "-E", self.dedup_stderr,
-                          "--output-stats=%s" % self.dedup_bam, "--log2stderr",
-                          "--temp-dir=%s" % DEFAULT_TEMPDIR]
+                          "--edit-distance-threshold=%i" % ReadGrouper.UMI_NM_ALLOW]
+            dedup_call.extend(get_umi_args(self.umi_tag))
+            dedup_call.extend(["--unpaired-reads=discard", "--unmapped-reads=discard", "-E", self.dedup_stderr,
+                               "--output-stats=%s" % self.dedup_bam, "--log2stderr",
+                               "--temp-dir=%s" % DEFAULT_TEMPDIR])
 
             subprocess.call(dedup_call)
 
@@ -548,65 +1338,103 @@ class ConsensusDeduplicatorPreprocessor(object):
     DEFAULT_OUTDIR = "."
     DEFAULT_NTHREADS = 0
     PREPROC_BAM_SUFFIX = "preprocess.bam"
+    IN_MEMORY_MAX_SIZE = 10000000  # grouped BAMs at or below this size (bytes) are tag-sorted in memory
+    EXCLUDE_FLAGS = su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP + su.SAM_FLAG_SECONDARY + su.SAM_FLAG_SUPPL
 
-    def __init__(self, group_bam, group_tag=UMITOOLS_UG_TAG, outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS):
-        """Constructor for ConsensusDeduplicatorPreprocessor.
+    def __init__(self, group_bam, group_tag=UMITOOLS_UG_TAG, outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS,
+                 in_memory_max_size=IN_MEMORY_MAX_SIZE, io_policy=None):
+        r"""Constructor for ConsensusDeduplicatorPreprocessor.
 
         :param str group_bam: grouped input BAM
         :param str group_tag: BAM tag to store the group ID
         :param str outdir: Optional output directory. Default current working directory.
         :param int nthreads: number threads for sort operations
+        :param int in_memory_max_size: max size in bytes of group_bam for sorting by group tag in memory. Larger \
+        inputs are streamed into samtools sort.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of \
+        the tag-sorted BAM
         """
 
         self.group_bam = group_bam
         self.group_tag = group_tag
         self.outdir = outdir
         self.nthreads = nthreads
+        self.in_memory_max_size = in_memory_max_size
+        self.io_policy = io_policy
         self.preprocess_bam = os.path.join(outdir, fu.add_extension(self.group_bam, self.PREPROC_BAM_SUFFIX))
         self._workflow()
 
-    # The following class methods are exposed for convenience, in case the user wants any intermediate files
     @classmethod
-    def update_tags(cls, qname_sorted, group_tag=UMITOOLS_UG_TAG, nthreads=DEFAULT_NTHREADS):
-        """Updates R2 tags to contain the unique UMI group/network ID.
+    def propagate_tags(cls, in_af, group_tag=UMITOOLS_UG_TAG):
+        """Generates reads with the R1 group ID propagated to R2, in a single pass over an alignment file.
 
-        :param str qname_sorted: filepath of a qname-sorted BAM
-        :param str group_tag: BAM tag for the group ID. Default MI.
-        :param int nthreads: number of threads to use for sorting operations
-        :return str: name of an output BAM
+        :param pysam.AlignmentFile in_af: alignments in any order, with the group tag set for R1s
+        :param str group_tag: BAM tag for the group ID. Default UG.
+        :return generator: pysam.AlignedSegment objects with the mate appended to the group tag
 
-        This method is needed because umi_tools group command outputs UMI ID tags to the R1s only.
+        Mates are matched with a buffer keyed by qname. R1s are yielded as soon as they are seen and only their group \
+        ID is kept, so the buffer holds full records only for R2s that precede their R1.
         """
 
-        r1_bam = su.sam_view(am=qname_sorted, nthreads=nthreads,
-                             f=su.SAM_FLAG_R1, F=su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP)
+        r1_tags = {}
+        r2_buffer = {}
 
-        r2_bam = su.sam_view(am=qname_sorted, nthreads=nthreads,
-                             f=su.SAM_FLAG_R2, F=su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP)
+        for align_seg in in_af.fetch(until_eof=True):
 
-        # Iterate over the pairs, add the UG tags, then write out to a BAM to be sorted
-        with tempfile.NamedTemporaryFile("wb", suffix=".tag.bam", delete=False) as tag_bam, \
-                pysam.AlignmentFile(r1_bam, "rb") as af1, \
-                pysam.AlignmentFile(r2_bam, "rb") as af2, \
-                pysam.AlignmentFile(tag_bam, "wb", header=af1.header) as tag_af:
+            if align_seg.flag & cls.EXCLUDE_FLAGS:
+                continue
+
+            qname = align_seg.query_name
 
-            for r1, r2 in zip(af1.fetch(until_eof=True), af2.fetch(until_eof=True)):
+            if align_seg.is_read1:
 
-                r1_tag = r1.get_tag(group_tag)
+                r1_tag = align_seg.get_tag(group_tag)
 
                 # Need to append the mate so the mates sort together with use of samtools sort -t
-                r1_tag_final = "{}_{}".format(r1_tag, su.ReadMate.R1.value)
-                r2_tag_final = "{}_{}".format(r1_tag, su.ReadMate.R2.value)
+                align_seg.set_tag(group_tag, "{}_{}".format(r1_tag, su.ReadMate.R1.value))
+                yield align_seg
+
+                r2 = r2_buffer.pop(qname, None)
+                if r2 is None:
+                    r1_tags[qname] = r1_tag
+                else:
+                    r2.set_tag(group_tag, "{}_{}".format(r1_tag, su.ReadMate.R2.value))
+                    yield r2
+
+            else:
+
+                r1_tag = r1_tags.pop(qname, None)
+                if r1_tag is None:
+                    r2_buffer[qname] = align_seg
+                else:
+                    align_seg.set_tag(group_tag, "{}_{}".format(r1_tag, su.ReadMate.R2.value))
+                    yield align_seg
+
+        if len(r2_buffer) > 0:
+            logger.warning("%i R2s without a grouped R1 were dropped." % len(r2_buffer))
+
+    # The following class methods are exposed for convenience, in case the user wants any intermediate files
+    @classmethod
+    def update_tags(cls, qname_sorted, group_tag=UMITOOLS_UG_TAG, nthreads=DEFAULT_NTHREADS):
+        """Updates R2 tags to contain the unique UMI group/network ID.
+
+        :param str qname_sorted: filepath of a BAM; need not be qname-sorted
+        :param str group_tag: BAM tag for the group ID. Default MI.
+        :param int nthreads: number of threads to compress the output BAM with. Default 0 (autodetect).
+        :return str: name of an output BAM
 
-                r1.set_tag(group_tag, r1_tag_final)
-                r2.set_tag(group_tag, r2_tag_final)
+        This method is needed because umi_tools group command outputs UMI ID tags to the R1s only.
+        """
+
+        with tempfile.NamedTemporaryFile("wb", suffix=".tag.bam", delete=False) as tag_bam, \
+                pysam.AlignmentFile(qname_sorted, "rb") as in_af, \
+                pysam.AlignmentFile(tag_bam, "wb", header=in_af.header, threads=fu.get_nthreads(nthreads)) as tag_af:
 
-                tag_af.write(r1)
-                tag_af.write(r2)
+            for align_seg in cls.propagate_tags(in_af, group_tag):
+                tag_af.write(align_seg)
 
             tag_bam_name = tag_bam.name
 
-        fu.safe_remove((r1_bam, r2_bam,))
         return tag_bam_name
 
     @classmethod
@@ -619,7 +1447,7 @@ class ConsensusDeduplicatorPreprocessor(object):
         :return str: temp output BAM
         """
 
-        logger.info("Sorting by read name and splitting into R1s and R2s.")
+        logger.info("Sorting by read name.")
         qname_sorted = su.sort_bam(bam=in_bam, by_qname=True, nthreads=nthreads)
 
         logger.info("Updating group ID tags.")
@@ -628,6 +1456,56 @@ class ConsensusDeduplicatorPreprocessor(object):
         fu.safe_remove((qname_sorted,))
         return updated_bam
 
+    def _sort_by_tag_in_memory(self):
+        """Propagates group tags and sorts by group tag in memory."""
+
+        groups = collections.defaultdict(list)
+
+        with pysam.AlignmentFile(self.group_bam, "rb") as in_af:
+            header = in_af.header.to_dict()
+            for align_seg in self.propagate_tags(in_af, self.group_tag):
+                groups[align_seg.get_tag(self.group_tag)].append(align_seg)
+
+        # Mimic samtools sort -t: order by tag value, then by position
+        with iop.open_bam(self.preprocess_bam, self.io_policy, header=header) as out_af:
+            for group_id in sorted(groups.keys()):
+                for align_seg in sorted(groups[group_id], key=lambda x: (x.reference_id, x.reference_start)):
+                    out_af.write(align_seg)
+
+    def _sort_by_tag_external(self):
+        """Propagates group tags and streams the records into samtools sort by group tag.
+
+        :raises RuntimeError: if samtools sort fails
+        """
+
+        sort_call = ["samtools", "sort", "-t", self.group_tag, "-o", self.preprocess_bam, "-O", "BAM",
+                     "-@", str(self.nthreads)]
+
+        compresslevel = iop.get_compresslevel(self.io_policy)
+        if compresslevel is not None:
+            sort_call += ["-l", str(compresslevel)]
+
+        sort_p = subprocess.Popen(sort_call + ["-"], stdin=subprocess.PIPE)
+
+        try:
+            # Compression is skipped as the records are immediately consumed by the sort
+            with pysam.AlignmentFile(self.group_bam, "rb") as in_af, \
+                    pysam.AlignmentFile(sort_p.stdin, "wbu", header=in_af.header) as tag_af:
+
+                for align_seg in self.propagate_tags(in_af, self.group_tag):
+                    tag_af.write(align_seg)
+
+        except BrokenPipeError:
+            # samtools exited early; its return code reports the failure
+            logger.error("samtools sort stopped reading the tagged records.")
+
+        finally:
+            sort_p.stdin.close()
+
+        if sort_p.wait() != 0:
+            raise RuntimeError("samtools sort by tag %s failed with return code %i." %
+                               (self.group_tag, sort_p.returncode))
+
     def _workflow(self):
         """Runs the preprocessing workflow for consensus deduplication.
 
@@ -636,17 +1514,13 @@ class ConsensusDeduplicatorPreprocessor(object):
 
         logger.info("Started preprocessing workflow for consensus deduplication.")
 
-        logger.info("Sorting by read name.")
-        qname_sorted = su.sort_bam(bam=self.group_bam, by_qname=True, nthreads=self.nthreads)
-
-        logger.info("Updating group ID tags for R2s.")
-        updated_bam = self.update_tags(qname_sorted, self.group_tag, self.nthreads)
-
-        logger.info("Sorting in preparation for consensus generation.")
         # Sort by the group ID tag (the mate was added to the group tag so no need for -n)
-        su.sort_bam(bam=updated_bam, output_am=self.preprocess_bam, nthreads=self.nthreads, t=self.group_tag)
+        logger.info("Updating group ID tags for R2s and sorting in preparation for consensus generation.")
 
-        fu.safe_remove((qname_sorted, updated_bam,))
+        if os.path.getsize(self.group_bam) <= self.in_memory_max_size:
+            self._sort_by_tag_in_memory()
+        else:
+            self._sort_by_tag_external()
 
         logger.info("Completed preprocessing workflow for consensus deduplication.")
 
@@ -662,18 +1536,33 @@ class ConsensusDeduplicator(object):
     DEFAULT_MAPQ = 40
     N_DUPLICATES_TAG = "ND"
     CONTIG_DEL_THRESH = 10  # candidate dels must be less than or equal to this value
+    DEFAULT_REALIGN = False
+    MAX_DUPLICATES = None  # optional max reads per mate/strand of a UMI group used for consensus generation
+    DEFAULT_SEED = 9
 
     def __init__(self, in_bam, ref, group_tag=UMITOOLS_UG_TAG, outdir=DEFAULT_OUTDIR, out_bam=DEFAULT_BAM,
-                 nthreads=DEFAULT_NTHREADS, contig_del_thresh=CONTIG_DEL_THRESH):
+                 nthreads=DEFAULT_NTHREADS, contig_del_thresh=CONTIG_DEL_THRESH, realign=DEFAULT_REALIGN,
+                 max_duplicates=MAX_DUPLICATES, random_seed=DEFAULT_SEED, sort_planner=None, io_policy=None):
         """Constructor for ConsensusDeduplicator.
 
         :param str in_bam: input alignments with UMI network/group ID in alignment tag
         :param str ref: reference FASTA
         :param str group_tag: BAM tag for the group ID. Default UG.
         :param str outdir: Optional output directory. Default current working directory.
-        :param str | None out_bam: Optional filepath of the output BAM.
+        :param str | None out_bam: Optional filepath of the output BAM. A .cram extension writes reference-compressed \
+        CRAM.
         :param int nthreads: number of threads to use for alignment
         :param int contig_del_thresh: max deletion length for which del/N gaps in the merged R2 contig are called
+        :param bool realign: should consensus reads be realigned with bowtie2? Default False, compute the CIGAR, MD, \
+        NM, and mate fields directly from the consensus positions.
+        :param int | None max_duplicates: reservoir sample at most this many reads per mate/strand of a UMI group, \
+        bounding the memory of jackpot groups. Default None, stream all reads into the consensus.
+        :param int random_seed: seed for reservoir sampling of large UMI groups
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner tracking intermediate orders. \
+        If provided, the consensus reads are written in their generated (name-grouped) order instead of coordinate \
+        sorted, and downstream stages sort only if they require it.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of \
+        the consensus BAM
 
         Note: a del/N gap refers to one of two cases:
         1) a true deletion in the alignment
@@ -686,6 +1575,15 @@ class ConsensusDeduplicator(object):
         self.outdir = outdir
         self.nthreads = nthreads
         self.contig_del_thresh = contig_del_thresh
+        self.realign = realign
+        self.max_duplicates = max_duplicates
+        self.random_seed = random_seed
+        self.sort_planner = sort_planner
+        self.io_policy = io_policy
+        self._ref_seqs = {}
+
+        # Private generator so sampling does not reseed or depend on the global random state
+        self.rng = random.Random(self.random_seed)
 
         outbam = out_bam
         if out_bam is None:
@@ -703,6 +1601,19 @@ class ConsensusDeduplicator(object):
         res = str(align_seg.get_tag(self.group_tag)).split("_")[0]
         return res
 
+    def _get_ref_seq(self, contig):
+        """Gets the reference sequence for a contig, caching it for subsequent lookups.
+
+        :param str contig: name of the reference contig
+        :return str: uppercase contig sequence
+        """
+
+        if contig not in self._ref_seqs:
+            with pysam.FastaFile(self.ref) as fasta:
+                self._ref_seqs[contig] = fasta.fetch(reference=contig).upper()
+
+        return self._ref_seqs[contig]
+
     @staticmethod
     def _base_from_index(array_index):
         """Returns the DNA base for the corresponding array index.
@@ -905,8 +1816,7 @@ class ConsensusDeduplicator(object):
                 opt_base_index = bases.tolist().index(2)
             else:
                 # Otherwise test if one of them matches the reference base and use it preferentially
-                ref_base = su.extract_seq(
-                    contig=consensus_key.ref, start=consensus_key.pos + 1, stop=consensus_key.pos + 1, ref=self.ref)
+                ref_base = self._get_ref_seq(consensus_key.ref)[consensus_key.pos]
 
                 opt_base_index = self._index_from_base(ref_base)
 
@@ -996,7 +1906,7 @@ class ConsensusDeduplicator(object):
         return ctuples
 
     def _construct_align_seg(self, read_umi_network, curr_mate_strand, start_pos,
-                             consensus_seq, consensus_quals, n_duplicates):
+                             consensus_seq, consensus_quals, n_duplicates, header=None):
         """Constructs a new read object for the consensus read.
 
         :param str read_umi_network: UMI network ID
@@ -1005,23 +1915,17 @@ class ConsensusDeduplicator(object):
         :param list consensus_seq: base calls for the consensus
         :param list consensus_quals: BQs for the consensus
         :param int n_duplicates: number of duplicates contributing to the consensus
+        :param pysam.AlignmentHeader | None header: header of the output file. If provided, the reference is set \
+        by name and MD and NM tags are computed against the reference.
         :return pysam.AlignedSegment: consensus read object
         """
 
-        # In future, instead of realigning:
-        # Use samtools fixmate to fix SAM flags and the tlen field
-        # Use samtools calmd to fix MD and NM tags, which are REQUIRED for variant calling
-
         qname, sam_flag = self._get_consensus_read_attrs(read_umi_network, curr_mate_strand)
 
-        new_align_seg = pysam.AlignedSegment()
+        new_align_seg = pysam.AlignedSegment(header)
         new_align_seg.query_name = qname
         new_align_seg.flag = sam_flag
 
-        # Unfortunately we need to construct a valid CIGAR
-        # cigartuples = self._construct_cigar(consensus_quals)
-        # new_align_seg.cigartuples = cigartuples
-
         # Convert missing bases in contig to N
         consensus_seq_update, consensus_quals_update = self._set_missing_bases(consensus_seq, consensus_quals)
 
@@ -1030,15 +1934,86 @@ class ConsensusDeduplicator(object):
         new_align_seg.query_sequence = "".join(consensus_seq_update)
         new_align_seg.query_qualities = [e for e in consensus_quals_update if e is not None]
 
-        # TODO: ensure this works with all references
-        new_align_seg.reference_id = 0
-        # new_align_seg.reference_name = curr_mate_strand.ref
+        # Every consensus base is placed at a known reference position, so matches and dels give a valid CIGAR
+        new_align_seg.cigartuples = self._construct_cigar(consensus_quals_update)
+
+        if header is None:
+            new_align_seg.reference_id = 0
+        else:
+            new_align_seg.reference_name = curr_mate_strand.ref
+
         new_align_seg.reference_start = start_pos
         new_align_seg.mapping_quality = self.DEFAULT_MAPQ
         new_align_seg.set_tag(self.N_DUPLICATES_TAG, n_duplicates)
 
+        if header is not None:
+            self._set_edit_tags(new_align_seg)
+
         return new_align_seg
 
+    def _set_edit_tags(self, align_seg):
+        """Sets the MD and NM tags of a consensus read against the reference.
+
+        :param pysam.AlignedSegment align_seg: consensus read object with a CIGAR of only match and del operations
+        """
+
+        ref_seq = self._get_ref_seq(align_seg.reference_name)
+        query_seq = align_seg.query_sequence
+        query_pos = 0
+        ref_pos = align_seg.reference_start
+
+        md_fields = []
+        match_len = 0
+        nm = 0
+
+        for cigar_op, op_len in align_seg.cigartuples:
+
+            if cigar_op == su.PYSAM_CIGARTUPLES_MATCH:
+                for ref_base, query_base in zip(ref_seq[ref_pos:ref_pos + op_len], query_seq[query_pos:query_pos + op_len]):
+                    if ref_base == query_base:
+                        match_len += 1
+                    else:
+                        md_fields.extend([str(match_len), ref_base])
+                        match_len = 0
+                        nm += 1
+
+                query_pos += op_len
+                ref_pos += op_len
+
+            elif cigar_op == su.PYSAM_CIGARTUPLES_DEL:
+                md_fields.extend([str(match_len), su.MD_DEL, ref_seq[ref_pos:ref_pos + op_len]])
+                match_len = 0
+                nm += op_len
+                ref_pos += op_len
+
+        md_fields.append(str(match_len))
+
+        align_seg.set_tag(su.SAM_MD_TAG, "".join(md_fields))
+        align_seg.set_tag(su.SAM_EDIT_DIST_TAG, nm)
+
+    @staticmethod
+    def _set_mate_info(consensus_reads):
+        """Sets the mate fields and template length for a pair of consensus reads.
+
+        :param list consensus_reads: consensus read objects for a UMI network
+        """
+
+        # Only R1-R2 pairs may be fixed; other combos (e.g. a lone mate) are left as constructed
+        if len(consensus_reads) != 2 or consensus_reads[0].is_read1 == consensus_reads[1].is_read1:
+            return
+
+        r1, r2 = consensus_reads
+        for align_seg, mate_seg in ((r1, r2), (r2, r1)):
+            align_seg.next_reference_id = mate_seg.reference_id
+            align_seg.next_reference_start = mate_seg.reference_start
+
+        tlen = max(r1.reference_end, r2.reference_end) - min(r1.reference_start, r2.reference_start)
+
+        # The leftmost mate gets the positive TLEN; for equal starts the forward mate is considered leftmost
+        leftmost = min(consensus_reads, key=lambda x: (x.reference_start, x.is_reverse))
+        for align_seg in consensus_reads:
+            align_seg.template_length = tlen if align_seg is leftmost else -tlen
+
     @staticmethod
     def _add_consensus_data(cbase, cbq, consensus_seq, consensus_quals):
         """Adds the consensus information unless at an insertion position.
@@ -1054,63 +2029,157 @@ class ConsensusDeduplicator(object):
         consensus_seq.append(cbase)
         consensus_quals.append(cbq)
 
-    def _write_consensus(self, out_af, consensus_dict, pos_list, read_umi_network):
+    def _write_consensus(self, out_af, consensus_dict, pos_list, read_umi_network, n_duplicates=None):
         """Generates a consensus for each [mate x strand x UMI x position] combo.
 
         :param pysam.AlignmentFile out_af: output file to write consensus reads on the fly
         :param collections.OrderedDict consensus_dict: ordered dict keeping aligned bases for each read-strand-position
         :param pos_list pos_list: read start positions
         :param str read_umi_network: UMI network ID
+        :param int | None n_duplicates: number of duplicates in the UMI network. Default None, use length of pos_list.
         """
 
-        last_mate_strand = list(consensus_dict.keys())[0]
-        last_mate_strand = MATE_STRAND_POS_TUPLE(mate=last_mate_strand.mate, strand=last_mate_strand.strand,
-                                                 pos=None, ref=last_mate_strand.ref)
+        # Collect the positions of each mate/strand; duplicates may start upstream of the first duplicate seen,
+        # so do not rely on the insertion order of the positions
+        mate_strand_positions = collections.OrderedDict()
+        for k in consensus_dict.keys():
+            mate_strand = MATE_STRAND_POS_TUPLE(mate=k.mate, strand=k.strand, pos=None, ref=k.ref)
+            mate_strand_positions.setdefault(mate_strand, []).append(k.pos)
+
+        if n_duplicates is None:
+            n_duplicates = len(pos_list)
+
+        consensus_reads = []
+
+        for mate_strand, positions in mate_strand_positions.items():
 
-        consensus_seq = []
-        consensus_quals = []
-        for k, v in consensus_dict.items():
-            curr_mate_strand = MATE_STRAND_POS_TUPLE(mate=k.mate, strand=k.strand, pos=None, ref=k.ref)
+            # The aligned start position of the consensus is the min start of all duplicates for the mate
+            # Positions not covered by any duplicate (e.g. between merged R2s) are treated as del/N gaps
+            start_pos = min(positions)
+            consensus_seq = []
+            consensus_quals = []
 
-            # Use this trick to determine when we have visited a new mate
-            # This logic assumes no input mates align to same strand (discordant pair)
-            if curr_mate_strand == last_mate_strand:
+            for pos in range(start_pos, max(positions) + 1):
+
+                k = MATE_STRAND_POS_TUPLE(mate=mate_strand.mate, strand=mate_strand.strand, pos=pos, ref=mate_strand.ref)
+                consensus_array = consensus_dict.get(k, np.zeros(shape=10, dtype=np.int32))
 
                 # Generate the consensus base for the position
-                consensus_base, consensus_bq = self._get_consensus(k, v)
+                consensus_base, consensus_bq = self._get_consensus(k, consensus_array)
 
                 # Add the data and deal with deletions
                 self._add_consensus_data(cbase=consensus_base, cbq=consensus_bq,
                                          consensus_seq=consensus_seq, consensus_quals=consensus_quals)
 
-            else:
-                # If we have started on a new mate/strand, write the results of the last mate-strand
-                # and reset the consensus seq; this is needed for R2s following R1s with shared network/group ID
-                # Our aligned start position of the consensus is the min start of all duplicates
-                mate_strand_pos = min(pos_list)
-                n_duplicates = len(pos_list)
+            # Generate a new read object for the mate/strand
+            new_align_seg = self._construct_align_seg(
+                read_umi_network, mate_strand, start_pos, consensus_seq, consensus_quals, n_duplicates,
+                header=out_af.header)
+
+            consensus_reads.append(new_align_seg)
+
+        self._set_mate_info(consensus_reads)
+
+        for new_align_seg in consensus_reads:
+            out_af.write(new_align_seg)
+
+    def _sample_read(self, align_seg, group_reads, group_counts):
+        """Adds a read to the reservoir of its mate/strand for the current UMI group.
+
+        :param pysam.AlignedSegment align_seg: read object
+        :param collections.OrderedDict group_reads: reservoir of reads for each mate/strand
+        :param collections.Counter group_counts: number of reads observed for each mate/strand
+        """
+
+        mate_strand = (su.ReadMate(align_seg.is_read1), su.Strand(align_seg.is_reverse))
+        group_counts[mate_strand] += 1
+        reservoir = group_reads.setdefault(mate_strand, [])
+
+        if self.max_duplicates is None or len(reservoir) < self.max_duplicates:
+            reservoir.append(align_seg)
+            return
+
+        # Standard reservoir sampling keeps each read with equal probability max_duplicates/count
+        replace_index = self.rng.randint(0, group_counts[mate_strand] - 1)
+        if replace_index < self.max_duplicates:
+            reservoir[replace_index] = align_seg
+
+    def _update_group_consensus(self, group_reads, consensus_dict, pos_list):
+        """Moves the held reads of a UMI group into the consensus dict.
+
+        :param collections.OrderedDict group_reads: held reads for each mate/strand
+        :param collections.OrderedDict consensus_dict: ordered dict keeping aligned bases for each read-strand-position
+        :param list pos_list: read start positions for duplicates
+        """
+
+        for reservoir in group_reads.values():
+            for align_seg in reservoir:
+                # Store the per-base information for each read in a dict
+                self._update_consensus_dict(align_seg, consensus_dict, pos_list)
+
+        group_reads.clear()
+
+    def _add_read(self, align_seg, group_reads, group_counts, consensus_dict, pos_list):
+        """Adds a read to the current UMI group.
+
+        :param pysam.AlignedSegment align_seg: read object
+        :param collections.OrderedDict group_reads: held reads for each mate/strand
+        :param collections.Counter group_counts: number of reads observed for each mate/strand
+        :param collections.OrderedDict consensus_dict: ordered dict keeping aligned bases for each read-strand-position
+        :param list pos_list: read start positions for duplicates
+
+        Without max_duplicates, reads are held only until a mate/strand is duplicated; the group is then streamed \
+        into the consensus dict. With max_duplicates, at most max_duplicates reads are held per mate/strand.
+        """
+
+        if self.max_duplicates is not None:
+            self._sample_read(align_seg, group_reads, group_counts)
+            return
+
+        mate_strand = (su.ReadMate(align_seg.is_read1), su.Strand(align_seg.is_reverse))
+        group_counts[mate_strand] += 1
+
+        # Hold the reads of a possible singleton so they can be passed through unchanged
+        if max(group_counts.values()) == 1:
+            group_reads[mate_strand] = [align_seg]
+            return
 
-                # Generate a new read object and write it
-                new_align_seg = self._construct_align_seg(
-                    read_umi_network, last_mate_strand, mate_strand_pos, consensus_seq, consensus_quals, n_duplicates)
+        self._update_group_consensus(group_reads, consensus_dict, pos_list)
+        self._update_consensus_dict(align_seg, consensus_dict, pos_list)
 
-                out_af.write(new_align_seg)
+    def _write_singleton(self, out_af, group_reads, read_umi_network):
+        """Writes the reads of a UMI group without duplicates, updating only the read name and tags.
 
-                # Reset the lists for the "next" UMI network (we are currently at it)
-                reset_base, reset_qual = self._get_consensus(k, v)
-                consensus_seq = [reset_base]
-                consensus_quals = [reset_qual]
+        :param pysam.AlignmentFile out_af: output file
+        :param collections.OrderedDict group_reads: reads for each mate/strand, one read each
+        :param str read_umi_network: UMI network ID
+        """
+
+        qname = str(read_umi_network.split("_")[0])
+
+        for (align_seg,) in group_reads.values():
+            align_seg.query_name = qname
+            align_seg.set_tag(self.N_DUPLICATES_TAG, 1)
+            out_af.write(align_seg)
 
-            last_mate_strand = curr_mate_strand
+    def _write_group(self, out_af, group_reads, group_counts, consensus_dict, pos_list, read_umi_network):
+        """Writes the consensus reads for a UMI group.
 
-        # Write the second mate/strand in the dict once we've completed the loop
-        mate_strand_pos = min(pos_list)
-        n_duplicates = len(pos_list)
+        :param pysam.AlignmentFile out_af: output file
+        :param collections.OrderedDict group_reads: held reads for each mate/strand
+        :param collections.Counter group_counts: number of reads observed for each mate/strand
+        :param collections.OrderedDict consensus_dict: ordered dict keeping aligned bases for each read-strand-position
+        :param list pos_list: read start positions for duplicates
+        :param str read_umi_network: UMI network ID
+        """
 
-        new_align_seg = self._construct_align_seg(
-            read_umi_network, last_mate_strand, mate_strand_pos, consensus_seq, consensus_quals, n_duplicates)
+        # Non-duplicated UMIs need no voting; pass the read(s) through
+        if all(v == 1 for v in group_counts.values()):
+            self._write_singleton(out_af, group_reads, read_umi_network)
+            return
 
-        out_af.write(new_align_seg)
+        self._update_group_consensus(group_reads, consensus_dict, pos_list)
+        self._write_consensus(out_af, consensus_dict, pos_list, read_umi_network, sum(group_counts.values()))
 
     def _generate_consensus_reads(self):
         """Generates consensus reads from a UMI group-tag-sorted BAM input.
@@ -1119,19 +2188,20 @@ class ConsensusDeduplicator(object):
         """
 
         with tempfile.NamedTemporaryFile("wb", suffix=".cdedup.bam", delete=False) as dedup_bam, \
-                pysam.AlignmentFile(self.in_bam, "rb") as in_af:
+                su.open_alignments(self.in_bam, self.ref) as in_af:
 
             # We are adding a tag so update the header
             af_header = in_af.header.to_dict()
             af_header[su.SAM_CO_HEADER] = "%s: Number PCR duplicates." % vu.VCF_ND_ID
             new_header = pysam.AlignmentHeader.from_dict(af_header)
 
-            with pysam.AlignmentFile(dedup_bam, "wb", header=new_header) as out_af:
+            with iop.open_bam(dedup_bam, self.io_policy, header=new_header) as out_af:
 
                 last_umi_network = "No_UMI"
 
-                # TODO: convert this to an array
-                # TODO: implement heuristic to avoid updating for non-duplicated UMIs
+                # Only singleton or sampled reads are held; duplicated groups are streamed into the consensus dict
+                group_reads = collections.OrderedDict()
+                group_counts = collections.Counter()
                 consensus_dict = collections.OrderedDict()
                 pos_list = []
 
@@ -1139,40 +2209,37 @@ class ConsensusDeduplicator(object):
 
                     read_umi_network = self._extract_umi_network(align_seg)
 
-                    if i == 0 or read_umi_network == last_umi_network:
-                        # Store the per-base information for each read in a dict
-                        self._update_consensus_dict(align_seg, consensus_dict, pos_list)
-                    else:
-                        # Generate the consensus for the last UMI network and write, then re-init dicts
-                        self._write_consensus(out_af, consensus_dict, pos_list, last_umi_network)
-
-                        # Regenerate the consensus dict and update with the current read
+                    if i != 0 and read_umi_network != last_umi_network:
+                        # Generate the consensus for the last UMI network and write, then re-init the group
+                        self._write_group(out_af, group_reads, group_counts, consensus_dict, pos_list,
+                                          last_umi_network)
+                        group_reads = collections.OrderedDict()
+                        group_counts = collections.Counter()
                         consensus_dict = collections.OrderedDict()
                         pos_list = []
-                        self._update_consensus_dict(align_seg, consensus_dict, pos_list)
 
+                    self._add_read(align_seg, group_reads, group_counts, consensus_dict, pos_list)
                     last_umi_network = read_umi_network
 
                 # Write the last consensus read
-                self._write_consensus(out_af, consensus_dict, pos_list, read_umi_network)
+                if len(group_counts) > 0:
+                    self._write_group(out_af, group_reads, group_counts, consensus_dict, pos_list, last_umi_network)
 
                 return dedup_bam.name
 
-    def _realign_consensus_reads(self, in_bam):
+    def _realign_consensus_reads(self, in_bam, out_bam):
         """Realigns the consensus reads to re-generate CIGAR, MD tags, mate information.
 
         :param str in_bam: input BAM of deduplicated consensus reads
-        :return str: output BAM name
+        :param str out_bam: output BAM name
         """
 
-        # Write the reads to FASTQ
-        r1_fastq, r2_fastq = su.bam_to_fastq(in_bam, None, True, self.nthreads, s=os.devnull)
+        # Stream the mates, which are adjacent, to the aligner rather than writing intermediate FASTQs
+        read_pairs = su.iterate_bam_read_pairs(in_bam, is_paired=True)
 
         # Realign the reads
         bowtie2_nthreads = 1 if self.nthreads == 0 else self.nthreads
-        baw(f1=r1_fastq, f2=r2_fastq, ref=self.ref, outbam=self.out_bam, nthreads=self.nthreads)
-
-        fu.safe_remove((r1_fastq, r2_fastq,))
+        baw(f1=None, f2=None, ref=self.ref, outbam=out_bam, nthreads=bowtie2_nthreads, read_pairs=read_pairs)
 
     def workflow(self):
         """Runs the ConsensusDeduplicator workflow."""
@@ -1180,131 +2247,124 @@ class ConsensusDeduplicator(object):
         logger.info("Started consensus read generation workflow for %s" % self.in_bam)
         consensus_bam = self._generate_consensus_reads()
 
-        self._realign_consensus_reads(consensus_bam)
+        # A CRAM output is converted from the BAM, retaining its order
+        out_bam = self.out_bam
+        if su.is_cram(self.out_bam):
+            out_bam = fu.replace_extension(self.out_bam, su.BAM_SUFFIX)
+
+        if self.realign:
+            logger.info("Realigning consensus reads.")
+            self._realign_consensus_reads(consensus_bam, out_bam)
+        elif self.sort_planner is not None:
+            # Mates of each consensus pair are written adjacently; leave any sorting to the consumers
+            shutil.move(consensus_bam, out_bam)
+            self.sort_planner.register(self.out_bam, SortOrder.NAME_GROUPED)
+        else:
+            # Consensus reads already carry alignment fields; only coordinate sorting is needed
+            su.sort_and_index(am=consensus_bam, output_am=out_bam, nthreads=self.nthreads,
+                              compresslevel=iop.get_compresslevel(self.io_policy))
+
+        if out_bam != self.out_bam:
+            logger.info("Compressing consensus reads to CRAM.")
+            su.bam_to_cram(bam=out_bam, ref=self.ref, output_cram=self.out_bam, nthreads=self.nthreads)
+            fu.safe_remove((out_bam, su.get_index_name(out_bam),))
+
         logger.info("Completed consensus read generation workflow.")
 
         fu.safe_remove((consensus_bam,))
 
 
+# ReadMasker of a masking worker process, set by _init_mask_worker
+_worker_masker = None
+
+
+def _init_mask_worker(masker_kwargs):
+    """Initializes a masking worker process with its own ReadMasker, so the primers are not pickled for each chunk.
+
+    :param dict masker_kwargs: keyword arguments to ReadMasker
+    """
+
+    global _worker_masker
+    _worker_masker = ReadMasker(**masker_kwargs)
+
+
+def _mask_chunk(contig, start, stop):
+    """Masks reads starting in a region of an indexed BAM with the ReadMasker of the worker process.
+
+    :param str contig: contig to mask reads from
+    :param int | None start: mask reads starting at or after this 0-based coordinate
+    :param int | None stop: mask reads starting before this 0-based coordinate
+    :return str: name of the masked chunk BAM
+    """
+
+    return _worker_masker.mask_chunk(contig, start, stop)
+
+
 class ReadMasker(object):
     """Class for masking the synthetic primer region of reads."""
 
     MASKED_SUFFIX = "masked.bam"
-    MATE_EXT_DELIM = "/"
-    GROUPBY_QNAME_FIELD = 0
-    GROUPBY_PRIMER_CONTIG_FIELD = 1
-    GROUPBY_PRIMER_START_FIELD = 2
-    GROUPBY_PRIMER_STOP_FIELD = 3
-    GROUPBY_PRIMER_STRAND_FIELD = 4
-    GROUPBY_DELIM = ","
     DEFAULT_OUTDIR = "."
     DEFAULT_NTHREADS = 0
     DEFAULT_RACE_LIKE = False
     DEFAULT_AMPLICON_START_BUFFER = 15
     DEFAULT_RACE_LIKE_START_BUFFER = 3
+    MASK_CACHE_SIZE = 100000  # max number of cached mask templates
+    MIN_CHUNK_SIZE = 1000  # min reference span for parallel masking of a chunk
+    NO_COORD_CONTIG = "*"
 
-    def __init__(self, in_bam, feature_file, race_like=DEFAULT_RACE_LIKE, sort_cmd=QNAME_SORTS[ILLUMINA_FORMAT_INDEX],
-                 outdir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS):
+    def __init__(self, in_bam, feature_file, race_like=DEFAULT_RACE_LIKE, outdir=DEFAULT_OUTDIR,
+                 nthreads=DEFAULT_NTHREADS, sort_planner=None, io_policy=None, ref=None):
         """Constructor for ReadMasker.
 
-        :param str in_bam: BAM file to mask
+        :param str in_bam: BAM file to mask, in any order
         :param str feature_file: BED or GTF/GFF file of primer locations
         :param bool race_like: is the data produced by RACE-like (e.g. AMP) data? Default False.
-        :param tuple sort_cmd: sort command and key dependent on the qname format
         :param str outdir: Optional output directory. Default current working directory.
-        :param int nthreads: number threads to use for SAM/BAM file manipulations. Default 0 (autodetect).
+        :param int nthreads: number of worker processes for masking a coordinate-sorted and indexed BAM. Default 0 \
+        (mask in a single pass in the current process).
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner to register the output order \
+        with. The masked BAM retains the order of the input.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of \
+        the masked BAM
+        :param str | None ref: optional reference FASTA for decoding a CRAM input. The masked output is BAM.
         """
 
         self.in_bam = in_bam
+        self.ref = ref
         self.feature_file = feature_file
         self.race_like = race_like
-        self.sort_cmd = sort_cmd
         self.nthreads = nthreads
+        self.sort_planner = sort_planner
+        self.io_policy = io_policy
         self.outdir = outdir
         self.out_bam = os.path.join(outdir, fu.replace_extension(os.path.basename(in_bam), self.MASKED_SUFFIX))
 
-        self.feature_file_type = ffu.BED_FILETYPE if self.feature_file.endswith(ffu.BED_FILETYPE) else ffu.GFF_FILETYPE
-        self.feature_file_nfields = len(pybedtools.BedTool(self.feature_file)[0].fields)
-
-        self.primer_start_offset = ffu.BED_INTERSECT_WB_B_BED_START_OFFSET if self.feature_file_type == ffu.BED_FILETYPE \
-            else ffu.BED_INTERSECT_WB_B_GFF_START_OFFSET
-
-        self.primer_stop_offset = ffu.BED_INTERSECT_WB_B_BED_STOP_OFFSET if self.feature_file_type == ffu.BED_FILETYPE \
-            else ffu.BED_INTERSECT_WB_B_GFF_STOP_OFFSET
-
-        self.primer_strand_offset = ffu.BED_INTERSECT_WB_B_BED_STRAND_OFFSET if self.feature_file_type == ffu.BED_FILETYPE \
-            else ffu.BED_INTERSECT_WB_B_GFF_STRAND_OFFSET
-
         # Store primer coordinates; use a more stringent buffer for RACE-like data as fragments may be amplified
         # by more than one R primer; use a loose buffer for amplicon data- it would be unusual for reads to start
         # within 15 nts of each other as primers are rarely tiled back to back on the same strand; thus, any reads
         # exhibiting this behavior are likely reads that have not been fully adapter-trimmed, or alignment artifacts
         start_buff = self.DEFAULT_RACE_LIKE_START_BUFFER if race_like else self.DEFAULT_AMPLICON_START_BUFFER
         self.primer_info = ffu.store_coords(feature_file=feature_file, use_name=False, start_buffer=start_buff)
+        self.primer_index = ffu.FeatureIndex(self.primer_info)
 
-    def _get_read_primer_intersection(self):
-        """Applies a custom bedtools sort pipeline to get primers associated with each read.
-
-        :return str: path of the output tempfile
-        """
-
-        intersect_cmd = ("bedtools", "intersect", "-bed", "-wa", "-wb", "-abam", self.in_bam, "-b", self.feature_file)
-
-        # Determine which fields of the intersected BED to summarize based on the feature file type and expected number
-        # of fields from the read portion (-wa) of the results
-        primer_coord_fields = [ffu.BED_INTERSECT_WB_READ_NFIELDS,
-                               ffu.BED_INTERSECT_WB_READ_NFIELDS + self.primer_start_offset,
-                               ffu.BED_INTERSECT_WB_READ_NFIELDS + self.primer_stop_offset,
-                               ffu.BED_INTERSECT_WB_READ_NFIELDS + self.primer_strand_offset]
-
-        # Need 1-based field numbers for bedtools groupby
-        primer_coord_fields = [str(e + 1) for e in primer_coord_fields]
-
-        # Use groupby to collapse the intersecting primer coordinates for each read
-        groupby_cmd = ("bedtools", "groupby", "-g", str(ffu.BED_INTERSECT_WB_B_BED_NAME_OFFSET + 1),
-                       "-c", ",".join(primer_coord_fields), "-o", "collapse")
-
-        # WARNING: determine if the number of fields in the read name can vary, as this could affect the sort
-        # Often if we encounter improperly paired R1s/R2s during iteration in the VariantCaller, it is because
-        # this sort is not working properly.
-
-        # Finally run the custom intersect, groupby, and sort pipeline in a subprocess
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".read.primer.intersect.sort.bed", delete=False) as sort_out, \
-                open(os.path.join(self.outdir, "%s.stderr.log" % self.__class__.__name__), "a") as masker_stderr:
+        # Reads from the same primer with the same alignment have the same mask
+        self._mask_cache = {}
 
-            intersect_p = subprocess.Popen(intersect_cmd, stdout=subprocess.PIPE, stderr=masker_stderr)
-            groupby_p = subprocess.Popen(groupby_cmd, stdin=intersect_p.stdout, stdout=subprocess.PIPE, stderr=masker_stderr)
-            sort_p = subprocess.Popen(self.sort_cmd, stdin=groupby_p.stdout, stdout=sort_out, stderr=masker_stderr)
-            sort_p.wait()
-            intersect_p.stdout.close()
-            groupby_p.stdout.close()
-            return sort_out.name
-
-    def _get_read_primer_associations(self, align_seg, groupby_res):
+    def _get_read_primer_associations(self, align_seg):
         """Determines originating primer(s) for each read, excluding primers where the alignment reads-through the primer.
 
         :param pysam.AlignedSegment: read object
-        :param str groupby_res: bedtools groupby result line
-        :return tuple: (str, set)- (qname, associated primer coord strings)
+        :return set: associated primer coord strings
         """
 
         primer_assocs = set()
 
-        groupby_res_split = groupby_res.rstrip(fu.FILE_NEWLINE).split(fu.FILE_DELIM)
-        intersecting_qname = groupby_res_split[self.GROUPBY_QNAME_FIELD].split(self.MATE_EXT_DELIM)[0]
-
-        # Split the contig again since we use groupby -o collapse instead of -o distinct
-        intersecting_primer_contig = [groupby_res_split[self.GROUPBY_PRIMER_CONTIG_FIELD].split(self.GROUPBY_DELIM)[0]]
-        intersecting_primer_starts = groupby_res_split[self.GROUPBY_PRIMER_START_FIELD].split(ffu.BED_GROUPBY_DELIM)
-        intersecting_primer_stops = groupby_res_split[self.GROUPBY_PRIMER_STOP_FIELD].split(ffu.BED_GROUPBY_DELIM)
-        intersecting_primer_strands = groupby_res_split[self.GROUPBY_PRIMER_STRAND_FIELD].split(ffu.BED_GROUPBY_DELIM)
+        intersecting_primers = self.primer_index.get_overlapping(
+            align_seg.reference_name, align_seg.reference_start, align_seg.reference_end)
 
-        intersecting_primers = zip(intersecting_primer_contig * len(intersecting_primer_starts),
-                                   intersecting_primer_starts, intersecting_primer_stops, intersecting_primer_strands)
+        for primer_coord_str in intersecting_primers:
 
-        for intersecting_primer in intersecting_primers:
-
-            primer_coord_str = su.COORD_FORMAT_STRAND.format(*intersecting_primer)
             primer_tuple = self.primer_info[primer_coord_str]
 
             # We should get no more than two matching primers. Primers in which the read has "read-through" should
@@ -1315,30 +2375,53 @@ class ReadMasker(object):
                     align_seg.reference_end in primer_tuple.allowable_coords:
                 primer_assocs.add(primer_coord_str)
 
-        return intersecting_qname, primer_assocs
+        return primer_assocs
 
-    def _get_mask_base_indices(self, align_seg, associated_primers):
-        """Finds the read indices to mask.
+    @staticmethod
+    def _get_query_index(align_seg, ref_coord):
+        """Gets the read index aligned to a reference coordinate with CIGAR arithmetic.
+
+        :param pysam.AlignedSegment: read object
+        :param int ref_coord: 1-based reference coordinate
+        :return int | None: 0-based index into the read, including softclips; None if the coordinate is not aligned
+        """
+
+        ref_pos = align_seg.reference_start + 1
+        query_pos = 0
+
+        for cigar_op, op_len in align_seg.cigartuples:
+
+            if cigar_op in su.PYSAM_CIGARTUPLES_ALIGNED:
+                if ref_pos <= ref_coord < ref_pos + op_len:
+                    return query_pos + ref_coord - ref_pos
+                ref_pos += op_len
+                query_pos += op_len
+
+            elif cigar_op in su.PYSAM_CIGARTUPLES_REF_ONLY:
+                if ref_pos <= ref_coord < ref_pos + op_len:
+                    return
+                ref_pos += op_len
+
+            elif cigar_op in su.PYSAM_CIGARTUPLES_QUERY_ONLY:
+                query_pos += op_len
+
+    def _get_mask_slices(self, align_seg, associated_primers):
+        """Finds the read index ranges to mask.
 
         :param pysam.AlignedSegment: read object
         :param set associated_primers: associated primers
-        :return set: set of read indices to mask
+        :return list: (start, stop) read index ranges to mask, with stop exclusive
         """
 
-        base_indices_to_mask = []
+        mask_slices = []
 
         read_mate = su.ReadMate(align_seg.is_read1)
         read_strand = su.Strand(align_seg.is_reverse)
+        query_length = align_seg.query_length
 
         # Convert BAM reference coordinates to 1-based for matching to all other 1-based coordinates
-        # Need to keep the None values from any softclips for proper indexing into the read
-        reference_positions = [p + 1 if isinstance(p, int) else p for p in
-                               align_seg.get_reference_positions(full_length=True)]
-
-        reference_positions_noclips = [p for p in reference_positions if p is not None]
-        reference_positions_set = set(reference_positions_noclips)
-        ref_pos_start = reference_positions_noclips[0]
-        ref_pos_end = reference_positions_noclips[-1]
+        ref_pos_start = align_seg.reference_start + 1
+        ref_pos_end = align_seg.reference_end
 
         for ap in associated_primers:
 
@@ -1350,141 +2433,210 @@ class ReadMasker(object):
             if primer_tuple.strand == su.Strand.MINUS:
                 primer_fiveprime_coord, primer_threeprime_coord = primer_threeprime_coord, primer_fiveprime_coord
 
+            threeprime_read_index = self._get_query_index(align_seg, primer_threeprime_coord)
+
             # One might think if read does not overlap the 3' end of the primer in question, there is no need to mask
             # However consider a short read with 3' BQ trimming that starts at a primer:
             # ---->  forward read
             # ------> forward primer
             # Handle this edge case first
-            if primer_threeprime_coord not in reference_positions_set and \
+            if threeprime_read_index is None and \
                     ((primer_tuple.strand == su.Strand.PLUS and primer_fiveprime_coord == ref_pos_start)
                      or (primer_tuple.strand == su.Strand.MINUS and primer_fiveprime_coord == ref_pos_end)):
 
                 # In this case the whole read should be masked only if it is Tile-seq or if it is a RACE-like R2
                 if not self.race_like or (self.race_like and read_strand == su.ReadMate.R2):
-                    base_indices_to_mask = set(range(0, align_seg.query_length))
-                    return base_indices_to_mask
+                    return [(0, query_length)]
 
             # For any other primers whose 3' ends are not in the reference, there is no need to check
-            if primer_threeprime_coord not in reference_positions_set:
+            if threeprime_read_index is None:
                 continue
 
-            # index() will throw a ValueError if the index is not found, which is why we have the line above
-            threeprime_read_index = reference_positions.index(primer_threeprime_coord)
-
             # For Tile-seq libraries, both ends of R1 and R2 should be masked
             if not self.race_like and ((read_strand == primer_tuple.strand and read_strand == su.Strand.PLUS) or
                                        (read_strand != primer_tuple.strand and read_strand == su.Strand.MINUS)):
 
                 # Mask from start of read (0 index) to index of 3' end of primer (include stop in range)
-                base_indices_to_mask += list(range(0, threeprime_read_index + 1))
+                mask_slices.append((0, threeprime_read_index + 1))
 
             if not self.race_like and ((read_strand == primer_tuple.strand and read_strand == su.Strand.MINUS) or
                                        (read_strand != primer_tuple.strand and read_strand == su.Strand.PLUS)):
 
                 # Mask from index of 3' end of primer to end of read (read length)
-                base_indices_to_mask += list(range(threeprime_read_index, align_seg.query_length))
+                mask_slices.append((threeprime_read_index, query_length))
 
             # For RACE-like (e.g. AMP) chemistry make sure the 5' end of a R1 is never masked
             if self.race_like and read_mate == su.ReadMate.R1 and read_strand != primer_tuple.strand:
 
                 if read_strand == su.Strand.PLUS and primer_fiveprime_coord == ref_pos_end:
-                    base_indices_to_mask += list(range(threeprime_read_index, align_seg.query_length))
+                    mask_slices.append((threeprime_read_index, query_length))
 
                 if read_strand == su.Strand.MINUS and primer_fiveprime_coord == ref_pos_start:
-                    base_indices_to_mask += list(range(0, threeprime_read_index + 1))
+                    mask_slices.append((0, threeprime_read_index + 1))
 
             # For RACE-like (e.g. AMP) chemistry make sure the 3' end of a R2 is never masked
             if self.race_like and read_mate == su.ReadMate.R2 and read_strand == primer_tuple.strand:
 
                 if read_strand == su.Strand.PLUS and primer_fiveprime_coord == ref_pos_start:
-                    base_indices_to_mask += list(range(0, threeprime_read_index + 1))
+                    mask_slices.append((0, threeprime_read_index + 1))
 
                 if read_strand == su.Strand.MINUS and primer_fiveprime_coord == ref_pos_end:
-                    base_indices_to_mask += list(range(threeprime_read_index, align_seg.query_length))
+                    mask_slices.append((threeprime_read_index, query_length))
 
-        return set(base_indices_to_mask)
+        return mask_slices
 
-    def _mask_reads(self, qname_sorted_bam, intersected_bed, masked_bam):
-        """Iterate over the reads of the intersection and mask relevant bases.
+    def _get_mask_base_indices(self, align_seg, associated_primers):
+        """Finds the read indices to mask.
 
-        :param str qname_sorted_bam: input qname-sorted BAM
-        :param str intersected_bed: input intersected with primers and groupedby
-        :param file masked_bam: temporary BAM to write masked alignments to
-        :raises RuntimeError: if the qname-sort between intersection results and alignments is not the same
+        :param pysam.AlignedSegment: read object
+        :param set associated_primers: associated primers
+        :return set: set of read indices to mask
         """
 
-        # Iterate over the reads and mask the synthetic primer regions
-        with pysam.AlignmentFile(qname_sorted_bam, check_sq=False) as in_af, \
-                pysam.AlignmentFile(masked_bam, "wb", header=in_af.header) as out_af, \
-                open(intersected_bed, "r") as intersected_bed_file:
+        base_indices_to_mask = set()
+        for mask_start, mask_stop in self._get_mask_slices(align_seg, associated_primers):
+            base_indices_to_mask |= set(range(mask_start, mask_stop))
 
-            # Create a generator iterator to iterate over the qname-sorted BAM reads and corresponding bedtools groupby
-            # results for the read (also sorted by qname)
-            read_gen_iter = zip(in_af.fetch(until_eof=True), intersected_bed_file)
+        return base_indices_to_mask
 
-            for align_seg, intersected_groupby_res in read_gen_iter:
+    def _get_cached_mask_slices(self, align_seg, associated_primers):
+        """Finds the read index ranges to mask, reusing the mask of reads with the same primers and alignment.
 
-                if align_seg.is_unmapped:
-                    out_af.write(align_seg)
-                    continue
+        :param pysam.AlignedSegment: read object
+        :param set associated_primers: associated primers
+        :return list: (start, stop) read index ranges to mask
+        """
+
+        mask_key = (frozenset(associated_primers), align_seg.is_read1, align_seg.is_reverse,
+                    align_seg.reference_start, align_seg.cigarstring)
+
+        if mask_key not in self._mask_cache:
+
+            if len(self._mask_cache) >= self.MASK_CACHE_SIZE:
+                self._mask_cache.clear()
+
+            self._mask_cache[mask_key] = self._get_mask_slices(align_seg, associated_primers)
+
+        return self._mask_cache[mask_key]
+
+    def _mask_read(self, align_seg):
+        """Masks the synthetic primer regions of a read.
+
+        :param pysam.AlignedSegment: read object, updated in place
+        """
+
+        if align_seg.is_unmapped:
+            return
+
+        # Get the associated (i.e. originating) primers for each read to inform masking regions
+        associated_primers = self._get_read_primer_associations(align_seg)
+
+        # Do the masking if primers were found associated with the read
+        if len(associated_primers) > 0:
+
+            # Mask through a numpy view of the quality array so each range is a single slice assignment
+            quals = align_seg.query_qualities
+            quals_view = np.frombuffer(quals, dtype=np.uint8)
+            for mask_start, mask_stop in self._get_cached_mask_slices(align_seg, associated_primers):
+                quals_view[mask_start:mask_stop] = su.MASKED_BQ
+
+            align_seg.query_qualities = quals
+
+    def _mask_reads(self, in_af, masked_bam, contig=None, start=None, stop=None):
+        """Iterate over the reads and mask relevant bases.
+
+        :param pysam.AlignmentFile in_af: input alignments
+        :param str masked_bam: BAM to write masked alignments to
+        :param str | None contig: optional contig to mask reads from. Default None, mask all reads.
+        :param int | None start: if contig, mask reads starting at or after this 0-based coordinate
+        :param int | None stop: if contig, mask reads starting before this 0-based coordinate
+        """
+
+        if contig is None:
+            reads = in_af.fetch(until_eof=True)
+        elif contig == self.NO_COORD_CONTIG:
+            reads = in_af.fetch(contig)
+        else:
+            reads = in_af.fetch(contig, start, stop)
+
+        with iop.open_bam(masked_bam, self.io_policy, header=in_af.header) as out_af:
 
-                # Get the associated (i.e. originating) primers for each read to inform masking regions
-                qname, associated_primers = self._get_read_primer_associations(align_seg, intersected_groupby_res)
+            for align_seg in reads:
 
-                if align_seg.query_name != qname:
-                    raise RuntimeError(
-                        "Inconsistent match between input BAM and primer intersection results. qname in input BAM was "
-                        "%s. qname in intersected groupby result was %s." % (align_seg.query_name, qname))
+                # Reads overlapping the chunk start belong to the previous chunk
+                if contig not in {None, self.NO_COORD_CONTIG} and align_seg.reference_start < start:
+                    continue
 
-                # Do the masking if primers were found associated with the read
-                if len(associated_primers) > 0:
-                    indices_to_mask = self._get_mask_base_indices(align_seg, associated_primers)
-                    masked_quals = [
-                        bq if i not in indices_to_mask else su.MASKED_BQ for i, bq in enumerate(align_seg.query_qualities)]
-                    align_seg.query_qualities = masked_quals
+                self._mask_read(align_seg)
 
                 # Always write the read whether or not it needs masking
                 out_af.write(align_seg)
 
+    def mask_chunk(self, contig, start, stop):
+        """Masks reads starting in a region of an indexed BAM. Run in a worker process.
+
+        :param str contig: contig to mask reads from
+        :param int | None start: mask reads starting at or after this 0-based coordinate
+        :param int | None stop: mask reads starting before this 0-based coordinate
+        :return str: name of the masked chunk BAM
+        """
+
+        # Chunks are written next to the output, as the temp dir may be too small for a large BAM
+        masked_bam = tempfile.NamedTemporaryFile(suffix=".masked.chunk.bam", delete=False, dir=self.outdir).name
+
+        with su.open_alignments(self.in_bam, self.ref) as in_af:
+            self._mask_reads(in_af, masked_bam, contig, start, stop)
+
+        return masked_bam
+
+    def _get_chunks(self, in_af):
+        """Splits the reference into chunks for parallel masking.
+
+        :param pysam.AlignmentFile in_af: coordinate-sorted and indexed alignments
+        :return list: (contig, start, stop) tuples in coordinate order
+        """
+
+        chunks = []
+        for contig, contig_len in zip(in_af.references, in_af.lengths):
+            chunk_size = max(self.MIN_CHUNK_SIZE, -(-contig_len // self.nthreads))
+            chunks.extend([(contig, i, i + chunk_size) for i in range(0, contig_len, chunk_size)])
+
+        # Reads without a coordinate sort to the end of the BAM
+        chunks.append((self.NO_COORD_CONTIG, None, None))
+        return chunks
+
     def workflow(self):
         """Runs the ReadMasker workflow."""
 
         logger.info("Started primer base quality masking for %s" % self.in_bam)
 
-        logger.info("Intersecting alignments with primer features.")
-        intersected_bed = self._get_read_primer_intersection()
+        with su.open_alignments(self.in_bam, self.ref) as in_af:
 
-        with tempfile.NamedTemporaryFile(suffix=".primer.intersected.bam") as primer_intersected:
-            # We must make sure that all reads in the qname-sorted BAM to be masked will be found in the bedtools
-            # groupby output such that the nreads is equivalent and we can iterate over both results simultaneously
-            # Unfortunately this requires us to intersect with the primers again but output a BAM instead of BED
-            ffu.intersect_features(ff1=self.in_bam, ff2=self.feature_file, outfile=primer_intersected.name)
-            fu.flush_files((primer_intersected,))
-
-            logger.info("Sorting BAM by qname to enable masking on read stream.")
-            # samtools sort -n will sort read names numerically instead of lexicographically, and sorts R1s
-            # prior to R2s
-            qname_sorted_bam = su.sort_bam(primer_intersected.name, by_qname=True, nthreads=self.nthreads)
+            # Daemonic workers (e.g. per-tile workers) may not start their own pool
+            if self.nthreads <= 1 or not in_af.has_index() or multiprocessing.current_process().daemon:
+                logger.info("Masking synthetic primer regions in reads.")
+                self._mask_reads(in_af, self.out_bam)
+                chunks = None
+            else:
+                chunks = self._get_chunks(in_af)
 
-        logger.info("Masking synthetic primer regions in reads.")
-        with tempfile.NamedTemporaryFile(suffix=".masked.bam") as masked_bam, \
-                tempfile.NamedTemporaryFile(suffix=".primer.nonintersected.bam") as primer_nonintersected:
+        if chunks is not None:
+            logger.info("Masking synthetic primer regions in reads with %i workers." % self.nthreads)
 
-            self._mask_reads(qname_sorted_bam, intersected_bed, masked_bam)
-            fu.flush_files((masked_bam,))
+            # Each worker builds its primer index once; chunks are returned in coordinate order, so the concatenated
+            # BAM retains the input order
+            masker_kwargs = dict(in_bam=self.in_bam, feature_file=self.feature_file, race_like=self.race_like,
+                                 outdir=self.outdir, io_policy=self.io_policy, ref=self.ref)
 
-            # We need to add back in the alignments that did not intersect any primers and were not masked;
-            # this is especially needed for the reads at the end of a cloned CDS, where an amplifying primer may
-            # sit in the vector, and thus reads emanating from it may not have intersected CDS-specific primers.
-            ffu.intersect_features(ff1=self.in_bam, ff2=self.feature_file, outfile=primer_nonintersected.name, v=True)
-            fu.flush_files((primer_nonintersected,))
+            with multiprocessing.Pool(processes=self.nthreads, initializer=_init_mask_worker,
+                                      initargs=(masker_kwargs,)) as pool:
+                masked_bams = pool.starmap(_mask_chunk, chunks)
 
-            # Add non-primer-intersecting reads back to the masked BAM here
-            su.cat_bams(bams=(masked_bam.name, primer_nonintersected.name,), output_bam=self.out_bam)
+            su.cat_bams(bams=masked_bams, output_bam=self.out_bam)
+            fu.safe_remove(tuple(masked_bams))
 
-        # Clean up the remaining tempfiles
-        pybedtools.cleanup()
-        fu.safe_remove(paths=(qname_sorted_bam, intersected_bed,))
+        if self.sort_planner is not None:
+            self.sort_planner.propagate(self.in_bam, self.out_bam)
 
         logger.info("Completed primer base quality masking.")
 
@@ -1497,33 +2649,70 @@ class VariantCallerPreprocessor(object):
     QNAME_SUFFIX = "qname.sort.bam"
     R1_SUFFIX = "R1.call.bam"
     R2_SUFFIX = "R2.call.bam"
+    FRAGMENT_SUFFIX = "fragment.call.bam"
+    DEFAULT_USE_INDEX = False
+    DEFAULT_REGION = None
+    PAIR_EXCLUDE_FLAGS = su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP + su.SAM_FLAG_SECONDARY + su.SAM_FLAG_SUPPL
 
-    def __init__(self, am, ref, output_dir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS):
+    def __init__(self, am, ref, output_dir=DEFAULT_OUTDIR, nthreads=DEFAULT_NTHREADS, sort_planner=None,
+                 use_index=DEFAULT_USE_INDEX, region=DEFAULT_REGION, io_policy=None, multiplicities=None):
         r"""Constructor for VariantCallerPreprocessor.
 
-        :param str am: SAM/BAM file to enumerate variants in
-        :param str ref: path to reference FASTA used in alignment. Must be samtools faidx indexed.
+        :param str am: SAM/BAM/CRAM file to enumerate variants in
+        :param str ref: path to reference FASTA used in alignment. Must be samtools faidx indexed. Also used to \
+        decode a CRAM input.
         :param str targets: BED, GFF, or GTF file containing targeted regions to enumerate variants for
         :param str output_dir: Optional output directory. Default current working directory.
         :param int nthreads: number threads to use for SAM/BAM file manipulations. Default 0 (autodetect).
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner tracking intermediate orders. \
+        If provided, the input is only grouped by read name if it is not already, and no coordinate sort is done.
+        :param bool use_index: read pairs directly from the coordinate-sorted and indexed input, buffering mates, \
+        instead of qname-sorting and splitting into R1 and R2 BAMs. Default False.
+        :param str | None region: optional samtools-style region (contig:start-stop) to restrict reading pairs to. \
+        Implies use_index.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of \
+        the sorted and split BAMs
+        :param dict | None multiplicities: optional {read name: multiplicity} of representatives of collapsed \
+        duplicates, counted towards the mapped reads
         """
 
         self.am = am
         self.ref = ref
         self.output_dir = output_dir
         self.nthreads = nthreads
+        self.sort_planner = sort_planner
+        self.io_policy = io_policy
+        self.region = region
+        self.use_index = use_index or region is not None
+        self.multiplicities = multiplicities if multiplicities is not None else {}
+        self.total_mapped = None
 
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
         self.in_bam = self.am
-        if self.am.endswith(su.SAM_SUFFIX) or (not os.path.exists(fu.add_extension(self.in_bam, su.BAM_INDEX_SUFFIX))):
+        if self.sort_planner is not None and not self.use_index and self.am.endswith(su.SAM_SUFFIX):
 
             self.in_bam = os.path.join(self.output_dir, fu.replace_extension(
                 os.path.basename(self.am), "in.bam"))
 
+            # Converting to BAM retains the order of the SAM
             logger.info("Converting SAM to BAM.")
-            su.sort_and_index(am=self.am, output_am=self.in_bam, nthreads=self.nthreads)
+            su.sam_view(am=self.am, output_am=self.in_bam, nthreads=self.nthreads)
+            self.sort_planner.propagate(self.am, self.in_bam)
+
+        elif (self.sort_planner is None or self.use_index) and (self.am.endswith(su.SAM_SUFFIX) or (
+                not os.path.exists(su.get_index_name(self.in_bam)))):
+
+            self.in_bam = os.path.join(self.output_dir, fu.replace_extension(
+                os.path.basename(self.am), "in.bam"))
+
+            logger.info("Converting SAM to BAM.")
+            su.sort_and_index(am=self.am, output_am=self.in_bam, nthreads=self.nthreads,
+                              compresslevel=iop.get_compresslevel(self.io_policy), ref=self.ref)
+
+            if self.sort_planner is not None:
+                self.sort_planner.register(self.in_bam, SortOrder.COORDINATE)
 
         self.qname_sorted = os.path.join(self.output_dir, fu.replace_extension(
             os.path.basename(self.am), self.QNAME_SUFFIX))
@@ -1534,15 +2723,200 @@ class VariantCallerPreprocessor(object):
         self.r2_calling_bam = os.path.join(self.output_dir, fu.replace_extension(
             os.path.basename(self.am), self.R2_SUFFIX))
 
+        # Single-end alignments of mates merged prior to alignment
+        self.fragment_calling_bam = os.path.join(self.output_dir, fu.replace_extension(
+            os.path.basename(self.am), self.FRAGMENT_SUFFIX))
+
         self.workflow()
 
+    @staticmethod
+    def is_merged_fragment(align_seg):
+        """Determines if an alignment is a fragment of mates merged prior to alignment.
+
+        :param pysam.AlignedSegment align_seg: read object
+        :return bool: whether the read is a merged fragment
+        """
+
+        res = not align_seg.is_paired and align_seg.has_tag(MateMerger.CONCORDANCE_TAG)
+        return res
+
+    def _count_mapped_read(self, align_seg):
+        """Counts a mapped read, including the duplicates it represents.
+
+        :param pysam.AlignedSegment align_seg: mapped read object
+        :return int: number of mapped reads represented
+
+        Merged fragments are counted twice, as each represents a pair.
+        """
+
+        nreads = 2 if self.is_merged_fragment(align_seg) else 1
+
+        if len(self.multiplicities) == 0 or align_seg.is_secondary or align_seg.is_supplementary:
+            return nreads
+
+        return nreads * self.multiplicities.get(align_seg.query_name, 1)
+
+    def _count_mapped(self):
+        """Counts the mapped reads of the input, or of the region if one is set, for inputs not split into mates.
+
+        :return int: number of mapped reads
+
+        The index statistics are used when possible. They are not restricted to a region, CRAM indices do not record \
+        mapped counts, and the duplicates of collapsed representatives are not indexed, so these are counted in a \
+        pass over the fetched alignments.
+        """
+
+        with su.open_alignments(self.in_bam, self.ref) as in_af:
+            if self.region is None and not su.is_cram(self.in_bam) and len(self.multiplicities) == 0:
+                return in_af.mapped
+
+            total_mapped = 0
+            fetch_kwargs = {"until_eof": True} if self.region is None else {"region": self.region}
+            for align_seg in in_af.fetch(**fetch_kwargs):
+                if not align_seg.is_unmapped:
+                    total_mapped += self._count_mapped_read(align_seg)
+
+        return total_mapped
+
+    def _split_mates(self, grouped_bam):
+        """Splits name-grouped alignments into R1, R2, and merged fragment BAMs in a single pass, counting mapped reads.
+
+        :param str grouped_bam: alignments with mates adjacent
+        """
+
+        total_mapped = 0
+        exclude_flags = su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP
+
+        with su.open_alignments(grouped_bam, self.ref, check_sq=False) as in_af, \
+                iop.open_bam(self.r1_calling_bam, self.io_policy, template=in_af) as r1_af, \
+                iop.open_bam(self.r2_calling_bam, self.io_policy, template=in_af) as r2_af, \
+                iop.open_bam(self.fragment_calling_bam, self.io_policy, template=in_af) as fragment_af:
+
+            for align_seg in in_af.fetch(until_eof=True):
+
+                if align_seg.is_unmapped:
+                    continue
+
+                total_mapped += self._count_mapped_read(align_seg)
+
+                if self.is_merged_fragment(align_seg):
+                    fragment_af.write(align_seg)
+                    continue
+
+                if align_seg.flag & exclude_flags:
+                    continue
+
+                if align_seg.is_read1:
+                    r1_af.write(align_seg)
+                elif align_seg.is_read2:
+                    r2_af.write(align_seg)
+
+        self.total_mapped = total_mapped
+
+    @staticmethod
+    def iterate_split_pairs(af1, af2):
+        """Iterates over read pairs from qname-ordered R1 and R2 alignments.
+
+        :param pysam.AlignmentFile af1: object corresponding to the R1 BAM
+        :param pysam.AlignmentFile af2: object corresponding to the R2 BAM
+        :return generator: (R1, R2) tuples of pysam.AlignedSegment
+        :raises RuntimeError: if the R1 and R2 of a pair have different read names
+        """
+
+        for r1, r2 in zip(af1.fetch(until_eof=True), af2.fetch(until_eof=True)):
+
+            # Sanity check to make sure we are always paired
+            if r1.query_name != r2.query_name:
+                raise RuntimeError(
+                    "Improper pairing of reads. R1 was %s and R2 was %s." % (r1.query_name, r2.query_name))
+
+            yield r1, r2
+
+    @classmethod
+    def iterate_buffered_pairs(cls, in_af, region=None):
+        """Iterates over read pairs from coordinate-sorted, indexed alignments, holding the first mate until its partner.
+
+        :param pysam.AlignmentFile in_af: coordinate-sorted and indexed alignments
+        :param str | None region: optional samtools-style region to fetch. Only pairs with both mates fetched are returned.
+        :return generator: (R1, R2) tuples of pysam.AlignedSegment, in order of the second mate's position. Merged \
+        fragments are returned as (fragment, None).
+
+        Buffered mates are evicted once the fetch passes their mate's position, so memory is bounded by fragment length.
+        """
+
+        mate_buffer = collections.OrderedDict()
+
+        for align_seg in in_af.fetch(region=region):
+
+            if align_seg.flag & cls.PAIR_EXCLUDE_FLAGS:
+                continue
+
+            if not align_seg.is_paired:
+                if cls.is_merged_fragment(align_seg):
+                    yield align_seg, None
+                continue
+
+            qname = align_seg.query_name
+            if qname in mate_buffer:
+                mate = mate_buffer.pop(qname)
+                yield (mate, align_seg) if mate.is_read1 else (align_seg, mate)
+                continue
+
+            # Drop the oldest mates whose partner should have been fetched by now; these were filtered or not fetched
+            read_coord = (align_seg.reference_id, align_seg.reference_start)
+            while len(mate_buffer) > 0:
+                oldest = next(iter(mate_buffer.values()))
+                if (oldest.next_reference_id, oldest.next_reference_start) >= read_coord:
+                    break
+                mate_buffer.popitem(last=False)
+
+            mate_buffer[qname] = align_seg
+
+    def iterate_read_pairs(self):
+        """Iterates over the preprocessed read pairs.
+
+        :return generator: (R1, R2) tuples of pysam.AlignedSegment, and (fragment, None) for merged fragments
+        """
+
+        if self.use_index:
+            with su.open_alignments(self.in_bam, self.ref) as in_af:
+                yield from self.iterate_buffered_pairs(in_af, self.region)
+            return
+
+        with pysam.AlignmentFile(self.r1_calling_bam, "rb", check_sq=False) as af1, \
+                pysam.AlignmentFile(self.r2_calling_bam, "rb", check_sq=False) as af2:
+            yield from self.iterate_split_pairs(af1, af2)
+
+        with pysam.AlignmentFile(self.fragment_calling_bam, "rb", check_sq=False) as fragment_af:
+            for align_seg in fragment_af.fetch(until_eof=True):
+                if self.is_merged_fragment(align_seg):
+                    yield align_seg, None
+
     def workflow(self):
         """Preprocesses the alignments: unmapped pair filtering, qname-sorting, and splitting into R1, R2 BAMs."""
 
         logger.info("Started variant call preprocessing workflow.")
 
+        if self.use_index:
+            # Pairs are read directly from the indexed BAM
+            self.total_mapped = self._count_mapped()
+            logger.info("Completed variant call preprocessing workflow.")
+            return
+
+        if self.sort_planner is not None:
+            logger.info("Grouping and splitting input BAM into R1 and R2.")
+            grouped_bam = self.sort_planner.require(
+                bam=self.in_bam, order=SortOrder.NAME_GROUPED, output_am=self.qname_sorted,
+                stage=self.__class__.__name__, ref=self.ref)
+
+            self._split_mates(grouped_bam)
+            logger.info("Completed variant call preprocessing workflow.")
+            return
+
         logger.info("Sorting and splitting input BAM into R1 and R2.")
-        su.sort_bam(bam=self.in_bam, output_am=self.qname_sorted, by_qname=True, nthreads=self.nthreads)
+        # An indexed CRAM input is sorted directly
+        sort_kwargs = {"reference": self.ref} if su.is_cram(self.in_bam) else {}
+        su.sort_bam(bam=self.in_bam, output_am=self.qname_sorted, by_qname=True, nthreads=self.nthreads, **sort_kwargs)
 
         su.sam_view(am=self.qname_sorted, output_am=self.r1_calling_bam, nthreads=self.nthreads,
                     f=su.SAM_FLAG_R1, F=su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP)
@@ -1550,4 +2924,8 @@ class VariantCallerPreprocessor(object):
         su.sam_view(am=self.qname_sorted, output_am=self.r2_calling_bam, nthreads=self.nthreads,
                     f=su.SAM_FLAG_R2, F=su.SAM_FLAG_UNMAP + su.SAM_FLAG_MUNMAP)
 
+        su.sam_view(am=self.qname_sorted, output_am=self.fragment_calling_bam, nthreads=self.nthreads,
+                    F=su.SAM_FLAG_PAIRED + su.SAM_FLAG_UNMAP)
+
+        self.total_mapped = self._count_mapped()
         logger.info("Completed variant call preprocessing workflow.")
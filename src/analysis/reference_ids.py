@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Indexed lookup of the Ensembl IDs in curated APPRIS and GENCODE reference files."""
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+APPRIS_CONTIG_DELIM = "|"
+APPRIS_TRX_INDEX = 0
+APPRIS_GENE_INDEX = 1
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+logger = logging.getLogger(__name__)
+
+
+class ReferenceIdIndex(object):
+    """SQLite index mapping Ensembl IDs to their versions, genes, contigs, and strands, built once per reference dir."""
+
+    DB_NAME = "reference_ids.sqlite"
+    META_SOURCES_KEY = "sources"
+    DB_TIMEOUT = 600  # seconds to wait on a concurrent build
+    SOURCE_FILES = (APPRIS_TRX_IDS, APPRIS_GENE_IDS, APPRIS_CONTIG_IDS, GENCODE_TRX_GFF)
+    ID_VERSION_DELIM = "."
+    GTF_CHROM_INDEX = 0
+    GTF_FEATURE_INDEX = 2
+    GTF_STRAND_INDEX = 6
+    GTF_ATTR_INDEX = 8
+    GTF_TRX_FEATURE = "transcript"
+    GTF_TRX_ID_RE = re.compile(r'transcript_id "([^"]+)"')
+
+    def __init__(self, reference_dir, index_dir=None):
+        r"""Constructor for ReferenceIdIndex.
+
+        :param str reference_dir: directory containing curated APPRIS reference files. The index is rebuilt if any \
+        reference file changes.
+        :param str | None index_dir: directory to write the index to, e.g. a cache dir shared across runs. Created if \
+        it does not exist. Default None, use the temp dir. The reference dir is never written to.
+        """
+
+        self.reference_dir = os.path.abspath(reference_dir)
+        self.index_dir = tempfile.gettempdir() if index_dir is None else os.path.abspath(index_dir)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        # Name the index by its reference dir so that one index dir may serve several reference dirs
+        dir_digest = hashlib.sha256(self.reference_dir.encode()).hexdigest()
+        self.db = os.path.join(self.index_dir, fu.add_extension(dir_digest, self.DB_NAME))
+
+        self.conn = sqlite3.connect(self.db, timeout=self.DB_TIMEOUT)
+        self._init_db()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_sources_signature(self):
+        """Gets a signature of the reference files that the index is built from.
+
+        :return str: names, sizes, and modification times of the reference files that exist
+        """
+
+        signature = []
+        for source_file in self.SOURCE_FILES:
+            source_path = os.path.join(self.reference_dir, source_file)
+            if os.path.exists(source_path):
+                source_stat = os.stat(source_path)
+                signature.append("%s:%i:%i" % (source_file, source_stat.st_size, source_stat.st_mtime_ns))
+
+        return fu.FILE_SPACE.join(signature)
+
+    def _init_db(self):
+        """Creates the index tables and builds the index if it is missing or out of date."""
+
+        sources_signature = self.get_sources_signature()
+
+        with self.conn:
+            # Take the write lock before checking so that concurrent runs build the index only once
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ensembl_ids (ensembl_id TEXT PRIMARY KEY, base_id TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ensembl_ids_base_id ON ensembl_ids (base_id)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcripts (transcript_id TEXT, gene_id TEXT, contig TEXT, chrom TEXT, "
+                "strand TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transcripts_transcript_id ON transcripts (transcript_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transcripts_gene_id ON transcripts (gene_id)")
+
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (self.META_SOURCES_KEY,)).fetchone()
+            if row is not None and row[0] == sources_signature:
+                return
+
+            logger.info("Building the reference ID index %s." % self.db)
+            self.conn.execute("DELETE FROM ensembl_ids")
+            self.conn.execute("DELETE FROM transcripts")
+            self.conn.execute("DELETE FROM meta")
+            self._load_ids()
+            self._load_contigs()
+            self._load_loci()
+            self.conn.execute("INSERT INTO meta VALUES (?, ?)", (self.META_SOURCES_KEY, sources_signature))
+
+    def _iterate_lines(self, source_file):
+        """Iterates over the lines of a reference file.
+
+        :param str source_file: basename of the file in the reference dir
+        :return generator: lines without newlines; nothing if the file does not exist
+        """
+
+        source_path = os.path.join(self.reference_dir, source_file)
+        if not os.path.exists(source_path):
+            return
+
+        with open(source_path, "r") as source_fh:
+            for line in source_fh:
+                yield line.rstrip(fu.FILE_NEWLINE)
+
+    def _load_ids(self):
+        """Loads the curated transcript and gene IDs."""
+
+        for id_file in (APPRIS_TRX_IDS, APPRIS_GENE_IDS):
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO ensembl_ids VALUES (?, ?)",
+                ((line, line.split(self.ID_VERSION_DELIM)[0]) for line in self._iterate_lines(id_file) if line))
+
+    def _load_contigs(self):
+        """Loads the transcript FASTA contig names and the gene of each transcript, in file order."""
+
+        contig_rows = []
+        for line in self._iterate_lines(APPRIS_CONTIG_IDS):
+            if not line:
+                continue
+
+            fields = line.split(APPRIS_CONTIG_DELIM)
+            contig_rows.append((fields[APPRIS_TRX_INDEX], fields[APPRIS_GENE_INDEX], line))
+
+        self.conn.executemany("INSERT INTO transcripts (transcript_id, gene_id, contig) VALUES (?, ?, ?)", contig_rows)
+
+    def _load_loci(self):
+        """Loads the chromosome and strand of each transcript from the GENCODE annotations."""
+
+        locus_rows = []
+        for line in self._iterate_lines(GENCODE_TRX_GFF):
+            fields = line.split(fu.FILE_DELIM)
+            if len(fields) <= self.GTF_ATTR_INDEX or fields[self.GTF_FEATURE_INDEX] != self.GTF_TRX_FEATURE:
+                continue
+
+            trx_id_match = self.GTF_TRX_ID_RE.search(fields[self.GTF_ATTR_INDEX])
+            if trx_id_match is not None:
+                locus_rows.append(
+                    (fields[self.GTF_CHROM_INDEX], fields[self.GTF_STRAND_INDEX], trx_id_match.group(1)))
+
+        self.conn.executemany("UPDATE transcripts SET chrom = ?, strand = ? WHERE transcript_id = ?", locus_rows)
+
+    def id_exists(self, ensembl_id):
+        """Determines if an Ensembl ID is in the curated set.
+
+        :param str ensembl_id: Ensembl gene or transcript ID, with version number
+        :return bool: whether the ID is in the curated set
+        """
+
+        row = self.conn.execute("SELECT 1 FROM ensembl_ids WHERE ensembl_id = ?", (ensembl_id,)).fetchone()
+        return row is not None
+
+    def get_alternative_id(self, ensembl_id):
+        """Gets a curated ID with the same base ID but a different version.
+
+        :param str ensembl_id: Ensembl gene or transcript ID, with version number
+        :return str | None: alternative ID, or None if the base ID is not in the curated set
+        """
+
+        row = self.conn.execute(
+            "SELECT ensembl_id FROM ensembl_ids WHERE base_id = ? AND ensembl_id != ? ORDER BY rowid LIMIT 1",
+            (ensembl_id.split(self.ID_VERSION_DELIM)[0], ensembl_id)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def get_trx_id(self, ensembl_gene_id):
+        """Gets the first curated transcript of a gene.
+
+        :param str ensembl_gene_id: Ensembl gene ID, with version number
+        :return str | None: transcript ID, or None if the gene ID was not found
+        """
+
+        row = self.conn.execute(
+            "SELECT transcript_id FROM transcripts WHERE gene_id = ? ORDER BY rowid LIMIT 1",
+            (ensembl_gene_id,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def get_contig(self, ensembl_id):
+        """Gets the name of the transcript FASTA contig for a transcript, or the first transcript of a gene.
+
+        :param str ensembl_id: Ensembl gene or transcript ID, with version number
+        :return str | None: full contig name, or None if the ID was not found
+        """
+
+        row = self.conn.execute(
+            "SELECT contig FROM transcripts WHERE transcript_id = ? OR gene_id = ? ORDER BY rowid LIMIT 1",
+            (ensembl_id, ensembl_id)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def get_locus(self, ensembl_trx_id):
+        """Gets the chromosome and strand of a transcript.
+
+        :param str ensembl_trx_id: Ensembl transcript ID, with version number
+        :return tuple | None: (chrom, strand), or None if the transcript is not annotated
+        """
+
+        row = self.conn.execute(
+            "SELECT chrom, strand FROM transcripts WHERE transcript_id = ? AND chrom IS NOT NULL LIMIT 1",
+            (ensembl_trx_id,)).fetchone()
+
+        return row
+
+    def close(self):
+        """Closes the index database."""
+
+        self.conn.close()
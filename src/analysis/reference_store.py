@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""Content-addressed store of indexed reference FASTAs shared across runs."""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from analysis.references import index_reference
+import analysis.seq_utils as su
+import core_utils.file_utils as fu
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceStore(object):
+    """Store of reference FASTAs and their faidx and bowtie2 indexes, keyed by FASTA contents and bowtie2 version."""
+
+    READY_FILE = "ready"  # names the stored FASTA; written last so its presence marks a complete entry
+    LOCK_SUFFIX = "lock"  # exclusive lock held while an entry is built or removed
+    BUILD_PREFIX = "build."
+    BOWTIE2_VERSION_NA = "NA"
+    BOWTIE2_VERSION_RE = re.compile(r"version (\S+)")
+    DEFAULT_MAX_AGE_DAYS = None
+    DEFAULT_MAX_SIZE_GB = None
+    SECONDS_PER_DAY = 86400
+    BYTES_PER_GB = 1073741824
+
+    def __init__(self, store_dir):
+        """Constructor for ReferenceStore.
+
+        :param str store_dir: directory holding the store. Created if it does not exist.
+        """
+
+        self.store_dir = os.path.abspath(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.bowtie2_version = self.get_bowtie2_version()
+        self._entry_fds = {}  # open entry dirs, each holding a shared lock until close
+
+    @classmethod
+    def get_bowtie2_version(cls):
+        """Gets the version of bowtie2-build, which determines the format of the FM index.
+
+        :return str: version, or NA if bowtie2-build is not installed
+        """
+
+        try:
+            version_output = subprocess.check_output(("bowtie2-build", "--version"), stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return cls.BOWTIE2_VERSION_NA
+
+        version_match = cls.BOWTIE2_VERSION_RE.search(version_output.decode())
+        return cls.BOWTIE2_VERSION_NA if version_match is None else version_match.group(1)
+
+    def get_key(self, ref):
+        """Gets the store key of a reference.
+
+        :param str ref: path of the reference FASTA
+        :return str: hex digest of the FASTA contents and the bowtie2 version
+        """
+
+        key_hash = hashlib.sha256(fu.get_file_digest(ref).encode())
+        key_hash.update(self.bowtie2_version.encode())
+        return key_hash.hexdigest()
+
+    @contextlib.contextmanager
+    def _lock(self, key, blocking=True):
+        """Holds an exclusive lock on a store entry.
+
+        :param str key: store key
+        :param bool blocking: wait for the lock? Default True. If False, yields False if the lock is held elsewhere.
+        :return bool: whether the lock was acquired
+        """
+
+        lock_file = os.path.join(self.store_dir, fu.add_extension(key, self.LOCK_SUFFIX))
+
+        while True:
+            lock_fh = open(lock_file, "a")
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_fh.close()
+                yield False
+                return
+
+            # collect_garbage may have removed the lock file while we waited, in which case lock the new file
+            try:
+                if os.path.samestat(os.fstat(lock_fh.fileno()), os.stat(lock_file)):
+                    break
+            except FileNotFoundError:
+                pass
+
+            lock_fh.close()
+
+        try:
+            yield True
+        finally:
+            # Closing the file releases the lock
+            lock_fh.close()
+
+    def _hold_entry(self, key):
+        """Takes a shared lock on an entry dir, which prevents its removal until close.
+
+        :param str key: store key
+        """
+
+        if key in self._entry_fds:
+            return
+
+        entry_fd = os.open(os.path.join(self.store_dir, key), os.O_RDONLY)
+        fcntl.flock(entry_fd, fcntl.LOCK_SH)
+        self._entry_fds[key] = entry_fd
+
+    def close(self):
+        """Releases the entries held by this run so that they may be garbage collected."""
+
+        for entry_fd in self._entry_fds.values():
+            os.close(entry_fd)
+
+        self._entry_fds = {}
+
+    def _get_stored_ref(self, key):
+        """Gets the stored FASTA of a complete entry.
+
+        :param str key: store key
+        :return str | None: path of the stored FASTA, or None if there is no complete entry
+        """
+
+        ready_file = os.path.join(self.store_dir, key, self.READY_FILE)
+        if not os.path.exists(ready_file):
+            return None
+
+        with open(ready_file, "r") as ready_fh:
+            return os.path.join(self.store_dir, key, ready_fh.read().strip())
+
+    def _build_entry(self, ref, key, fm_index):
+        r"""Copies and indexes a reference in a build dir and renames it into place.
+
+        :param str ref: path of the reference FASTA
+        :param str key: store key
+        :param bool fm_index: build the bowtie2 FM index?
+        :return str: path of the stored FASTA
+
+        Any faidx and bowtie2 index files next to the input FASTA are copied along with it, so only missing indexes \
+        are built.
+        """
+
+        # The key in the build dir name lets collect_garbage find builds abandoned by killed runs
+        build_dir = tempfile.mkdtemp(prefix=self.BUILD_PREFIX + key + fu.FILE_EXT_DELIM, dir=self.store_dir)
+        ref_basename = os.path.basename(ref)
+
+        try:
+            for filename in [ref, fu.add_extension(ref, su.FASTA_INDEX_SUFFIX)] + glob.glob(ref + ".*bt2*"):
+                if os.path.exists(filename):
+                    shutil.copy(filename, build_dir)
+
+            build_ref = os.path.join(build_dir, ref_basename)
+            index_reference(build_ref, fm_index)
+
+            if not os.path.exists(fu.add_extension(build_ref, su.FASTA_INDEX_SUFFIX)):
+                raise RuntimeError("Failed to index reference FASTA %s." % ref)
+
+            with open(os.path.join(build_dir, self.READY_FILE), "w") as ready_fh:
+                ready_fh.write(ref_basename + fu.FILE_NEWLINE)
+
+            # The rename is atomic so concurrent runs never see a partial entry
+            os.rename(build_dir, os.path.join(self.store_dir, key))
+
+        except Exception:
+            fu.safe_remove((build_dir,), force_remove=True)
+            raise
+
+        return os.path.join(self.store_dir, key, ref_basename)
+
+    def get_reference(self, ref, fm_index=True):
+        r"""Gets an indexed copy of a reference, building the indexes only if no run has built them before.
+
+        :param str ref: path of the reference FASTA
+        :param bool fm_index: require the bowtie2 FM index? Default True. Not needed by the banded aligner.
+        :return str: path of the stored, indexed FASTA
+
+        Stored files should be treated as read-only, as they are shared by concurrent runs. The entry is held until \
+        close, so garbage collection by concurrent runs does not remove it while it is in use.
+        """
+
+        key = self.get_key(ref)
+
+        with self._lock(key):
+            stored_ref = self._get_stored_ref(key)
+
+            if stored_ref is None:
+                logger.info("Adding reference %s to the reference store %s." % (ref, self.store_dir))
+                stored_ref = self._build_entry(ref, key, fm_index)
+            else:
+                logger.info("Using stored reference %s." % stored_ref)
+                # An entry first stored for the banded aligner may lack the FM index, which is added in place
+                index_reference(stored_ref, fm_index)
+
+            # Record the last use for garbage collection
+            os.utime(os.path.join(self.store_dir, key, self.READY_FILE))
+            self._hold_entry(key)
+
+        return stored_ref
+
+    def _get_entries(self):
+        """Gets the complete entries of the store.
+
+        :return list: (last_used, nbytes, key) tuples, oldest first
+        """
+
+        entries = []
+        for key in os.listdir(self.store_dir):
+            ready_file = os.path.join(self.store_dir, key, self.READY_FILE)
+            if not os.path.exists(ready_file):
+                continue
+
+            entry_dir = os.path.join(self.store_dir, key)
+            nbytes = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(ready_file), nbytes, key))
+
+        return sorted(entries)
+
+    def _remove_entry(self, key):
+        """Removes an entry if no run holds it.
+
+        :param str key: store key
+        :return bool: whether the entry was removed
+        """
+
+        entry_dir = os.path.join(self.store_dir, key)
+
+        with self._lock(key, blocking=False) as acquired:
+            if not acquired or not os.path.exists(entry_dir):
+                return False
+
+            entry_fd = os.open(entry_dir, os.O_RDONLY)
+            try:
+                fcntl.flock(entry_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            finally:
+                os.close(entry_fd)
+
+            logger.info("Removing stored reference %s." % key)
+            fu.safe_remove((entry_dir, os.path.join(self.store_dir, fu.add_extension(key, self.LOCK_SUFFIX)),),
+                           force_remove=True)
+
+        return True
+
+    def _remove_orphans(self):
+        """Removes build dirs abandoned by killed runs and lock files of keys without an entry."""
+
+        orphan_keys = set()
+        for filename in os.listdir(self.store_dir):
+            if filename.startswith(self.BUILD_PREFIX):
+                orphan_keys.add(filename[len(self.BUILD_PREFIX):].split(fu.FILE_EXT_DELIM)[0])
+            elif filename.endswith(fu.FILE_EXT_DELIM + self.LOCK_SUFFIX):
+                orphan_keys.add(fu.remove_extension(filename))
+
+        for key in orphan_keys:
+            if key in self._entry_fds:
+                continue
+
+            # Builds hold the lock, so any build dir found while we hold it has been abandoned
+            with self._lock(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+
+                orphans = glob.glob(os.path.join(self.store_dir, self.BUILD_PREFIX + key + fu.FILE_EXT_DELIM + "*"))
+                if not os.path.exists(os.path.join(self.store_dir, key)):
+                    orphans.append(os.path.join(self.store_dir, fu.add_extension(key, self.LOCK_SUFFIX)))
+
+                if len(orphans) > 0:
+                    logger.info("Removing abandoned files %s from the reference store." % orphans)
+                    fu.safe_remove(tuple(orphans), force_remove=True)
+
+    def collect_garbage(self, max_age_days=DEFAULT_MAX_AGE_DAYS, max_size_gb=DEFAULT_MAX_SIZE_GB, keep=()):
+        r"""Removes entries unused for longer than a max age, then the least recently used entries over a max size.
+
+        :param float | None max_age_days: remove entries last used more than this many days ago. Default None, \
+        no age limit.
+        :param float | None max_size_gb: remove the least recently used entries until the store is at most this \
+        size. Default None, no size limit.
+        :param tuple keep: stored FASTAs that should not be removed, e.g. those used by the current run
+        :return list: keys of the removed entries
+
+        Entries being built, or held by a run that has not closed its store, are skipped. Build dirs and lock files \
+        left by killed runs are also removed.
+        """
+
+        self._remove_orphans()
+
+        keep_keys = {os.path.basename(os.path.dirname(os.path.abspath(f))) for f in keep}
+        entries = self._get_entries()
+        store_nbytes = sum(nbytes for _, nbytes, _ in entries)
+        min_last_used = None if max_age_days is None else time.time() - max_age_days * self.SECONDS_PER_DAY
+        max_nbytes = None if max_size_gb is None else max_size_gb * self.BYTES_PER_GB
+
+        removed = []
+        for last_used, nbytes, key in entries:
+
+            is_old = min_last_used is not None and last_used < min_last_used
+            is_over_size = max_nbytes is not None and store_nbytes > max_nbytes
+            if key in keep_keys or key in self._entry_fds or not (is_old or is_over_size):
+                continue
+
+            if not self._remove_entry(key):
+                continue
+
+            store_nbytes -= nbytes
+            removed.append(key)
+
+        return removed
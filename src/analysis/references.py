@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Utilities for extracting reference files from Ensembl IDs."""
 
+import collections
 import logging
 import pybedtools
 import pysam
@@ -9,9 +10,11 @@ import subprocess
 
 from analysis.aligners import BowtieConfig
 import analysis.seq_utils as su
-from analysis.coordinate_mapper import MapperBase
+from analysis.coordinate_mapper import MapperBase, AminoAcidMapper
+from analysis.reference_ids import ReferenceIdIndex, APPRIS_CONTIG_DELIM, APPRIS_GENE_INDEX
 import core_utils.file_utils as fu
 import core_utils.feature_file_utils as ffu
+from core_utils.gff_index import GffIndex
 from satmut_utils.definitions import *
 
 __author__ = "Ian_Hoskins"
@@ -21,9 +24,10 @@ __maintainer__ = "Ian Hoskins"
 __email__ = "ianjameshoskins@utexas.edu"
 __status__ = "Development"
 
-APPRIS_CONTIG_DELIM = "|"
-APPRIS_TRX_INDEX = 0
-APPRIS_GENE_INDEX = 1
+PANEL_FASTA = "panel.fa"
+PANEL_GFF = "panel.gtf"
+PANEL_MANIFEST = "panel_manifest.txt"
+PANEL_ENTRY_TUPLE = collections.namedtuple("PANEL_ENTRY_TUPLE", "ensembl_id, transcript_id, contig")
 
 logger = logging.getLogger(__name__)
 
@@ -47,28 +51,22 @@ def ensembl_id_exists(reference_dir, ensembl_id):
     :raises InvalidEnsemblId: if the Ensembl ID does not start with ENST or ENSG
     """
 
-    if re.search(MapperBase.ENSEMBL_TRX_PREFIX, ensembl_id):
-        with open(os.path.join(reference_dir, APPRIS_TRX_IDS), "r") as id_file:
-            ids = {line.rstrip(fu.FILE_NEWLINE) for line in id_file}
-    elif re.search(MapperBase.ENSEMBL_GENE_PREFIX, ensembl_id):
-        with open(os.path.join(reference_dir, APPRIS_GENE_IDS), "r") as id_file:
-            ids = {line.rstrip(fu.FILE_NEWLINE) for line in id_file}
-    else:
+    if not re.search(MapperBase.ENSEMBL_TRX_PREFIX, ensembl_id) and \
+            not re.search(MapperBase.ENSEMBL_GENE_PREFIX, ensembl_id):
         raise InvalidEnsemblId("Ensembl ID %s was passed. Please provide a valid Ensembl identifier." % ensembl_id)
 
-    if ensembl_id in ids:
-        return True, None
-    else:
-        ensembl_id_base = ensembl_id.split(".")[0]
+    with ReferenceIdIndex(reference_dir) as id_index:
+        if id_index.id_exists(ensembl_id):
+            return True, None
+
         # See if we have the base ID but a different version
-        for appris_id in ids:
-            base_id = appris_id.split(".")[0]
-            if ensembl_id_base == base_id:
-                logger.info(
-                    "Ensembl ID %s was not found; however, curated reference files contain %s" % (ensembl_id, appris_id))
-                return False, appris_id
-        else:
-            return False, None
+        appris_id = id_index.get_alternative_id(ensembl_id)
+
+    if appris_id is not None:
+        logger.info(
+            "Ensembl ID %s was not found; however, curated reference files contain %s" % (ensembl_id, appris_id))
+
+    return False, appris_id
 
 
 def get_trx_id_from_gene_id(reference_dir, ensembl_gene_id):
@@ -79,15 +77,9 @@ def get_trx_id_from_gene_id(reference_dir, ensembl_gene_id):
     :return str | None: transcript ID corresponding to the ensembl_gene_id; None if the gene ID not found
     """
 
-    with open(os.path.join(reference_dir, APPRIS_CONTIG_IDS), "r") as contig_file:
-        for line in contig_file:
-            gene_id = line.split(APPRIS_CONTIG_DELIM)[APPRIS_GENE_INDEX]
-
-            # Use the first transcript found for the gene ID
-            if ensembl_gene_id == gene_id:
-                return line.split(APPRIS_CONTIG_DELIM)[APPRIS_TRX_INDEX]
-        else:
-            return None
+    # Use the first transcript found for the gene ID
+    with ReferenceIdIndex(reference_dir) as id_index:
+        return id_index.get_trx_id(ensembl_gene_id)
 
 
 def extract_fasta_reference(reference_dir, ensembl_id, outdir="."):
@@ -97,6 +89,7 @@ def extract_fasta_reference(reference_dir, ensembl_id, outdir="."):
     :param str ensembl_id: Ensembl gene or transcript ID, with version number
     :param str outdir: optional output directory for the reference files
     :return str: filepath of the output FASTA
+    :raises EnsemblIdNotFound: if the ID has no contig in the transcript FASTA
     """
 
     if not os.path.exists(outdir):
@@ -104,9 +97,11 @@ def extract_fasta_reference(reference_dir, ensembl_id, outdir="."):
 
     output_fasta = os.path.join(outdir, fu.add_extension(ensembl_id, su.FASTA_FILETYPE))
 
-    with open(os.path.join(reference_dir, APPRIS_CONTIG_IDS), "r") as contig_id_file:
-        contig_id = [line.rstrip(fu.FILE_NEWLINE) for line in contig_id_file if ensembl_id in set(
-            line.split(APPRIS_CONTIG_DELIM)[:2])][0]
+    with ReferenceIdIndex(reference_dir) as id_index:
+        contig_id = id_index.get_contig(ensembl_id)
+
+    if contig_id is None:
+        raise EnsemblIdNotFound("No transcript reference contig associated with Ensembl ID %s" % ensembl_id)
 
     logger.info("Extracting transcript reference FASTA for %s." % ensembl_id)
     fa = pysam.faidx(os.path.join(reference_dir, APPRIS_TRX_FASTA), contig_id)
@@ -132,10 +127,8 @@ def extract_gff_reference(reference_dir, ensembl_id, outdir="."):
     logger.info("Extracting GFF transcript annotations for %s." % ensembl_id)
     output_gff = os.path.join(outdir, fu.add_extension(ensembl_id, su.GFF_DEFAULT_EXT))
 
-    extract_call = ("fgrep", ensembl_id, os.path.join(reference_dir, GENCODE_TRX_GFF))
-
-    with open(output_gff, "w") as out_gff:
-        subprocess.call(extract_call, stdout=out_gff)
+    # Seek to the transcript's records rather than scanning the whole annotation
+    GffIndex(os.path.join(reference_dir, GENCODE_TRX_GFF)).write_transcript(ensembl_id, output_gff)
 
     return output_gff
 
@@ -150,10 +143,11 @@ def faidx_ref(ref):
     subprocess.call(("samtools", "faidx", ref))
 
 
-def index_reference(ref):
+def index_reference(ref, fm_index=True):
     """samtools and bowtie2-indexes the reference FASTA.
 
     :param str ref: reference FASTA
+    :param bool fm_index: build the bowtie2 FM index? Default True. Not needed by the banded aligner.
     """
 
     # Need to index the reference with samtools and create a FM-index with bowtie2 if it has not been done
@@ -161,6 +155,9 @@ def index_reference(ref):
         logger.info("Generating FASTA index file for %s." % ref)
         faidx_ref(ref)
 
+    if not fm_index:
+        return
+
     # Build the bowtie2 index if it doesn't exist
     try:
         _ = BowtieConfig(ref=ref).test_build()
@@ -170,13 +167,12 @@ def index_reference(ref):
         _ = BowtieConfig(ref=ref).build_fm_index()
 
 
-def get_ensembl_references(reference_dir, ensembl_id, outdir="."):
-    """Extracts reference files given an Ensembl gene or transcript ID.
+def resolve_ensembl_id(reference_dir, ensembl_id):
+    """Resolves an Ensembl ID to a curated transcript ID.
 
     :param str reference_dir: directory containing curated APPRIS reference files
     :param str ensembl_id: Ensembl gene or transcript ID, with version number
-    :param str outdir: optional output directory for the reference files
-    :return tuple: (transcript_fasta, transcript_gff)
+    :return str: Ensembl transcript ID
     :raises EnsemblIdNotFound: if the ensembl ID is not valid or the ID was not found in the APPRIS set
     """
 
@@ -189,7 +185,7 @@ def get_ensembl_references(reference_dir, ensembl_id, outdir="."):
                 (ensembl_id, alternative_id))
         else:
             raise EnsemblIdNotFound(
-                "Ensembl ID %s was not found in the references. Please provide custom reference files.")
+                "Ensembl ID %s was not found in the references. Please provide custom reference files." % ensembl_id)
 
     # Always select a transcript ID if a gene ID was passed; this ensures we get only one transcript reference
     # when filtering the GFF
@@ -200,11 +196,119 @@ def get_ensembl_references(reference_dir, ensembl_id, outdir="."):
             raise EnsemblIdNotFound(
                 "No Ensembl transcript associated with Ensembl ID %s" % ensembl_id)
 
+    return ensembl_trx_id
+
+
+def get_ensembl_references(reference_dir, ensembl_id, outdir=".", fm_index=True, reference_store=None):
+    r"""Extracts reference files given an Ensembl gene or transcript ID.
+
+    :param str reference_dir: directory containing curated APPRIS reference files
+    :param str ensembl_id: Ensembl gene or transcript ID, with version number
+    :param str outdir: optional output directory for the reference files
+    :param bool fm_index: build the bowtie2 FM index for the transcript FASTA? Default True.
+    :param analysis.reference_store.ReferenceStore | None reference_store: optional store of indexed references \
+    shared across runs. If provided, the returned FASTA is the stored copy. Default None, index in outdir.
+    :return tuple: (transcript_fasta, transcript_gff)
+    :raises EnsemblIdNotFound: if the ensembl ID is not valid or the ID was not found in the APPRIS set
+    """
+
+    ensembl_trx_id = resolve_ensembl_id(reference_dir, ensembl_id)
+
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
     fa = extract_fasta_reference(reference_dir, ensembl_id, outdir)
     gff = extract_gff_reference(reference_dir, ensembl_trx_id, outdir)
-    index_reference(fa)
+
+    if reference_store is not None:
+        return reference_store.get_reference(fa, fm_index), gff
+
+    index_reference(fa, fm_index)
 
     return fa, gff
+
+
+def build_panel_references(reference_dir, ensembl_ids, outdir=".", fm_index=True):
+    r"""Extracts and indexes one combined reference for a panel of Ensembl IDs.
+
+    :param str reference_dir: directory containing curated APPRIS reference files
+    :param list ensembl_ids: Ensembl gene or transcript IDs, with version numbers
+    :param str outdir: optional output directory for the panel reference files
+    :param bool fm_index: build the bowtie2 FM index for the panel FASTA? Default True.
+    :return str: path of the panel manifest
+    :raises EnsemblIdNotFound: if any ensembl ID is not valid or was not found in the APPRIS set
+
+    The transcripts of all IDs are written to one multi-contig FASTA and GFF, which are indexed once along with one \
+    set of CDS annotations. The manifest is written last, so a panel dir with a manifest is complete.
+    """
+
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+
+    panel_entries = []
+    with ReferenceIdIndex(reference_dir) as id_index:
+        for ensembl_id in ensembl_ids:
+            ensembl_trx_id = resolve_ensembl_id(reference_dir, ensembl_id)
+            panel_entries.append(PANEL_ENTRY_TUPLE(
+                ensembl_id=ensembl_id, transcript_id=ensembl_trx_id, contig=id_index.get_contig(ensembl_trx_id)))
+
+    # IDs of the same gene or transcript share a contig
+    trx_contigs = collections.OrderedDict((e.transcript_id, e.contig) for e in panel_entries)
+
+    logger.info("Extracting %i transcript references for the panel." % len(trx_contigs))
+    panel_fa = os.path.join(outdir, PANEL_FASTA)
+    with pysam.FastaFile(os.path.join(reference_dir, APPRIS_TRX_FASTA)) as trx_ff, \
+            open(panel_fa, "w") as out_fasta_fh:
+        for contig in trx_contigs.values():
+            out_fasta_fh.write(su.FASTA_HEADER_CHAR + contig + fu.FILE_NEWLINE + trx_ff.fetch(contig) + fu.FILE_NEWLINE)
+
+    logger.info("Extracting GFF transcript annotations for the panel.")
+    panel_gff = os.path.join(outdir, PANEL_GFF)
+    gff_index = GffIndex(os.path.join(reference_dir, GENCODE_TRX_GFF))
+    with open(gff_index.gff, "rb") as gff_fh, open(panel_gff, "w") as out_gff_fh:
+        for ensembl_trx_id in trx_contigs.keys():
+            out_gff_fh.write(gff_index.read_transcript(ensembl_trx_id, gff_fh))
+
+    index_reference(panel_fa, fm_index)
+
+    # Fill the CDS store in the panel dir, which calling runs pass to the variant caller
+    logger.info("Collecting transcript CDS annotations for the panel.")
+    aa_mapper = AminoAcidMapper(gff=panel_gff, ref=os.path.join(reference_dir, GRCH38_FASTA), outdir=outdir,
+                                use_pickle=False, make_pickle=False)
+    _ = aa_mapper._get_cds_info()
+    aa_mapper.cds_store.close()
+
+    panel_manifest = os.path.join(outdir, PANEL_MANIFEST)
+    with open(panel_manifest, "w") as manifest_fh:
+        manifest_fh.write(fu.FILE_DELIM.join(PANEL_ENTRY_TUPLE._fields) + fu.FILE_NEWLINE)
+        for panel_entry in panel_entries:
+            manifest_fh.write(fu.FILE_DELIM.join(panel_entry) + fu.FILE_NEWLINE)
+
+    return panel_manifest
+
+
+def get_panel_references(panel_dir, ensembl_id):
+    """Selects an Ensembl ID's references from a previously built panel, without extracting or indexing.
+
+    :param str panel_dir: directory of a panel built by build_panel_references
+    :param str ensembl_id: Ensembl gene or transcript ID, with version number
+    :return tuple | None: (panel_fasta, panel_gff), or None if the panel is incomplete or does not contain the ID
+    """
+
+    panel_manifest = os.path.join(panel_dir, PANEL_MANIFEST)
+    if not os.path.exists(panel_manifest):
+        return None
+
+    with open(panel_manifest, "r") as manifest_fh:
+        _ = manifest_fh.readline()
+        panel_entries = [PANEL_ENTRY_TUPLE(*line.rstrip(fu.FILE_NEWLINE).split(fu.FILE_DELIM)) for line in manifest_fh]
+
+    for panel_entry in panel_entries:
+        if ensembl_id in {panel_entry.ensembl_id, panel_entry.transcript_id,
+                          panel_entry.contig.split(APPRIS_CONTIG_DELIM)[APPRIS_GENE_INDEX]}:
+            logger.info("Selecting contig %s from the panel references in %s." % (panel_entry.contig, panel_dir))
+            break
+    else:
+        return None
+
+    return os.path.join(panel_dir, PANEL_FASTA), os.path.join(panel_dir, PANEL_GFF)
@@ -2,14 +2,18 @@
 """Collection of sequence manipulation utilities."""
 
 import aenum
+import collections
 import logging
+import numpy as np
 import os
 import pysam
 import random
 import subprocess
 import tempfile
 
-from core_utils.file_utils import flush_files, add_extension, remove_extension, FILE_NEWLINE
+import core_utils.fastq_utils as fqu
+from core_utils.file_utils import flush_files, add_extension, remove_extension, FILE_DELIM, FILE_NEWLINE, \
+    GZ_EXTENSION
 from satmut_utils.definitions import DEFAULT_TEMPDIR
 
 __author__ = "Ian Hoskins"
@@ -22,6 +26,8 @@ __status__ = "Development"
 tempfile.tempdir = DEFAULT_TEMPDIR
 logger = logging.getLogger(__name__)
 
+FASTQ_RECORD_TUPLE = collections.namedtuple("FASTQ_RECORD_TUPLE", "name, sequence, quality, comment")
+
 DEFAULT_ERROR_RATE = 0.01
 DEFAULT_INDEL_RATE = 0.005
 MASKED_BQ = 0
@@ -50,9 +56,11 @@ SAM_FLAG_REVERSE = 16
 SAM_HD_TAG = "HD"
 SAM_SQ_TAG = "SQ"
 SAM_RG_TAG = "RG"
+SAM_RG_ID_TAG = "ID"
 SAM_PG_TAG = "PG"
 SAM_HD_SO_TAG = "SO"
 SAM_HD_SO_QNAME_VAL = "queryname"
+SAM_HD_SO_UNSORTED_VAL = "unsorted"
 
 DNA_BASES = ("A", "C", "G", "T")
 RNA_BASES = ("A", "C", "G", "U")
@@ -77,6 +85,8 @@ SAM_BAM_SUFFIX = "am"
 SAM_SUFFIX = "sam"
 BAM_SUFFIX = "bam"
 BAM_INDEX_SUFFIX = "bai"
+CRAM_SUFFIX = "cram"
+CRAM_INDEX_SUFFIX = "crai"
 SAM_HEADER_CHAR = "@"
 SAM_HD_HEADER = "HD"
 SAM_SQ_HEADER = "SQ"
@@ -98,6 +108,12 @@ PYSAM_CIGARTUPLES_INS = 1
 PYSAM_CIGARTUPLES_DEL = 2
 PYSAM_CIGARTUPLES_SOFTCLIP = 4
 PYSAM_CIGARTUPLES_HARDCLIP = 5
+PYSAM_CIGARTUPLES_REFSKIP = 3
+PYSAM_CIGARTUPLES_SEQ_MATCH = 7
+PYSAM_CIGARTUPLES_SEQ_MISMATCH = 8
+PYSAM_CIGARTUPLES_ALIGNED = {PYSAM_CIGARTUPLES_MATCH, PYSAM_CIGARTUPLES_SEQ_MATCH, PYSAM_CIGARTUPLES_SEQ_MISMATCH}
+PYSAM_CIGARTUPLES_REF_ONLY = {PYSAM_CIGARTUPLES_DEL, PYSAM_CIGARTUPLES_REFSKIP}
+PYSAM_CIGARTUPLES_QUERY_ONLY = {PYSAM_CIGARTUPLES_INS, PYSAM_CIGARTUPLES_SOFTCLIP}
 COORD_FORMAT = "{}:{}-{}"
 COORD_FORMAT_STRAND = "{}:{}-{}:{}"
 R_COMPAT_NA = "NA"
@@ -159,21 +175,24 @@ def get_contig_lookup(transcriptome_reference):
 
     :param str transcriptome_reference: path of the transcriptome reference
     :return dict: mapping of short Ensembl transcript IDs to the full contig name
+
+    Contig names are read from the FASTA index if it exists, rather than scanning the FASTA.
     """
 
     contig_lookup = {}
 
-    grep_call = ("grep", "^>", transcriptome_reference)
-
-    with tempfile.NamedTemporaryFile(suffix=".grep.res", mode="r+") as res_file:
+    fasta_index = add_extension(transcriptome_reference, FASTA_INDEX_SUFFIX)
+    if os.path.exists(fasta_index):
+        with open(fasta_index, "r") as index_fh:
+            full_names = [line.split(FILE_DELIM)[0] for line in index_fh]
+    else:
+        with open(transcriptome_reference, "r") as ref_fh:
+            full_names = [line.strip(FASTA_HEADER_CHAR + FILE_NEWLINE) for line in ref_fh
+                          if line.startswith(FASTA_HEADER_CHAR)]
 
-        subprocess.run(grep_call, stdout=res_file)
-        flush_files((res_file,))
-
-        for line in res_file:
-            full_name = line.strip(FASTA_HEADER_CHAR + FILE_NEWLINE)
-            short_name = full_name.split(FASTA_CONTIG_DELIM)[FASTA_CONTIG_ID_FIELD]
-            contig_lookup[short_name] = full_name
+    for full_name in full_names:
+        short_name = full_name.split(FASTA_CONTIG_DELIM)[FASTA_CONTIG_ID_FIELD]
+        contig_lookup[short_name] = full_name
 
     return contig_lookup
 
@@ -224,6 +243,44 @@ def extract_seq(contig, start, stop, ref):
     return seq
 
 
+def is_cram(am):
+    """Determines if an alignment file is CRAM by its extension.
+
+    :param str am: alignment file
+    :return bool: whether the file is CRAM
+    """
+
+    res = am.endswith("." + CRAM_SUFFIX)
+    return res
+
+
+def get_index_name(am):
+    """Gets the name of the index of a BAM or CRAM.
+
+    :param str am: alignment file
+    :return str: name of the .bai or .crai index
+    """
+
+    index_suffix = CRAM_INDEX_SUFFIX if is_cram(am) else BAM_INDEX_SUFFIX
+    return add_extension(am, index_suffix)
+
+
+def open_alignments(am, ref=None, **kwargs):
+    r"""Opens a BAM or CRAM for reading.
+
+    :param str am: alignment file
+    :param str | None ref: reference FASTA for decoding CRAM. If None, htslib looks up the reference in the header \
+    or REF_PATH.
+    :param kwargs: additional keyword arguments for pysam.AlignmentFile
+    :return pysam.AlignmentFile: alignment file open for reading
+    """
+
+    if is_cram(am):
+        return pysam.AlignmentFile(am, "rc", reference_filename=ref, **kwargs)
+
+    return pysam.AlignmentFile(am, "rb", **kwargs)
+
+
 def sam_view(am, output_am=None, output_format="BAM", nthreads=0, *args, **kwargs):
     """samtools view an alignment file.
 
@@ -262,6 +319,21 @@ def sam_view(am, output_am=None, output_format="BAM", nthreads=0, *args, **kwarg
     return outname
 
 
+def bam_to_cram(bam, ref, output_cram=None, nthreads=0):
+    """Converts an alignment file to CRAM with reference-based compression, and indexes it.
+
+    :param str bam: alignment file
+    :param str ref: indexed reference FASTA the alignments were made to
+    :param str | None output_cram: optional output name
+    :param int nthreads: number additional threads to use
+    :return str: output CRAM
+    """
+
+    outname = sam_view(bam, output_cram, "CRAM", nthreads, T=ref)
+    index_bam(outname)
+    return outname
+
+
 def sort_bam(bam, output_am=None, output_format="BAM", by_qname=False, nthreads=0, *args, **kwargs):
     """samtools sort an alignment file.
 
@@ -319,21 +391,53 @@ def sort_bam(bam, output_am=None, output_format="BAM", by_qname=False, nthreads=
     return outname
 
 
+def collate_bam(bam, output_am=None, nthreads=0, compresslevel=None, ref=None):
+    """samtools collate an alignment file so that mates are adjacent, without a full qname sort.
+
+    :param str bam: alignment file
+    :param str | None output_am: optional output name
+    :param int nthreads: number additional threads to use
+    :param int | None compresslevel: optional BGZF compression level of the output. Default None (samtools default).
+    :param str | None ref: optional reference FASTA for decoding a CRAM input
+    :return str: output file
+    :raises subprocess.CalledProcessError: if samtools collate fails
+    """
+
+    outname = output_am
+    if output_am is None:
+        outname = tempfile.NamedTemporaryFile("w+b", suffix=".collate.bam", delete=False).name
+
+    call_args = ["samtools", "collate", "-o", outname, "-@", str(nthreads)]
+
+    if compresslevel is not None:
+        call_args += ["-l", str(compresslevel)]
+
+    if ref is not None:
+        call_args += ["--reference", ref]
+
+    call_args += [bam]
+    subprocess.run(call_args, check=True)
+
+    return outname
+
+
 def index_bam(bam):
-    """Indexes a BAM.
+    """Indexes a BAM or CRAM.
 
-    :param str bam: BAM file name
+    :param str bam: BAM or CRAM file name
     """
 
     pysam.index(bam)
 
 
-def sort_and_index(am, output_am=None, nthreads=0):
-    """Sorts and indexes a SAM/BAM file.
+def sort_and_index(am, output_am=None, nthreads=0, compresslevel=None, ref=None):
+    """Sorts and indexes a SAM/BAM/CRAM file.
 
     :param str am: alignment file
     :param str output_am: optional output name
     :param int nthreads: number additional threads to use
+    :param int | None compresslevel: optional BGZF compression level of the output. Default None (samtools default).
+    :param str | None ref: optional reference FASTA for decoding a CRAM input
     :return str: output BAM file
     """
 
@@ -341,7 +445,11 @@ def sort_and_index(am, output_am=None, nthreads=0):
     if output_am is None:
         outname = tempfile.NamedTemporaryFile("w+b", suffix=".bam", delete=False).name
 
-    sorted_bam = sort_bam(bam=am, output_am=outname, nthreads=nthreads)
+    sort_kwargs = {} if compresslevel is None else {"l": str(compresslevel)}
+    if ref is not None:
+        sort_kwargs["reference"] = ref
+
+    sorted_bam = sort_bam(bam=am, output_am=outname, nthreads=nthreads, **sort_kwargs)
     index_bam(sorted_bam)
 
     return sorted_bam
@@ -394,13 +502,15 @@ def bam_fixmate(bam, output_bam=None, nthreads=0):
     return outname
 
 
-def bam_to_fastq(bam, out_prefix=None, is_paired=True, nthreads=0, *args, **kwargs):
+def bam_to_fastq(bam, out_prefix=None, is_paired=True, nthreads=0, compress=False, *args, **kwargs):
     """Converts BAM to FASTQ.
 
     :param str bam: BAM file to convert
     :param str | None out_prefix: output prefix to use for FASTQs, containing the directory path
     :param bool is_paired: does the BAM consist of paired reads? Default True
     :param int nthreads: number additional threads to use
+    :param bool compress: write BGZF-compressed .gz FASTQs with the same threads, instead of plain FASTQs? \
+    Default False.
     :param sequence args: additional flags to pass in as str, no - prefix
     :param dict kwargs: key-value args to pass, no --prefix
     :return tuple: (str, str | None) paths of the R1 and R2 (if present) FASTQ files
@@ -426,12 +536,15 @@ def bam_to_fastq(bam, out_prefix=None, is_paired=True, nthreads=0, *args, **kwar
         else:
             raise NotImplementedError("The option %s is not recognized." % k)
 
-    r1_fastq = add_extension(add_extension(outfile_prefix, "R1"), FASTQ_SUFFIX)
+    # samtools compresses outputs ending in .gz
+    fastq_suffix = add_extension(FASTQ_SUFFIX, GZ_EXTENSION) if compress else FASTQ_SUFFIX
+
+    r1_fastq = add_extension(add_extension(outfile_prefix, "R1"), fastq_suffix)
     r2_fastq = None
     call_args.extend(["-1", r1_fastq])
 
     if is_paired:
-        r2_fastq = add_extension(add_extension(outfile_prefix, "R2"), FASTQ_SUFFIX)
+        r2_fastq = add_extension(add_extension(outfile_prefix, "R2"), fastq_suffix)
         call_args.extend(["-2", r2_fastq])
 
     call_args.extend([bam])
@@ -441,6 +554,82 @@ def bam_to_fastq(bam, out_prefix=None, is_paired=True, nthreads=0, *args, **kwar
     return r1_fastq, r2_fastq
 
 
+def format_fastq_record(record):
+    r"""Formats a FASTQ record, or a FASTA record if there are no qualities.
+
+    :param pysam.FastxRecord | analysis.seq_utils.FASTQ_RECORD_TUPLE record: record with name, sequence, quality, \
+    and comment attributes
+    :return str: record terminated by a newline
+    """
+
+    header = record.name
+    if record.comment is not None:
+        header += " " + record.comment
+
+    if record.quality is None:
+        return FILE_NEWLINE.join((FASTA_HEADER_CHAR + header, record.sequence)) + FILE_NEWLINE
+
+    res = FILE_NEWLINE.join(
+        (FASTQ_QNAME_CHAR + header, record.sequence, FASTQ_SPACER_CHAR, record.quality)) + FILE_NEWLINE
+    return res
+
+
+def align_seg_to_fastq_record(align_seg):
+    """Gets the FASTQ record of a read, in its sequenced orientation.
+
+    :param pysam.AlignedSegment align_seg: read
+    :return analysis.seq_utils.FASTQ_RECORD_TUPLE: record without mate suffix or comment
+    """
+
+    quals = align_seg.get_forward_qualities()
+    qual_str = pysam.qualities_to_qualitystring(quals, offset=ILLUMINA_BQ_OFFSET) if quals is not None \
+        else chr(DEFAULT_MAX_BQ + ILLUMINA_BQ_OFFSET) * align_seg.query_length
+
+    res = FASTQ_RECORD_TUPLE(
+        name=align_seg.query_name, sequence=align_seg.get_forward_sequence(), quality=qual_str, comment=None)
+
+    return res
+
+
+def iterate_bam_read_pairs(bam, is_paired=True):
+    r"""Generates FASTQ records of the reads in a BAM, as bam_to_fastq does but without writing files.
+
+    :param str bam: BAM file, ideally qname-sorted or with mates adjacent
+    :param bool is_paired: does the BAM consist of paired reads? Default True
+    :return generator: (R1, R2 | None) FASTQ_RECORD_TUPLEs
+
+    Secondary and supplementary alignments are skipped. For paired input, reads whose mate is absent are dropped, \
+    which is equivalent to bam_to_fastq with the singletons written to /dev/null.
+    """
+
+    unpaired_mates = {}
+    with pysam.AlignmentFile(bam, "rb", check_sq=False) as in_af:
+        for align_seg in in_af.fetch(until_eof=True):
+
+            if align_seg.is_secondary or align_seg.is_supplementary:
+                continue
+
+            record = align_seg_to_fastq_record(align_seg)
+            if not is_paired:
+                yield record, None
+                continue
+
+            if align_seg.is_read1 == align_seg.is_read2:
+                continue
+
+            mate_key = (align_seg.query_name, align_seg.is_read2)
+            mate_record = unpaired_mates.pop(mate_key, None)
+            if mate_record is None:
+                unpaired_mates[(align_seg.query_name, align_seg.is_read1)] = record
+            elif align_seg.is_read1:
+                yield record, mate_record
+            else:
+                yield mate_record, record
+
+    if len(unpaired_mates) > 0:
+        logger.warning("Dropped %i reads without a mate in %s." % (len(unpaired_mates), bam))
+
+
 def get_edit_distance(align_seg):
     """Gets the edit distance of an alignment.
 
@@ -579,7 +768,7 @@ def bq_ascii_to_int(bq, offset=ILLUMINA_BQ_OFFSET):
 
 def fasta_to_fastq(in_fasta, out_fastq=None, min_bq=DEFAULT_MIN_BQ, max_bq=DEFAULT_MAX_BQ, max_len=DEFAULT_READ_LEN,
                    add_error_snps=True, add_error_indels=False, snp_prob=DEFAULT_ERROR_RATE,
-                   indel_prob=DEFAULT_INDEL_RATE, letters=DNA_BASES):
+                   indel_prob=DEFAULT_INDEL_RATE, letters=DNA_BASES, nthreads=0):
     r"""Adds random quality scores to a FASTA to generate a FASTQ, optionally trims sequences to a max read length, \
     and adds sequencing error to simulate real sequencing reads.
 
@@ -593,59 +782,67 @@ def fasta_to_fastq(in_fasta, out_fastq=None, min_bq=DEFAULT_MIN_BQ, max_bq=DEFAU
     :param float snp_prob: proportion of bases to mutate to SNPs
     :param float indel_prob: proportion of bases to mutate to InDels
     :param tuple letters: available letters to mutate to
+    :param int nthreads: number of threads to compress a .gz output FASTQ with. Default 0 (autodetect).
     :return str: name of the output FASTQ
     """
 
-    def _create_fastq_lines(out_fh):
-        """Writes a FASTQ record from a FASTA sequence.
+    # Qualities are drawn in bulk; seeding from the random module keeps simulations reproducible with random.seed
+    rng = np.random.default_rng(random.getrandbits(32))
+
+    def _write_batch(writer, headers, seqs):
+        """Writes FASTQ records for a batch of FASTA sequences.
 
-        :param file out_fh: output file handle to write to
+        :param core_utils.fastq_utils.FastqWriter writer: output FASTQ writer
+        :param list headers: FASTA headers, without the leading >
+        :param list seqs: FASTA sequences
         """
 
-        seq_len = len(seq)
+        new_seqs = []
+        for seq in seqs:
+            new_seq = seq
+            if max_len is not None and len(seq) > max_len:
+                new_seq = seq[:max_len]
 
-        new_seq = seq
-        if max_len is not None and seq_len > max_len:
-            new_seq = seq[:max_len]
+            # Add sequencing error and InDels to challenge variant callers
+            if add_error_snps:
+                new_seq = introduce_error(new_seq, prob=snp_prob, letters=letters)
 
-        # Add sequencing error and InDels to challenge variant callers
-        if add_error_snps:
-            new_seq = introduce_error(new_seq, prob=snp_prob, letters=letters)
+            if add_error_indels:
+                new_seq = introduce_indels(new_seq, prob=indel_prob, letters=letters)
 
-        if add_error_indels:
-            new_seq = introduce_indels(new_seq, prob=indel_prob, letters=letters)
+            new_seqs.append(new_seq)
 
-        new_bqs = "".join([bq_int_to_ascii(random.randint(min_bq, max_bq)) for _ in range(len(new_seq))])
+        seq_lens = [len(new_seq) for new_seq in new_seqs]
+        bq_str = (rng.integers(min_bq, max_bq + 1, sum(seq_lens)) + ILLUMINA_BQ_OFFSET).astype(np.uint8).tobytes()
+        bq_ends = np.cumsum(seq_lens).tolist()
+        new_bqs = [bq_str[end - seq_len:end].decode() for end, seq_len in zip(bq_ends, seq_lens)]
 
-        out_fh.write(new_seq + FILE_NEWLINE)
-        out_fh.write(FASTQ_SPACER_CHAR + FILE_NEWLINE)
-        out_fh.write(new_bqs + FILE_NEWLINE)
+        writer.write(fqu.FastqBatch.from_records(headers, new_seqs, new_bqs))
 
     out_fq = out_fastq
     if out_fastq is None:
         out_fq = tempfile.NamedTemporaryFile(suffix=".fastq", delete=False).name
 
     with open(in_fasta, "r") as infile, \
-            open(out_fq, "w") as outfile:
+            fqu.FastqWriter(out_fq, nthreads=nthreads) as writer:
 
         # Need to potentially concatenate multi-line FASTA sequences which makes for somewhat more complicated parsing
-        seq = ""
-        for (rec_num, line) in enumerate(infile):
+        headers = []
+        seqs = []
+        for line in infile:
             if line.startswith(FASTA_HEADER_CHAR):
-                if rec_num == 0:
-                    outfile.write(FASTQ_QNAME_CHAR + line[1:])
-                else:
-                    # Write the last entry's seq and quals before a new one
-                    _create_fastq_lines(outfile)
-
-                    # Reset the last seq then write the new qname
-                    seq = ""
-                    outfile.write(FASTQ_QNAME_CHAR + line[1:])
+                if len(headers) == fqu.DEFAULT_BATCH_SIZE:
+                    _write_batch(writer, headers, ["".join(seq_lines) for seq_lines in seqs])
+                    headers = []
+                    seqs = []
+
+                headers.append(line[1:].rstrip("\r\n"))
+                seqs.append([])
             else:
-                seq += line.rstrip("\r\n")
-        else:
-            # This allows us to write single-record FASTAs and the last records of a multi-line FASTA
-            _create_fastq_lines(outfile)
+                seqs[-1].append(line.rstrip("\r\n"))
+
+        # This allows us to write single-record FASTAs and the last records of a multi-line FASTA
+        _write_batch(writer, headers, ["".join(seq_lines) for seq_lines in seqs])
 
         return out_fq
 
@@ -13,8 +13,9 @@ import statistics
 import tempfile
 
 import analysis.coordinate_mapper as cm
+import analysis.read_batches as rb
 import analysis.read_preprocessor as rp
-from analysis.references import APPRIS_CONTIG_DELIM, APPRIS_TRX_INDEX
+from analysis.reference_ids import APPRIS_CONTIG_DELIM, APPRIS_TRX_INDEX
 import analysis.seq_utils as su
 
 from core_utils.feature_file_utils import intersect_features
@@ -66,6 +67,10 @@ class VariantCaller(object):
     VARIANT_CALL_OUTDIR = "./satmut_utils_call_results"
     VARIANT_CALL_PREFIX = "./out"
     VARIANT_CALL_STATS = False
+    VARIANT_CALL_USE_INDEX = rp.VariantCallerPreprocessor.DEFAULT_USE_INDEX
+    VARIANT_CALL_REGION = rp.VariantCallerPreprocessor.DEFAULT_REGION
+    VARIANT_CALL_MULTIPLICITY_TABLE = None
+    VARIANT_CALL_ANCHORED_COUNTER = None
 
     VARIANT_CALL_MIN_BQ = 30
     VARIANT_CALL_MIN_DP = 2
@@ -74,6 +79,7 @@ class VariantCaller(object):
     VARIANT_CALL_COV_EXT = "cov.bedgraph"
     VARIANT_CALL_REF_CANDIDATE_EXT = "var.cand.vcf"
     VARIANT_CALL_MAX_MNP_WINDOW = 3
+    VARIANT_CALL_BATCH_SIZE = rb.DEFAULT_BATCH_SIZE
 
     DEFAULT_NTHREADS = 0
     _STATS_DELIM = ","
@@ -88,11 +94,15 @@ class VariantCaller(object):
     R_NM_INDEX = 3
 
     def __init__(self, am, ref, trx_gff, gff_ref, targets=VARIANT_CALL_TARGET, primers=VARIANT_CALL_PRIMERS,
-                 output_dir=VARIANT_CALL_OUTDIR, nthreads=DEFAULT_NTHREADS, mut_sig=DEFAULT_MUT_SIG):
+                 output_dir=VARIANT_CALL_OUTDIR, nthreads=DEFAULT_NTHREADS, mut_sig=DEFAULT_MUT_SIG, sort_planner=None,
+                 use_index=VARIANT_CALL_USE_INDEX, region=VARIANT_CALL_REGION,
+                 multiplicity_table=VARIANT_CALL_MULTIPLICITY_TABLE, anchored_counter=VARIANT_CALL_ANCHORED_COUNTER,
+                 io_policy=None, cds_store_dir=None):
         r"""Constructor for VariantCaller.
 
-        :param str am: SAM/BAM file to enumerate variants in
-        :param str ref: path to reference FASTA used in alignment. Must be samtools faidx indexed.
+        :param str am: SAM/BAM/CRAM file to enumerate variants in
+        :param str ref: path to reference FASTA used in alignment. Must be samtools faidx indexed. Also used to \
+        decode a CRAM input.
         :param str trx_gff: GFF file containing transcript metafeatures and exon features, in 5' to 3' order, \
         regardless of strand. Ordering is essential.
         :param str gff_ref: reference FASTA corresponding to the GFF features
@@ -103,7 +113,22 @@ class VariantCaller(object):
         :param str | None output_dir: output dir to use for output files; if None, will create a tempdir.
         :param int nthreads: number threads to use for SAM/BAM file manipulations. Default 0 (autodetect).
         :param str mut_sig: mutagenesis signature- one of {NNN, NNK, NNS}. Default NNK.
-        :raises RuntimeError: if no alignments are found in the input BAM
+        :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner tracking intermediate orders. \
+        If provided, the input need not be coordinate sorted and indexed.
+        :param bool use_index: read pairs directly from the coordinate-sorted and indexed input, buffering mates, \
+        instead of qname-sorting and splitting the input into R1 and R2 BAMs. Default False.
+        :param str | None region: optional samtools-style region (contig:start-stop) to call variants in. Implies \
+        use_index.
+        :param str | None multiplicity_table: optional side table from analysis.read_preprocessor.DuplicateCollapser. \
+        If provided, counts and depth from each representative are weighted by its number of exact duplicates.
+        :param analysis.anchored_counter.PrimerAnchoredCounter | None anchored_counter: optional counts of read pairs \
+        placed at their primers without alignment, to add to the counts from the alignments. The alignments should \
+        be of the fallback pairs of the counter.
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of \
+        the preprocessed BAMs
+        :param str | None cds_store_dir: optional directory of transcript CDS annotations shared across runs. Default \
+        None, the output dir.
+        :raises RuntimeError: if no alignments are found in the input BAM and no pairs were anchored
         """
 
         logger.info("Initializing %s" % self.__class__.__name__)
@@ -124,14 +149,25 @@ class VariantCaller(object):
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
-        # Preprocess the alignments and setup the output directory
-        self.vc_preprocessor = rp.VariantCallerPreprocessor(am=am, ref=ref, output_dir=output_dir, nthreads=nthreads)
+        # Representatives without an entry have no duplicates
+        self.multiplicities = {}
+        if multiplicity_table is not None:
+            self.multiplicities = rp.DuplicateCollapser.load_multiplicities(multiplicity_table)
 
-        # This assumes the BAM is coordinate sorted and indexed
-        with pysam.AlignmentFile(self.vc_preprocessor.in_bam, "rb") as rs_af:
-            self.total_mapped = rs_af.mapped
+        # Preprocess the alignments and setup the output directory; mapped reads, including the duplicates of
+        # representatives, are counted by the preprocessor
+        self.vc_preprocessor = rp.VariantCallerPreprocessor(
+            am=am, ref=ref, output_dir=output_dir, nthreads=nthreads, sort_planner=sort_planner,
+            use_index=use_index, region=region, io_policy=io_policy, multiplicities=self.multiplicities)
+
+        self.total_mapped = self.vc_preprocessor.total_mapped
+        with su.open_alignments(self.vc_preprocessor.in_bam, self.ref, check_sq=False) as rs_af:
             self.contigs = rs_af.references
 
+        self.anchored_counter = anchored_counter
+        if anchored_counter is not None:
+            self.total_mapped += 2 * anchored_counter.n_anchored
+
         if int(self.total_mapped) == 0:
             raise RuntimeError("No alignments to process.")
 
@@ -140,7 +176,8 @@ class VariantCaller(object):
 
         logger.info("Loading transcript CDS annotations for AA change determination.")
         self.amino_acid_mapper = cm.AminoAcidMapper(
-            gff=self.transcript_gff, ref=self.gff_reference, mut_sig=mut_sig, outdir=output_dir)
+            gff=self.transcript_gff, ref=self.gff_reference, mut_sig=mut_sig, outdir=output_dir, use_pickle=False,
+            make_pickle=False, cds_store_dir=cds_store_dir)
 
         # Get the list of unique contigs for constructing VCF headers
 
@@ -606,7 +643,7 @@ class VariantCaller(object):
             self.variant_counts[call_tuple][r_index][self.R_RP_INDEX].append(
                 self._STATS_DELIM.join(list(map(str, per_bp_stats.r2_read_pos))))
 
-    def _add_counts_and_stats(self, call_tuple, per_bp_stats, r1_nm, r2_nm, r1_strand, r2_strand):
+    def _add_counts_and_stats(self, call_tuple, per_bp_stats, r1_nm, r2_nm, r1_strand, r2_strand, weight=1):
         """Adds counts and BQ, NM, read position stats to the call dictionary.
 
         :param collections.namedtuple call_tuple: CALL_TUPLE specifying the variant
@@ -615,6 +652,7 @@ class VariantCaller(object):
         :param int r2_nm: R2 edit distance
         :param analysis.seq_utils.Strand r1_strand: R1 strand
         :param analysis.seq_utils.Strand r2_strand: R2 strand
+        :param int weight: number of exact-duplicate pairs the pair represents. Stats are added once.
         """
 
         # Enumerate the supporting counts and stats
@@ -638,7 +676,7 @@ class VariantCaller(object):
             r1_strand_index = self.R1_PLUS_INDEX
 
         self._assign_stats(r1_strand_index, call_tuple, per_bp_stats)
-        self.variant_counts[call_tuple][r1_strand_index][self.R_COUNTS_INDEX] += 1
+        self.variant_counts[call_tuple][r1_strand_index][self.R_COUNTS_INDEX] += weight
         self.variant_counts[call_tuple][r1_strand_index][self.R_NM_INDEX].append(r1_nm)
 
         r2_strand_index = self.R2_MINUS_INDEX
@@ -646,10 +684,11 @@ class VariantCaller(object):
             r2_strand_index = self.R2_PLUS_INDEX
 
         self._assign_stats(r2_strand_index, call_tuple, per_bp_stats)
-        self.variant_counts[call_tuple][r2_strand_index][self.R_COUNTS_INDEX] += 1
+        self.variant_counts[call_tuple][r2_strand_index][self.R_COUNTS_INDEX] += weight
         self.variant_counts[call_tuple][r2_strand_index][self.R_NM_INDEX].append(r2_nm)
 
-    def _update_counts(self, collective_variants, filt_r1_mms, filt_r2_mms, r1_nm, r2_nm, r1_strand, r2_strand):
+    def _update_counts(self, collective_variants, filt_r1_mms, filt_r2_mms, r1_nm, r2_nm, r1_strand, r2_strand,
+                       weight=1):
         """Updates the global dict with variant call counts and supporting read statistics.
 
         :param dict collective_variants: dict keyed by CALL_TUPLE and valued by set of mismatch coordinate positions
@@ -659,6 +698,7 @@ class VariantCaller(object):
         :param int r2_nm: R2 edit distance
         :param analysis.seq_utils.Strand r1_strand: R1 strand
         :param analysis.seq_utils.Strand r2_strand: R2 strand
+        :param int weight: number of exact-duplicate pairs the pair represents
         """
 
         # Here k is a CALL_TUPLE and v is a set of coordinate positions supporting the call
@@ -673,7 +713,7 @@ class VariantCaller(object):
                 refs=refs, alts=alts, positions=positions)
 
             # Then store the counts and stats into a dict to facilitate summation across reads
-            self._add_counts_and_stats(new_call_tuple, per_bp_stats, r1_nm, r2_nm, r1_strand, r2_strand)
+            self._add_counts_and_stats(new_call_tuple, per_bp_stats, r1_nm, r2_nm, r1_strand, r2_strand, weight)
 
     @staticmethod
     def _get_unmasked_positions(align_seg):
@@ -711,17 +751,19 @@ class VariantCaller(object):
 
         return False
 
-    def _update_pos_dp(self, r1, r2):
+    def _update_pos_dp(self, r1, r2=None, weight=1):
         """Updates the reference position dict for fragment coverage.
 
-        :param pysam.AlignedSegment r1: R1 read object
-        :param pysam.AlignedSegment r2: R2 read object
+        :param pysam.AlignedSegment r1: R1 read object, or a merged fragment
+        :param pysam.AlignedSegment | None r2: R2 read object; None for a merged fragment
+        :param int weight: number of exact-duplicate pairs the pair represents
         :return None: if no unmasked positions exist
         """
 
         # Only update the DP for positions with nonzero BQ
         ref_positions = self._get_unmasked_positions(r1)
-        ref_positions |= self._get_unmasked_positions(r2)
+        if r2 is not None:
+            ref_positions |= self._get_unmasked_positions(r2)
 
         if len(ref_positions) == 0:
             return None
@@ -735,87 +777,356 @@ class VariantCaller(object):
 
         for pos in fragment_pos:
             # Enumerate the read pair for the DP denominator to frequency
-            self.coordinate_counts[COORDINATE_KEY(r1.reference_name, pos + 1)] += 1
+            self.coordinate_counts[COORDINATE_KEY(r1.reference_name, pos + 1)] += weight
+
+    @staticmethod
+    def _filter_concordant_edits(fragment_mms, concordance):
+        """Filters the edits of a merged fragment to those at bases where both mates agreed.
+
+        :param list fragment_mms: MM_TUPLEs for the fragment, with read positions relative to the R1 5' end
+        :param str concordance: per-base concordance codes of the fragment, in R1 orientation
+        :return tuple: filtered list of R1 and R2 MM_TUPLES, with R2 read positions relative to the R2 5' end
+        """
+
+        fragment_len = len(concordance)
+
+        filt_r1_mms = [mm for mm in fragment_mms if 0 < mm.read_pos <= fragment_len and
+                       concordance[mm.read_pos - 1] == rp.MateMerger.CONCORDANT]
+        filt_r2_mms = [mm._replace(read_pos=fragment_len - mm.read_pos + 1) for mm in filt_r1_mms]
+
+        return filt_r1_mms, filt_r2_mms
+
+    def _call_edits(self, filt_r1_mms, filt_r2_mms, filt_r1_indel_mms, filt_r2_indel_mms, r1_nm, r2_nm, r1_strand,
+                    r2_strand, max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW, weight=1):
+        """Calls variants from the mate-concordant edits of a read pair and updates the counts and stats.
+
+        :param list filt_r1_mms: list of concordant mismatch MM_TUPLEs for R1
+        :param list filt_r2_mms: list of concordant mismatch MM_TUPLEs for R2
+        :param list filt_r1_indel_mms: list of concordant InDel MM_TUPLEs for R1
+        :param list filt_r2_indel_mms: list of concordant InDel MM_TUPLEs for R2
+        :param int r1_nm: R1 edit distance
+        :param int r2_nm: R2 edit distance
+        :param analysis.seq_utils.Strand r1_strand: R1 strand
+        :param analysis.seq_utils.Strand r2_strand: R2 strand
+        :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+        :param int weight: number of exact-duplicate pairs the pair represents
+        """
+
+        # If we found no intersected mismatches, continue to the next read pair
+        if len(filt_r1_mms) != 0:
+            # Call SNPs, MNPs, and haplotypes
+            haplotype_res = self._call_haplotypes(filt_r1_mms, max_mnp_window)
+
+            if isinstance(haplotype_res, tuple):
+                haplotypes, position_blacklist = haplotype_res
+                if len(position_blacklist) == 0:
+                    # In this case we had >= 3 mismatches but they were not within the window and position_blacklist
+                    # is an empty set
+                    haplotypes = None
+            else:
+                # In this case we had either 1 mismatch or 2 mismatches that were not within the window
+                haplotypes = None
+                position_blacklist = set()
 
-    def _iterate_over_reads(self, af1, af2, min_bq=VARIANT_CALL_MIN_BQ, max_nm=VARIANT_CALL_MAX_NM,
-                            max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW):
-        """Iterates over read pairs to enumerate variants.
+            # Call SNPs not captured in a MNP or haplotype
+            snps = self._call_snps(filt_r1_mms, position_blacklist, haplotypes)
 
-        :param pysam.AlignmentFile af1: object corresponding to the R1 BAM
-        :param pysam.AlignmentFile af2: object corresponding to the R2 BAM
+            collective_variants = snps
+            if haplotypes is not None:
+                collective_variants = {**haplotypes, **snps}
+
+            # Now that we have called haplotypes and SNPs for the pair, update the dict of counts and stats
+            self._update_counts(
+                collective_variants, filt_r1_mms, filt_r2_mms, r1_nm, r2_nm, r1_strand, r2_strand, weight)
+
+        if len(filt_r1_indel_mms) != 0:
+            indels = self._call_indels(filt_r1_indel_mms)
+            self._update_counts(
+                indels, filt_r1_indel_mms, filt_r2_indel_mms, r1_nm, r2_nm, r1_strand, r2_strand, weight)
+
+    def _call_fragment(self, fragment, min_bq=VARIANT_CALL_MIN_BQ, max_nm=VARIANT_CALL_MAX_NM,
+                       max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW):
+        """Calls variants in a fragment of mates merged prior to alignment.
+
+        :param pysam.AlignedSegment fragment: merged fragment with a concordance tag
         :param int min_bq: min base quality
         :param int max_nm: max edit distance (NM tag) to consider a read for variant calls
         :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+
+        Concordant fragment bases carry the lower mate BQ, so the R1 and R2 BQ stats are both the fragment BQ.
         """
 
-        # Because we must start with qname-sorted BAMs, we can't extract reads particular to a genomic region without
-        # first intersecting
-        for r1, r2 in zip(af1.fetch(until_eof=True), af2.fetch(until_eof=True)):
+        fragment_nm = su.get_edit_distance(fragment)
+        if fragment_nm > max_nm:
+            return
 
-            # Sanity check to make sure we are always paired
-            # Split to handle consensus deduplicated input which include the mate ID along with the group ID
-            if r1.query_name != r2.query_name:
-                raise RuntimeError(
-                    "Improper pairing of reads. R1 was %s and R2 was %s." % (r1.query_name, r2.query_name))
+        # The fragment is in R1 orientation
+        r1_strand = su.Strand(fragment.is_reverse)
+        r2_strand = su.Strand(not fragment.is_reverse)
 
-            if not self._reads_overlap(r1, r2):
-                continue
+        weight = self.multiplicities.get(fragment.query_name, 1)
+        self._update_pos_dp(fragment, weight=weight)
 
-            # Only call variants for pairs that pass filters
-            r1_nm = su.get_edit_distance(r1)
-            r2_nm = su.get_edit_distance(r2)
-            if r1_nm > max_nm or r2_nm > max_nm:
-                continue
+        concordance = rp.MateMerger.decode_concordance(fragment.get_tag(rp.MateMerger.CONCORDANCE_TAG))
 
-            r1_strand = su.Strand(r1.is_reverse)
-            r2_strand = su.Strand(r2.is_reverse)
+        filt_r1_mms, filt_r2_mms = self._filter_concordant_edits(
+            self._enumerate_mismatches(fragment, min_bq), concordance)
 
-            # Compute fragment coverage/depth; note only filtered read pairs contribute to depth
-            self._update_pos_dp(r1, r2)
+        filt_r1_indel_mms, filt_r2_indel_mms = self._filter_concordant_edits(
+            self._enumerate_indels(fragment, min_bq), concordance)
 
-            # Enumerate mismatch positions for each read in the pair
-            r1_mms = self._enumerate_mismatches(r1, min_bq)
-            r2_mms = self._enumerate_mismatches(r2, min_bq)
+        self._call_edits(filt_r1_mms, filt_r2_mms, filt_r1_indel_mms, filt_r2_indel_mms,
+                         fragment_nm, fragment_nm, r1_strand, r2_strand, max_mnp_window, weight)
 
-            # Now find intersections between the mismatches
-            filt_r1_mms, filt_r2_mms = self._intersect_edits(r1_mms, r2_mms)
+    def _call_pair(self, r1, r2, min_bq=VARIANT_CALL_MIN_BQ, max_nm=VARIANT_CALL_MAX_NM,
+                   max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW):
+        """Calls variants in a read pair from its read objects.
 
-            # Enumerate simple InDels with another pass over the aligned_pairs
-            r1_indel_mms = self._enumerate_indels(r1, min_bq)
-            r2_indel_mms = self._enumerate_indels(r2, min_bq)
+        :param pysam.AlignedSegment r1: R1 read object, or a merged fragment
+        :param pysam.AlignedSegment | None r2: R2 read object; None for a merged fragment
+        :param int min_bq: min base quality
+        :param int max_nm: max edit distance (NM tag) to consider a read for variant calls
+        :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+        """
 
-            # Now find intersections between the mismatches
-            filt_r1_indel_mms, filt_r2_indel_mms = self._intersect_edits(r1_indel_mms, r2_indel_mms)
+        # Concordance of merged mates was determined prior to alignment
+        if r2 is None:
+            self._call_fragment(r1, min_bq, max_nm, max_mnp_window)
+            return
 
-            # If we found no intersected mismatches, continue to the next read pair
-            if len(filt_r1_mms) != 0:
-                # Call SNPs, MNPs, and haplotypes
-                haplotype_res = self._call_haplotypes(filt_r1_mms, max_mnp_window)
+        if not self._reads_overlap(r1, r2):
+            return
 
-                if isinstance(haplotype_res, tuple):
-                    haplotypes, position_blacklist = haplotype_res
-                    if len(position_blacklist) == 0:
-                        # In this case we had >= 3 mismatches but they were not within the window and position_blacklist
-                        # is an empty set
-                        haplotypes = None
-                else:
-                    # In this case we had either 1 mismatch or 2 mismatches that were not within the window
-                    haplotypes = None
-                    position_blacklist = set()
+        # Only call variants for pairs that pass filters
+        r1_nm = su.get_edit_distance(r1)
+        r2_nm = su.get_edit_distance(r2)
+        if r1_nm > max_nm or r2_nm > max_nm:
+            return
+
+        r1_strand = su.Strand(r1.is_reverse)
+        r2_strand = su.Strand(r2.is_reverse)
+
+        # Compute fragment coverage/depth; note only filtered read pairs contribute to depth
+        weight = self.multiplicities.get(r1.query_name, 1)
+        self._update_pos_dp(r1, r2, weight)
+
+        # Enumerate mismatch positions for each read in the pair
+        r1_mms = self._enumerate_mismatches(r1, min_bq)
+        r2_mms = self._enumerate_mismatches(r2, min_bq)
+
+        # Now find intersections between the mismatches
+        filt_r1_mms, filt_r2_mms = self._intersect_edits(r1_mms, r2_mms)
+
+        # Enumerate simple InDels with another pass over the aligned_pairs
+        r1_indel_mms = self._enumerate_indels(r1, min_bq)
+        r2_indel_mms = self._enumerate_indels(r2, min_bq)
 
-                # Call SNPs not captured in a MNP or haplotype
-                snps = self._call_snps(filt_r1_mms, position_blacklist, haplotypes)
+        # Now find intersections between the mismatches
+        filt_r1_indel_mms, filt_r2_indel_mms = self._intersect_edits(r1_indel_mms, r2_indel_mms)
+
+        self._call_edits(filt_r1_mms, filt_r2_mms, filt_r1_indel_mms, filt_r2_indel_mms,
+                         r1_nm, r2_nm, r1_strand, r2_strand, max_mnp_window, weight)
+
+    def _update_batch_dp(self, batch, pair_indices, firsts, lasts, weights):
+        r"""Updates the reference position dict for the fragment coverage of a run of simple pairs.
+
+        :param analysis.read_batches.ReadPairBatch batch: batch of read pairs
+        :param numpy.ndarray pair_indices: indices of the passing pairs in the run, in order
+        :param numpy.ndarray firsts: first unmasked reference position of each pair in the batch
+        :param numpy.ndarray lasts: last unmasked reference position of each pair in the batch
+        :param numpy.ndarray weights: number of exact-duplicate pairs each pair in the batch represents
+
+        Positions are added in the order the per-pair update would first visit them, so the coverage output is \
+        unchanged.
+        """
 
-                collective_variants = snps
-                if haplotypes is not None:
-                    collective_variants = {**haplotypes, **snps}
+        # Pairs with all bases masked do not contribute to depth
+        pair_indices = pair_indices[firsts[pair_indices] <= lasts[pair_indices]]
+        if len(pair_indices) == 0:
+            return
 
-                # Now that we have called haplotypes and SNPs for the pair, update the dict of counts and stats
-                self._update_counts(collective_variants, filt_r1_mms, filt_r2_mms, r1_nm, r2_nm, r1_strand, r2_strand)
+        run_firsts = firsts[pair_indices]
+        range_index, positions = rb.gather_ranges(run_firsts, lasts[pair_indices] - run_firsts + 1)
+        keys = batch.r1.reference_ids[pair_indices][range_index] * (np.iinfo(np.int32).max + 1) + positions
 
-            if len(filt_r1_indel_mms) != 0:
-                indels = self._call_indels(filt_r1_indel_mms)
-                self._update_counts(indels, filt_r1_indel_mms, filt_r2_indel_mms, r1_nm, r2_nm, r1_strand, r2_strand)
+        unique_keys, first_elements, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights[pair_indices][range_index], minlength=len(unique_keys))
+
+        visit_order = np.argsort(first_elements, kind="stable")
+        visit_elements = first_elements[visit_order]
+        visit_pairs = pair_indices[range_index[visit_elements]]
+        contigs = {batch.r1.reference_ids[i]: batch.read_pairs[i][0].reference_name for i in np.unique(visit_pairs)}
+
+        for reference_id, pos, count in zip(batch.r1.reference_ids[visit_pairs].tolist(),
+                                            positions[visit_elements].tolist(), counts[visit_order].tolist()):
+            self.coordinate_counts[COORDINATE_KEY(contigs[reference_id], pos + 1)] += int(count)
+
+    @staticmethod
+    def _get_batch_mismatches(columns, passing, min_bq):
+        r"""Enumerates the mismatches of one mate of the passing simple pairs.
+
+        :param analysis.read_batches.AlignmentColumns columns: columns for R1 or R2 of a batch
+        :param numpy.ndarray passing: bool array of passing pairs
+        :param int min_bq: min base quality
+        :return tuple: (read index, mismatch fields) where the fields are (0-based position, REF byte, ALT byte, BQ, \
+        read position) arrays
+        """
+
+        read_index, positions, refs, alts, bqs, read_positions = columns.get_mismatches(min_bq, passing)
+        return read_index, (positions, refs, alts, bqs, read_positions)
+
+    @staticmethod
+    def _get_concordant_mismatches(r1_read_index, r1_fields, r2_read_index, r2_fields):
+        r"""Finds the mismatches of R1 and R2 at the same pair, position, REF, and ALT.
+
+        :param numpy.ndarray r1_read_index: pair index of each R1 mismatch
+        :param tuple r1_fields: R1 mismatch fields, see _get_batch_mismatches
+        :param numpy.ndarray r2_read_index: pair index of each R2 mismatch
+        :param tuple r2_fields: R2 mismatch fields
+        :return tuple: (R1 indices, R2 indices) of the concordant mismatches, in order
+
+        The columns are sorted together rather than packed into one key, so positions on large contigs do not \
+        collide. A mate has at most one mismatch per position, so equal neighbors come from different mates.
+        """
+
+        columns = [np.concatenate((r1_col, r2_col)) for r1_col, r2_col in
+                   zip((r1_read_index,) + r1_fields[:3], (r2_read_index,) + r2_fields[:3])]
+
+        # lexsort uses the last column as the primary key
+        order = np.lexsort(columns[::-1])
+        sorted_columns = [col[order] for col in columns]
+        same_as_next = np.ones(max(len(order) - 1, 0), dtype=bool)
+        for col in sorted_columns:
+            same_as_next &= col[1:] == col[:-1]
+
+        concordant = np.zeros(len(order), dtype=bool)
+        concordant[order[:-1][same_as_next]] = True
+        concordant[order[1:][same_as_next]] = True
+
+        n_r1 = len(r1_read_index)
+        return np.flatnonzero(concordant[:n_r1]), np.flatnonzero(concordant[n_r1:])
+
+    @staticmethod
+    def _get_mm_tuples(contig, mismatch_fields, indices):
+        """Gets MM_TUPLEs from the mismatch columns of one read.
+
+        :param str contig: reference name
+        :param tuple mismatch_fields: (0-based position, REF byte, ALT byte, BQ, read position) arrays
+        :param numpy.ndarray indices: indices of the mismatches to get
+        :return list: list of MM_TUPLEs
+        """
+
+        positions, refs, alts, bqs, read_positions = mismatch_fields
+        return [MM_TUPLE(contig=contig, pos=int(positions[i]) + 1, ref=chr(refs[i]), alt=chr(alts[i]), bq=int(bqs[i]),
+                         read_pos=int(read_positions[i])) for i in indices]
+
+    def _call_batch(self, batch, min_bq=VARIANT_CALL_MIN_BQ, max_nm=VARIANT_CALL_MAX_NM,
+                    max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW):
+        r"""Calls variants in a batch of read pairs.
+
+        :param analysis.read_batches.ReadPairBatch batch: batch of read pairs
+        :param int min_bq: min base quality
+        :param int max_nm: max edit distance (NM tag) to consider a read for variant calls
+        :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+
+        Simple pairs are filtered and their mismatches enumerated over the whole batch. Other pairs are called from \
+        their read objects, in order, so that the results match calling each pair from its read objects.
+        """
+
+        passing = batch.filter_pairs(max_nm=max_nm)
+
+        weights = np.ones(len(batch), dtype=np.int64)
+        if len(self.multiplicities) > 0:
+            weights = np.array([self.multiplicities.get(r1.query_name, 1) for r1, _ in batch.read_pairs],
+                               dtype=np.int64)
+
+        r1_first, r1_last = batch.r1.get_unmasked_spans()
+        r2_first, r2_last = batch.r2.get_unmasked_spans()
+        firsts = np.minimum(r1_first, r2_first)
+        lasts = np.maximum(r1_last, r2_last)
+
+        # Only mismatches found in both mates are kept
+        r1_read_index, r1_fields = self._get_batch_mismatches(batch.r1, passing, min_bq)
+        r2_read_index, r2_fields = self._get_batch_mismatches(batch.r2, passing, min_bq)
+        r1_concordant, r2_concordant = self._get_concordant_mismatches(
+            r1_read_index, r1_fields, r2_read_index, r2_fields)
+        r1_read_index = r1_read_index[r1_concordant]
+        r2_read_index = r2_read_index[r2_concordant]
+        edited_pairs = np.unique(r1_read_index)
+
+        # Split the batch into runs of simple pairs at each pair that must be called from its read objects
+        run_start = 0
+        for run_end in np.flatnonzero(~batch.is_simple).tolist() + [len(batch)]:
+
+            run_indices = np.arange(run_start, run_end)
+            self._update_batch_dp(batch, run_indices[passing[run_start:run_end]], firsts, lasts, weights)
+
+            run_edited = edited_pairs[np.searchsorted(edited_pairs, run_start):np.searchsorted(edited_pairs, run_end)]
+            for pair_index in run_edited.tolist():
+
+                r1, r2 = batch.read_pairs[pair_index]
+                r1_bounds = np.searchsorted(r1_read_index, [pair_index, pair_index + 1])
+                r2_bounds = np.searchsorted(r2_read_index, [pair_index, pair_index + 1])
+                filt_r1_mms = self._get_mm_tuples(r1.reference_name, r1_fields, r1_concordant[slice(*r1_bounds)])
+                filt_r2_mms = self._get_mm_tuples(r2.reference_name, r2_fields, r2_concordant[slice(*r2_bounds)])
+
+                # Simple pairs have no InDels
+                self._call_edits(
+                    filt_r1_mms, filt_r2_mms, [], [], int(batch.r1.nms[pair_index]), int(batch.r2.nms[pair_index]),
+                    su.Strand(r1.is_reverse), su.Strand(r2.is_reverse), max_mnp_window, int(weights[pair_index]))
+
+            if run_end < len(batch):
+                r1, r2 = batch.read_pairs[run_end]
+                self._call_pair(r1, r2, min_bq, max_nm, max_mnp_window)
+
+            run_start = run_end + 1
+
+    def _iterate_over_reads(self, af1=None, af2=None, min_bq=VARIANT_CALL_MIN_BQ, max_nm=VARIANT_CALL_MAX_NM,
+                            max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW, read_pairs=None,
+                            batch_size=VARIANT_CALL_BATCH_SIZE):
+        r"""Iterates over read pairs to enumerate variants.
+
+        :param pysam.AlignmentFile | None af1: object corresponding to the R1 BAM
+        :param pysam.AlignmentFile | None af2: object corresponding to the R2 BAM
+        :param int min_bq: min base quality
+        :param int max_nm: max edit distance (NM tag) to consider a read for variant calls
+        :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+        :param iter | None read_pairs: optional iterable of (R1, R2) pairs to use instead of af1 and af2. Merged \
+        fragments are provided as (fragment, None).
+        :param int batch_size: number of pairs to decode into columns at a time. Set to 0 to call each pair from its \
+        read objects.
+        :raises RuntimeError: if R1 and R2 BAMs are provided and their read names are not paired
+
+        Pairs without InDels are filtered and their mismatches enumerated with vectorized operations over the batch. \
+        Merged fragments and pairs with InDels, clipping other than soft clips, or missing tags are called from their \
+        read objects. Pairs are processed in order so that the results match calling each pair from its read objects.
+        """
+
+        if read_pairs is None:
+            read_pairs = rp.VariantCallerPreprocessor.iterate_split_pairs(af1, af2)
+
+        if batch_size == 0:
+            for r1, r2 in read_pairs:
+                self._call_pair(r1, r2, min_bq, max_nm, max_mnp_window)
+            return
+
+        for batch in rb.iterate_read_pair_batches(read_pairs, batch_size):
+            self._call_batch(batch, min_bq, max_nm, max_mnp_window)
+
+    def _add_anchored_counts(self, max_mnp_window=VARIANT_CALL_MAX_MNP_WINDOW):
+        """Adds the depth and edits of read pairs counted without alignment.
+
+        :param int max_mnp_window: max number of consecutive nucleotides to search for haplotypes
+        """
+
+        for contig, contig_coverage in zip(self.anchored_counter.contigs, self.anchored_counter.coverage):
+            for pos in np.flatnonzero(contig_coverage):
+                self.coordinate_counts[COORDINATE_KEY(contig, int(pos) + 1)] += int(contig_coverage[pos])
+
+        # Anchored pairs have no indels; pairs suggesting them were aligned instead
+        for edits in self.anchored_counter.anchored_edits:
+            self._call_edits(edits.r1_mms, edits.r2_mms, [], [], edits.r1_nm, edits.r2_nm, edits.r1_strand,
+                             edits.r2_strand, max_mnp_window)
 
     def _summarize_stats(self, var_list, read_index, stat_index, pos_index):
         """Summarizes per-bp stats across reads for a particular contributing base to a variant call.
@@ -1163,13 +1474,15 @@ class VariantCaller(object):
         # see https://github.com/pysam-developers/pysam/issues/939
         # verbosity_save = pysam.set_verbosity(0)
 
-        with pysam.AlignmentFile(self.vc_preprocessor.r1_calling_bam, "rb", check_sq=False) as af1, \
-                pysam.AlignmentFile(self.vc_preprocessor.r2_calling_bam, "rb", check_sq=False) as af2, \
-                open(reference_bed, "w") as cov_fh, \
+        with open(reference_bed, "w") as cov_fh, \
                 pysam.VariantFile(patch_reference, "w", header=reference_vcf_header) as reference_candidates_fh:
 
             logger.info("Collecting read mismatch data. This may take some time...")
-            self._iterate_over_reads(af1, af2, min_bq, max_nm, max_mnp_window)
+            self._iterate_over_reads(min_bq=min_bq, max_nm=max_nm, max_mnp_window=max_mnp_window,
+                                     read_pairs=self.vc_preprocessor.iterate_read_pairs())
+
+            if self.anchored_counter is not None:
+                self._add_anchored_counts(max_mnp_window)
 
             logger.info("Calling variants.")
             concordant_counts = self._call_variants(min_supporting_qnames)
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""Batched FASTQ reading and writing with numpy byte arrays."""
+
+import itertools
+import logging
+import numpy as np
+
+import core_utils.file_utils as fu
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+FASTQ_QNAME_BYTE = ord("@")
+FASTQ_SPACER_BYTE = ord("+")
+NEWLINE_BYTE = ord(fu.FILE_NEWLINE)
+CARRIAGE_RETURN_BYTE = ord("\r")
+UNKNOWN_BASE_BYTE = ord("N")
+FASTQ_NLINES = 4
+DEFAULT_BATCH_SIZE = 100000
+DEFAULT_BLOCK_SIZE = 4194304
+DEFAULT_COMPRESSION_LEVEL = fu.DEFAULT_COMPRESSION_LEVEL
+QNAME_DELIMS = (fu.FILE_SPACE, fu.FILE_DELIM)
+
+
+def _get_complement_table():
+    """Gets a byte lookup table for complementing IUPAC DNA bases.
+
+    :return numpy.ndarray: uint8 table of length 256
+    """
+
+    table = np.arange(256, dtype=np.uint8)
+    for base, comp in zip("ACGTUNRYKMBDHVSW", "TGCAANYRMKVHDBSW"):
+        table[ord(base)] = ord(comp)
+        table[ord(base.lower())] = ord(comp.lower())
+
+    return table
+
+
+COMPLEMENT_TABLE = _get_complement_table()
+
+
+def open_fastq(filename, mode="rb", compresslevel=DEFAULT_COMPRESSION_LEVEL, nthreads=0):
+    """Opens a plain or gzipped FASTQ in binary mode.
+
+    :param str filename: FASTQ path; gzipped if it ends with .gz
+    :param str mode: one of {rb, wb, ab}. Default rb.
+    :param int compresslevel: gzip compression level for writing. Default 6.
+    :param int nthreads: number of threads for BGZF compression. Default 0 (autodetect).
+    :return file: open binary file object
+    """
+
+    if filename.endswith(fu.GZ_EXTENSION):
+        return fu.open_gzip(filename, mode, nthreads, compresslevel)
+
+    return open(filename, mode)
+
+
+def _gather_indices(starts, lens, reverse=False):
+    """Gets the buffer indices of a set of variable-length fields, concatenated in order.
+
+    :param numpy.ndarray starts: start index of each field
+    :param numpy.ndarray lens: length of each field
+    :param bool reverse: reverse the bases of each field? Default False.
+    :return numpy.ndarray: int64 indices
+    """
+
+    total = int(lens.sum())
+    field_index = np.repeat(np.arange(len(lens)), lens)
+    field_offsets = np.arange(total) - np.repeat(np.cumsum(lens) - lens, lens)
+
+    if reverse:
+        field_offsets = lens[field_index] - 1 - field_offsets
+
+    res = starts[field_index] + field_offsets
+    return res
+
+
+class FastqBatch(object):
+    """A batch of FASTQ records held in a single byte array with per-record field offsets."""
+
+    def __init__(self, buffer, header_starts, header_lens, seq_starts, seq_lens, qual_starts):
+        r"""Constructor for FastqBatch.
+
+        :param numpy.ndarray buffer: uint8 array holding the record fields
+        :param numpy.ndarray header_starts: index of each header, without the leading @
+        :param numpy.ndarray header_lens: length of each header, which includes any comment
+        :param numpy.ndarray seq_starts: index of each sequence
+        :param numpy.ndarray seq_lens: length of each sequence and quality string
+        :param numpy.ndarray qual_starts: index of each quality string
+        """
+
+        self.buffer = buffer
+        self.header_starts = header_starts
+        self.header_lens = header_lens
+        self.seq_starts = seq_starts
+        self.seq_lens = seq_lens
+        self.qual_starts = qual_starts
+
+    def __len__(self):
+        """Gets the number of records.
+
+        :return int: number of records
+        """
+
+        return len(self.seq_lens)
+
+    @classmethod
+    def from_bytes(cls, data):
+        r"""Parses complete 4-line FASTQ records.
+
+        :param bytes data: FASTQ records, each line terminated by a newline
+        :return core_utils.fastq_utils.FastqBatch: batch
+        :raises RuntimeError: if the records are malformed
+        """
+
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        line_ends = np.flatnonzero(buffer == NEWLINE_BYTE)
+
+        if len(line_ends) % FASTQ_NLINES != 0:
+            raise RuntimeError("FASTQ records must have %i lines." % FASTQ_NLINES)
+
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int64)
+
+        # Tolerate Windows line endings
+        if len(line_ends) > 0:
+            line_ends = line_ends - (buffer[np.maximum(line_ends - 1, 0)] == CARRIAGE_RETURN_BYTE)
+
+        line_lens = line_ends - line_starts
+        header_starts, seq_starts, spacer_starts, qual_starts = [line_starts[i::FASTQ_NLINES] for i in
+                                                                 range(FASTQ_NLINES)]
+
+        if not (np.all(buffer[header_starts] == FASTQ_QNAME_BYTE) and
+                np.all(buffer[spacer_starts] == FASTQ_SPACER_BYTE)):
+            raise RuntimeError("Malformed FASTQ record; expected @ header and + spacer lines.")
+
+        seq_lens = line_lens[1::FASTQ_NLINES]
+        if not np.array_equal(seq_lens, line_lens[3::FASTQ_NLINES]):
+            raise RuntimeError("FASTQ sequence and quality lengths differ.")
+
+        res = cls(buffer, header_starts + 1, line_lens[0::FASTQ_NLINES] - 1, seq_starts, seq_lens, qual_starts)
+        return res
+
+    @classmethod
+    def from_records(cls, headers, sequences, qualities):
+        r"""Creates a batch from strings.
+
+        :param list headers: headers without the leading @, which may include comments
+        :param list sequences: sequences
+        :param list qualities: ASCII quality strings
+        :return core_utils.fastq_utils.FastqBatch: batch
+        """
+
+        fields = [field for record in zip(headers, sequences, qualities) for field in record]
+        field_lens = np.fromiter((len(field) for field in fields), dtype=np.int64, count=len(fields))
+
+        # Fields are delimited by newlines in the buffer
+        field_starts = np.cumsum(field_lens + 1) - field_lens - 1
+        buffer = np.frombuffer(fu.FILE_NEWLINE.join(fields).encode(), dtype=np.uint8)
+
+        res = cls(buffer, field_starts[0::3], field_lens[0::3], field_starts[1::3], field_lens[1::3],
+                  field_starts[2::3])
+        return res
+
+    def _decode_fields(self, starts, lens):
+        """Decodes variable-length fields to strings.
+
+        :param numpy.ndarray starts: start index of each field
+        :param numpy.ndarray lens: length of each field
+        :return list: strings
+        """
+
+        data = self.buffer.tobytes()
+        res = [data[start:start + length].decode() for start, length in zip(starts.tolist(), lens.tolist())]
+        return res
+
+    def get_headers(self):
+        """Gets the record headers, without the leading @.
+
+        :return list: headers, including any comments
+        """
+
+        return self._decode_fields(self.header_starts, self.header_lens)
+
+    def get_names(self):
+        """Gets the read names, without comments.
+
+        :return list: read names
+        """
+
+        res = []
+        for header in self.get_headers():
+            for delim in QNAME_DELIMS:
+                header = header.split(delim, 1)[0]
+            res.append(header)
+
+        return res
+
+    def get_sequences(self):
+        """Gets the sequences.
+
+        :return list: sequences
+        """
+
+        return self._decode_fields(self.seq_starts, self.seq_lens)
+
+    def get_qualities(self):
+        """Gets the ASCII quality strings.
+
+        :return list: quality strings
+        """
+
+        return self._decode_fields(self.qual_starts, self.seq_lens)
+
+    def get_prefixes(self, length, pad=UNKNOWN_BASE_BYTE):
+        """Gets the first bases of each sequence as a matrix.
+
+        :param int length: number of bases
+        :param int pad: byte to pad sequences shorter than length with. Default N.
+        :return numpy.ndarray: uint8 matrix of shape (number of records, length)
+        """
+
+        offsets = np.arange(length)
+        indices = np.minimum(self.seq_starts[:, None] + offsets, len(self.buffer) - 1)
+        res = np.where(offsets < self.seq_lens[:, None], self.buffer[indices], pad).astype(np.uint8)
+        return res
+
+    def get_prefix_strings(self, length):
+        """Gets the first bases of each sequence.
+
+        :param int length: max number of bases
+        :return list: sequence prefixes, which may be shorter than length
+        """
+
+        return self._decode_fields(self.seq_starts, np.minimum(self.seq_lens, length))
+
+    def get_quality_matrix(self, offset=33, pad=0):
+        """Gets the integer base qualities as a matrix.
+
+        :param int offset: quality encoding offset. Default 33.
+        :param int pad: value for positions beyond the end of shorter reads. Default 0.
+        :return numpy.ndarray: int16 matrix of shape (number of records, longest read length)
+        """
+
+        max_len = int(self.seq_lens.max()) if len(self) > 0 else 0
+        offsets = np.arange(max_len)
+        indices = np.minimum(self.qual_starts[:, None] + offsets, len(self.buffer) - 1)
+        quals = self.buffer[indices].astype(np.int16) - offset
+        res = np.where(offsets < self.seq_lens[:, None], quals, pad).astype(np.int16)
+        return res
+
+    def _rebuild(self, headers=None, seqs=None, quals=None):
+        """Creates a new batch from replacement field bytes, keeping the other fields.
+
+        :param numpy.ndarray | None headers: concatenated header bytes, or None to keep the headers
+        :param numpy.ndarray | None seqs: concatenated sequence bytes, or None to keep the sequences
+        :param numpy.ndarray | None quals: concatenated quality bytes, or None to keep the qualities
+        :return core_utils.fastq_utils.FastqBatch: batch
+        """
+
+        header_bytes = headers if headers is not None else \
+            self.buffer[_gather_indices(self.header_starts, self.header_lens)]
+        seq_bytes = seqs if seqs is not None else self.buffer[_gather_indices(self.seq_starts, self.seq_lens)]
+        qual_bytes = quals if quals is not None else self.buffer[_gather_indices(self.qual_starts, self.seq_lens)]
+
+        header_starts = np.cumsum(self.header_lens) - self.header_lens
+        seq_starts = np.cumsum(self.seq_lens) - self.seq_lens
+        buffer = np.concatenate((header_bytes, seq_bytes, qual_bytes))
+
+        res = FastqBatch(buffer, header_starts, self.header_lens, seq_starts + len(header_bytes), self.seq_lens,
+                         seq_starts + len(header_bytes) + len(seq_bytes))
+        return res
+
+    def reverse_complement(self):
+        """Reverse complements the sequences and reverses the qualities.
+
+        :return core_utils.fastq_utils.FastqBatch: new batch
+        """
+
+        seqs = COMPLEMENT_TABLE[self.buffer[_gather_indices(self.seq_starts, self.seq_lens, reverse=True)]]
+        quals = self.buffer[_gather_indices(self.qual_starts, self.seq_lens, reverse=True)]
+        return self._rebuild(seqs=seqs, quals=quals)
+
+    def convert_quality_offset(self, from_offset, to_offset):
+        """Converts the quality encoding, e.g. from Phred+64 to Phred+33.
+
+        :param int from_offset: current quality encoding offset
+        :param int to_offset: new quality encoding offset
+        :return core_utils.fastq_utils.FastqBatch: new batch
+        """
+
+        quals = self.buffer[_gather_indices(self.qual_starts, self.seq_lens)].astype(np.int16)
+        return self._rebuild(quals=(quals + to_offset - from_offset).astype(np.uint8))
+
+    def with_headers(self, headers):
+        """Replaces the record headers.
+
+        :param list headers: new headers without the leading @, which may include comments
+        :return core_utils.fastq_utils.FastqBatch: new batch
+        """
+
+        header_lens = np.fromiter((len(header) for header in headers), dtype=np.int64, count=len(headers))
+        batch = FastqBatch(self.buffer, self.header_starts, header_lens, self.seq_starts, self.seq_lens,
+                           self.qual_starts)
+        return batch._rebuild(headers=np.frombuffer("".join(headers).encode(), dtype=np.uint8))
+
+    def with_names(self, names):
+        """Replaces the read names, keeping any comments.
+
+        :param list names: new read names
+        :return core_utils.fastq_utils.FastqBatch: new batch
+        """
+
+        headers = [name + header[len(old_name):] for name, old_name, header in
+                   zip(names, self.get_names(), self.get_headers())]
+        return self.with_headers(headers)
+
+    def to_bytes(self):
+        """Formats the records as FASTQ.
+
+        :return bytes: FASTQ records
+        """
+
+        # Each record is @header\nseq\n+\nqual\n
+        record_lens = self.header_lens + 2 * self.seq_lens + 6
+        record_starts = np.cumsum(record_lens) - record_lens
+
+        out = np.empty(int(record_lens.sum()), dtype=np.uint8)
+        seq_dest = record_starts + self.header_lens + 2
+        qual_dest = seq_dest + self.seq_lens + 3
+
+        out[record_starts] = FASTQ_QNAME_BYTE
+        out[_gather_indices(record_starts + 1, self.header_lens)] = \
+            self.buffer[_gather_indices(self.header_starts, self.header_lens)]
+        out[seq_dest - 1] = NEWLINE_BYTE
+        out[_gather_indices(seq_dest, self.seq_lens)] = self.buffer[_gather_indices(self.seq_starts, self.seq_lens)]
+        out[qual_dest - 3] = NEWLINE_BYTE
+        out[qual_dest - 2] = FASTQ_SPACER_BYTE
+        out[qual_dest - 1] = NEWLINE_BYTE
+        out[_gather_indices(qual_dest, self.seq_lens)] = self.buffer[_gather_indices(self.qual_starts, self.seq_lens)]
+        out[qual_dest + self.seq_lens] = NEWLINE_BYTE
+
+        return out.tobytes()
+
+
+class FastqReader(object):
+    """Reads plain or gzipped 4-line FASTQs in batches of records."""
+
+    def __init__(self, filename, batch_size=DEFAULT_BATCH_SIZE, block_size=DEFAULT_BLOCK_SIZE):
+        r"""Constructor for FastqReader.
+
+        :param str filename: FASTQ path; gzipped if it ends with .gz
+        :param int batch_size: number of records in each batch, except the last. Default 100000.
+        :param int block_size: number of bytes to read at a time. Default 4 MiB.
+        """
+
+        self.filename = filename
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.fh = open_fastq(filename, "rb")
+        self._pending = b""
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Reads the next batch of records.
+
+        :return core_utils.fastq_utils.FastqBatch: batch
+        :raises StopIteration: when all records have been read
+        """
+
+        n_lines = self.batch_size * FASTQ_NLINES
+        blocks = [self._pending]
+        n_newlines = self._pending.count(b"\n")
+
+        while n_newlines < n_lines and not self._eof:
+            block = self.fh.read(self.block_size)
+            if len(block) == 0:
+                self._eof = True
+                break
+            blocks.append(block)
+            n_newlines += block.count(b"\n")
+
+        data = b"".join(blocks)
+        if self._eof and len(data) > 0 and not data.endswith(b"\n"):
+            data += b"\n"
+            n_newlines += 1
+
+        if len(data) == 0:
+            raise StopIteration
+
+        # Cut after the last line of the last complete record in the batch
+        n_keep = min(n_lines, n_newlines - n_newlines % FASTQ_NLINES)
+        if n_keep == 0:
+            raise RuntimeError("Truncated FASTQ record at the end of %s." % self.filename)
+
+        cut = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == NEWLINE_BYTE)[n_keep - 1] + 1
+        self._pending = data[cut:]
+
+        if self._eof and n_keep < n_lines and len(self._pending) > 0:
+            raise RuntimeError("Truncated FASTQ record at the end of %s." % self.filename)
+
+        return FastqBatch.from_bytes(data[:cut])
+
+    def close(self):
+        """Closes the FASTQ."""
+
+        self.fh.close()
+
+
+class FastqWriter(object):
+    """Writes batches of FASTQ records to a plain or gzipped FASTQ with a single write per batch."""
+
+    def __init__(self, filename, compresslevel=DEFAULT_COMPRESSION_LEVEL, nthreads=0):
+        """Constructor for FastqWriter.
+
+        :param str filename: FASTQ path; gzipped with parallel BGZF compression if it ends with .gz
+        :param int compresslevel: gzip compression level. Default 6.
+        :param int nthreads: number of compression threads. Default 0 (autodetect).
+        """
+
+        self.filename = filename
+        self.fh = open_fastq(filename, "wb", compresslevel, nthreads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, batch):
+        """Writes a batch.
+
+        :param core_utils.fastq_utils.FastqBatch batch: records to write
+        """
+
+        self.fh.write(batch.to_bytes())
+
+    def close(self):
+        """Closes the FASTQ."""
+
+        self.fh.close()
+
+
+def iterate_paired_batches(f1, f2, batch_size=DEFAULT_BATCH_SIZE):
+    """Generates batches of read pairs from paired FASTQs.
+
+    :param str f1: R1 FASTQ
+    :param str f2: R2 FASTQ
+    :param int batch_size: number of pairs in each batch, except the last. Default 100000.
+    :return generator: (core_utils.fastq_utils.FastqBatch, core_utils.fastq_utils.FastqBatch) R1 and R2 batches
+    :raises RuntimeError: if the FASTQs have different numbers of records
+    """
+
+    with FastqReader(f1, batch_size) as r1_reader, FastqReader(f2, batch_size) as r2_reader:
+        # A batch missing from one FASTQ is filled with None, so extra records are never silently dropped
+        for r1_batch, r2_batch in itertools.zip_longest(r1_reader, r2_reader):
+            if r1_batch is None or r2_batch is None or len(r1_batch) != len(r2_batch):
+                raise RuntimeError("FASTQs %s and %s have different numbers of records." % (f1, f2))
+            yield r1_batch, r2_batch
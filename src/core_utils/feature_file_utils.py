@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Collection of feature file (BED, GFF, etc.) manipulation utilities."""
 
+import bisect
 import collections
 import os
 import pybedtools
@@ -232,3 +233,50 @@ def store_coords(feature_file, use_name=True, start_buffer=0):
         observed_features.add(feature_coords)
 
     return feature_dict
+
+
+class FeatureIndex(object):
+    """Interval index over features stored with store_coords, for overlap queries without bedtools."""
+
+    def __init__(self, feature_dict):
+        """Constructor for FeatureIndex.
+
+        :param collections.OrderedDict feature_dict: {key: COORD_TUPLE} as returned by store_coords
+        """
+
+        self.feature_dict = feature_dict
+        self.contig_starts = {}
+        self.contig_features = {}
+        self.contig_max_len = {}
+
+        contig_features = collections.defaultdict(list)
+        for feature_key, coord_tuple in feature_dict.items():
+            contig_features[coord_tuple.contig].append((coord_tuple.start, coord_tuple.stop, feature_key))
+
+        # Sort by start so candidates can be found by bisection; the max feature length bounds the lookback
+        for contig, features in contig_features.items():
+            features.sort()
+            self.contig_features[contig] = features
+            self.contig_starts[contig] = [feature[0] for feature in features]
+            self.contig_max_len[contig] = max(feature[1] - feature[0] for feature in features)
+
+    def get_overlapping(self, contig, start, stop):
+        """Gets the keys of features overlapping an interval by at least one base.
+
+        :param str contig: contig name
+        :param int start: 0-based start of the interval
+        :param int stop: 0-based, exclusive stop of the interval
+        :return list: feature keys in order of feature start
+        """
+
+        if contig not in self.contig_starts:
+            return []
+
+        starts = self.contig_starts[contig]
+        lower = bisect.bisect_left(starts, start - self.contig_max_len[contig])
+        upper = bisect.bisect_left(starts, stop)
+
+        res = [feature_key for _, feature_stop, feature_key in self.contig_features[contig][lower:upper]
+               if feature_stop > start]
+
+        return res
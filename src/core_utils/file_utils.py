@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 """Collection of file manipulation utilities."""
 
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
 import os
 import shutil
+import struct
 import subprocess
+import zlib
 
 __author__ = "Ian Hoskins"
 __credits__ = ["Ian Hoskins"]
@@ -18,6 +25,14 @@ FILE_NEWLINE = "\n"
 FILE_SPACE = " "
 GZ_EXTENSION = "gz"
 
+DEFAULT_COMPRESSION_LEVEL = 6  # matches the gzip command line default
+BGZF_BLOCK_SIZE = 65280  # max uncompressed bytes per block, as in htslib
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_FOOTER = struct.Struct("<II")
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BGZF_PENDING_PER_THREAD = 4
+DIGEST_CHUNK_SIZE = 1048576
+
 
 def safe_remove(paths, force_remove=False):
     """Safely remove a file or directory.
@@ -105,25 +120,169 @@ def replace_extension(filename, ext, ignore_exts=(".gz", ".bz", ".bz2",)):
     return ext_res
 
 
-def gzip_file(filename, force=False):
-    """Gzips a file.
+def get_nthreads(nthreads=0):
+    """Gets the number of threads to use.
+
+    :param int nthreads: requested number of threads. Default 0 (autodetect).
+    :return int: number of threads
+    """
+
+    if nthreads > 0:
+        return nthreads
+
+    return os.cpu_count() or 1
+
+
+def compress_bgzf_block(data, compresslevel=DEFAULT_COMPRESSION_LEVEL):
+    """Compresses data into a single BGZF block.
+
+    :param bytes data: at most BGZF_BLOCK_SIZE bytes to compress
+    :param int compresslevel: deflate compression level. Default 6.
+    :return bytes: a gzip member with the BGZF extra field
+    """
+
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    # Header fields are ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN, SI1, SI2, SLEN, and BSIZE (block size - 1)
+    block_size = BGZF_HEADER.size + len(cdata) + BGZF_FOOTER.size
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, ord("B"), ord("C"), 2, block_size - 1)
+    return header + cdata + BGZF_FOOTER.pack(zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    """Writes BGZF files, compressing independent blocks in a thread pool and writing them in order."""
+
+    def __init__(self, filename, mode="wb", nthreads=0, compresslevel=DEFAULT_COMPRESSION_LEVEL):
+        r"""Constructor for BgzfWriter.
+
+        :param str filename: output path
+        :param str mode: one of {wb, ab}. Default wb.
+        :param int nthreads: number of compression threads. Default 0 (autodetect).
+        :param int compresslevel: deflate compression level. Default 6.
+
+        BGZF files are concatenated gzip members with an EOF marker block, so they may be read by gzip, zcat, \
+        Python's gzip module, and htslib.
+        """
+
+        super().__init__()
+        self.filename = filename
+        self.compresslevel = compresslevel
+        self.nthreads = get_nthreads(nthreads)
+        self.fh = open(filename, mode)
+        self.buffer = bytearray()
+
+        # Bound the number of blocks in flight so memory does not grow with the input
+        self.pending = collections.deque()
+        self.max_pending = self.nthreads * BGZF_PENDING_PER_THREAD
+        self.executor = None
+        if self.nthreads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads)
+
+    def writable(self):
+        """Determines if the file is writable.
+
+        :return bool: True
+        """
+
+        return True
+
+    def _write_block(self, data):
+        """Compresses a block, writing it once the blocks before it have been written.
+
+        :param bytes data: at most BGZF_BLOCK_SIZE bytes to compress
+        """
+
+        if self.executor is None:
+            self.fh.write(compress_bgzf_block(data, self.compresslevel))
+            return
+
+        self.pending.append(self.executor.submit(compress_bgzf_block, data, self.compresslevel))
+        while len(self.pending) > self.max_pending:
+            self.fh.write(self.pending.popleft().result())
+
+    def write(self, data):
+        """Writes data.
+
+        :param bytes data: data to write
+        :return int: number of bytes written
+        """
+
+        self.buffer.extend(data)
+
+        if len(self.buffer) >= BGZF_BLOCK_SIZE:
+            nfull = len(self.buffer) - len(self.buffer) % BGZF_BLOCK_SIZE
+            for start in range(0, nfull, BGZF_BLOCK_SIZE):
+                self._write_block(bytes(self.buffer[start:start + BGZF_BLOCK_SIZE]))
+            del self.buffer[:nfull]
+
+        return len(data)
+
+    def close(self):
+        """Writes the remaining data and the EOF block, then closes the file."""
+
+        if self.closed:
+            return
+
+        try:
+            if len(self.buffer) > 0:
+                self._write_block(bytes(self.buffer))
+                self.buffer.clear()
+
+            while len(self.pending) > 0:
+                self.fh.write(self.pending.popleft().result())
+
+            self.fh.write(BGZF_EOF)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.fh.close()
+            super().close()
+
+
+def open_gzip(filename, mode="rt", nthreads=0, compresslevel=DEFAULT_COMPRESSION_LEVEL):
+    """Opens a gzipped file, writing with parallel BGZF compression.
+
+    :param str filename: file path
+    :param str mode: one of {rt, rb, wt, wb, at, ab}. Default rt.
+    :param int nthreads: number of compression threads for writing. Default 0 (autodetect).
+    :param int compresslevel: deflate compression level for writing. Default 6.
+    :return file: open file object
+    """
+
+    if mode.startswith("r"):
+        return gzip.open(filename, mode)
+
+    bgzf_writer = BgzfWriter(filename, mode[0] + "b", nthreads, compresslevel)
+    if mode.endswith("b"):
+        return bgzf_writer
+
+    return io.TextIOWrapper(io.BufferedWriter(bgzf_writer, BGZF_BLOCK_SIZE))
+
+
+def gzip_file(filename, force=False, nthreads=0):
+    """Gzips a file with parallel BGZF compression, removing the uncompressed file as gzip does.
 
     :param str filename: file path
     :param bool force: force overwrite? Default False.
+    :param int nthreads: number of compression threads. Default 0 (autodetect).
     :return str: path of the gzipped file
+    :raises RuntimeError: if the file is not found, or if the gzipped file exists and force is False
     """
 
-    if os.path.exists(filename):
+    if not os.path.exists(filename):
+        raise RuntimeError("Filename %s not found." % filename)
 
-        gzip_call = ["gzip"]
-        if force:
-            gzip_call.append("--force")
-        gzip_call.append(filename)
+    gz_filename = add_extension(filename, GZ_EXTENSION)
+    if os.path.exists(gz_filename) and not force:
+        raise RuntimeError("Gzipped file %s already exists." % gz_filename)
 
-        subprocess.call(tuple(gzip_call))
-        return add_extension(filename, GZ_EXTENSION)
-    else:
-        raise RuntimeError("Filename %s not found." % filename)
+    with open(filename, "rb") as in_fh, BgzfWriter(gz_filename, nthreads=nthreads) as out_fh:
+        shutil.copyfileobj(in_fh, out_fh, BGZF_BLOCK_SIZE * BGZF_PENDING_PER_THREAD)
+
+    shutil.copystat(filename, gz_filename)
+    os.remove(filename)
+    return gz_filename
 
 
 def gunzip_file(filename):
@@ -153,3 +312,18 @@ def is_gzipped(filename):
         return True
 
     return False
+
+
+def get_file_digest(filename):
+    """Gets the SHA-256 digest of a file's contents.
+
+    :param str filename: file path
+    :return str: hex digest
+    """
+
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as in_fh:
+        for chunk in iter(lambda: in_fh.read(DIGEST_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Sidecar index of the byte ranges of each transcript's records in a GFF/GTF."""
+
+import collections
+import hashlib
+import logging
+import os
+import pybedtools
+import re
+import tempfile
+
+import core_utils.file_utils as fu
+from satmut_utils.definitions import DEFAULT_TEMPDIR
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+logger = logging.getLogger(__name__)
+
+
+class GffIndex(object):
+    """Maps transcript IDs to the byte ranges of their records, so one transcript can be read with a seek."""
+
+    INDEX_SUFFIX = "tidx"
+    SIGNATURE_PREFIX = "#"
+    COMMENT_CHAR = b"#"
+    # Matches both GTF (transcript_id "ID") and GFF3 (transcript_id=ID) attributes
+    TRX_ID_RE = re.compile(rb'(?:^|[;\t ])transcript_id[ =]"?([^";\n]+)"?')
+
+    def __init__(self, gff, index_dir=None):
+        r"""Constructor for GffIndex.
+
+        :param str gff: uncompressed GFF/GTF. The index is rebuilt if the GFF changes.
+        :param str | None index_dir: directory to write the index to, e.g. a cache dir shared across runs. Created if \
+        it does not exist. Default None, use the temp dir. The GFF dir is never written to.
+        """
+
+        self.gff = os.path.abspath(gff)
+        self.index_dir = tempfile.gettempdir() if index_dir is None else os.path.abspath(index_dir)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        # Name the index by its GFF path so that one index dir may serve GFFs of the same basename
+        gff_digest = hashlib.sha256(self.gff.encode()).hexdigest()
+        self.index_file = os.path.join(self.index_dir, fu.add_extension(
+            gff_digest, fu.add_extension(os.path.basename(self.gff), self.INDEX_SUFFIX)))
+
+        # Ordered by the first record of each transcript in the GFF
+        self.ranges = collections.OrderedDict()
+        if not self._load_index():
+            self._build_index()
+
+    def get_signature(self):
+        """Gets a signature of the GFF that the index is built from.
+
+        :return str: size and modification time of the GFF
+        """
+
+        gff_stat = os.stat(self.gff)
+        return "%i:%i" % (gff_stat.st_size, gff_stat.st_mtime_ns)
+
+    def _load_index(self):
+        """Loads the index if it exists and matches the GFF.
+
+        :return bool: whether the index was loaded
+        """
+
+        if not os.path.exists(self.index_file):
+            return False
+
+        with open(self.index_file, "r") as index_fh:
+            if index_fh.readline().rstrip(fu.FILE_NEWLINE) != self.SIGNATURE_PREFIX + self.get_signature():
+                return False
+
+            for line in index_fh:
+                trx_id, start, stop = line.rstrip(fu.FILE_NEWLINE).split(fu.FILE_DELIM)
+                self.ranges.setdefault(trx_id, []).append((int(start), int(stop)))
+
+        return True
+
+    def _build_index(self):
+        """Records the byte ranges of consecutive records of each transcript and writes the index."""
+
+        logger.info("Indexing transcript records in %s." % self.gff)
+
+        signature = self.get_signature()
+        self.ranges = collections.OrderedDict()
+        last_trx_id = None
+        offset = 0
+
+        with open(self.gff, "rb") as gff_fh:
+            for line in gff_fh:
+                line_start = offset
+                offset += len(line)
+
+                trx_id_match = None if line.startswith(self.COMMENT_CHAR) else self.TRX_ID_RE.search(line)
+                if trx_id_match is None:
+                    last_trx_id = None
+                    continue
+
+                trx_id = trx_id_match.group(1).decode()
+                if trx_id == last_trx_id:
+                    trx_ranges = self.ranges[trx_id]
+                    trx_ranges[-1] = (trx_ranges[-1][0], offset)
+                else:
+                    self.ranges.setdefault(trx_id, []).append((line_start, offset))
+
+                last_trx_id = trx_id
+
+        # Write to a temp file and rename so that concurrent runs never read a partial index
+        index_fd, index_tmp = tempfile.mkstemp(dir=os.path.dirname(self.index_file))
+        with os.fdopen(index_fd, "w") as index_fh:
+            index_fh.write(self.SIGNATURE_PREFIX + signature + fu.FILE_NEWLINE)
+            for trx_id, trx_ranges in self.ranges.items():
+                for start, stop in trx_ranges:
+                    index_fh.write(fu.FILE_DELIM.join((trx_id, str(start), str(stop))) + fu.FILE_NEWLINE)
+
+        os.replace(index_tmp, self.index_file)
+
+    def get_transcript_ids(self):
+        """Gets the indexed transcript IDs.
+
+        :return list: transcript IDs, in order of their first record in the GFF
+        """
+
+        return list(self.ranges.keys())
+
+    def read_transcript(self, trx_id, gff_fh=None):
+        """Reads the records of a transcript.
+
+        :param str trx_id: transcript ID
+        :param file | None gff_fh: optional GFF opened in binary mode, to avoid reopening it for each transcript
+        :return str: GFF lines of the transcript, in file order; empty if the transcript is not in the GFF
+        """
+
+        if gff_fh is None:
+            with open(self.gff, "rb") as gff_fh:
+                return self.read_transcript(trx_id, gff_fh)
+
+        records = []
+        for start, stop in self.ranges.get(trx_id, []):
+            gff_fh.seek(start)
+            records.append(gff_fh.read(stop - start))
+
+        return b"".join(records).decode()
+
+    def write_transcript(self, trx_id, output_gff):
+        """Writes the records of a transcript to a new GFF.
+
+        :param str trx_id: transcript ID
+        :param str output_gff: output GFF path
+        """
+
+        with open(output_gff, "w") as out_fh:
+            out_fh.write(self.read_transcript(trx_id))
+
+    def iterate_transcripts(self, trx_ids=None):
+        """Iterates over the records of each transcript.
+
+        :param list | None trx_ids: optional transcript IDs to read. Default None, all transcripts in GFF order.
+        :return generator: (trx_id, list) transcript ID and its records as pybedtools.Interval objects
+        """
+
+        with open(self.gff, "rb") as gff_fh:
+            for trx_id in (self.ranges.keys() if trx_ids is None else trx_ids):
+                yield trx_id, self.parse_records(self.read_transcript(trx_id, gff_fh))
+
+    @staticmethod
+    def parse_records(records):
+        """Parses GFF records into features.
+
+        :param str records: GFF lines
+        :return list: pybedtools.Interval objects
+        """
+
+        return [pybedtools.create_interval_from_list(r.split(fu.FILE_DELIM)) for r in records.splitlines()]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Sets the compression, location, and lifetime of intermediate files."""
+
+import logging
+import os
+import pysam
+import shutil
+import tempfile
+
+import analysis.seq_utils as su
+import core_utils.file_utils as fu
+from satmut_utils.definitions import DEFAULT_TEMPDIR
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+logger = logging.getLogger(__name__)
+
+
+class IntermediatePolicy(object):
+    """Decides how intermediates are compressed, where they are written, and when they are removed."""
+
+    DEFAULT_COMPRESSION_LEVEL = 1
+    DEFAULT_NTHREADS = 0
+    DEFAULT_KEEP_INTERMEDIATES = False
+    DEFAULT_SCRATCH_DIR = None
+    SCRATCH_SPACE_FACTOR = 4  # free space required in the scratch dir, as a multiple of the input size
+
+    def __init__(self, compresslevel=DEFAULT_COMPRESSION_LEVEL, nthreads=DEFAULT_NTHREADS,
+                 keep_intermediates=DEFAULT_KEEP_INTERMEDIATES, scratch_dir=DEFAULT_SCRATCH_DIR):
+        r"""Constructor for IntermediatePolicy.
+
+        :param int | None compresslevel: BGZF compression level for intermediate BAMs, from 0 (uncompressed) to 9. \
+        Default 1. None uses the htslib default.
+        :param int nthreads: number of threads for BGZF compression. Default 0 (autodetect).
+        :param bool keep_intermediates: keep intermediates rather than removing them after their last use. \
+        Default False.
+        :param str | None scratch_dir: optional directory, e.g. a RAM-backed /dev/shm, to write intermediates to \
+        when it has enough free space. Default None, use the temp dir.
+        """
+
+        self.compresslevel = compresslevel
+        self.nthreads = nthreads
+        self.keep_intermediates = keep_intermediates
+        self.scratch_dir = scratch_dir
+        self.intermediates = set()
+
+    @property
+    def bam_write_mode(self):
+        """Gets the pysam mode for writing intermediate BAMs.
+
+        :return str: pysam.AlignmentFile write mode
+        """
+
+        if self.compresslevel == 0:
+            return "wbu"
+
+        return "wb"
+
+    @property
+    def format_options(self):
+        """Gets the htslib format options setting the compression level of intermediate BAMs.
+
+        :return list | None: format options for pysam.AlignmentFile; None for the htslib default level
+
+        pysam only accepts wb0/wbu as a mode with a level, so other levels are set as a format option.
+        """
+
+        if self.compresslevel is None or self.compresslevel == 0:
+            return None
+
+        return [("level=%i" % self.compresslevel).encode()]
+
+    @property
+    def threads(self):
+        """Gets the number of threads for BGZF compression.
+
+        :return int: number of threads
+        """
+
+        return fu.get_nthreads(self.nthreads)
+
+    def open_bam(self, filename, **kwargs):
+        """Opens an intermediate BAM for writing.
+
+        :param str | file filename: output BAM
+        :param kwargs: header or template keyword arguments for pysam.AlignmentFile
+        :return pysam.AlignmentFile: alignment file open for writing
+        """
+
+        return pysam.AlignmentFile(
+            filename, self.bam_write_mode, threads=self.threads, format_options=self.format_options, **kwargs)
+
+    def get_scratch_dir(self, required_bytes=0):
+        """Gets the directory to write intermediates to.
+
+        :param int required_bytes: expected size of the intermediates
+        :return str: the scratch dir if it exists and has at least the required free space; otherwise the temp dir
+        """
+
+        if self.scratch_dir is not None and os.path.isdir(self.scratch_dir) and \
+                os.access(self.scratch_dir, os.W_OK) and shutil.disk_usage(self.scratch_dir).free >= required_bytes:
+            return self.scratch_dir
+
+        if self.scratch_dir is not None:
+            logger.info("Scratch dir %s is unavailable or lacks %i free bytes; using %s." %
+                        (self.scratch_dir, required_bytes, tempfile.gettempdir()))
+
+        return tempfile.gettempdir()
+
+    def make_tempdir(self, suffix=None, input_files=()):
+        """Makes a temp dir for intermediates, in the scratch dir if it has enough space.
+
+        :param str | None suffix: optional suffix of the temp dir name
+        :param tuple input_files: inputs of the workflow, whose size is used to estimate the size of the intermediates
+        :return str: path of the temp dir
+        """
+
+        required_bytes = self.SCRATCH_SPACE_FACTOR * sum(os.path.getsize(f) for f in input_files if os.path.exists(f))
+        return tempfile.mkdtemp(suffix=suffix, dir=self.get_scratch_dir(required_bytes))
+
+    def register(self, *filenames):
+        """Marks files as intermediates that may be removed once they are released.
+
+        :param filenames: paths of intermediate files
+        """
+
+        self.intermediates.update(os.path.abspath(f) for f in filenames if f is not None)
+
+    def release(self, *filenames):
+        """Removes intermediates after their last consumer has finished, along with any BAM index.
+
+        :param filenames: paths of files no longer needed. Files not registered as intermediates are never removed.
+        """
+
+        if self.keep_intermediates:
+            return
+
+        for filename in filenames:
+
+            if filename is None:
+                continue
+
+            file_path = os.path.abspath(filename)
+            if file_path not in self.intermediates:
+                continue
+
+            self.intermediates.remove(file_path)
+            fu.safe_remove((file_path, fu.add_extension(file_path, su.BAM_INDEX_SUFFIX),))
+
+    def handoff(self, inputs, outputs):
+        r"""Registers the outputs of a stage and releases the inputs it consumed.
+
+        :param tuple inputs: files read by the stage, which have no later consumers
+        :param tuple outputs: intermediate files written by the stage
+
+        Inputs passed through as outputs, e.g. when a stage is skipped, are neither released nor newly registered, \
+        so workflow inputs that were never registered are never removed.
+        """
+
+        input_paths = {os.path.abspath(f) for f in inputs if f is not None}
+        output_paths = {os.path.abspath(f) for f in outputs if f is not None}
+        self.register(*(output_paths - input_paths))
+        self.release(*(input_paths - output_paths))
+
+
+def open_bam(filename, io_policy=None, **kwargs):
+    r"""Opens an intermediate BAM for writing under an optional policy.
+
+    :param str | file filename: output BAM
+    :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy. Default None, write with the \
+    htslib default compression in a single thread.
+    :param kwargs: header or template keyword arguments for pysam.AlignmentFile
+    :return pysam.AlignmentFile: alignment file open for writing
+    """
+
+    if io_policy is None:
+        return pysam.AlignmentFile(filename, "wb", **kwargs)
+
+    return io_policy.open_bam(filename, **kwargs)
+
+
+def get_compresslevel(io_policy=None):
+    """Gets the compression level to pass to samtools under an optional policy.
+
+    :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy
+    :return int | None: compression level, or None for the samtools default
+    """
+
+    if io_policy is None:
+        return None
+
+    return io_policy.compresslevel
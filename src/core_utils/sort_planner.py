@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Tracks the ordering of alignment intermediates to skip redundant sorts."""
+
+import aenum
+import collections
+import logging
+import os
+import pysam
+
+import analysis.seq_utils as su
+import core_utils.io_policy as iop
+
+__author__ = "Ian Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+logger = logging.getLogger(__name__)
+
+SAM_HD_GO_TAG = "GO"
+SAM_HD_GO_QUERY_VAL = "query"
+SAM_HD_SO_COORD_VAL = "coordinate"
+
+SORT_TUPLE = collections.namedtuple("SORT_TUPLE", "stage, bam, order, observed_order")
+
+
+class SortOrder(aenum.Enum):
+    """Enum for alignment file orderings."""
+    UNKNOWN = "unknown"
+    NAME_GROUPED = "name_grouped"  # mates adjacent, e.g. bowtie2 native output or samtools collate
+    QUERYNAME = "queryname"
+    COORDINATE = "coordinate"
+
+
+class SortPlanner(object):
+    """Tracks the ordering of alignment files and only sorts when a required ordering is not already met."""
+
+    DEFAULT_NTHREADS = 0
+
+    def __init__(self, nthreads=DEFAULT_NTHREADS, io_policy=None):
+        r"""Constructor for SortPlanner.
+
+        :param int nthreads: number additional threads to use for sorting
+        :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression \
+        level of sorted outputs
+        """
+
+        self.nthreads = nthreads
+        self.io_policy = io_policy
+        self.orders = {}
+        self.performed = []
+        self.skipped = []
+
+    def register(self, bam, order):
+        """Records the ordering of an alignment file.
+
+        :param str bam: alignment file
+        :param core_utils.sort_planner.SortOrder order: ordering of the file
+        """
+
+        self.orders[os.path.abspath(bam)] = order
+
+    def propagate(self, in_bam, out_bam):
+        """Records that an order-preserving operation wrote out_bam from in_bam.
+
+        :param str in_bam: input alignment file
+        :param str out_bam: output alignment file written in the same order as in_bam
+        """
+
+        self.register(out_bam, self.get_order(in_bam))
+
+    def get_order(self, bam):
+        """Gets the ordering of an alignment file, falling back to the @HD header if it was not registered.
+
+        :param str bam: alignment file
+        :return core_utils.sort_planner.SortOrder: ordering of the file
+        """
+
+        bam_path = os.path.abspath(bam)
+        if bam_path in self.orders:
+            return self.orders[bam_path]
+
+        with pysam.AlignmentFile(bam, "rb", check_sq=False) as af:
+            hd = af.header.to_dict().get(su.SAM_HD_TAG, {})
+
+        if hd.get(su.SAM_HD_SO_TAG) == SAM_HD_SO_COORD_VAL:
+            return SortOrder.COORDINATE
+        elif hd.get(su.SAM_HD_SO_TAG) == su.SAM_HD_SO_QNAME_VAL:
+            return SortOrder.QUERYNAME
+        elif hd.get(SAM_HD_GO_TAG) == SAM_HD_GO_QUERY_VAL:
+            return SortOrder.NAME_GROUPED
+
+        return SortOrder.UNKNOWN
+
+    @staticmethod
+    def satisfies(observed_order, order):
+        """Determines if an observed ordering meets a required ordering.
+
+        :param core_utils.sort_planner.SortOrder observed_order: ordering of a file
+        :param core_utils.sort_planner.SortOrder order: required ordering
+        :return bool: whether the required ordering is met
+        """
+
+        if observed_order == order:
+            return True
+
+        # A qname-sorted file also has mates adjacent
+        return order == SortOrder.NAME_GROUPED and observed_order == SortOrder.QUERYNAME
+
+    def require(self, bam, order, output_am=None, stage=None, ref=None):
+        """Ensures an alignment file has the required ordering, sorting only if needed.
+
+        :param str bam: alignment file
+        :param core_utils.sort_planner.SortOrder order: required ordering
+        :param str | None output_am: optional output name if a sort is needed
+        :param str | None stage: name of the requesting stage, for the run summary
+        :param str | None ref: optional reference FASTA for decoding a CRAM input
+        :return str: bam if it already has the required ordering; otherwise the sorted output file
+
+        Note callers should use the returned path, as output_am is not written when the sort is skipped.
+        """
+
+        observed_order = self.get_order(bam)
+        sort_tuple = SORT_TUPLE(stage=stage, bam=bam, order=order, observed_order=observed_order)
+
+        if self.satisfies(observed_order, order):
+
+            # Coordinate-sorted consumers expect an index
+            if order == SortOrder.COORDINATE and not os.path.exists(su.get_index_name(bam)):
+                su.index_bam(bam)
+
+            logger.info("Skipped %s sort of %s for %s; already %s." % (order.value, bam, stage, observed_order.value))
+            self.skipped.append(sort_tuple)
+            return bam
+
+        logger.info("Sorting %s (%s) to %s order for %s." % (bam, observed_order.value, order.value, stage))
+
+        compresslevel = iop.get_compresslevel(self.io_policy)
+
+        if order == SortOrder.COORDINATE:
+            out_bam = su.sort_and_index(
+                am=bam, output_am=output_am, nthreads=self.nthreads, compresslevel=compresslevel, ref=ref)
+        elif order == SortOrder.QUERYNAME:
+            sort_kwargs = {} if compresslevel is None else {"l": str(compresslevel)}
+            if ref is not None:
+                sort_kwargs["reference"] = ref
+
+            out_bam = su.sort_bam(bam=bam, output_am=output_am, by_qname=True, nthreads=self.nthreads, **sort_kwargs)
+        elif order == SortOrder.NAME_GROUPED:
+            out_bam = su.collate_bam(
+                bam=bam, output_am=output_am, nthreads=self.nthreads, compresslevel=compresslevel, ref=ref)
+        else:
+            raise NotImplementedError("Sorting to %s order is not supported." % order.value)
+
+        self.performed.append(sort_tuple)
+        self.register(out_bam, order)
+        return out_bam
+
+    def log_summary(self):
+        """Logs the sorts performed and skipped."""
+
+        logger.info("Sort summary: %i performed, %i skipped." % (len(self.performed), len(self.skipped)))
+
+        for st in self.performed:
+            logger.info("Performed %s sort for %s (was %s)." % (st.order.value, st.stage, st.observed_order.value))
+
+        for st in self.skipped:
+            logger.info("Skipped %s sort for %s (already %s)." % (st.order.value, st.stage, st.observed_order.value))
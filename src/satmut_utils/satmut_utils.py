@@ -2,22 +2,30 @@
 """Runs satmut_utils."""
 
 import argparse
+import collections
 import logging
+import multiprocessing
 import os
 from shutil import copy
 import sys
 import tempfile
 
 from analysis.read_preprocessor import FastqPreprocessor, UMIExtractor, ReadGrouper, \
-    ConsensusDeduplicatorPreprocessor, ConsensusDeduplicator, ReadMasker, QnameVerification
+    ConsensusDeduplicatorPreprocessor, ConsensusDeduplicator, ReadMasker, TileDemultiplexer, MateMerger, \
+    DuplicateCollapser, QnameEncoder
+from analysis.aligners import ALIGNER_BOWTIE2, VALID_ALIGNERS, DEFAULT_ALIGNER
+from analysis.anchored_counter import PrimerAnchoredCounter
 import analysis.read_editor as ri
-from analysis.references import get_ensembl_references, index_reference, faidx_ref
-from analysis.seq_utils import FASTA_INDEX_SUFFIX
+from analysis.reference_store import ReferenceStore
+from analysis.references import get_ensembl_references, get_panel_references, index_reference, faidx_ref, PANEL_GFF
+from analysis.seq_utils import FASTA_INDEX_SUFFIX, cat_bams
 from analysis.variant_caller import VariantCaller
 import core_utils.file_utils as fu
+from core_utils.io_policy import IntermediatePolicy
+from core_utils.sort_planner import SortPlanner, SortOrder
 from core_utils.string_utils import none_or_str
-from satmut_utils.definitions import AMP_UMI_REGEX, GRCH38_FASTA, QNAME_SORTS, INT_FORMAT_INDEX, DEFAULT_MUT_SIG, \
-    VALID_MUT_SIGS, KEEP_INTERMEDIATES, LOG_FORMATTER, DEFAULT_TEMPDIR
+from satmut_utils.definitions import AMP_UMI_REGEX, GRCH38_FASTA, DEFAULT_MUT_SIG, VALID_MUT_SIGS, \
+    KEEP_INTERMEDIATES, LOG_FORMATTER, DEFAULT_TEMPDIR
 from scripts.run_bowtie2_aligner import workflow as baw
 
 __author__ = "Ian Hoskins"
@@ -36,6 +44,15 @@ DEFAULT_NTHREADS = 0
 DEFAULT_SEED = 9
 DEFAULT_REFDIR = "./references"
 DEFAULT_OUTDIR = "./satmut_utils_results"
+DEFAULT_DEMUX = False
+DEFAULT_MERGE = False
+DEFAULT_COLLAPSE = False
+DEFAULT_ANCHORED = False
+DEFAULT_ENCODE_QNAMES = False
+DEFAULT_RESTORE_QNAMES = False
+TILE_MERGED_BAM = "tiles.merged.bam"
+TILE_MERGED_MULTIPLICITY = "tiles.multiplicity.txt"
+MATE_MERGED_BAM = "mates.merged.bam"
 
 LOGFILE = fu.replace_extension(os.path.basename(__file__), "log")
 logger = logging.getLogger()
@@ -87,6 +104,30 @@ def parse_commandline_params(args):
                         help='Max edit distance to consider a read pair for simulation and variant calling. '
                              'Default %i.' % VariantCaller.VARIANT_CALL_MAX_NM)
 
+    parser.add_argument("--intermediate_compression", type=int, choices=range(10),
+                        default=IntermediatePolicy.DEFAULT_COMPRESSION_LEVEL,
+                        help='BGZF compression level of intermediate BAMs, from 0 (uncompressed) to 9. Default %i.'
+                             % IntermediatePolicy.DEFAULT_COMPRESSION_LEVEL)
+
+    parser.add_argument("--scratch_dir", type=none_or_str, default="None",
+                        help='Optional directory for intermediate files, e.g. a RAM-backed /dev/shm. Used only if it '
+                             'has enough free space for the run; otherwise the temp dir is used.')
+
+    parser.add_argument("--panel_dir", type=none_or_str, default="None",
+                        help='Optional directory of a gene panel reference built by satmut_panel. If it contains the '
+                             '--ensembl_id, its prebuilt references and indexes are used.')
+
+    parser.add_argument("--reference_store", type=none_or_str, default="None",
+                        help='Optional directory of indexed references shared across runs. References are keyed by '
+                             'their contents and the bowtie2 version, so each index is built only once.')
+
+    parser.add_argument("--reference_store_max_age", type=float, default=ReferenceStore.DEFAULT_MAX_AGE_DAYS,
+                        help='Optional number of days after which unused references are removed from the store.')
+
+    parser.add_argument("--reference_store_max_size", type=float, default=ReferenceStore.DEFAULT_MAX_SIZE_GB,
+                        help='Optional max size of the reference store in GB. The least recently used references '
+                             'are removed to stay within this size.')
+
     # Subcommands
     subparsers = parser.add_subparsers(title='subcommands', help='sub-command help', dest="subcommand", required=True)
 
@@ -117,6 +158,9 @@ def parse_commandline_params(args):
     parser_sim.add_argument("-y", "--random_seed", type=int, default=DEFAULT_SEED,
                             help='Seed for random read sampling. Default %i' % DEFAULT_SEED)
 
+    parser_sim.add_argument("--output_cram", action="store_true",
+                            help='Flag to write the edited alignments as CRAM compressed against the reference.')
+
     # call subcommand
     parser_call = subparsers.add_parser(CALL_WORKFLOW, help='%s help' % CALL_WORKFLOW)
     parser_call.set_defaults(func=call_workflow)
@@ -199,6 +243,11 @@ def parse_commandline_params(args):
                                   'reassigned the unknown base N if the gap is greater than this threshold. '
                                   'To avoid this behavior, provide -f.')
 
+    parser_call.add_argument("--max_duplicates", type=int, default=ConsensusDeduplicator.MAX_DUPLICATES,
+                             help='If -d, sample at most this many reads per mate and strand of a UMI group to '
+                                  'generate the consensus. Bounds the time and memory spent on jackpot UMI groups. '
+                                  'Default use all reads.')
+
     parser_call.add_argument("-f", "--primer_fasta", type=none_or_str,
                              help='If -z and -cd, this may be set to append originating R2 primer sequences to read names. '
                                   'Useful for RACE-like libraries to prohibit R2 merging. Without this flag, R2s from '
@@ -208,6 +257,51 @@ def parse_commandline_params(args):
     parser_call.add_argument("-a", "--primer_nm_allowance", type=int, default=UMIExtractor.PRIMER_NM_ALLOW,
                              help='If -f, find primers in R2 with up to this many edit operations.')
 
+    parser_call.add_argument("--demultiplex_tiles", action="store_true",
+                             help='Flag to split read pairs by their originating primer in --primer_fasta, and '
+                                  'preprocess, align, deduplicate, and mask each tile in parallel workers before '
+                                  'calling variants on the merged tiles. Bounds the memory of each worker.')
+
+    parser_call.add_argument("--merge_mates", action="store_true",
+                             help='Flag to merge overlapping mates into single fragments before alignment. Mate '
+                                  'concordance is recorded per base and only concordant edits are called. Not '
+                                  'supported with -d or -z.')
+
+    parser_call.add_argument("--anchored_counting", action="store_true",
+                             help='Flag to count SNPs and MNPs in read pairs starting at primers in --primers by '
+                                  'placing them at the primer offsets, without alignment. Pairs that cannot be '
+                                  'anchored or suggest an indel are aligned as usual. For amplicon (Tile-seq) '
+                                  'libraries; not supported with -d, -z, --merge_mates, or --demultiplex_tiles.')
+
+    parser_call.add_argument("--encode_qnames", action="store_true",
+                             help='Flag to replace read names with integers after UMI extraction. The UMI is '
+                                  'carried as an alignment tag and the original names are kept in a gzipped side '
+                                  'table. Shrinks intermediate BAMs and speeds up sorting.')
+
+    parser_call.add_argument("--restore_qnames", action="store_true",
+                             help='If --encode_qnames, write the preprocessed alignments with their original read '
+                                  'names to the output directory. Not supported with --demultiplex_tiles.')
+
+    parser_call.add_argument("--collapse_duplicates", action="store_true",
+                             help='Flag to align only one representative of each exact-duplicate read pair. Variant '
+                                  'counts and depth are weighted by the number of duplicates of each representative. '
+                                  'Ignored with --consensus_deduplicate.')
+
+    parser_call.add_argument("--collapse_quals", type=str, default=DuplicateCollapser.DEFAULT_QUAL_COLLAPSE,
+                             choices=sorted(DuplicateCollapser.VALID_QUAL_COLLAPSE),
+                             help='If --collapse_duplicates, how to collapse the base qualities of duplicates into '
+                                  'the representative. One of {max, mean}. Default %s.'
+                                  % DuplicateCollapser.DEFAULT_QUAL_COLLAPSE)
+
+    parser_call.add_argument("--alignment_cache_dir", type=none_or_str, default=None,
+                             help='Optional directory of a persistent alignment cache shared across runs. Only read '
+                                  'pairs missing from the cache are aligned. The cache is invalidated if the reference '
+                                  'or alignment parameters change.')
+
+    parser_call.add_argument("--aligner", type=str, default=DEFAULT_ALIGNER, choices=sorted(VALID_ALIGNERS),
+                             help='Aligner to use. banded runs an in-process aligner suited to single-transcript or '
+                                  'amplicon references, without the bowtie2 dependency. Default %s.' % DEFAULT_ALIGNER)
+
     parser_call.add_argument("--keep_intermediates", action="store_true",
                              help='Flag to write intermediate files (e.g. trimmed FASTQs, original alignments, '
                                   'preprocessed alignments) to the output_dir. Not recommended as files can be large.')
@@ -216,13 +310,18 @@ def parse_commandline_params(args):
     return parsed_args
 
 
-def get_sim_reference(reference_dir, ensembl_id, ref, outdir=ri.ReadEditor.DEFAULT_REFERENCE_DIR):
-    """Get and build index files for the sim workflow reference FASTA.
+def get_sim_reference(reference_dir, ensembl_id, ref, outdir=ri.ReadEditor.DEFAULT_REFERENCE_DIR,
+                      reference_store=None, panel_dir=None):
+    r"""Get and build index files for the sim workflow reference FASTA.
 
     :param str reference_dir: directory containing curated APPRIS reference files
     :param str ensembl_id: Ensembl gene or transcript ID, with version number
     :param str ref: path to reference FASTA used in alignment. Must be bowtie2 FM-index and samtools faidx indexed.
     :param str outdir: optional output dir for the reference files. Default /tmp/references
+    :param analysis.reference_store.ReferenceStore | None reference_store: optional store of indexed references \
+    shared across runs. Default None, copy and index the reference in outdir.
+    :param str | None panel_dir: optional directory of a gene panel reference to select the Ensembl ID from. \
+    Default None.
     :return str: reference FASTA filepath
     """
 
@@ -231,12 +330,21 @@ def get_sim_reference(reference_dir, ensembl_id, ref, outdir=ri.ReadEditor.DEFAU
     if not os.path.exists(outdir_fullpath):
         os.mkdir(outdir_fullpath)
 
+    panel_refs = None
+    if ensembl_id is not None and panel_dir is not None:
+        panel_refs = get_panel_references(panel_dir=panel_dir, ensembl_id=ensembl_id)
+
     # Determine if the provided Ensembl ID is found in the curated APPRIS references
-    if ensembl_id is not None:
+    if panel_refs is not None:
+        ref_fa, _ = panel_refs
+    elif ensembl_id is not None:
         if ref is not None:
             logger.error("Both an Ensembl ID and a reference FASTA were provided. Please choose one.")
 
-        ref_fa, _ = get_ensembl_references(reference_dir=reference_dir, ensembl_id=ensembl_id, outdir=outdir_fullpath)
+        ref_fa, _ = get_ensembl_references(reference_dir=reference_dir, ensembl_id=ensembl_id, outdir=outdir_fullpath,
+                                           reference_store=reference_store)
+    elif reference_store is not None:
+        ref_fa = reference_store.get_reference(ref)
     else:
         logger.info("Copying input reference FASTA and indexing.")
         ref_fa = os.path.join(outdir_fullpath, os.path.basename(ref))
@@ -247,7 +355,8 @@ def get_sim_reference(reference_dir, ensembl_id, ref, outdir=ri.ReadEditor.DEFAU
 
 
 def get_call_references(reference_dir, ensembl_id, ref, transcript_gff, gff_reference,
-                        outdir=VariantCaller.VARIANT_CALL_REFERENCE_DIR):
+                        outdir=VariantCaller.VARIANT_CALL_REFERENCE_DIR, fm_index=True, reference_store=None,
+                        panel_dir=None):
     """Get and/or build index files for references.
 
     :param str reference_dir: directory containing curated APPRIS reference files
@@ -257,6 +366,11 @@ def get_call_references(reference_dir, ensembl_id, ref, transcript_gff, gff_refe
     regardless of strand. Ordering is essential.
     :param str gff_reference: reference FASTA corresponding to the GFF features
     :param str outdir: optional output dir for the reference files. Default /tmp/references
+    :param bool fm_index: build the bowtie2 FM index for the reference? Default True.
+    :param analysis.reference_store.ReferenceStore | None reference_store: optional store of indexed references \
+    shared across runs. Default None, copy and index the reference in outdir.
+    :param str | None panel_dir: optional directory of a gene panel reference to select the Ensembl ID from. \
+    Default None.
     :return tuple: (ref_fa, gff, gff_ref) filepaths
     """
 
@@ -268,15 +382,28 @@ def get_call_references(reference_dir, ensembl_id, ref, transcript_gff, gff_refe
     gff = transcript_gff
     gff_ref = gff_reference
 
+    # Select a prebuilt panel reference, whose CDS annotations are stored next to its GFF
+    panel_refs = None
+    if ensembl_id is not None and panel_dir is not None:
+        panel_refs = get_panel_references(panel_dir=panel_dir, ensembl_id=ensembl_id)
+
     # Determine if the provided Ensembl ID is found in the curated APPRIS references
-    if ensembl_id is not None:
-        ref_fa, gff = get_ensembl_references(reference_dir=reference_dir, ensembl_id=ensembl_id, outdir=outdir_fullpath)
+    if panel_refs is not None:
+        ref_fa, gff = panel_refs
+        gff_ref = os.path.join(reference_dir, GRCH38_FASTA)
+    elif ensembl_id is not None:
+        ref_fa, gff = get_ensembl_references(
+            reference_dir=reference_dir, ensembl_id=ensembl_id, outdir=outdir_fullpath, fm_index=fm_index,
+            reference_store=reference_store)
         gff_ref = os.path.join(reference_dir, GRCH38_FASTA)
     else:
-        logger.info("Copying input reference FASTA and indexing.")
-        ref_fa = os.path.join(outdir_fullpath, os.path.basename(ref))
-        copy(ref, ref_fa)
-        index_reference(ref_fa)
+        if reference_store is not None:
+            ref_fa = reference_store.get_reference(ref, fm_index)
+        else:
+            logger.info("Copying input reference FASTA and indexing.")
+            ref_fa = os.path.join(outdir_fullpath, os.path.basename(ref))
+            copy(ref, ref_fa)
+            index_reference(ref_fa, fm_index)
 
         # Make sure the GFF reference has a samtools index file
         if not os.path.exists(fu.add_extension(gff_reference, FASTA_INDEX_SUFFIX)):
@@ -291,10 +418,14 @@ def sim_workflow(bam, vcf, race_like, ensembl_id=ri.ReadEditor.DEFAULT_ENSEMBL_I
                  primers=ri.ReadEditor.DEFAULT_PRIMERS, outdir=ri.ReadEditor.DEFAULT_OUTDIR,
                  buffer=ri.ReadEditor.DEFAULT_BUFFER, max_nm=VariantCaller.VARIANT_CALL_MAX_NM,
                  random_seed=ri.ReadEditor.DEFAULT_SEED, force_edit=ri.ReadEditor.DEFAULT_FORCE,
-                 nthreads=ri.ReadEditor.DEFAULT_NTHREADS):
-    """Runs the satmut_utils sim workflow.
-
-    :param str bam: BAM file to edit into
+                 nthreads=ri.ReadEditor.DEFAULT_NTHREADS,
+                 intermediate_compression=IntermediatePolicy.DEFAULT_COMPRESSION_LEVEL,
+                 scratch_dir=IntermediatePolicy.DEFAULT_SCRATCH_DIR, output_cram=ri.ReadEditor.DEFAULT_OUTPUT_CRAM,
+                 reference_store_dir=None, reference_store_max_age=ReferenceStore.DEFAULT_MAX_AGE_DAYS,
+                 reference_store_max_size=ReferenceStore.DEFAULT_MAX_SIZE_GB, panel_dir=None):
+    r"""Runs the satmut_utils sim workflow.
+
+    :param str bam: BAM or CRAM file to edit into
     :param str vcf: VCF file specifying variants to edit
     :param bool race_like: is the data produced by RACE-like (e.g. AMP) data? Default False.
     :param str | None ensembl_id: Ensembl gene or transcript ID, with version number
@@ -308,21 +439,33 @@ def sim_workflow(bam, vcf, race_like, ensembl_id=ri.ReadEditor.DEFAULT_ENSEMBL_I
     :param bool force_edit: flag to attempt editing of variants despite a NonconfiguredVariant exception.
     :param int nthreads: Number of threads to use for SAM/BAM operations and alignment. Default 0 (autodetect) \
     for samtools operations. If 0, will pass 1 to bowtie2 --threads.
-    :return tuple: (str | None, str, str | None) paths of the edited BAM, R1 FASTQ, R2 FASTQ
+    :param int | None intermediate_compression: BGZF compression level of intermediate BAMs, from 0 (uncompressed) \
+    to 9. Default 1. None for the samtools default.
+    :param str | None scratch_dir: optional directory, e.g. a RAM-backed /dev/shm, for intermediate files. Used only \
+    if it has enough free space. Default None.
+    :param bool output_cram: write the edited alignments as reference-compressed CRAM. Default False.
+    :param str | None reference_store_dir: optional directory of indexed references shared across runs. Default None.
+    :param float | None reference_store_max_age: remove stored references unused for this many days. Default None.
+    :param float | None reference_store_max_size: remove the least recently used stored references to keep the store \
+    within this many GB. Default None.
+    :param str | None panel_dir: optional directory of a gene panel reference built by satmut_panel. If it contains \
+    ensembl_id, its prebuilt references and indexes are used. Default None.
+    :return tuple: (str | None, str, str | None) paths of the edited BAM or CRAM, R1 FASTQ, R2 FASTQ
     """
 
-    # Unfortunately sort-order harmony with samtools sort -n requires we know the format of the qname
-    # Check to make sure we have either Illumina format or single integer read names
-    if primers is not None:
-        _ = QnameVerification(bam=bam)
-
     outdir_fullpath = os.path.abspath(outdir)
 
     if not os.path.exists(outdir_fullpath):
         os.mkdir(outdir_fullpath)
 
+    reference_store = None if reference_store_dir is None else ReferenceStore(reference_store_dir)
     ref_fa = get_sim_reference(
-        reference_dir=reference_dir, ensembl_id=ensembl_id, ref=ref, outdir=outdir_fullpath)
+        reference_dir=reference_dir, ensembl_id=ensembl_id, ref=ref, outdir=outdir_fullpath,
+        reference_store=reference_store, panel_dir=panel_dir)
+
+    if reference_store is not None:
+        reference_store.collect_garbage(
+            max_age_days=reference_store_max_age, max_size_gb=reference_store_max_size, keep=(ref_fa,))
 
     out_prefix = fu.remove_extension(os.path.basename(bam))
 
@@ -330,11 +473,250 @@ def sim_workflow(bam, vcf, race_like, ensembl_id=ri.ReadEditor.DEFAULT_ENSEMBL_I
     output_bam, zipped_r1_fastq, zipped_r2_fastq = ri.ReadEditor(
         bam=bam, variants=vcf, ref=ref_fa, race_like=race_like, primers=primers,
         output_dir=outdir_fullpath, output_prefix=out_prefix, buffer=buffer, max_nm=max_nm,
-        random_seed=random_seed, force_edit=force_edit, nthreads=nthreads).workflow()
+        random_seed=random_seed, force_edit=force_edit, nthreads=nthreads,
+        io_policy=IntermediatePolicy(
+            compresslevel=intermediate_compression, nthreads=nthreads, scratch_dir=scratch_dir),
+        output_cram=output_cram).workflow()
+
+    if reference_store is not None:
+        reference_store.close()
 
     return output_bam, zipped_r1_fastq, zipped_r2_fastq
 
 
+def preprocess_workflow(fastq1, fastq2, ref_fa, outdir,
+                        r1_fiveprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
+                        r1_threeprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
+                        r2_fiveprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
+                        r2_threeprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
+                        race_like=ReadMasker.DEFAULT_RACE_LIKE, primers=VariantCaller.VARIANT_CALL_PRIMERS,
+                        consensus_dedup=VariantCaller.VARIANT_CALL_CDEDUP,
+                        contig_del_thresh=ConsensusDeduplicator.CONTIG_DEL_THRESH,
+                        max_duplicates=ConsensusDeduplicator.MAX_DUPLICATES,
+                        nthreads=FastqPreprocessor.NCORES, ntrimmed=FastqPreprocessor.NTRIMMED,
+                        overlap_len=FastqPreprocessor.OVERLAP_LEN, trim_bq=FastqPreprocessor.TRIM_QUALITY,
+                        ncores=FastqPreprocessor.NCORES, omit_trim=FastqPreprocessor.TRIM_FLAG, sort_planner=None,
+                        merge_mates=DEFAULT_MERGE, collapse_duplicates=DEFAULT_COLLAPSE,
+                        collapse_quals=DuplicateCollapser.DEFAULT_QUAL_COLLAPSE, alignment_cache_dir=None,
+                        aligner=DEFAULT_ALIGNER, umi_tag=None, io_policy=None):
+    r"""Runs FASTQ preprocessing, alignment, optional consensus deduplication, and optional primer masking.
+
+    :param str fastq1: path of the R1 FASTQ, with UMIs extracted if consensus_dedup
+    :param str fastq2: path of the R2 FASTQ, with UMIs extracted if consensus_dedup
+    :param str ref_fa: indexed reference FASTA
+    :param str outdir: output dir for the intermediate files
+    :param str | None r1_fiveprime_adapters: comma-delimited 5' adapters to trim from R1. Default None.
+    :param str | None r1_threeprime_adapters: comma-delimited 3' adapters to trim from R1. Default None.
+    :param str | None r2_fiveprime_adapters: comma-delimited 5' adapters to trim from R2. Default None.
+    :param str | None r2_threeprime_adapters: comma-delimited 3' adapters to trim from R2. Default None.
+    :param bool race_like: is the data produced by RACE-like (e.g. AMP) data? Default False.
+    :param str | None primers: BED or GFF file containing primers to mask. Must contain a strand field.
+    :param bool consensus_dedup: should consensus bases be generated during deduplication? Default False.
+    :param int contig_del_thresh: max deletion length for which del/N gaps in the merged R2 contig are called. Default 10.
+    :param int | None max_duplicates: max reads per mate/strand of a UMI group used for the consensus. Default None, \
+    use all reads.
+    :param int nthreads: Number of threads to use for BAM operations. Default 0 (autodetect).
+    :param int ntrimmed: Max number of adapters to trim from each read. Default 4.
+    :param int overlap_len: number of bases to match in read to trim. Default 8.
+    :param int trim_bq: quality score for cutadapt quality trimming at the 3' end. Default 15.
+    :param int ncores: Number CPU cores to use for cutadapt. Default 0, autodetect.
+    :param bool omit_trim: flag to turn off adapter and 3' base quality trimming. Default False.
+    :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner tracking intermediate orders
+    :param bool merge_mates: merge overlapping mates into single fragments before alignment? Default False.
+    :param bool collapse_duplicates: align only one representative of each exact-duplicate pair? Default False. \
+    Ignored with consensus_dedup.
+    :param str collapse_quals: how to collapse the base qualities of duplicates, one of {max, mean}. Default mean.
+    :param str | None alignment_cache_dir: optional directory of a persistent alignment cache. Default None.
+    :param str aligner: one of {bowtie2, banded}. Default bowtie2.
+    :param str | None umi_tag: tag in the read comments holding the UMI, if read names were encoded by \
+    QnameEncoder. Default None, the UMI is appended to the read name.
+    :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy setting the compression of the \
+    intermediate BAMs and releasing each intermediate after its last consumer. Default None, keep all intermediates.
+    :return tuple: (BAM to call variants in, duplicate multiplicity table or None)
+    :raises NotImplementedError: if merge_mates is set along with consensus_dedup or race_like
+    """
+
+    # UMI grouping discards unpaired reads, and RACE-like masking depends on the mate of each read
+    if merge_mates and (consensus_dedup or race_like):
+        raise NotImplementedError("Mate merging is not supported with consensus deduplication or RACE-like data.")
+
+    if io_policy is None:
+        io_policy = IntermediatePolicy(compresslevel=None, nthreads=1, keep_intermediates=True)
+
+    # Run the FASTQ preprocessing workflow which includes adapter trimming and 3' BQ trimming
+    fqp = FastqPreprocessor(
+        f1=fastq1, f2=fastq2, r1_fiveprime_adapters=r1_fiveprime_adapters, r1_threeprime_adapters=r1_threeprime_adapters,
+        r2_fiveprime_adapters=r2_fiveprime_adapters, r2_threeprime_adapters=r2_threeprime_adapters, outdir=outdir,
+        ncores=ncores, trim_bq=trim_bq, ntrimmed=ntrimmed, overlap_len=overlap_len, no_trim=omit_trim)
+
+    trimmed_f1 = fqp.trimmed_f1
+    trimmed_f2 = fqp.trimmed_f2
+    io_policy.handoff((fastq1, fastq2,), (trimmed_f1, trimmed_f2,))
+
+    # The consensus vote and umi_tools UMI clustering count every copy of a read, so duplicates are kept for them
+    if collapse_duplicates and consensus_dedup:
+        logger.warning("Duplicates are not collapsed with consensus deduplication, which counts every copy.")
+
+    multiplicity_table = None
+    if collapse_duplicates and not consensus_dedup:
+        dc = DuplicateCollapser(f1=trimmed_f1, f2=trimmed_f2, outdir=outdir, qual_collapse=collapse_quals)
+        io_policy.handoff((trimmed_f1, trimmed_f2,), (dc.collapsed_f1, dc.collapsed_f2,))
+        trimmed_f1 = dc.collapsed_f1
+        trimmed_f2 = dc.collapsed_f2
+        multiplicity_table = dc.multiplicity_table
+
+    # Run local alignment; handle the ncores/nthreads option for cutadapt versus bowtie2 options
+    # Only UMI grouping requires coordinate-sorted alignments; otherwise keep the native name-grouped output
+    bowtie2_nthreads = 1 if nthreads == 0 else nthreads
+
+    if merge_mates:
+        # Align merged fragments and the remaining pairs separately; the concordance tags are carried over as comments
+        mm = MateMerger(f1=trimmed_f1, f2=trimmed_f2, outdir=outdir)
+        io_policy.handoff((trimmed_f1, trimmed_f2,), (mm.merged_fastq, mm.unmerged_f1, mm.unmerged_f2,))
+
+        merged_bta = baw(f1=mm.merged_fastq, ref=ref_fa, f2=None, outdir=outdir, outbam=None, local=True,
+                         nthreads=bowtie2_nthreads, coordinate_sort=False, append_comment=True,
+                         cache_dir=alignment_cache_dir, aligner=aligner)
+        unmerged_bta = baw(f1=mm.unmerged_f1, ref=ref_fa, f2=mm.unmerged_f2, outdir=outdir, outbam=None, local=True,
+                           nthreads=bowtie2_nthreads, coordinate_sort=False, cache_dir=alignment_cache_dir,
+                           aligner=aligner)
+
+        io_policy.handoff((mm.merged_fastq, mm.unmerged_f1, mm.unmerged_f2,),
+                          (merged_bta.output_bam, unmerged_bta.output_bam,))
+
+        preproc_in_bam = cat_bams((merged_bta.output_bam, unmerged_bta.output_bam,),
+                                  os.path.join(outdir, MATE_MERGED_BAM))
+        io_policy.handoff((merged_bta.output_bam, unmerged_bta.output_bam,), (preproc_in_bam,))
+
+        if sort_planner is not None:
+            sort_planner.register(preproc_in_bam, SortOrder.NAME_GROUPED)
+    else:
+        # Encoded read names carry their UMI and primer tags in the comments
+        bta = baw(f1=trimmed_f1, ref=ref_fa, f2=trimmed_f2, outdir=outdir, outbam=None, local=True,
+                  nthreads=bowtie2_nthreads, coordinate_sort=consensus_dedup, sort_planner=sort_planner,
+                  append_comment=umi_tag is not None, cache_dir=alignment_cache_dir, aligner=aligner)
+        preproc_in_bam = bta.output_bam
+        io_policy.handoff((trimmed_f1, trimmed_f2,), (preproc_in_bam,))
+
+    # Run consensus deduplication
+    if consensus_dedup:
+        # Run consensus deduplication (majority vote for each base call within a read's UMI group)
+        rg = ReadGrouper(in_bam=preproc_in_bam, outdir=outdir, umi_tag=umi_tag)
+        io_policy.handoff((preproc_in_bam,), (rg.group_bam,))
+
+        cdp = ConsensusDeduplicatorPreprocessor(group_bam=rg.group_bam, outdir=outdir, nthreads=nthreads,
+                                                io_policy=io_policy)
+        io_policy.handoff((rg.group_bam,), (cdp.preprocess_bam,))
+
+        cd = ConsensusDeduplicator(in_bam=cdp.preprocess_bam, ref=ref_fa, outdir=outdir, out_bam=None,
+                                   nthreads=nthreads, contig_del_thresh=contig_del_thresh,
+                                   max_duplicates=max_duplicates, sort_planner=sort_planner, io_policy=io_policy)
+        cd.workflow()
+        io_policy.handoff((cdp.preprocess_bam,), (cd.out_bam,))
+        preproc_in_bam = cd.out_bam
+
+    # Optionally run primer masking
+    vc_in_bam = preproc_in_bam
+    if primers is not None:
+        rm = ReadMasker(in_bam=preproc_in_bam, feature_file=primers, race_like=race_like, outdir=outdir,
+                        nthreads=nthreads, sort_planner=sort_planner, io_policy=io_policy, ref=ref_fa)
+        rm.workflow()
+        io_policy.handoff((preproc_in_bam,), (rm.out_bam,))
+        vc_in_bam = rm.out_bam
+
+    return vc_in_bam, multiplicity_table
+
+
+def _preprocess_tile(fastq1, fastq2, ref_fa, outdir, preprocess_kwargs):
+    """Runs the preprocessing workflow for a single tile in a worker process.
+
+    :param str fastq1: path of the tile R1 FASTQ
+    :param str fastq2: path of the tile R2 FASTQ
+    :param str ref_fa: indexed reference FASTA
+    :param str outdir: output dir for the tile intermediate files
+    :param dict preprocess_kwargs: additional keyword arguments to preprocess_workflow
+    :return tuple: (BAM to call variants in, str value of its core_utils.sort_planner.SortOrder, duplicate \
+    multiplicity table or None)
+    """
+
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+
+    tile_planner = SortPlanner()
+    tile_bam, tile_table = preprocess_workflow(
+        fastq1=fastq1, fastq2=fastq2, ref_fa=ref_fa, outdir=outdir, nthreads=0, ncores=1, sort_planner=tile_planner,
+        **preprocess_kwargs)
+
+    return tile_bam, tile_planner.get_order(tile_bam).value, tile_table
+
+
+def demultiplex_workflow(fastq1, fastq2, ref_fa, outdir, primer_fa, primer_nm_allowance=UMIExtractor.PRIMER_NM_ALLOW,
+                         sort_planner=None, nworkers=DEFAULT_NTHREADS, io_policy=None, **preprocess_kwargs):
+    r"""Splits read pairs into tiles by originating primer, preprocesses each tile in parallel, and merges the tiles.
+
+    :param str fastq1: path of the R1 FASTQ, with UMIs extracted if consensus deduplicating
+    :param str fastq2: path of the R2 FASTQ, with UMIs extracted if consensus deduplicating
+    :param str ref_fa: indexed reference FASTA
+    :param str outdir: output dir for the intermediate files
+    :param str primer_fa: primer FASTA. Each primer name is used as a tile ID.
+    :param int primer_nm_allowance: Max edit distance a read can have to match a primer. Default 3.
+    :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner to register the merged order with
+    :param int nworkers: number of tiles to process at once. Default 0 (number of CPUs).
+    :param core_utils.io_policy.IntermediatePolicy | None io_policy: optional policy for the tile intermediates. \
+    Default None, keep all intermediates.
+    :param preprocess_kwargs: additional keyword arguments to preprocess_workflow
+    :return tuple: (merged BAM to call variants in, merged duplicate multiplicity table or None)
+
+    Reads of each tile are UMI-grouped and consensus deduplicated separately, which bounds the memory of each worker.
+    """
+
+    tdm = TileDemultiplexer(r1_fastq=fastq1, r2_fastq=fastq2, primer_fasta=primer_fa,
+                            primer_nm_allow=primer_nm_allowance, outdir=outdir)
+
+    if io_policy is None:
+        io_policy = IntermediatePolicy(compresslevel=None, nthreads=1, keep_intermediates=True)
+
+    # Tile FASTQs are released by the workers once trimmed; workers compress in a single thread as tiles run at once
+    tile_policy = IntermediatePolicy(compresslevel=io_policy.compresslevel, nthreads=1,
+                                     keep_intermediates=io_policy.keep_intermediates, scratch_dir=io_policy.scratch_dir)
+    tile_policy.register(*[tile_fastq for tile_fastqs in tdm.tile_fastqs.values() for tile_fastq in tile_fastqs])
+    tile_kwargs = dict(preprocess_kwargs, io_policy=tile_policy)
+
+    tile_args = [(tile_r1, tile_r2, ref_fa, os.path.join(outdir, tile.replace(os.sep, "_")), tile_kwargs)
+                 for tile, (tile_r1, tile_r2) in tdm.tile_fastqs.items()]
+
+    nprocs = nworkers if nworkers > 0 else multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, len(tile_args)))
+
+    logger.info("Preprocessing %i tiles with %i workers." % (len(tile_args), nprocs))
+    with multiprocessing.Pool(processes=nprocs) as pool:
+        tile_results = pool.starmap(_preprocess_tile, tile_args)
+
+    # Read names are unique across tiles, so mates remain adjacent if they were within each tile
+    tile_orders = {SortOrder(tile_order) for _, tile_order, _ in tile_results}
+    grouped = tile_orders.issubset({SortOrder.NAME_GROUPED, SortOrder.QUERYNAME})
+
+    tile_bams = collections.OrderedDict(zip(tdm.tile_fastqs.keys(), [tile_bam for tile_bam, _, _ in tile_results]))
+    merged_bam = TileDemultiplexer.merge_tile_bams(tile_bams, os.path.join(outdir, TILE_MERGED_BAM), grouped=grouped)
+
+    io_policy.register(*tile_bams.values())
+    io_policy.handoff(tuple(tile_bams.values()), (merged_bam,))
+
+    merged_table = None
+    tile_tables = collections.OrderedDict(
+        [(tile, tile_table) for tile, (_, _, tile_table) in zip(tdm.tile_fastqs.keys(), tile_results)
+         if tile_table is not None])
+
+    if len(tile_tables) > 0:
+        merged_table = TileDemultiplexer.merge_tile_multiplicities(
+            tile_tables, os.path.join(outdir, TILE_MERGED_MULTIPLICITY))
+
+    if sort_planner is not None:
+        sort_planner.register(merged_bam, SortOrder.NAME_GROUPED if grouped else SortOrder.UNKNOWN)
+
+    return merged_bam, merged_table
+
+
 def call_workflow(fastq1, fastq2,
                   r1_fiveprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
                   r1_threeprime_adapters=FastqPreprocessor.DEFAULT_ADAPTER,
@@ -349,13 +731,22 @@ def call_workflow(fastq1, fastq2,
                   primer_fa=UMIExtractor.PRIMER_FASTA, primer_nm_allowance=UMIExtractor.PRIMER_NM_ALLOW,
                   consensus_dedup=VariantCaller.VARIANT_CALL_CDEDUP, umi_regex=AMP_UMI_REGEX,
                   contig_del_thresh=ConsensusDeduplicator.CONTIG_DEL_THRESH,
+                  max_duplicates=ConsensusDeduplicator.MAX_DUPLICATES,
                   min_bq=VariantCaller.VARIANT_CALL_MIN_BQ, max_nm=VariantCaller.VARIANT_CALL_MAX_NM,
                   min_supporting_qnames=VariantCaller.VARIANT_CALL_MIN_DP,
                   max_mnp_window=VariantCaller.VARIANT_CALL_MAX_MNP_WINDOW,
                   nthreads=FastqPreprocessor.NCORES, ntrimmed=FastqPreprocessor.NTRIMMED,
                   overlap_len=FastqPreprocessor.OVERLAP_LEN, trim_bq=FastqPreprocessor.TRIM_QUALITY,
                   ncores=FastqPreprocessor.NCORES, omit_trim=FastqPreprocessor.TRIM_FLAG,
-                  mut_sig=DEFAULT_MUT_SIG, keep_intermediates=KEEP_INTERMEDIATES):
+                  mut_sig=DEFAULT_MUT_SIG, keep_intermediates=KEEP_INTERMEDIATES, demultiplex_tiles=DEFAULT_DEMUX,
+                  merge_mates=DEFAULT_MERGE, collapse_duplicates=DEFAULT_COLLAPSE,
+                  collapse_quals=DuplicateCollapser.DEFAULT_QUAL_COLLAPSE, alignment_cache_dir=None,
+                  aligner=DEFAULT_ALIGNER, anchored_counting=DEFAULT_ANCHORED, encode_qnames=DEFAULT_ENCODE_QNAMES,
+                  restore_qnames=DEFAULT_RESTORE_QNAMES,
+                  intermediate_compression=IntermediatePolicy.DEFAULT_COMPRESSION_LEVEL,
+                  scratch_dir=IntermediatePolicy.DEFAULT_SCRATCH_DIR, reference_store_dir=None,
+                  reference_store_max_age=ReferenceStore.DEFAULT_MAX_AGE_DAYS,
+                  reference_store_max_size=ReferenceStore.DEFAULT_MAX_SIZE_GB, panel_dir=None):
     r"""Runs the satmut_utils call workflow.
 
     :param str fastq1: path of the R1 FASTQ
@@ -379,6 +770,8 @@ def call_workflow(fastq1, fastq2,
     :param bool consensus_dedup: should consensus bases be generated during deduplication? Default False.
     :param str umi_regex: regex for matching the UMIs (see umi_tools for docs)
     :param int contig_del_thresh: max deletion length for which del/N gaps in the merged R2 contig are called. Default 10.
+    :param int | None max_duplicates: if consensus_dedup, max reads per mate/strand of a UMI group used for the \
+    consensus. Default None, use all reads.
     :param int min_bq: min base qual; should be >= 1 such that masked primers do not contribute to depth. Default 30.
     :param int max_nm: max edit distance to consider a read for variant calling. Default 10.
     :param int min_supporting_qnames: min number of fragments with R1-R2 concordant calls for which to keep a \
@@ -392,36 +785,100 @@ def call_workflow(fastq1, fastq2,
     :param bool omit_trim: flag to turn off adapter and 3' base quality trimming. Default False.
     :param str mut_sig: mutagenesis signature- one of {NNN, NNK, NNS}. Default NNN.
     :param bool keep_intermediates: flag to write intermediate files to the output_dir. Default False.
+    :param bool demultiplex_tiles: split read pairs by originating primer in primer_fa and preprocess each tile in \
+    parallel workers. Default False.
+    :param bool merge_mates: merge overlapping mates into single fragments before alignment. Default False.
+    :param bool collapse_duplicates: align only one representative of each exact-duplicate read pair, and weight \
+    variant counts and depth by the number of duplicates. Ignored with consensus_dedup. Default False.
+    :param str collapse_quals: how to collapse the base qualities of duplicates, one of {max, mean}. Default mean.
+    :param str | None alignment_cache_dir: optional directory of a persistent alignment cache shared across runs, \
+    which is invalidated if the reference or alignment parameters change. Default None.
+    :param str aligner: one of {bowtie2, banded}. banded aligns in-process without bowtie2. Default bowtie2.
+    :param bool anchored_counting: count read pairs starting at primers without alignment, and align only the \
+    remaining pairs. Default False.
+    :param bool encode_qnames: replace read names with integers after UMI extraction, keeping the original names \
+    in a side table. Default False.
+    :param bool restore_qnames: if encode_qnames, write the preprocessed alignments with their original read names \
+    to the output directory. Default False.
+    :param int | None intermediate_compression: BGZF compression level of intermediate BAMs, from 0 (uncompressed) \
+    to 9. Default 1. None for the samtools default.
+    :param str | None scratch_dir: optional directory, e.g. a RAM-backed /dev/shm, for intermediate files. Used only \
+    if it has enough free space and intermediates are not kept. Default None.
+    :param str | None reference_store_dir: optional directory of indexed references shared across runs. Transcript CDS \
+    annotations are also stored here, unless a panel is used. Default None, store them in the temp dir of the run.
+    :param float | None reference_store_max_age: remove stored references unused for this many days. Default None.
+    :param float | None reference_store_max_size: remove the least recently used stored references to keep the store \
+    within this many GB. Default None.
+    :param str | None panel_dir: optional directory of a gene panel reference built by satmut_panel. If it contains \
+    ensembl_id, its prebuilt references and indexes are used. Default None.
     :return tuple: (VCF, BED) filepaths
-    :raises NotImplementedError: if mut_sig is not one of NNN, NNK, NNS; or if not 1 <= max_mnp_window <= 3
+    :raises NotImplementedError: if mut_sig is not one of NNN, NNK, NNS; if not 1 <= max_mnp_window <= 3; if \
+    merge_mates is set along with consensus_dedup or race_like; or if anchored_counting is set along with \
+    consensus_dedup, race_like, merge_mates, or demultiplex_tiles; or if restore_qnames is set along with \
+    demultiplex_tiles
+    :raises RuntimeError: if demultiplex_tiles is set without a primer FASTA, anchored_counting without primers, or \
+    restore_qnames without encode_qnames
     """
 
+    if demultiplex_tiles and primer_fa is None:
+        raise RuntimeError("A primer FASTA must be provided to demultiplex tiles.")
+
     if mut_sig not in VALID_MUT_SIGS:
         raise NotImplementedError("Mutation signature %s must be one of {NNN, NNK, NNS}." % mut_sig)
 
     if max_mnp_window not in {1, 2, 3}:
         raise NotImplementedError("--max_mnp_window must be one of {1,2,3}.")
 
-    # Unfortunately sort-order harmony with samtools sort -n requires we know the format of the qname
-    # Check to make sure we have either Illumina format or single integer read names
-    if primers is not None:
-        qv = QnameVerification(fastq=fastq1)
-        sort_cmd = QNAME_SORTS[qv.format_index]
+    if merge_mates and (consensus_dedup or race_like):
+        raise NotImplementedError("--merge_mates is not supported with consensus deduplication or RACE-like data.")
+
+    if anchored_counting and primers is None:
+        raise RuntimeError("A primer feature file must be provided for anchored counting.")
+
+    # Anchoring requires both mates to start at primers and have no UMI prefix
+    if anchored_counting and (consensus_dedup or race_like or merge_mates or demultiplex_tiles):
+        raise NotImplementedError("--anchored_counting is not supported with consensus deduplication, RACE-like data, "
+                                  "--merge_mates, or --demultiplex_tiles.")
+
+    if restore_qnames and not encode_qnames:
+        raise RuntimeError("--restore_qnames requires --encode_qnames.")
+
+    # Tile read names are prefixed by their tile
+    if restore_qnames and demultiplex_tiles:
+        raise NotImplementedError("--restore_qnames is not supported with --demultiplex_tiles.")
 
     outdir_fullpath = os.path.abspath(outdir)
 
     if not os.path.exists(outdir_fullpath):
         os.mkdir(outdir_fullpath)
 
+    # Intermediates are written with light compression and removed as soon as their last consumer has finished
+    io_policy = IntermediatePolicy(compresslevel=intermediate_compression, nthreads=nthreads,
+                                   keep_intermediates=keep_intermediates, scratch_dir=scratch_dir)
+
     # Create a temp dir for intermediate files unless user wants them
     tempdir = outdir_fullpath
     if not keep_intermediates:
-        tempdir = tempfile.mkdtemp(suffix=".call.tmp")
+        tempdir = io_policy.make_tempdir(suffix=".call.tmp", input_files=(fastq1, fastq2,))
 
-    # Get and index the references
+    # Get and index the references, reusing indexes built by previous runs if a reference store is provided
+    reference_store = None if reference_store_dir is None else ReferenceStore(reference_store_dir)
     ref_fa, gff, gff_ref = get_call_references(
         reference_dir=reference_dir, ensembl_id=ensembl_id, ref=ref, transcript_gff=transcript_gff,
-        gff_reference=gff_reference, outdir=tempdir)
+        gff_reference=gff_reference, outdir=tempdir, fm_index=aligner == ALIGNER_BOWTIE2,
+        reference_store=reference_store, panel_dir=panel_dir)
+
+    if reference_store is not None:
+        reference_store.collect_garbage(
+            max_age_days=reference_store_max_age, max_size_gb=reference_store_max_size, keep=(ref_fa,))
+
+    # The CDS annotations of a panel were stored with its GFF when the panel was built
+    cds_store_dir = reference_store_dir
+    if panel_dir is not None and gff == os.path.join(panel_dir, PANEL_GFF):
+        cds_store_dir = panel_dir
+
+    # Track the order of each intermediate so that only the sorts a stage requires are done
+    sort_planner = SortPlanner(nthreads=nthreads, io_policy=io_policy)
 
     fqp_r1 = fastq1
     fqp_r2 = fastq2
@@ -430,54 +887,78 @@ def call_workflow(fastq1, fastq2,
         # before we have trimmed adapters as for umi_tools the adapter is used for "anchoring" the UMI.
         ue = UMIExtractor(r1_fastq=fastq1, r2_fastq=fastq2, umi_regex=umi_regex,
                           primer_fasta=primer_fa, primer_nm_allow=primer_nm_allowance, outdir=tempdir)
+        io_policy.handoff((fqp_r1, fqp_r2,), (ue.r1_out_fastq, ue.r2_out_fastq,))
         fqp_r1 = ue.r1_out_fastq
         fqp_r2 = ue.r2_out_fastq
 
-    # Run the FASTQ preprocessing workflow which includes adapter trimming and 3' BQ trimming
-    fqp = FastqPreprocessor(
-        f1=fqp_r1, f2=fqp_r2, r1_fiveprime_adapters=r1_fiveprime_adapters, r1_threeprime_adapters=r1_threeprime_adapters,
-        r2_fiveprime_adapters=r2_fiveprime_adapters, r2_threeprime_adapters=r2_threeprime_adapters, outdir=tempdir,
-        ncores=ncores, trim_bq=trim_bq, ntrimmed=ntrimmed, overlap_len=overlap_len, no_trim=omit_trim)
-
-    # Run local alignment; handle the ncores/nthreads option for cutadapt versus bowtie2 options
-    bowtie2_nthreads = 1 if nthreads == 0 else nthreads
-    bta = baw(f1=fqp.trimmed_f1, ref=ref_fa, f2=fqp.trimmed_f2, outdir=tempdir, outbam=None, local=True,
-              nthreads=bowtie2_nthreads)
-
-    # Run consensus deduplication
-    preproc_in_bam = bta.output_bam
-    if consensus_dedup:
-        # Run consensus deduplication (majority vote for each base call within a read's UMI group)
-        rg = ReadGrouper(in_bam=bta.output_bam, outdir=tempdir)
-        cdp = ConsensusDeduplicatorPreprocessor(group_bam=rg.group_bam, outdir=tempdir, nthreads=nthreads)
-        cd = ConsensusDeduplicator(in_bam=cdp.preprocess_bam, ref=ref_fa, outdir=tempdir, out_bam=None,
-                                   nthreads=nthreads, contig_del_thresh=contig_del_thresh)
-        cd.workflow()
-        preproc_in_bam = cd.out_bam
-
-    # Optionally run primer masking
-    vc_in_bam = preproc_in_bam
-    if primers is not None:
-
-        # Make sure to pass the proper sort command based on the qname format
+    pac = None
+    if anchored_counting:
+        # Only the pairs that could not be counted at their primer offsets are aligned
+        pac = PrimerAnchoredCounter(f1=fastq1, f2=fastq2, ref=ref_fa, primers=primers, outdir=tempdir,
+                                    min_bq=min_bq, max_nm=max_nm)
+        io_policy.handoff((fqp_r1, fqp_r2,), (pac.fallback_f1, pac.fallback_f2,))
+        fqp_r1 = pac.fallback_f1
+        fqp_r2 = pac.fallback_f2
+
+    qe = None
+    umi_tag = None
+    if encode_qnames:
+        # The UMI appended by UMI extraction moves to a tag that is carried through alignment
+        qe = QnameEncoder(r1_fastq=fqp_r1, r2_fastq=fqp_r2, has_umi=consensus_dedup, outdir=tempdir, nthreads=nthreads)
+        io_policy.handoff((fqp_r1, fqp_r2,), (qe.r1_out_fastq, qe.r2_out_fastq,))
+        fqp_r1 = qe.r1_out_fastq
+        fqp_r2 = qe.r2_out_fastq
         if consensus_dedup:
-            sort_cmd = QNAME_SORTS[INT_FORMAT_INDEX]
+            umi_tag = QnameEncoder.UMI_TAG
+
+    preprocess_kwargs = dict(
+        r1_fiveprime_adapters=r1_fiveprime_adapters, r1_threeprime_adapters=r1_threeprime_adapters,
+        r2_fiveprime_adapters=r2_fiveprime_adapters, r2_threeprime_adapters=r2_threeprime_adapters,
+        race_like=race_like, primers=primers, consensus_dedup=consensus_dedup, contig_del_thresh=contig_del_thresh,
+        max_duplicates=max_duplicates, ntrimmed=ntrimmed, overlap_len=overlap_len, trim_bq=trim_bq, omit_trim=omit_trim,
+        merge_mates=merge_mates, collapse_duplicates=collapse_duplicates, collapse_quals=collapse_quals,
+        alignment_cache_dir=os.path.abspath(alignment_cache_dir) if alignment_cache_dir is not None else None,
+        aligner=aligner, umi_tag=umi_tag)
+
+    if demultiplex_tiles:
+        vc_in_bam, multiplicity_table = demultiplex_workflow(
+            fastq1=fqp_r1, fastq2=fqp_r2, ref_fa=ref_fa, outdir=tempdir, primer_fa=primer_fa,
+            primer_nm_allowance=primer_nm_allowance, sort_planner=sort_planner, nworkers=nthreads,
+            io_policy=io_policy, **preprocess_kwargs)
+    else:
+        vc_in_bam, multiplicity_table = preprocess_workflow(
+            fastq1=fqp_r1, fastq2=fqp_r2, ref_fa=ref_fa, outdir=tempdir, nthreads=nthreads, ncores=ncores,
+            sort_planner=sort_planner, io_policy=io_policy, **preprocess_kwargs)
 
-        rm = ReadMasker(in_bam=preproc_in_bam, feature_file=primers, race_like=race_like, sort_cmd=sort_cmd,
-                        outdir=tempdir, nthreads=nthreads)
-        rm.workflow()
-        vc_in_bam = rm.out_bam
+    out_prefix = os.path.join(outdir_fullpath, fu.remove_extension(
+        os.path.basename(os.path.commonprefix((fastq1, fastq2)))))
+
+    # Write the preprocessed alignments under their original read names
+    if restore_qnames:
+        QnameEncoder.restore_qnames(
+            in_bam=vc_in_bam, qname_table=qe.qname_table,
+            out_bam=fu.add_extension(out_prefix, QnameEncoder.RESTORED_SUFFIX))
 
     # Initialize the VariantCaller and prepare the alignments
     vc = VariantCaller(
         am=vc_in_bam, targets=targets, ref=ref_fa, trx_gff=gff, gff_ref=gff_ref, primers=primers,
-        output_dir=tempdir, nthreads=nthreads, mut_sig=mut_sig)
+        output_dir=tempdir, nthreads=nthreads, mut_sig=mut_sig, sort_planner=sort_planner,
+        multiplicity_table=multiplicity_table, anchored_counter=pac, io_policy=io_policy,
+        cds_store_dir=cds_store_dir)
 
-    # Run variant calling
-    out_prefix = os.path.join(outdir_fullpath, fu.remove_extension(
-        os.path.basename(os.path.commonprefix((fastq1, fastq2)))))
+    # Once the mates are split, pairs are read from the R1, R2, and fragment BAMs
+    vcp = vc.vc_preprocessor
+    io_policy.register(vcp.in_bam, vcp.qname_sorted)
+    io_policy.handoff((vc_in_bam, vcp.in_bam, vcp.qname_sorted,),
+                      (vcp.r1_calling_bam, vcp.r2_calling_bam, vcp.fragment_calling_bam,))
 
+    # Run variant calling
     output_vcf, output_bed = vc.workflow(min_bq, max_nm, min_supporting_qnames, max_mnp_window, out_prefix)
+    sort_planner.log_summary()
+    io_policy.release(vcp.r1_calling_bam, vcp.r2_calling_bam, vcp.fragment_calling_bam)
+
+    if reference_store is not None:
+        reference_store.close()
 
     if not keep_intermediates:
         fu.safe_remove((tempdir,), force_remove=True)
@@ -511,7 +992,12 @@ def main():
             ensembl_id=args_dict["ensembl_id"], reference_dir=args_dict["reference_dir"],
             ref=args_dict["reference"], primers=args_dict["primers"], outdir=args_dict["output_dir"],
             buffer=args_dict["edit_buffer"], max_nm=args_dict["max_nm"], random_seed=args_dict["random_seed"],
-            force_edit=args_dict["force_edit"], nthreads=args_dict["nthreads"])
+            force_edit=args_dict["force_edit"], nthreads=args_dict["nthreads"],
+            intermediate_compression=args_dict["intermediate_compression"], scratch_dir=args_dict["scratch_dir"],
+            output_cram=args_dict["output_cram"],
+            reference_store_dir=args_dict["reference_store"],
+            reference_store_max_age=args_dict["reference_store_max_age"],
+            reference_store_max_size=args_dict["reference_store_max_size"], panel_dir=args_dict["panel_dir"])
 
         logger.info("Completed sim workflow.")
 
@@ -530,12 +1016,21 @@ def main():
             targets=args_dict["targets"], outdir=args_dict["output_dir"], primers=args_dict["primers"],
             primer_fa=args_dict["primer_fasta"], primer_nm_allowance=args_dict["primer_nm_allowance"],
             consensus_dedup=args_dict["consensus_deduplicate"], umi_regex=args_dict["umi_regex"],
-            contig_del_thresh=args_dict["contig_del_threshold"], min_bq=args_dict["min_bq"],
+            contig_del_thresh=args_dict["contig_del_threshold"], max_duplicates=args_dict["max_duplicates"],
+            min_bq=args_dict["min_bq"],
             max_nm=args_dict["max_nm"], min_supporting_qnames=args_dict["min_supporting"],
             max_mnp_window=args_dict["max_mnp_window"], nthreads=args_dict["nthreads"],
             ntrimmed=args_dict["ntrimmed"], overlap_len=args_dict["overlap_length"], trim_bq=args_dict["trim_bq"],
             ncores=args_dict["ncores"], omit_trim=args_dict["omit_trim"], mut_sig=args_dict["mutagenesis_signature"],
-            keep_intermediates=args_dict["keep_intermediates"])
+            keep_intermediates=args_dict["keep_intermediates"], demultiplex_tiles=args_dict["demultiplex_tiles"],
+            merge_mates=args_dict["merge_mates"], collapse_duplicates=args_dict["collapse_duplicates"],
+            collapse_quals=args_dict["collapse_quals"], alignment_cache_dir=args_dict["alignment_cache_dir"],
+            aligner=args_dict["aligner"], anchored_counting=args_dict["anchored_counting"],
+            encode_qnames=args_dict["encode_qnames"], restore_qnames=args_dict["restore_qnames"],
+            intermediate_compression=args_dict["intermediate_compression"], scratch_dir=args_dict["scratch_dir"],
+            reference_store_dir=args_dict["reference_store"],
+            reference_store_max_age=args_dict["reference_store_max_age"],
+            reference_store_max_size=args_dict["reference_store_max_size"], panel_dir=args_dict["panel_dir"])
 
         logger.info("Completed call workflow.")
 
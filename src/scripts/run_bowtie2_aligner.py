@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
-"""Runs bowtie2 alignment."""
+"""Runs bowtie2 alignment, or the built-in banded aligner."""
 
 import argparse
 import logging
 import os
 import sys
 
-from analysis.aligners import BowtieConfig, Bowtie2, DEFAULT_TEMPDIR
+from analysis.aligners import BowtieConfig, Bowtie2, BandedAligner, DEFAULT_TEMPDIR, ALIGNER_BANDED, \
+    VALID_ALIGNERS, DEFAULT_ALIGNER
 from core_utils.file_utils import replace_extension
 from core_utils.string_utils import none_or_str
 from satmut_utils.definitions import DEFAULT_QUALITY_OFFSET, LOG_FORMATTER
@@ -54,35 +55,69 @@ def parse_commandline_params(args):
     parser.add_argument("-j", "--nthreads", type=int, required=False, default=BowtieConfig.DEFAULT_NTHREADS,
                         help='Number of threads to use for alignment.')
 
+    parser.add_argument("-c", "--cache_dir", type=none_or_str, required=False, default=Bowtie2.DEFAULT_CACHE_DIR,
+                        help='Optional directory of a persistent alignment cache. Only read pairs missing from the '
+                             'cache are aligned. The cache is invalidated if the reference or parameters change.')
+
+    parser.add_argument("-a", "--aligner", type=str, required=False, default=DEFAULT_ALIGNER,
+                        choices=sorted(VALID_ALIGNERS),
+                        help='Aligner to use. banded runs an in-process aligner for short, single-transcript or '
+                             'amplicon references, and does not require bowtie2 or an FM index. Default %s.'
+                             % DEFAULT_ALIGNER)
+
     parsed_args = vars(parser.parse_args(args))
     return parsed_args
 
 
 def workflow(f1, ref, f2=None, outdir=Bowtie2.DEFAULT_OUTDIR, outbam=Bowtie2.DEFAULT_OUTBAM,
-             local=BowtieConfig.DEFAULT_LOCAL, nthreads=BowtieConfig.DEFAULT_NTHREADS):
-    """Runs the Bowtie2 alignment workflow.
+             local=BowtieConfig.DEFAULT_LOCAL, nthreads=BowtieConfig.DEFAULT_NTHREADS,
+             coordinate_sort=Bowtie2.DEFAULT_COORD_SORT, sort_planner=None, append_comment=False,
+             cache_dir=Bowtie2.DEFAULT_CACHE_DIR, aligner=DEFAULT_ALIGNER, read_pairs=None):
+    r"""Runs the alignment workflow.
 
-    :param str f1: path to FASTA or FASTQ 1
+    :param str | None f1: path to FASTA or FASTQ 1, or None if read_pairs is provided
     :param str ref: path of indexed reference FASTA
     :param str | None f2: optional path to FASTA or FASTQ 2
     :param str outdir: optional output directory to write the output BAM to. Default current directory.
     :param str | None outbam: full file path of an output BAM to create; if None, use basename of f1, f2
     :param bool local: should a local alignment be done instead of global alignment (default True)
     :param int nthreads: number of threads to use for alignment
-    :return analysis.aligners.Bowtie2: aligner object
+    :param bool coordinate_sort: coordinate sort and index the output BAM? Default True.
+    :param core_utils.sort_planner.SortPlanner | None sort_planner: optional planner to register the output order with
+    :param bool append_comment: append FASTQ comments, which must be SAM-formatted tags, to the alignments? \
+    Default False.
+    :param str | None cache_dir: optional directory of a persistent alignment cache. Default None, no caching. \
+    Only used by the bowtie2 aligner.
+    :param str aligner: one of {bowtie2, banded}. Default bowtie2.
+    :param iterable | None read_pairs: optional (R1, R2 | None) records to align instead of FASTQs, e.g. from \
+    analysis.seq_utils.iterate_bam_read_pairs. Avoids writing intermediate FASTQs. outbam must be provided.
+    :return analysis.aligners.Bowtie2 | analysis.aligners.BandedAligner: aligner object
     """
 
+    if aligner == ALIGNER_BANDED:
+        if cache_dir is not None:
+            logger.warning("The alignment cache is only used by bowtie2; ignoring %s." % cache_dir)
+
+        ba = BandedAligner(ref=ref, f1=f1, f2=f2, output_dir=outdir, output_bam=outbam, local=local,
+                           nthreads=nthreads, coordinate_sort=coordinate_sort, sort_planner=sort_planner,
+                           append_comment=append_comment, read_pairs=read_pairs)
+        return ba
+
     # Need to change to tempdir in case temp BAMs are created, as bowtie2 does not have an option for setting
     # the temp directory; make sure to handle relative paths
-    f1_full = os.path.abspath(f1)
-    f2_full = os.path.abspath(f2)
+    f1_full = os.path.abspath(f1) if f1 is not None else None
+    f2_full = os.path.abspath(f2) if f2 is not None else None
     outdir_full = os.path.abspath(outdir)
+    cache_dir_full = os.path.abspath(cache_dir) if cache_dir is not None else None
 
     call_dir = os.getcwd()
     os.chdir(DEFAULT_TEMPDIR)
 
-    bc = BowtieConfig(ref, local, nthreads, DEFAULT_QUALITY_OFFSET)
-    bt = Bowtie2(config=bc, f1=f1_full, f2=f2_full, output_dir=outdir_full, output_bam=outbam)
+    flags = (BowtieConfig.APPEND_COMMENT_FLAG,) if append_comment else ()
+    bc = BowtieConfig(ref, local, nthreads, DEFAULT_QUALITY_OFFSET, *flags)
+    bt = Bowtie2(config=bc, f1=f1_full, f2=f2_full, output_dir=outdir_full, output_bam=outbam,
+                 coordinate_sort=coordinate_sort, sort_planner=sort_planner, cache_dir=cache_dir_full,
+                 read_pairs=read_pairs)
 
     os.chdir(call_dir)
 
@@ -105,7 +140,8 @@ def main():
     logger.info("Started %s" % sys.argv[0])
 
     workflow(f1=parsed_args["fast1"], ref=parsed_args["ref"], f2=parsed_args["fast2"], outdir=parsed_args["output_dir"],
-             outbam=parsed_args["outbam"], local=parsed_args["local"], nthreads=parsed_args["nthreads"])
+             outbam=parsed_args["outbam"], local=parsed_args["local"], nthreads=parsed_args["nthreads"],
+             cache_dir=parsed_args["cache_dir"], aligner=parsed_args["aligner"])
 
     logger.info("Completed %s" % sys.argv[0])
 
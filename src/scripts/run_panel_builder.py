@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Builds one combined, indexed reference for a panel of Ensembl IDs."""
+
+import argparse
+import logging
+import os
+import sys
+
+from analysis.aligners import ALIGNER_BOWTIE2, VALID_ALIGNERS, DEFAULT_ALIGNER
+from analysis.references import build_panel_references
+from core_utils.file_utils import replace_extension
+from satmut_utils.definitions import LOG_FORMATTER
+
+__author__ = "Ian_Hoskins"
+__credits__ = ["Ian Hoskins"]
+__license__ = "GPLv3"
+__maintainer__ = "Ian Hoskins"
+__email__ = "ianjameshoskins@utexas.edu"
+__status__ = "Development"
+
+DEFAULT_REFDIR = "./references"
+DEFAULT_OUTDIR = "./panel_references"
+
+LOGFILE = replace_extension(os.path.basename(__file__), "log")
+logger = logging.getLogger(__name__)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(LOG_FORMATTER)
+logger.addHandler(console_handler)
+
+
+def parse_commandline_params(args):
+    """Parses command line parameters.
+
+    :param list args: command line arguments, no script name
+    :return argparse.Namespace: namespace object with dict-like access
+    """
+
+    parser = argparse.ArgumentParser(description="%s arguments" % __name__)
+
+    parser.add_argument("-i", "--ensembl_ids", type=str, required=True, nargs="+",
+                        help='Ensembl gene (ENSG) or transcript (ENST) IDs of the panel. Include minor version '
+                             'numbers, e.g. ENST00000398165.7')
+
+    parser.add_argument("-x", "--reference_dir", type=str, required=False, default=DEFAULT_REFDIR,
+                        help='Directory containing curated reference files.')
+
+    parser.add_argument("-o", "--output_dir", type=str, required=False, default=DEFAULT_OUTDIR,
+                        help='Optional output directory for the panel references. Pass it to satmut_utils '
+                             '--panel_dir. Default %s.' % DEFAULT_OUTDIR)
+
+    parser.add_argument("-a", "--aligner", type=str, required=False, default=DEFAULT_ALIGNER,
+                        choices=sorted(VALID_ALIGNERS),
+                        help='Aligner the panel will be used with. The bowtie2 FM index is only built for bowtie2. '
+                             'Default %s.' % DEFAULT_ALIGNER)
+
+    parsed_args = vars(parser.parse_args(args))
+    return parsed_args
+
+
+def workflow(ensembl_ids, reference_dir=DEFAULT_REFDIR, outdir=DEFAULT_OUTDIR, aligner=DEFAULT_ALIGNER):
+    """Runs the panel reference building workflow.
+
+    :param list ensembl_ids: Ensembl gene or transcript IDs, with version numbers
+    :param str reference_dir: directory containing curated APPRIS reference files. Default ./references.
+    :param str outdir: output directory for the panel references. Default ./panel_references.
+    :param str aligner: one of {bowtie2, banded}. Default bowtie2.
+    :return str: path of the panel manifest
+    """
+
+    return build_panel_references(
+        reference_dir=reference_dir, ensembl_ids=ensembl_ids, outdir=os.path.abspath(outdir),
+        fm_index=aligner == ALIGNER_BOWTIE2)
+
+
+def main():
+    """Runs the workflow when called from command line."""
+
+    parsed_args = parse_commandline_params(sys.argv[1:])
+
+    outdir = parsed_args["output_dir"]
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+
+    log_handler = logging.FileHandler(os.path.join(outdir, LOGFILE))
+    log_handler.setFormatter(LOG_FORMATTER)
+    logger.addHandler(log_handler)
+
+    logger.info("Started %s" % sys.argv[0])
+
+    workflow(ensembl_ids=parsed_args["ensembl_ids"], reference_dir=parsed_args["reference_dir"], outdir=outdir,
+             aligner=parsed_args["aligner"])
+
+    logger.info("Completed %s" % sys.argv[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Tests for analysis.aligners."""
 
+import numpy as np
 import pysam
 import tempfile
 import unittest
@@ -98,3 +99,172 @@ class TestBowtie2(TestAligners):
             test_af.reset()
 
         self.assertTrue(matches_ref and has_snps and (has_ins or has_dels))
+
+
+class TestBandedAligner(TestAligners):
+    """Tests for BandedAligner."""
+
+    CBS_REF = "CBS.fa"
+    CBS_SIM_R1 = "CBS_sim.R1.fq.gz"
+    CBS_SIM_R2 = "CBS_sim.R2.fq.gz"
+    CBS_SIM_BAM = "CBS_sim.bam"
+
+    def test_alignment(self):
+        """Test proper alignment of various types of reads."""
+
+        ba = al.BandedAligner(ref=self.ref, f1=self.test_fasta, output_dir=self.tempdir,
+                              output_bam=self.test_bam, coordinate_sort=False)
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as test_af:
+            aligned = {align_seg.query_name: align_seg for align_seg in test_af}
+
+        self.assertEqual(
+            (aligned["WT"].cigarstring, aligned["WT"].get_tag(su.SAM_EDIT_DIST_TAG)), ("105M", 0))
+        self.assertTrue(
+            aligned["InDels"].is_unmapped or su.SAM_CIGAR_INS in aligned["InDels"].cigarstring or
+            su.SAM_CIGAR_DEL in aligned["InDels"].cigarstring or aligned["InDels"].get_tag(su.SAM_EDIT_DIST_TAG) > 0)
+
+    def test_local_soft_clip(self):
+        """Test that local alignment soft-clips bases that do not match the reference."""
+
+        clip_fasta = tempfile.NamedTemporaryFile(suffix=".clip.fa", delete=False, dir=self.tempdir).name
+        with open(clip_fasta, "w") as clip_fh:
+            clip_fh.write(fu.FILE_NEWLINE.join([">clipped", self.wt_seq + "T" * 20]) + fu.FILE_NEWLINE)
+
+        ba = al.BandedAligner(ref=self.ref, f1=clip_fasta, output_dir=self.tempdir, coordinate_sort=False)
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as test_af:
+            align_seg = next(test_af)
+
+        self.assertEqual((align_seg.cigarstring, align_seg.get_tag(su.SAM_MD_TAG)), ("105M20S", "105"))
+
+    def test_ungapped_fast_path(self):
+        """Test that the ungapped fast path matches the banded DP and defers reads with indels to it."""
+
+        ba = al.BandedAligner(ref=self.ref, f1=self.test_fasta, output_dir=self.tempdir, coordinate_sort=False)
+
+        # Delete two bases mid-read so that no ungapped alignment is optimal
+        del_seq = self.wt_seq[:50] + self.wt_seq[52:]
+        quals = np.full(len(self.wt_seq), 40, dtype=np.int64)
+
+        observed = []
+        for seq in (self.wt_seq, self.snp_seq, del_seq):
+            read = np.frombuffer(seq.encode(), dtype=np.uint8)
+            mm_pens = ba._get_mismatch_penalties(quals[:len(seq)])
+            _, contig_index, _, diagonal = next(
+                candidate for candidate in ba._get_candidates((read.tobytes(), su.reverse_complement(seq).encode()))
+                if not candidate[2])
+            observed.append((ba._extend_ungapped(read, mm_pens, contig_index, diagonal),
+                             ba._extend(read, mm_pens, contig_index, diagonal)))
+
+        self.assertEqual(observed[0][0], observed[0][1])
+        self.assertTrue(observed[1][0] is None or observed[1][0] == observed[1][1])
+        self.assertIsNone(observed[2][0])
+
+    def test_mate_contigs(self):
+        """Test that mates aligned to different contigs name the mate contig in RNEXT."""
+
+        contig_seqs = [self.wt_seq, "TTAGGCATCGATCGGACTTACGCAGGTCAATGCCGTTAGCACTGGATCCAGTCATGGCAATCG"]
+        ref_fasta = tempfile.NamedTemporaryFile(suffix=".mates.ref.fa", delete=False, dir=self.tempdir).name
+        with open(ref_fasta, "w") as ref_fh:
+            ref_fh.write(fu.FILE_NEWLINE.join([">contig1", contig_seqs[0], ">contig2", contig_seqs[1]]) +
+                         fu.FILE_NEWLINE)
+
+        # The first pair spans both contigs and the second aligns to contig1 only
+        mate_seqs = [(contig_seqs[0][:50], su.reverse_complement(contig_seqs[1][:50])),
+                     (contig_seqs[0][:50], su.reverse_complement(contig_seqs[0][-50:]))]
+
+        fastqs = []
+        for mate in (0, 1):
+            fastqs.append(tempfile.NamedTemporaryFile(suffix=".mates.R%i.fq" % (mate + 1), delete=False,
+                                                      dir=self.tempdir).name)
+            with open(fastqs[mate], "w") as fastq_fh:
+                for i, pair in enumerate(mate_seqs):
+                    fastq_fh.write(fu.FILE_NEWLINE.join(["@pair%i" % i, pair[mate], "+", "I" * 50]) + fu.FILE_NEWLINE)
+
+        ba = al.BandedAligner(ref=ref_fasta, f1=fastqs[0], f2=fastqs[1], output_dir=self.tempdir, local=False,
+                              coordinate_sort=False)
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as test_af:
+            observed = [(align_seg.query_name, align_seg.reference_name, align_seg.next_reference_name)
+                        for align_seg in test_af]
+
+        expected = [("pair0", "contig1", "contig2"), ("pair0", "contig2", "contig1"),
+                    ("pair1", "contig1", "contig1"), ("pair1", "contig1", "contig1")]
+
+        self.assertEqual(expected, observed)
+
+    def test_end_to_end_concordance(self):
+        """Test that end-to-end alignments of simulated pairs are concordant with bowtie2."""
+
+        ba = al.BandedAligner(
+            ref=os.path.join(self.test_data_dir, self.CBS_REF),
+            f1=os.path.join(self.test_data_dir, self.CBS_SIM_R1), f2=os.path.join(self.test_data_dir, self.CBS_SIM_R2),
+            output_dir=self.tempdir, local=False, coordinate_sort=False)
+
+        with pysam.AlignmentFile(os.path.join(self.test_data_dir, self.CBS_SIM_BAM), "rb") as expected_af:
+            expected = {(align_seg.query_name, align_seg.is_read1):
+                        (align_seg.flag, align_seg.reference_start, align_seg.mapping_quality)
+                        for align_seg in expected_af}
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as observed_af:
+            observed = {(align_seg.query_name, align_seg.is_read1):
+                        (align_seg.flag, align_seg.reference_start, align_seg.mapping_quality)
+                        for align_seg in observed_af}
+
+        self.assertDictEqual(observed, expected)
+
+    def test_parallel_chunks(self):
+        """Test that read pairs aligned in chunks by worker processes match a single process alignment."""
+
+        observed = []
+        for nthreads in (1, 2):
+            ba = al.BandedAligner(
+                ref=os.path.join(self.test_data_dir, self.CBS_REF), f1=os.path.join(self.test_data_dir, self.CBS_SIM_R1),
+                f2=os.path.join(self.test_data_dir, self.CBS_SIM_R2), output_dir=self.tempdir,
+                output_bam=os.path.join(self.tempdir, "CBS_sim.nthreads%i.bam" % nthreads), local=False,
+                nthreads=nthreads, coordinate_sort=False)
+
+            with pysam.AlignmentFile(ba.output_bam, "rb") as observed_af:
+                observed.append([align_seg.to_string() for align_seg in observed_af])
+
+        self.assertEqual(observed[0], observed[1])
+
+    def test_streamed_read_pairs(self):
+        """Test that read pairs streamed from a BAM align as their FASTQs do."""
+
+        cbs_bam = os.path.join(self.test_data_dir, self.CBS_SIM_BAM)
+        streamed_bam = os.path.join(self.tempdir, "CBS_sim.streamed.bam")
+
+        ba = al.BandedAligner(
+            ref=os.path.join(self.test_data_dir, self.CBS_REF), f1=None, output_dir=self.tempdir,
+            output_bam=streamed_bam, local=False, coordinate_sort=False,
+            read_pairs=su.iterate_bam_read_pairs(cbs_bam))
+
+        with pysam.AlignmentFile(cbs_bam, "rb") as expected_af:
+            expected = {(align_seg.query_name, align_seg.is_read1):
+                        (align_seg.flag, align_seg.reference_start, align_seg.mapping_quality)
+                        for align_seg in expected_af}
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as observed_af:
+            observed = {(align_seg.query_name, align_seg.is_read1):
+                        (align_seg.flag, align_seg.reference_start, align_seg.mapping_quality)
+                        for align_seg in observed_af}
+
+        self.assertDictEqual(observed, expected)
+
+    def test_end_to_end_indels(self):
+        """Test that simulated indels are placed as in the truth VCF."""
+
+        ba = al.BandedAligner(
+            ref=os.path.join(self.test_data_dir, self.CBS_REF),
+            f1=os.path.join(self.test_data_dir, self.CBS_SIM_R1), f2=os.path.join(self.test_data_dir, self.CBS_SIM_R2),
+            output_dir=self.tempdir, local=False, coordinate_sort=False)
+
+        with pysam.AlignmentFile(ba.output_bam, "rb") as observed_af:
+            observed = {(align_seg.query_name, align_seg.is_read1):
+                        (align_seg.cigarstring, align_seg.get_tag(su.SAM_MD_TAG)) for align_seg in observed_af}
+
+        # Truth VCF has ACT>A at 955 and T>TG at 1094
+        self.assertEqual(observed[("0000003129", True)], ("48M2D97M", "48^CT97"))
+        self.assertEqual(observed[("0000323491", True)], ("79M1I70M", "149"))
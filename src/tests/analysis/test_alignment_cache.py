@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Tests for analysis.alignment_cache."""
+
+import pysam
+import tempfile
+import unittest
+
+import analysis.alignment_cache as ac
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+TEST_PAIR_SAM = [
+    "read1\t99\tWT\t1\t42\t8M\t=\t5\t12\tACGTACGT\tIIIIIIII\tAS:i:0\tNM:i:0\tRG:Z:sample1",
+    "read1\t147\tWT\t5\t42\t8M\t=\t1\t-12\tACGTACGT\tIIIIIIII\tAS:i:0\tNM:i:0\tRG:Z:sample1"
+]
+
+
+class TestAlignmentCache(unittest.TestCase):
+    """Tests for AlignmentCache."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestAlignmentCache."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.ref = tempfile.NamedTemporaryFile(suffix=".cache.fa", delete=False, dir=cls.tempdir).name
+        with open(cls.ref, "w") as ref_fh:
+            ref_fh.write(">WT\nACGTACGTACGT\n")
+
+        cls.fastq = tempfile.NamedTemporaryFile(suffix=".cache.fq", delete=False, dir=cls.tempdir).name
+        with open(cls.fastq, "w") as fq_fh:
+            fq_fh.write("@read1\nACGTACGT\n+\nIIIIIIII\n@read2\nACGTACGT\n+\nIIIII555\n")
+
+        with pysam.FastxFile(cls.fastq) as fq_ff:
+            cls.records = list(fq_ff)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestAlignmentCache."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_get_pair_key_quals(self):
+        """Tests that read pairs differing only by base qualities have different keys."""
+
+        observed = ac.AlignmentCache.get_pair_key(*self.records)
+        self.assertNotEqual(ac.AlignmentCache.get_pair_key(self.records[1], self.records[0]), observed)
+
+    def test_pack_unpack_records(self):
+        """Tests that records are restored with a new read name and read group."""
+
+        packed = ac.AlignmentCache.pack_records(TEST_PAIR_SAM)
+        observed = ac.AlignmentCache.unpack_records(packed, "read9", "sample2")
+
+        expected = "".join([line.replace("read1", "read9").replace("sample1", "sample2") + fu.FILE_NEWLINE
+                            for line in TEST_PAIR_SAM])
+
+        self.assertEqual(expected, observed)
+
+    def test_hits_and_misses(self):
+        """Tests that cached read pairs are hits and uncached pairs are misses."""
+
+        cache_dir = tempfile.mkdtemp(dir=self.tempdir)
+        digest = ac.AlignmentCache.get_config_digest(self.ref, ["--local"])
+        alignment_cache = ac.AlignmentCache(cache_dir, digest)
+
+        key1 = ac.AlignmentCache.get_pair_key(self.records[0])
+        key2 = ac.AlignmentCache.get_pair_key(self.records[1])
+        alignment_cache.put_many([(key1, ac.AlignmentCache.pack_records(TEST_PAIR_SAM))])
+        observed = alignment_cache.get_many([key1, key2])
+        alignment_cache.close()
+
+        self.assertEqual(({key1}, 1, 1), (set(observed.keys()), alignment_cache.hits, alignment_cache.misses))
+
+    def test_invalidation(self):
+        """Tests that cached alignments are not returned when the parameters change."""
+
+        cache_dir = tempfile.mkdtemp(dir=self.tempdir)
+        key1 = ac.AlignmentCache.get_pair_key(self.records[0])
+
+        alignment_cache = ac.AlignmentCache(cache_dir, ac.AlignmentCache.get_config_digest(self.ref, ["--local"]))
+        alignment_cache.put_many([(key1, ac.AlignmentCache.pack_records(TEST_PAIR_SAM))])
+        alignment_cache.close()
+
+        alignment_cache = ac.AlignmentCache(
+            cache_dir, ac.AlignmentCache.get_config_digest(self.ref, ["--end-to-end"]))
+        observed = alignment_cache.get_many([key1])
+        alignment_cache.close()
+
+        self.assertEqual({}, observed)
+
+    def test_concurrent_configs(self):
+        """Tests that runs with different parameters sharing a cache keep their own alignments."""
+
+        cache_dir = tempfile.mkdtemp(dir=self.tempdir)
+        key1 = ac.AlignmentCache.get_pair_key(self.records[0])
+        local_records = ac.AlignmentCache.pack_records(TEST_PAIR_SAM)
+        e2e_records = ac.AlignmentCache.pack_records([line.replace("AS:i:0", "AS:i:-6") for line in TEST_PAIR_SAM])
+
+        local_cache = ac.AlignmentCache(cache_dir, ac.AlignmentCache.get_config_digest(self.ref, ["--local"]))
+        e2e_cache = ac.AlignmentCache(cache_dir, ac.AlignmentCache.get_config_digest(self.ref, ["--end-to-end"]))
+        local_cache.put_many([(key1, local_records)])
+        e2e_cache.put_many([(key1, e2e_records)])
+        local_cache.set_header(["@SQ\tSN:WT\tLN:12"])
+
+        observed = (local_cache.get_many([key1]), e2e_cache.get_many([key1]), e2e_cache.get_header())
+        local_cache.close()
+        e2e_cache.close()
+
+        self.assertEqual(({key1: local_records}, {key1: e2e_records}, None), observed)
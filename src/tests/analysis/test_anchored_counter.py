@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Tests for analysis.anchored_counter."""
+
+import pysam
+import tempfile
+import unittest
+
+import analysis.anchored_counter as ac
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+
+class TestPrimerAnchoredCounter(unittest.TestCase):
+    """Tests for PrimerAnchoredCounter."""
+
+    CBS_REF = "CBS.fa"
+    CBS_SIM_R1 = "CBS_sim.R1.fq.gz"
+    CBS_SIM_R2 = "CBS_sim.R2.fq.gz"
+    CBS_SIM_PRIMERS = "CBS_sim_primers.bed"
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestPrimerAnchoredCounter."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.test_dir = os.path.dirname(__file__)
+        cls.test_data_dir = os.path.abspath(os.path.join(cls.test_dir, "..", "test_data"))
+
+        cls.pac = ac.PrimerAnchoredCounter(
+            f1=os.path.join(cls.test_data_dir, cls.CBS_SIM_R1), f2=os.path.join(cls.test_data_dir, cls.CBS_SIM_R2),
+            ref=os.path.join(cls.test_data_dir, cls.CBS_REF),
+            primers=os.path.join(cls.test_data_dir, cls.CBS_SIM_PRIMERS), outdir=cls.tempdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestPrimerAnchoredCounter."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_counts(self):
+        """Tests that every pair is either counted or written for alignment."""
+
+        with pysam.FastxFile(self.pac.fallback_f1) as f1_ff, pysam.FastxFile(self.pac.fallback_f2) as f2_ff:
+            fallback_names = [(r1.name, r2.name) for r1, r2 in zip(f1_ff, f2_ff)]
+
+        self.assertEqual(
+            (self.pac.n_input, self.pac.n_anchored + self.pac.n_fallback + self.pac.n_filtered, len(fallback_names)),
+            (10, 10, self.pac.n_fallback))
+
+    def test_indel_fallback(self):
+        """Tests that pairs with simulated indels are aligned rather than counted."""
+
+        with pysam.FastxFile(self.pac.fallback_f1) as f1_ff:
+            fallback_names = {r1.name for r1 in f1_ff}
+
+        self.assertTrue({"0000003129", "0000323491"}.issubset(fallback_names))
+
+    def test_mnp_edits(self):
+        """Tests that the edits of a simulated MNP are concordant between mates."""
+
+        observed = [[(mm.pos, mm.ref, mm.alt) for mm in edits.r1_mms] for edits in self.pac.anchored_edits]
+        self.assertIn([(795, "G", "A"), (796, "A", "T"), (797, "C", "G")], observed)
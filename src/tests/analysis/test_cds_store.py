@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Tests for analysis.cds_store."""
+
+import os
+import tempfile
+import unittest
+
+from analysis.cds_store import CdsStore
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+TEST_GFF_RECORDS = "WT\tsatmut\texon\t1\t30\t.\t+\t.\ttranscript_id \"WT\";\n"
+
+
+class TestCdsStore(unittest.TestCase):
+    """Tests for CdsStore."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestCdsStore."""
+
+        cls.tempdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestCdsStore."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_put_get(self):
+        """Tests that stored CDS annotations are returned from a new connection to the store."""
+
+        store_dir = tempfile.mkdtemp(dir=self.tempdir)
+        cds_info = (30, 3, 27, "GGGATGCCCAAATTTGGGCCCTAGAAACCC", "ATGCCCAAATTTGGGCCCTAG")
+        cds_key = CdsStore.get_key(TEST_GFF_RECORDS, "digest")
+
+        store = CdsStore(store_dir)
+        store.put(cds_key, cds_info)
+        store.close()
+
+        store = CdsStore(store_dir)
+        self.assertEqual((cds_info, None), (store.get(cds_key), store.get(CdsStore.get_key("", "digest"))))
+        store.close()
+
+    def test_get_key(self):
+        """Tests that keys change with either the GFF records or the reference digest."""
+
+        keys = {CdsStore.get_key(TEST_GFF_RECORDS, "digest"), CdsStore.get_key(TEST_GFF_RECORDS, "other"),
+                CdsStore.get_key(TEST_GFF_RECORDS.replace("30", "33"), "digest")}
+
+        self.assertEqual(3, len(keys))
+
+    def test_get_ref_digest(self):
+        """Tests that the reference digest is remembered until the reference changes."""
+
+        store = CdsStore(tempfile.mkdtemp(dir=self.tempdir))
+        ref = os.path.join(self.tempdir, "ref.fa")
+        with open(ref, "w") as ref_fh:
+            ref_fh.write(">WT\nACGTACGTAC\n")
+
+        first = store.get_ref_digest(ref)
+        with open(ref, "a") as ref_fh:
+            ref_fh.write(">MUT\nACGTACGTAA\n")
+
+        self.assertNotEqual(first, store.get_ref_digest(ref))
+        store.close()
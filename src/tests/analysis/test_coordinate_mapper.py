@@ -97,6 +97,11 @@ class TestAminoAcidMapper(unittest.TestCase):
 
         fu.safe_remove((cls.tempdir,), force_remove=True)
 
+    def test_cds_store_dir(self):
+        """Tests that the CDS store is written to the output dir by default."""
+
+        self.assertEqual(self.tempdir, os.path.dirname(self.cbs_pezy3_aa_mapper.cds_store.db))
+
     def test_add_cds_info(self):
         """Tests that transcript information is added to the CDS info dict."""
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Tests for analysis.read_batches."""
+
+import numpy as np
+import pysam
+import unittest
+
+import analysis.read_batches as rb
+
+HEADER = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "test_contig", "LN": 1000}]})
+
+
+def make_align_seg(name, flag, start, cigarstring, sequence, qualities, md, nm):
+    """Makes an alignment for testing.
+
+    :param str name: read name
+    :param int flag: SAM flag
+    :param int start: 0-based reference start
+    :param str cigarstring: CIGAR string
+    :param str sequence: read sequence
+    :param list qualities: base qualities
+    :param str md: MD tag
+    :param int nm: NM tag
+    :return pysam.AlignedSegment: read object
+    """
+
+    align_seg = pysam.AlignedSegment(HEADER)
+    align_seg.query_name = name
+    align_seg.flag = flag
+    align_seg.reference_id = 0
+    align_seg.reference_start = start
+    align_seg.mapping_quality = 44
+    align_seg.cigarstring = cigarstring
+    align_seg.query_sequence = sequence
+    align_seg.query_qualities = qualities
+    align_seg.set_tags([("NM", nm), ("MD", md)])
+    return align_seg
+
+
+class TestReadPairBatch(unittest.TestCase):
+    """Tests for ReadPairBatch and AlignmentColumns."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestReadPairBatch."""
+
+        # Mismatches at reference positions 102 (G>T), 104 (C>A, low BQ in R2 only), and 108 (C>N)
+        cls.simple_r1 = make_align_seg(
+            "simple", 99, 100, "2S10M", "GGAATCCATTNT", [40] * 6 + [10] + [40] * 5, "2G5C1", 2)
+        cls.simple_r2 = make_align_seg(
+            "simple", 147, 102, "10M", "TCAATTNTAG", [40] * 2 + [10] + [40] * 7, "0G1C3C3", 3)
+        cls.indel_r1 = make_align_seg("indel", 99, 100, "4M1I5M", "AAGAAAACCA", [40] * 10, "9", 1)
+        cls.indel_r2 = make_align_seg("indel", 147, 100, "9M", "AAGAAACCA", [40] * 9, "9", 0)
+
+        cls.batch = rb.ReadPairBatch([(cls.simple_r1, cls.simple_r2), (cls.indel_r1, cls.indel_r2)])
+
+    def test_is_simple(self):
+        """Tests that pairs with InDels are left to be called from their read objects."""
+
+        self.assertEqual([True, False], self.batch.is_simple.tolist())
+
+    def test_get_mismatches(self):
+        """Tests that mismatches are enumerated from the MD tag with BQ and N filtering."""
+
+        read_index, positions, refs, alts, bqs, read_positions = self.batch.r2.get_mismatches(min_bq=30)
+        observed = list(zip(read_index.tolist(), positions.tolist(), map(chr, refs), map(chr, alts), bqs.tolist(),
+                            read_positions.tolist()))
+
+        # R2 is on the reverse strand so read positions are from the end of the read
+        self.assertEqual([(0, 102, "G", "T", 40, 10)], observed)
+
+    def test_get_mismatches_aligned_pairs(self):
+        """Tests that mismatches agree with the aligned pairs of the read object."""
+
+        read_index, positions, refs, alts, bqs, read_positions = self.batch.r1.get_mismatches(min_bq=0)
+        observed = list(zip(positions.tolist(), map(chr, refs), map(chr, alts)))
+
+        expected = [(ref_pos, ref_base.upper(), self.simple_r1.query_sequence[query_pos])
+                    for query_pos, ref_pos, ref_base in self.simple_r1.get_aligned_pairs(with_seq=True)
+                    if ref_base is not None and ref_base.islower() and self.simple_r1.query_sequence[query_pos] != "N"]
+
+        self.assertEqual(expected, observed)
+
+    def test_get_unmasked_spans(self):
+        """Tests that masked bases are excluded from the aligned span."""
+
+        masked_r1 = make_align_seg("masked", 99, 100, "2S10M", "GGAATCCATTNT", [0] * 4 + [40] * 6 + [0] * 2, "2G5C1", 2)
+        first, last = rb.AlignmentColumns([masked_r1, self.indel_r1]).get_unmasked_spans()
+
+        # Alignments that are not simple have no unmasked span
+        expected = ([102, np.iinfo(np.int64).max], [107, np.iinfo(np.int64).min])
+        self.assertEqual(expected, (first.tolist(), last.tolist()))
+
+    def test_filter_pairs(self):
+        """Tests that the edit distance filter is applied to both mates."""
+
+        self.assertEqual(([True, False], [False, False]),
+                         (self.batch.filter_pairs(max_nm=3).tolist(), self.batch.filter_pairs(max_nm=2).tolist()))
+
+    def test_iterate_read_pair_batches(self):
+        """Tests that pairs are split into batches of the requested size."""
+
+        read_pairs = [(self.simple_r1, self.simple_r2)] * 5
+        observed = [len(batch) for batch in rb.iterate_read_pair_batches(read_pairs, batch_size=2)]
+        self.assertEqual([2, 2, 1], observed)
@@ -414,6 +414,190 @@ class TestFastqPreprocessor(unittest.TestCase):
                     self.assertEqual(expected, line.strip(fu.FILE_NEWLINE))
 
 
+class TestMateMerger(unittest.TestCase):
+    """Tests for MateMerger."""
+
+    FRAGMENT = "ACGTTGCAAGGCTTACCGATGCATGCAATCGGATCCATGAGTCAGTGCAACGTTAGCCATGCATTGACCAGTAGGCTAACGTGCATCGATCGTAGCTAGC"
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestMateMerger."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.r1_fastq = tempfile.NamedTemporaryFile(suffix=".merge.R1.fastq", delete=False, dir=cls.tempdir).name
+        cls.r2_fastq = tempfile.NamedTemporaryFile(suffix=".merge.R2.fastq", delete=False, dir=cls.tempdir).name
+
+        # The first pair overlaps by 40 bases; the second pair is from unrelated sequence and should not be merged
+        cls.r1_seq = cls.FRAGMENT[:70]
+        cls.r2_seq = su.reverse_complement(cls.FRAGMENT[30:])
+
+        with open(cls.r1_fastq, "w") as r1_fh, open(cls.r2_fastq, "w") as r2_fh:
+            r1_fh.write("@pair1\n%s\n+\n%s\n" % (cls.r1_seq, "I" * len(cls.r1_seq)))
+            r2_fh.write("@pair1\n%s\n+\n%s\n" % (cls.r2_seq, "I" * len(cls.r2_seq)))
+            r1_fh.write("@pair2\n%s\n+\n%s\n" % ("A" * 70, "I" * 70))
+            r2_fh.write("@pair2\n%s\n+\n%s\n" % ("C" * 70, "I" * 70))
+
+        cls.mm = rp.MateMerger(f1=cls.r1_fastq, f2=cls.r2_fastq, outdir=cls.tempdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestMateMerger."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_encode_decode_concordance(self):
+        """Tests that concordance codes are recovered after run-length encoding."""
+
+        codes = "SSSCCCCDCS"
+        encoded = rp.MateMerger.encode_concordance(codes)
+
+        self.assertEqual((codes, "3S4C1D1C1S"), (rp.MateMerger.decode_concordance(encoded), encoded))
+
+    def test_merge_mates(self):
+        """Tests that overlapping mates are merged into the fragment with concordance codes."""
+
+        observed = self.mm.merge_mates(self.r1_seq, "I" * 70, self.r2_seq, "I" * 70)
+        self.assertEqual((self.FRAGMENT, "I" * 100, "30S40C30S"), observed)
+
+    def test_find_overlap(self):
+        """Tests that the offset of R2 is found, and that mates shorter than the min overlap are not merged."""
+
+        r1_bases = np.frombuffer(self.r1_seq.encode(), dtype=np.uint8)
+        r2_rc_bases = np.frombuffer(self.FRAGMENT[30:].encode(), dtype=np.uint8)
+
+        observed = (self.mm._find_overlap(r1_bases, r2_rc_bases), self.mm._find_overlap(r1_bases, r2_rc_bases[:10]))
+        self.assertEqual((30, None), observed)
+
+    def test_merge_mates_discordant(self):
+        """Tests that a discordant base takes the higher quality call and is marked discordant."""
+
+        r1_seq = self.r1_seq[:50] + "T" + self.r1_seq[51:]
+        r1_quals = "I" * 50 + "5" + "I" * 19
+        frag_seq, frag_quals, concordance = self.mm.merge_mates(r1_seq, r1_quals, self.r2_seq, "I" * 70)
+
+        self.assertEqual((self.FRAGMENT, "I", "30S20C1D19C30S"), (frag_seq, frag_quals[50], concordance))
+
+    def test_workflow(self):
+        """Tests that merged and unmerged pairs are written separately."""
+
+        with pysam.FastxFile(self.mm.merged_fastq) as merged_ff, pysam.FastxFile(self.mm.unmerged_f1) as r1_ff:
+            observed = ([(r.name, r.comment) for r in merged_ff], [r.name for r in r1_ff])
+
+        self.assertEqual(([("pair1", "XC:Z:30S40C30S")], ["pair2"]), observed)
+
+
+class TestDuplicateCollapser(unittest.TestCase):
+    """Tests for DuplicateCollapser."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestDuplicateCollapser."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.r1_fastq = tempfile.NamedTemporaryFile(suffix=".collapse.R1.fastq", delete=False, dir=cls.tempdir).name
+        cls.r2_fastq = tempfile.NamedTemporaryFile(suffix=".collapse.R2.fastq", delete=False, dir=cls.tempdir).name
+
+        # pair1 and pair3 are exact duplicates with different qualities; pair2 is unique
+        with open(cls.r1_fastq, "w") as r1_fh, open(cls.r2_fastq, "w") as r2_fh:
+            r1_fh.write("@pair1_AAA\nACGTACGT\n+\nIIIIIIII\n@pair2_AAA\nACGTACGA\n+\nIIIIIIII\n"
+                        "@pair3_CCC\nACGTACGT\n+\n55555555\n")
+            r2_fh.write("@pair1_AAA\nTTGGCCAA\n+\nIIIIIIII\n@pair2_AAA\nTTGGCCAA\n+\nIIIIIIII\n"
+                        "@pair3_CCC\nTTGGCCAA\n+\nIIIIIIII\n")
+
+        cls.dc = rp.DuplicateCollapser(f1=cls.r1_fastq, f2=cls.r2_fastq, outdir=cls.tempdir, copy_quals=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestDuplicateCollapser."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_workflow(self):
+        """Tests that exact duplicates are collapsed into a representative with mean qualities."""
+
+        with pysam.FastxFile(self.dc.collapsed_f1) as r1_ff:
+            observed = [(r.name, r.quality) for r in r1_ff]
+
+        # Mean of I (73) and 5 (53)
+        self.assertEqual([("pair1_AAA", "????????"), ("pair2_AAA", "IIIIIIII")], observed)
+
+    def test_load_multiplicities(self):
+        """Tests that only representatives with duplicates are in the multiplicity table."""
+
+        observed = rp.DuplicateCollapser.load_multiplicities(self.dc.multiplicity_table)
+        self.assertEqual({"pair1_AAA": 2}, observed)
+
+    def test_workflow_umi(self):
+        """Tests that duplicates with different UMIs are not collapsed."""
+
+        outdir = tempfile.mkdtemp(dir=self.tempdir)
+        dc = rp.DuplicateCollapser(f1=self.r1_fastq, f2=self.r2_fastq, outdir=outdir, use_umi=True,
+                                   qual_collapse=rp.DuplicateCollapser.QUAL_COLLAPSE_MAX)
+
+        self.assertEqual((3, 3), (dc.n_input, dc.n_unique))
+
+
+class TestQnameEncoder(unittest.TestCase):
+    """Tests for QnameEncoder."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestQnameEncoder."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.r1_fastq = tempfile.NamedTemporaryFile(suffix=".encode.R1.fastq", delete=False, dir=cls.tempdir).name
+        cls.r2_fastq = tempfile.NamedTemporaryFile(suffix=".encode.R2.fastq", delete=False, dir=cls.tempdir).name
+
+        with open(cls.r1_fastq, "w") as r1_fh, open(cls.r2_fastq, "w") as r2_fh:
+            r1_fh.write("@M1:1:FC:1:1:1:1.GGCCTTAA_AAA 1:N:0\nACGTACGT\n+\nIIIIIIII\n"
+                        "@M1:1:FC:1:1:1:2.XXXXXXXX_CCC 1:N:0\nACGTACGA\n+\nIIIIIIII\n")
+            r2_fh.write("@M1:1:FC:1:1:1:1.GGCCTTAA_AAA 2:N:0\nTTGGCCAA\n+\nIIIIIIII\n"
+                        "@M1:1:FC:1:1:1:2.XXXXXXXX_CCC 2:N:0\nTTGGCCAA\n+\nIIIIIIII\n")
+
+        cls.qe = rp.QnameEncoder(r1_fastq=cls.r1_fastq, r2_fastq=cls.r2_fastq, has_umi=True, outdir=cls.tempdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestQnameEncoder."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_workflow(self):
+        """Tests that read names are replaced with integers and the UMI is moved to a tag."""
+
+        with pysam.FastxFile(self.qe.r1_out_fastq) as r1_ff, pysam.FastxFile(self.qe.r2_out_fastq) as r2_ff:
+            observed = [(r1.name, r2.name, r1.comment, r2.comment) for r1, r2 in zip(r1_ff, r2_ff)]
+
+        expected = [("1", "1", "RX:Z:AAA", "RX:Z:AAA"), ("2", "2", "RX:Z:CCC", "RX:Z:CCC")]
+        self.assertEqual(expected, observed)
+
+    def test_get_comment_tag(self):
+        """Tests that a tag value is parsed from a read comment."""
+
+        observed = rp.QnameEncoder.get_comment_tag("XC:Z:10C RX:Z:AAA", rp.QnameEncoder.UMI_TAG)
+        self.assertEqual("AAA", observed)
+
+    def test_restore_qnames(self):
+        """Tests that the original read names are restored, and names that are not IDs are kept."""
+
+        header = {su.SAM_HD_TAG: {"VN": "1.0"}, su.SAM_SQ_TAG: [{"SN": "chr1", "LN": 100}]}
+        encoded_bam = tempfile.NamedTemporaryFile(suffix=".encoded.bam", delete=False, dir=self.tempdir).name
+
+        with pysam.AlignmentFile(encoded_bam, "wb", header=header) as out_af:
+            for qname in ("2", "consensus"):
+                align_seg = pysam.AlignedSegment(out_af.header)
+                align_seg.query_name = qname
+                align_seg.flag = su.SAM_FLAG_UNMAP
+                align_seg.query_sequence = "ACGT"
+                out_af.write(align_seg)
+
+        restored_bam = rp.QnameEncoder.restore_qnames(encoded_bam, self.qe.qname_table)
+        with pysam.AlignmentFile(restored_bam, "rb", check_sq=False) as in_af:
+            observed = [align_seg.query_name for align_seg in in_af.fetch(until_eof=True)]
+
+        self.assertEqual(["M1:1:FC:1:1:1:2.XXXXXXXX_CCC", "consensus"], observed)
+
+
 class TestUmiExtractor(unittest.TestCase):
     """Tests for UmiExtractor."""
 
@@ -561,6 +745,92 @@ class TestUmiExtractor(unittest.TestCase):
 # Skip testing ReadGrouper and ReadDeduplicator as these are wrappers of umi_tools
 
 
+class TestTileDemultiplexer(unittest.TestCase):
+    """Tests for TileDemultiplexer."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestTileDemultiplexer."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.r1_fastq = tempfile.NamedTemporaryFile(suffix=".demux.R1.fastq", delete=False, dir=cls.tempdir).name
+        cls.r2_fastq = tempfile.NamedTemporaryFile(suffix=".demux.R2.fastq", delete=False, dir=cls.tempdir).name
+        cls.primer_fasta = tempfile.NamedTemporaryFile(suffix=".demux.primer.fasta", delete=False, dir=cls.tempdir).name
+
+        # The second pair lacks the primer in R2
+        with open(cls.r1_fastq, "w") as r1_fh, \
+                open(cls.r2_fastq, "w") as r2_fh, \
+                open(cls.primer_fasta, "w") as primer_fh:
+
+            r1_fh.write(TEST_R1_UMI_TILESEQ_FASTQ + TEST_R1_UMI_TILESEQ_FASTQ)
+            r2_fh.write(TEST_R2_UMI_TILESEQ_FASTQ + TEST_R2_UMI_TILESEQ_NOPRIMER_FASTQ)
+            primer_fh.write(TILESEQ_CBS_1R_FASTA)
+
+        cls.tdm = rp.TileDemultiplexer(r1_fastq=cls.r1_fastq, r2_fastq=cls.r2_fastq, primer_fasta=cls.primer_fasta,
+                                       outdir=cls.tempdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestTileDemultiplexer."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_get_tile_primer_error(self):
+        """Tests that a R2 primer with errors within the allowance is assigned to the tile."""
+
+        observed = self.tdm.get_tile(r1_seq=TEST_R1_UMI_TILESEQ_FASTQ.splitlines()[1],
+                                     r2_seq=TEST_R2_UMI_TILESEQ_PRIMER_ERROR_FASTQ.splitlines()[1])
+
+        self.assertEqual("CBS_pEZY3:1083-1101(-)", observed)
+
+    def test_get_candidate_primers(self):
+        """Tests that only primers sharing an exact seed with the read start are fuzzy-matched."""
+
+        primer_prefix = TEST_R2_UMI_TILESEQ_FASTQ.splitlines()[1][:self.tdm.max_primer_len]
+        observed = (self.tdm._get_candidate_primers(primer_prefix), self.tdm._get_candidate_primers("A" * 18))
+        self.assertEqual(([0], []), observed)
+
+    def test_merge_tile_bams_header(self):
+        """Tests that the merged BAM of coordinate-sorted tiles is not marked as coordinate-sorted."""
+
+        header = pysam.AlignmentHeader.from_dict(
+            {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "CBS_pEZY3", "LN": 7160}]})
+
+        tile_bams = collections.OrderedDict()
+        for tile, start in (("tile1", 200), ("tile2", 100)):
+            tile_bams[tile] = tempfile.NamedTemporaryFile(suffix=".tile.bam", delete=False, dir=self.tempdir).name
+            with pysam.AlignmentFile(tile_bams[tile], "wb", header=header) as tile_af:
+                align_seg = pysam.AlignedSegment(header)
+                align_seg.query_name = "read"
+                align_seg.reference_id = 0
+                align_seg.reference_start = start
+                align_seg.query_sequence = "ACGTACGTAC"
+                align_seg.cigarstring = "10M"
+                tile_af.write(align_seg)
+
+        observed = []
+        for grouped in (False, True):
+            merged_bam = tempfile.NamedTemporaryFile(suffix=".merged.bam", delete=False, dir=self.tempdir).name
+            rp.TileDemultiplexer.merge_tile_bams(tile_bams, merged_bam, grouped=grouped)
+            with pysam.AlignmentFile(merged_bam, "rb") as merged_af:
+                observed.append(merged_af.header.to_dict()["HD"])
+
+        expected = [{"VN": "1.0", "SO": "unsorted"}, {"VN": "1.0", "SO": "unsorted", "GO": "query"}]
+        self.assertEqual(expected, observed)
+
+    def test_workflow(self):
+        """Tests that read pairs are written to per-tile FASTQs."""
+
+        expected = collections.OrderedDict([("CBS_pEZY3:1083-1101(-)", 1), (rp.TileDemultiplexer.UNASSIGNED_TILE, 1)])
+
+        observed = collections.OrderedDict()
+        for tile, (tile_r1, _) in self.tdm.tile_fastqs.items():
+            with pysam.FastxFile(tile_r1) as tile_ff:
+                observed[tile] = len(list(tile_ff))
+
+        self.assertEqual(expected, observed)
+
+
 class TestConsensusDeduplicatorPreprocessor(unittest.TestCase):
     """Tests for ConsensusDeduplicatorPreprocessor."""
 
@@ -594,6 +864,27 @@ class TestConsensusDeduplicatorPreprocessor(unittest.TestCase):
         fu.safe_remove((updated_bam,))
         self.assertEqual(expected, observed)
 
+    def test_propagate_tags_r2_first(self):
+        """Tests that we propagate tags in a single pass when R2s precede their R1s."""
+
+        expected = ["3275192_R1", "3275192_R2", "6956334_R1", "6956334_R2"]
+
+        with pysam.AlignmentFile(self.grouped_bam, "rb") as grouped_af:
+            header = grouped_af.header.to_dict()
+            reads = list(grouped_af.fetch(until_eof=True))
+
+        with tempfile.NamedTemporaryFile(suffix=".reversed.bam", delete=False, dir=self.tempdir) as reversed_bam, \
+                pysam.AlignmentFile(reversed_bam, "wb", header=header) as reversed_af:
+            for align_seg in reversed(reads):
+                reversed_af.write(align_seg)
+
+        with pysam.AlignmentFile(reversed_bam.name, "rb") as reversed_af:
+            observed = [align_seg.get_tag(rp.UMITOOLS_UG_TAG) for align_seg in
+                        rp.ConsensusDeduplicatorPreprocessor.propagate_tags(reversed_af)]
+
+        fu.safe_remove((reversed_bam.name,))
+        self.assertEqual(expected, observed)
+
     def test_update_tags_from_grouped_bam(self):
         """Tests that we properly qname-sorted the BAM and update tags."""
 
@@ -620,6 +911,21 @@ class TestConsensusDeduplicatorPreprocessor(unittest.TestCase):
         fu.safe_remove((cdp.preprocess_bam,))
         self.assertEqual(expected, observed)
 
+    def test_workflow_external(self):
+        """Tests that streaming into samtools sort on group tag gives the same order without a temp BAM."""
+
+        expected = (["3275192_R1", "3275192_R2", "6956334_R1", "6956334_R2"], [])
+
+        outdir = tempfile.mkdtemp(dir=self.tempdir)
+        cdp = rp.ConsensusDeduplicatorPreprocessor(group_bam=self.grouped_bam, outdir=outdir, in_memory_max_size=0)
+
+        with pysam.AlignmentFile(cdp.preprocess_bam, "rb") as preprocess_af:
+            observed = ([align_seg.get_tag(rp.UMITOOLS_UG_TAG) for align_seg in preprocess_af.fetch(until_eof=True)],
+                        os.listdir(outdir))
+
+        fu.safe_remove((cdp.preprocess_bam,))
+        self.assertEqual(expected, observed)
+
 
 class TestConsensusDeduplicator(unittest.TestCase):
     """Tests for ConsensusDeduplicator."""
@@ -896,6 +1202,62 @@ class TestConsensusDeduplicator(unittest.TestCase):
 
         self.assertTrue(all(test_res))
 
+    def test_sample_read_max_duplicates(self):
+        """Tests that reads of a jackpot UMI group are reservoir sampled."""
+
+        cd = rp.ConsensusDeduplicator(in_bam=self.preproc_bam, ref=self.ref, outdir=self.tempdir, max_duplicates=1)
+
+        group_reads = collections.OrderedDict()
+        group_counts = collections.Counter()
+
+        for align_seg in (self.test_align_seg_del, self.test_align_seg_del_dup,
+                          self.test_align_seg_del_dup_minority_call):
+            cd._sample_read(align_seg, group_reads, group_counts)
+
+        observed = ([len(v) for v in group_reads.values()], list(group_counts.values()))
+        self.assertEqual(([1], [3]), observed)
+
+    def test_add_read_streams_duplicates(self):
+        """Tests that reads of a duplicated UMI group are streamed into the consensus instead of being held."""
+
+        group_reads = collections.OrderedDict()
+        group_counts = collections.Counter()
+        consensus_dict = collections.OrderedDict()
+        pos_list = []
+
+        for align_seg in (self.test_align_seg_del, self.test_align_seg_del_dup,
+                          self.test_align_seg_del_dup_minority_call):
+            self.cd._add_read(align_seg, group_reads, group_counts, consensus_dict, pos_list)
+
+        observed = (len(group_reads), len(pos_list), list(group_counts.values()))
+        self.assertEqual((0, 3, [3]), observed)
+
+    def test_write_group_singleton(self):
+        """Tests that a non-duplicated UMI group is passed through with only the read name and tags updated."""
+
+        align_seg = pysam.AlignedSegment.fromstring(self.test_align_seg_mismatches.to_string(), self.test_header)
+        expected = ("10000001", align_seg.query_sequence, align_seg.cigarstring, 1)
+
+        group_reads = collections.OrderedDict()
+        group_counts = collections.Counter()
+        consensus_dict = collections.OrderedDict()
+        pos_list = []
+        self.cd._add_read(align_seg, group_reads, group_counts, consensus_dict, pos_list)
+
+        with tempfile.NamedTemporaryFile(suffix=".consensus.bam", delete=False, dir=self.tempdir) as consensus_bam, \
+                pysam.AlignmentFile(consensus_bam, mode="wb", header=self.test_header) as consensus_af:
+
+            self.cd._write_group(consensus_af, group_reads, group_counts, consensus_dict, pos_list, "10000001_R1")
+            consensus_bam_name = consensus_bam.name
+
+        with pysam.AlignmentFile(consensus_bam_name, "rb") as res_af:
+            observed = [(res.query_name, res.query_sequence, res.cigarstring, res.get_tag(self.cd.N_DUPLICATES_TAG))
+                        for res in res_af.fetch(until_eof=True)]
+
+        fu.safe_remove((consensus_bam_name,))
+
+        self.assertEqual([expected], observed)
+
     def test_generate_consensus_reads(self):
         """Tests that three fragments are properly deduplicated in succession."""
 
@@ -924,6 +1286,27 @@ class TestConsensusDeduplicator(unittest.TestCase):
         test_res = [expected_1 == observed_1, expected_2 == observed_2]
         self.assertTrue(all(test_res))
 
+    def test_generate_consensus_reads_alignment_fields(self):
+        """Tests that consensus reads carry CIGAR, MD, NM, and mate fields without realignment."""
+
+        # The R2 consensus should start at the min R2 duplicate start, not the R1 start
+        expected = [
+            ("10015877", 2396, "64M1D66M", "64^G66", 1, 2407, 163),
+            ("10015877", 2407, "53M1D98M", "53^G98", 1, 2396, -163)]
+
+        consensus_bam = self.cd._generate_consensus_reads()
+
+        with pysam.AlignmentFile(consensus_bam, "rb") as consensus_af:
+            observed = [
+                (align_seg.query_name, align_seg.reference_start, align_seg.cigarstring,
+                 align_seg.get_tag(su.SAM_MD_TAG), align_seg.get_tag(su.SAM_EDIT_DIST_TAG),
+                 align_seg.next_reference_start, align_seg.template_length)
+                for align_seg in consensus_af.fetch(until_eof=True)][-2:]
+
+        fu.safe_remove((consensus_bam,))
+
+        self.assertEqual(expected, observed)
+
 
 class TestReadMasker(unittest.TestCase):
     """Tests for ReadMasker."""
@@ -973,6 +1356,28 @@ class TestReadMasker(unittest.TestCase):
 
         fu.safe_remove((cls.tempdir, cls.preproc_bam,), force_remove=True)
 
+    def test_get_read_primer_associations(self):
+        """Test that only primers the read starts or ends in are associated, excluding read-through primers."""
+
+        rm = rp.ReadMasker(in_bam=self.preproc_bam, feature_file=self.primer_bed2, outdir=self.tempdir)
+
+        # The read spans 13F and 12R but only originates from 13F
+        observed = rm._get_read_primer_associations(self.test_align_seg_r1_reverse)
+        expected = {"CBS_pEZY3:2289-2309:+"}
+        self.assertEqual(expected, observed)
+
+    def test_get_query_index(self):
+        """Test that we find the read index of a reference coordinate across softclips and deletions."""
+
+        align_seg = pysam.AlignedSegment()
+        align_seg.query_sequence = "NNACGTCA"
+        align_seg.reference_start = 10
+        align_seg.cigarstring = "2S3M1D3M"
+
+        # 1-based coordinates of the first aligned base, the deleted base, and the base following the deletion
+        observed = [rp.ReadMasker._get_query_index(align_seg, ref_coord) for ref_coord in (11, 14, 15)]
+        self.assertEqual([2, None, 5], observed)
+
     def test_get_mask_base_indices_tileseq_r1(self):
         """Test that we return the read indices to mask for a Tile-seq R1 starting and ending at a primer start."""
 
@@ -1104,4 +1509,99 @@ class TestReadMasker(unittest.TestCase):
 
         self.assertEqual(0, len(expected - observed))
 
-# Skip testing VariantCallerPreprocessor as we simply make samtools calls which are tested in test_seq_utils
+    def test_workflow_parallel(self):
+        """Tests that masking chunks of an indexed BAM in worker processes gives the same reads as a single pass."""
+
+        with tempfile.NamedTemporaryFile(mode="wb", suffix=".test.bam", delete=False, dir=self.tempdir) as test_bam, \
+                pysam.AlignmentFile(self.preproc_bam, mode="rb") as in_af, \
+                pysam.AlignmentFile(test_bam, mode="wb", header=in_af.header) as out_af:
+
+            for align_seg in in_af.fetch(until_eof=True):
+                align_seg.query_name = align_seg.query_name.split("_")[0]
+                out_af.write(align_seg)
+
+            test_bam_fn = test_bam.name
+
+        sorted_bam = fu.replace_extension(test_bam_fn, "sorted.bam")
+        pysam.sort("-o", sorted_bam, test_bam_fn)
+        pysam.index(sorted_bam)
+
+        observed = []
+        for nthreads in (0, 2):
+            outdir = tempfile.mkdtemp(dir=self.tempdir)
+            rm = rp.ReadMasker(in_bam=sorted_bam, feature_file=self.primer_bed2, race_like=True, outdir=outdir,
+                               nthreads=nthreads)
+            rm.workflow()
+
+            with pysam.AlignmentFile(rm.out_bam, "rb") as test_af:
+                observed.append([align_seg.to_string() for align_seg in test_af.fetch(until_eof=True)])
+
+        self.assertEqual(observed[0], observed[1])
+
+
+class TestVariantCallerPreprocessor(unittest.TestCase):
+    """Tests for VariantCallerPreprocessor. The sort and split steps are samtools calls tested in test_seq_utils."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Setup for TestVariantCallerPreprocessor."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        header = pysam.AlignmentHeader.from_dict(
+            {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 1000}]})
+
+        # (qname, flag, start, mate start); pair3 is missing its mate and pair4 has an unmapped mate
+        read_info = [("pair1", 99, 10, 60), ("pair2", 163, 20, 30), ("pair2", 83, 30, 20), ("pair3", 99, 40, 200),
+                     ("pair4", 73, 50, 50), ("pair1", 147, 60, 10)]
+
+        cls.test_bam = tempfile.NamedTemporaryFile(suffix=".coord.bam", delete=False, dir=cls.tempdir).name
+        with pysam.AlignmentFile(cls.test_bam, "wb", header=header) as test_af:
+            for qname, flag, start, mate_start in read_info:
+                align_seg = pysam.AlignedSegment(header)
+                align_seg.query_name = qname
+                align_seg.flag = flag
+                align_seg.reference_id = 0
+                align_seg.reference_start = start
+                align_seg.next_reference_id = 0
+                align_seg.next_reference_start = mate_start
+                align_seg.query_sequence = "ACGTACGTAC"
+                align_seg.cigarstring = "10M"
+                test_af.write(align_seg)
+
+        pysam.index(cls.test_bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestVariantCallerPreprocessor."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_iterate_buffered_pairs(self):
+        """Tests that mates are paired from a coordinate-sorted BAM and returned as R1, R2."""
+
+        expected = [("pair2", True, False), ("pair1", True, False)]
+
+        with pysam.AlignmentFile(self.test_bam, "rb") as test_af:
+            observed = [(r1.query_name, r1.is_read1, r2.is_read1) for r1, r2 in
+                        rp.VariantCallerPreprocessor.iterate_buffered_pairs(test_af)]
+
+        self.assertEqual(expected, observed)
+
+    def test_iterate_buffered_pairs_region(self):
+        """Tests that only pairs with both mates in the region are returned."""
+
+        with pysam.AlignmentFile(self.test_bam, "rb") as test_af:
+            observed = [r1.query_name for r1, _ in
+                        rp.VariantCallerPreprocessor.iterate_buffered_pairs(test_af, region="chr1:1-45")]
+
+        self.assertEqual(["pair2"], observed)
+
+    def test_total_mapped_region(self):
+        """Tests that mapped reads are counted over the region only, if one is provided."""
+
+        observed = [rp.VariantCallerPreprocessor(
+            am=self.test_bam, ref=None, output_dir=tempfile.mkdtemp(dir=self.tempdir), use_index=True,
+            region=region).total_mapped
+            for region in (None, "chr1:1-45")]
+
+        self.assertEqual([6, 4], observed)
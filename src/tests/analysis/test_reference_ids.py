@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Tests for analysis.reference_ids."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from analysis.reference_ids import ReferenceIdIndex
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+
+class TestReferenceIdIndex(unittest.TestCase):
+    """Tests for ReferenceIdIndex."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestReferenceIdIndex."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        test_data_dir = os.path.join(os.path.split(os.path.dirname(__file__))[0], "test_data")
+
+        for reference_file in ReferenceIdIndex.SOURCE_FILES:
+            shutil.copy(os.path.join(test_data_dir, reference_file), cls.tempdir)
+
+        cls.index_dir = tempfile.mkdtemp()
+        cls.id_index = ReferenceIdIndex(cls.tempdir, index_dir=cls.index_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestReferenceIdIndex."""
+
+        cls.id_index.close()
+        fu.safe_remove((cls.tempdir, cls.index_dir,), force_remove=True)
+
+    def test_get_alternative_id(self):
+        """Tests that a curated ID with a different version is found for a version-less match."""
+
+        observed = [self.id_index.get_alternative_id(ensembl_id)
+                    for ensembl_id in ("ENSG00000160200.1", "ENSG00000160200.17", "ENSG1.1")]
+        self.assertEqual(["ENSG00000160200.17", None, None], observed)
+
+    def test_get_trx_id(self):
+        """Tests that the transcript of a gene is found."""
+
+        self.assertEqual("ENST00000398165.7", self.id_index.get_trx_id("ENSG00000160200.17"))
+
+    def test_get_contig(self):
+        """Tests that gene and transcript IDs map to the same transcript FASTA contig."""
+
+        observed = {self.id_index.get_contig(ensembl_id) for ensembl_id in ("ENSG00000160200.17", "ENST00000398165.7")}
+        self.assertEqual(1, len(observed))
+        self.assertTrue(observed.pop().startswith("ENST00000398165.7|ENSG00000160200.17|"))
+
+    def test_get_locus(self):
+        """Tests that the chromosome and strand of a transcript are indexed from the annotations."""
+
+        self.assertEqual(("21", "-"), self.id_index.get_locus("ENST00000398165.7"))
+
+    def test_rebuild(self):
+        """Tests that the index is rebuilt when a reference file changes."""
+
+        trx_ids = os.path.join(self.tempdir, APPRIS_TRX_IDS)
+        with open(trx_ids, "a") as trx_ids_fh:
+            trx_ids_fh.write("ENST00000000001.1" + fu.FILE_NEWLINE)
+
+        with ReferenceIdIndex(self.tempdir, index_dir=self.index_dir) as id_index:
+            self.assertTrue(id_index.id_exists("ENST00000000001.1"))
+
+    def test_index_dir(self):
+        """Tests that the index is written to the index dir and not the reference dir."""
+
+        observed = (os.path.dirname(self.id_index.db), [f for f in os.listdir(self.tempdir) if f.endswith(".sqlite")])
+        self.assertEqual((self.index_dir, []), observed)
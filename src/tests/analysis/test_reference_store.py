@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Tests for analysis.reference_store."""
+
+import os
+import pysam
+import tempfile
+import unittest
+
+from analysis.reference_store import ReferenceStore
+import analysis.seq_utils as su
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+
+class TestReferenceStore(unittest.TestCase):
+    """Tests for ReferenceStore."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestReferenceStore."""
+
+        cls.tempdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestReferenceStore."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def _make_ref(self, basename, seq):
+        """Makes a faidx-indexed reference FASTA.
+
+        :param str basename: FASTA basename
+        :param str seq: reference sequence
+        :return str: path of the FASTA
+        """
+
+        ref = os.path.join(self.tempdir, basename)
+        with open(ref, "w") as ref_fh:
+            ref_fh.write(">WT\n%s\n" % seq)
+
+        pysam.faidx(ref)
+        return ref
+
+    def test_get_reference_reused(self):
+        """Tests that references with identical contents share one indexed entry."""
+
+        store = ReferenceStore(tempfile.mkdtemp(dir=self.tempdir))
+        first = store.get_reference(self._make_ref("first.fa", "ACGTACGTAC"), fm_index=False)
+        second = store.get_reference(self._make_ref("second.fa", "ACGTACGTAC"), fm_index=False)
+
+        observed = (first == second, os.path.exists(fu.add_extension(first, su.FASTA_INDEX_SUFFIX)),
+                    len(store._get_entries()))
+        self.assertEqual((True, True, 1), observed)
+
+    def test_collect_garbage_age(self):
+        """Tests that only entries unused for longer than the max age are removed."""
+
+        store = ReferenceStore(tempfile.mkdtemp(dir=self.tempdir))
+        old_ref = store.get_reference(self._make_ref("old.fa", "AAAACCCCGG"), fm_index=False)
+        new_ref = store.get_reference(self._make_ref("new.fa", "GGGGTTTTCC"), fm_index=False)
+
+        old_time = os.path.getmtime(old_ref) - 10 * ReferenceStore.SECONDS_PER_DAY
+        os.utime(os.path.join(os.path.dirname(old_ref), ReferenceStore.READY_FILE), (old_time, old_time))
+        store.close()
+        store.collect_garbage(max_age_days=5)
+
+        self.assertEqual([False, True], [os.path.exists(f) for f in (old_ref, new_ref)])
+
+    def test_collect_garbage_size_keep(self):
+        """Tests that entries are removed to stay within the max size, except those kept."""
+
+        store = ReferenceStore(tempfile.mkdtemp(dir=self.tempdir))
+        refs = [store.get_reference(self._make_ref("size%i.fa" % i, seq), fm_index=False)
+                for i, seq in enumerate(("ACACACACAC", "GTGTGTGTGT"))]
+        store.close()
+        store.collect_garbage(max_size_gb=0, keep=(refs[1],))
+
+        self.assertEqual([False, True], [os.path.exists(f) for f in refs])
+
+
+    def test_collect_garbage_held(self):
+        """Tests that entries held by a concurrent run are not removed until it closes its store."""
+
+        store_dir = tempfile.mkdtemp(dir=self.tempdir)
+        run_store = ReferenceStore(store_dir)
+        held_ref = run_store.get_reference(self._make_ref("held.fa", "CCCCAAAATT"), fm_index=False)
+
+        gc_store = ReferenceStore(store_dir)
+        held_removed = gc_store.collect_garbage(max_size_gb=0)
+        run_store.close()
+        closed_removed = gc_store.collect_garbage(max_size_gb=0)
+
+        observed = (held_removed, len(closed_removed), os.path.exists(held_ref), os.listdir(store_dir))
+        self.assertEqual(([], 1, False, []), observed)
+
+    def test_collect_garbage_orphans(self):
+        """Tests that abandoned build dirs and stale lock files are removed."""
+
+        store_dir = tempfile.mkdtemp(dir=self.tempdir)
+        store = ReferenceStore(store_dir)
+        ref = store.get_reference(self._make_ref("orphan.fa", "TTTTGGGGAA"), fm_index=False)
+        store.close()
+
+        key = os.path.basename(os.path.dirname(ref))
+        tempfile.mkdtemp(prefix=ReferenceStore.BUILD_PREFIX + key + fu.FILE_EXT_DELIM, dir=store_dir)
+        stale_lock = os.path.join(store_dir, fu.add_extension("stale", ReferenceStore.LOCK_SUFFIX))
+        open(stale_lock, "w").close()
+
+        store.collect_garbage()
+
+        expected = sorted([key, fu.add_extension(key, ReferenceStore.LOCK_SUFFIX)])
+        self.assertEqual(expected, sorted(os.listdir(store_dir)))
@@ -142,3 +142,34 @@ class TestReferences(unittest.TestCase):
             _, _ = get_ensembl_references(reference_dir=self.test_data_dir, ensembl_id="ENST1.1", outdir=self.tempdir)
 
     # Don't make smoke test of get_ensembl_references() as we test extraction of both FASTA and GFF as well as indexing
+
+    def _make_panel_dir(self):
+        """Makes a panel dir with a manifest of the CBS transcript.
+
+        :return str: panel dir
+        """
+
+        panel_dir = tempfile.mkdtemp(dir=self.tempdir)
+        with open(os.path.join(self.test_data_dir, APPRIS_CONTIG_IDS), "r") as contig_fh:
+            cbs_contig = [line.rstrip(fu.FILE_NEWLINE) for line in contig_fh if "ENST00000398165.7" in line][0]
+
+        with open(os.path.join(panel_dir, PANEL_MANIFEST), "w") as manifest_fh:
+            manifest_fh.write(fu.FILE_DELIM.join(PANEL_ENTRY_TUPLE._fields) + fu.FILE_NEWLINE)
+            manifest_fh.write(
+                fu.FILE_DELIM.join(("ENST00000398165.7", "ENST00000398165.7", cbs_contig)) + fu.FILE_NEWLINE)
+
+        return panel_dir
+
+    def test_get_panel_references(self):
+        """Tests that a gene in the panel selects the panel references."""
+
+        panel_dir = self._make_panel_dir()
+        observed = get_panel_references(panel_dir=panel_dir, ensembl_id="ENSG00000160200.17")
+
+        expected = (os.path.join(panel_dir, PANEL_FASTA), os.path.join(panel_dir, PANEL_GFF))
+        self.assertEqual(expected, observed)
+
+    def test_get_panel_references_not_in_panel(self):
+        """Tests that an ID not in the panel is not selected."""
+
+        self.assertIsNone(get_panel_references(panel_dir=self._make_panel_dir(), ensembl_id="ENST00000291547.9"))
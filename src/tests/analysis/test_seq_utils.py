@@ -244,6 +244,59 @@ class TestSamtools(unittest.TestCase):
         self.assertTrue(test_res)
 
 
+class TestCram(unittest.TestCase):
+    """Tests for CRAM conversion and reading."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Setup for TestCram."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.ref = os.path.join(cls.tempdir, "test.fa")
+
+        random.seed(9)
+        ref_seq = "".join(random.choice(su.DNA_BASES) for _ in range(200))
+        with open(cls.ref, "w") as ref_fh:
+            ref_fh.write(">test_contig\n%s\n" % ref_seq)
+        pysam.faidx(cls.ref)
+
+        header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "test_contig", "LN": len(ref_seq)}]})
+        cls.test_bam = os.path.join(cls.tempdir, "test.bam")
+        with pysam.AlignmentFile(cls.test_bam, "wb", header=header) as out_af:
+            for i, start in enumerate((10, 50, 90)):
+                align_seg = pysam.AlignedSegment(header)
+                align_seg.query_name = "read%i" % i
+                align_seg.reference_id = 0
+                align_seg.reference_start = start
+                align_seg.cigarstring = "30M"
+                align_seg.query_sequence = ref_seq[start:start + 29] + "N"
+                align_seg.query_qualities = [30] * 30
+                out_af.write(align_seg)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestCram."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_bam_to_cram(self):
+        """Test that alignments are unchanged by conversion to an indexed CRAM."""
+
+        out_cram = su.bam_to_cram(self.test_bam, self.ref, os.path.join(self.tempdir, "test.cram"))
+
+        with su.open_alignments(self.test_bam) as bam_af, su.open_alignments(out_cram, self.ref) as cram_af:
+            expected = [(r.query_name, r.reference_start, r.query_sequence) for r in bam_af.fetch(until_eof=True)]
+            observed = [(r.query_name, r.reference_start, r.query_sequence) for r in cram_af.fetch(until_eof=True)]
+
+        self.assertEqual((expected, True), (observed, os.path.exists(su.get_index_name(out_cram))))
+
+    def test_get_index_name(self):
+        """Test that CRAM and BAM indices are named by their format."""
+
+        observed = (su.get_index_name("test.cram"), su.get_index_name("test.bam"))
+        self.assertEqual(("test.cram.crai", "test.bam.bai"), observed)
+
+
 class TestFastaToFastq(unittest.TestCase):
     """Tests for analysis.seq_utils.fasta_to_fastq."""
 
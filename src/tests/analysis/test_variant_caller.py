@@ -162,6 +162,24 @@ class TestVariantCaller(unittest.TestCase):
                         fu.add_extension(cls.test_invalid_bam, su.BAM_INDEX_SUFFIX),
                         fu.add_extension(cls.test_indel_bam, su.BAM_INDEX_SUFFIX),), force_remove=True)
 
+    def test_init_cram_total_mapped(self):
+        """Tests that mapped reads are counted for an indexed CRAM input, whose index does not record them."""
+
+        test_cram = fu.replace_extension(self.test_bam, su.CRAM_SUFFIX)
+        with pysam.AlignmentFile(self.test_bam, "rb") as in_af, \
+                pysam.AlignmentFile(test_cram, "wc", template=in_af, reference_filename=self.ref) as out_af:
+            for align_seg in in_af.fetch(until_eof=True):
+                out_af.write(align_seg)
+
+        pysam.index(test_cram)
+
+        cram_vc = vc.VariantCaller(
+            am=test_cram, ref=self.ref, trx_gff=self.gff, gff_ref=self.gff_ref, targets=self.target_bed,
+            primers=self.primer_bed, output_dir=tempfile.mkdtemp(dir=self.tempdir), use_index=True)
+
+        fu.safe_remove((test_cram, su.get_index_name(test_cram)))
+        self.assertEqual(self.vc.total_mapped, cram_vc.total_mapped)
+
     def test_is_indel_no_indel(self):
         """Tests that InDels are not detected from a pysam aligned pair."""
 
@@ -547,6 +565,17 @@ class TestVariantCaller(unittest.TestCase):
 
         self.assertEqual(expected, observed)
 
+    def test_filter_concordant_edits(self):
+        """Test that only fragment edits at mate-concordant bases are kept, with R2 positions from the R2 5' end."""
+
+        fragment_mms = [vc.MM_TUPLE(contig="CBS_pEZY3", pos=2410, ref="A", alt="G", bq=39, read_pos=10),
+                        vc.MM_TUPLE(contig="CBS_pEZY3", pos=2440, ref="C", alt="T", bq=39, read_pos=40)]
+
+        expected = ([fragment_mms[1]], [fragment_mms[1]._replace(read_pos=61)])
+        observed = vc.VariantCaller._filter_concordant_edits(fragment_mms, "S" * 30 + "C" * 40 + "S" * 30)
+
+        self.assertEqual(expected, observed)
+
     def test_unpack_stats_snp(self):
         """Tests extraction of positions, reference bases, alternate bases and quality info from SNPs in a pair."""
 
@@ -832,6 +861,38 @@ class TestVariantCaller(unittest.TestCase):
 
         self.assertEqual(0, len(self.vc.variant_counts))
 
+    def test_iterate_over_reads_batched(self):
+        """Tests that calling batches of pairs gives the same counts and coverage as calling each pair."""
+
+        with pysam.AlignmentFile(self.test_bam, "rb") as test_af:
+            read_pairs = list(self.vc.vc_preprocessor.iterate_buffered_pairs(test_af))
+
+        # Compare a batch of one pair, a batch size that does not divide the pairs, and one batch of all pairs
+        self.assertGreater(len(read_pairs), 2)
+        batch_sizes = (0, 1, len(read_pairs) - 1, len(read_pairs) + 1)
+
+        observed = []
+        for batch_size in batch_sizes:
+            self.vc.variant_counts = collections.OrderedDict()
+            self.vc.coordinate_counts = collections.defaultdict(int)
+            self.vc._iterate_over_reads(min_bq=30, max_nm=10, read_pairs=read_pairs, batch_size=batch_size)
+            observed.append((list(self.vc.variant_counts.items()), sorted(self.vc.coordinate_counts.items())))
+
+        self.assertTrue(len(observed[0][0]) > 0 and len(observed[0][1]) > 0)
+        for batch_observed in observed[1:]:
+            self.assertEqual(observed[0], batch_observed)
+
+    def test_get_concordant_mismatches_large_position(self):
+        """Tests that mismatches are matched on position beyond 2^24, where a packed key would collide."""
+
+        large_pos = 2 ** 24
+        fields = [np.array(f) for f in ([5, large_pos + 5], [ord("A")] * 2, [ord("G")] * 2, [30] * 2, [1] * 2)]
+        r1_fields = tuple(fields)
+        r2_fields = (np.array([large_pos + 5, 5 + 2 ** 25]),) + tuple(f.copy() for f in fields[1:])
+
+        observed = vc.VariantCaller._get_concordant_mismatches(np.array([0, 0]), r1_fields, np.array([0, 0]), r2_fields)
+        self.assertEqual(([1], [0]), tuple(i.tolist() for i in observed))
+
     def test_iterate_over_reads_qname_mismatch(self):
         """Tests that an exception is generated if we have a mismatch between qnames of a pair."""
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Tests for core_utils.fastq_utils."""
+
+import os
+import pysam
+import tempfile
+import unittest
+
+import core_utils.fastq_utils as fqu
+import core_utils.file_utils as fu
+from satmut_utils.definitions import DEFAULT_TEMPDIR
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+TEST_FASTQ = """@read1 1:N:0
+ACGTN
++
+IIII5
+@read2
+GGA
++
+FFF
+@read3
+T
++
+#
+"""
+
+
+class TestFastqBatch(unittest.TestCase):
+    """Tests for FastqBatch."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestFastqBatch."""
+
+        cls.batch = fqu.FastqBatch.from_bytes(TEST_FASTQ.encode())
+
+    def test_from_bytes(self):
+        """Test that records are parsed into names, sequences, and qualities."""
+
+        observed = (self.batch.get_names(), self.batch.get_sequences(), self.batch.get_qualities())
+        expected = (["read1", "read2", "read3"], ["ACGTN", "GGA", "T"], ["IIII5", "FFF", "#"])
+        self.assertEqual(expected, observed)
+
+    def test_to_bytes(self):
+        """Test that records are written as they were read."""
+
+        self.assertEqual(TEST_FASTQ.encode(), self.batch.to_bytes())
+
+    def test_reverse_complement(self):
+        """Test that sequences are reverse complemented and qualities reversed."""
+
+        rc_batch = self.batch.reverse_complement()
+        observed = (rc_batch.get_sequences(), rc_batch.get_qualities())
+        self.assertEqual((["NACGT", "TCC", "A"], ["5IIII", "FFF", "#"]), observed)
+
+    def test_get_prefixes(self):
+        """Test that prefixes of short reads are padded."""
+
+        observed = ["".join(map(chr, prefix)) for prefix in self.batch.get_prefixes(4)]
+        self.assertEqual(["ACGT", "GGAN", "TNNN"], observed)
+
+    def test_convert_quality_offset(self):
+        """Test that qualities are converted between encodings."""
+
+        observed = self.batch.convert_quality_offset(33, 64).get_qualities()
+        self.assertEqual(["hhhhT", "eee", "B"], observed)
+
+    def test_with_names(self):
+        """Test that read names are replaced and comments kept."""
+
+        observed = self.batch.with_names(["1", "2", "3"]).get_headers()
+        self.assertEqual(["1 1:N:0", "2", "3"], observed)
+
+
+class TestFastqReaderWriter(unittest.TestCase):
+    """Tests for FastqReader and FastqWriter."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestFastqReaderWriter."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.test_dir = os.path.dirname(__file__)
+        cls.test_data_dir = os.path.abspath(os.path.join(cls.test_dir, "..", "test_data"))
+        cls.r1_fastq = os.path.join(cls.test_data_dir, "CBS_sim.R1.fq.gz")
+        cls.r2_fastq = os.path.join(cls.test_data_dir, "CBS_sim.R2.fq.gz")
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestFastqReaderWriter."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def test_read_batches(self):
+        """Test that small batches and blocks read the same records as pysam."""
+
+        with fqu.FastqReader(self.r1_fastq, batch_size=3, block_size=100) as reader:
+            observed = [(name, seq) for batch in reader for name, seq in zip(batch.get_names(), batch.get_sequences())]
+
+        with pysam.FastxFile(self.r1_fastq) as r1_ff:
+            expected = [(r.name, r.sequence) for r in r1_ff]
+
+        self.assertEqual(expected, observed)
+
+    def test_write_gzipped(self):
+        """Test that batches are written to a gzipped FASTQ."""
+
+        out_fastq = os.path.join(self.tempdir, "test.fq.gz")
+        with fqu.FastqWriter(out_fastq) as writer:
+            for batch in fqu.FastqReader(self.r1_fastq, batch_size=4):
+                writer.write(batch)
+
+        with pysam.FastxFile(self.r1_fastq) as in_ff, pysam.FastxFile(out_fastq) as out_ff:
+            self.assertEqual([str(r) for r in in_ff], [str(r) for r in out_ff])
+
+    def test_iterate_paired_batches(self):
+        """Test that paired batches have the same number of records."""
+
+        observed = [(len(r1_batch), len(r2_batch)) for r1_batch, r2_batch in
+                    fqu.iterate_paired_batches(self.r1_fastq, self.r2_fastq, batch_size=4)]
+        self.assertEqual([(4, 4), (4, 4), (2, 2)], observed)
+
+    def test_iterate_paired_batches_mismatched(self):
+        """Test that FASTQs with different numbers of records raise an error."""
+
+        r1_fastq = os.path.join(self.tempdir, "mismatched.R1.fq")
+        r2_fastq = os.path.join(self.tempdir, "mismatched.R2.fq")
+        with open(r1_fastq, "w") as r1_fh, open(r2_fastq, "w") as r2_fh:
+            r1_fh.write("".join(["@read%i\nACGT\n+\nIIII\n" % i for i in range(3)]))
+            r2_fh.write("".join(["@read%i\nTTGG\n+\nIIII\n" % i for i in range(2)]))
+
+        with self.assertRaises(RuntimeError):
+            _ = list(fqu.iterate_paired_batches(r1_fastq, r2_fastq, batch_size=2))
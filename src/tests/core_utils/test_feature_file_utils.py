@@ -140,6 +140,20 @@ chr19	59066354	59066491	gi|571026644|ref|NM_014453.3|:1-137	0	-
 
         self.assertEqual(observed, expected)
 
+    def test_feature_index(self):
+        """Test that we can query features overlapping an interval."""
+
+        with tempfile.NamedTemporaryFile("w", suffix=".test.bed", delete=False, dir=self.tempdir) as test_bed:
+            test_bed.write(TEST_BED)
+
+        feature_index = ffu.FeatureIndex(ffu.store_coords(test_bed.name, use_name=True))
+
+        # Overlaps the last base of the 330-509 feature and the first base of the 138-329 feature only
+        observed = feature_index.get_overlapping("chr19", 59063804, 59065412)
+        expected = ["gi|571026644|ref|NM_014453.3|:330-509", "gi|571026644|ref|NM_014453.3|:138-329"]
+
+        self.assertEqual(observed, expected)
+
 
 class TestSlopFeatures(unittest.TestCase):
     """Tests for core_utils.feature_file_utils.slop_features."""
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """Tests for core_utils.file_utils."""
 
+import gzip
+import pysam
 import tempfile
 import unittest
 
@@ -76,3 +78,51 @@ class TestFileUtils(unittest.TestCase):
 
         obs = fu.replace_extension("fakefile.txt", "bam")
         self.assertEqual(obs, "fakefile.bam")
+
+    def test_bgzf_writer(self):
+        """Test that blocks compressed in parallel are written in order and readable by gzip."""
+
+        data = bytes(range(256)) * 1000
+        out_gz = os.path.join(self.temp_dir, "test.bgzf.gz")
+        with fu.BgzfWriter(out_gz, nthreads=4) as out_fh:
+            out_fh.write(data[:1000])
+            out_fh.write(data[1000:])
+
+        with gzip.open(out_gz, "rb") as in_fh:
+            self.assertEqual(data, in_fh.read())
+
+    def test_bgzf_writer_htslib(self):
+        """Test that the output is valid BGZF with an EOF block."""
+
+        out_gz = os.path.join(self.temp_dir, "test.htslib.gz")
+        with fu.open_gzip(out_gz, "wt", nthreads=2) as out_fh:
+            out_fh.write(">test\nACGT\n")
+
+        with open(out_gz, "rb") as in_fh:
+            self.assertTrue(in_fh.read().endswith(fu.BGZF_EOF))
+
+        with pysam.FastxFile(out_gz) as in_ff:
+            self.assertEqual([("test", "ACGT")], [(r.name, r.sequence) for r in in_ff])
+
+    def test_gzip_file(self):
+        """Test that a file is replaced by its gzipped copy."""
+
+        test_file = os.path.join(self.temp_dir, "test.gzip.txt")
+        with open(test_file, "w") as out_fh:
+            out_fh.write("test\n" * 100000)
+
+        gz_file = fu.gzip_file(test_file, nthreads=2)
+
+        with gzip.open(gz_file, "rt") as in_fh:
+            self.assertEqual((False, "test\n" * 100000), (os.path.exists(test_file), in_fh.read()))
+
+    def test_get_file_digest(self):
+        """Test that the file digest depends only on the file contents."""
+
+        test_files = [os.path.join(self.temp_dir, "test.digest.%i.txt" % i) for i in range(3)]
+        for test_file, contents in zip(test_files, ("ACGT\n", "ACGT\n", "ACGA\n")):
+            with open(test_file, "w") as out_fh:
+                out_fh.write(contents)
+
+        digests = [fu.get_file_digest(f) for f in test_files]
+        self.assertEqual((True, False), (digests[0] == digests[1], digests[0] == digests[2]))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Tests for core_utils.gff_index."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import core_utils.file_utils as fu
+from core_utils.gff_index import GffIndex
+from satmut_utils.definitions import *
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+CBS_TRX_ID = "ENST00000398165.7"
+PKNOX1_TRX_ID = "ENST00000291547.9"
+
+
+class TestGffIndex(unittest.TestCase):
+    """Tests for GffIndex."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestGffIndex."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.index_dir = tempfile.mkdtemp()
+        test_data_dir = os.path.join(os.path.split(os.path.dirname(__file__))[0], "test_data")
+
+        # This just has CBS and PKNOX1 annotations
+        cls.gff = os.path.join(cls.tempdir, GENCODE_TRX_GFF)
+        shutil.copy(os.path.join(test_data_dir, GENCODE_TRX_GFF), cls.gff)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestGffIndex."""
+
+        fu.safe_remove((cls.tempdir, cls.index_dir,), force_remove=True)
+
+    def test_read_transcript(self):
+        """Tests that the records read for a transcript are those matching its ID."""
+
+        with open(self.gff, "r") as gff_fh:
+            expected = "".join([line for line in gff_fh if CBS_TRX_ID in line])
+
+        self.assertEqual(expected, GffIndex(self.gff, self.index_dir).read_transcript(CBS_TRX_ID))
+
+    def test_iterate_transcripts(self):
+        """Tests that transcripts are iterated in GFF order with their features."""
+
+        observed = [(trx_id, features[0].fields[2], len(features))
+                    for trx_id, features in GffIndex(self.gff, self.index_dir).iterate_transcripts()]
+
+        self.assertEqual([(PKNOX1_TRX_ID, "transcript", 27), (CBS_TRX_ID, "transcript", 39)], observed)
+
+    def test_rebuild(self):
+        """Tests that a stale index is rebuilt when the GFF changes."""
+
+        gff_copy = os.path.join(self.tempdir, "rebuild.gtf")
+        shutil.copy(self.gff, gff_copy)
+        _ = GffIndex(gff_copy, self.index_dir)
+
+        with open(gff_copy, "a") as gff_fh:
+            gff_fh.write(fu.FILE_DELIM.join(
+                ["21", "test", "exon", "1", "10", ".", "+", ".", 'transcript_id "ENST00000000001.1";']) + fu.FILE_NEWLINE)
+
+        self.assertEqual([PKNOX1_TRX_ID, CBS_TRX_ID, "ENST00000000001.1"], GffIndex(gff_copy, self.index_dir).get_transcript_ids())
+
+    def test_index_dir(self):
+        """Tests that the index is written to the index dir and not next to the GFF."""
+
+        gff_index = GffIndex(self.gff, self.index_dir)
+        observed = (os.path.dirname(gff_index.index_file),
+                    [f for f in os.listdir(self.tempdir) if f.endswith(GffIndex.INDEX_SUFFIX)])
+        self.assertEqual((self.index_dir, []), observed)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Tests for core_utils.io_policy."""
+
+import os
+import pysam
+import tempfile
+import unittest
+
+import core_utils.file_utils as fu
+from core_utils.io_policy import IntermediatePolicy, open_bam
+from satmut_utils.definitions import DEFAULT_TEMPDIR
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+HEADER = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "test_contig", "LN": 1000}]})
+
+
+class TestIntermediatePolicy(unittest.TestCase):
+    """Tests for IntermediatePolicy."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestIntermediatePolicy."""
+
+        cls.tempdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestIntermediatePolicy."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def _touch(self, basename):
+        """Creates an empty file in the temp dir.
+
+        :param str basename: file basename
+        :return str: file path
+        """
+
+        filename = os.path.join(self.tempdir, basename)
+        with open(filename, "w"):
+            pass
+        return filename
+
+    def test_bam_write_mode(self):
+        """Test that levels map to a pysam mode and format options."""
+
+        observed = [(IntermediatePolicy(compresslevel=level).bam_write_mode,
+                     IntermediatePolicy(compresslevel=level).format_options) for level in (None, 0, 1)]
+        self.assertEqual([("wb", None), ("wbu", None), ("wb", [b"level=1"])], observed)
+
+    def test_open_bam(self):
+        """Test that intermediate BAMs written under the policy can be read back."""
+
+        align_seg = pysam.AlignedSegment(HEADER)
+        align_seg.query_name = "read1"
+        align_seg.reference_id = 0
+        align_seg.reference_start = 10
+        align_seg.cigarstring = "5M"
+        align_seg.query_sequence = "ACGTA"
+        align_seg.query_qualities = [30] * 5
+
+        observed = []
+        for level, policy in ((None, None), (1, IntermediatePolicy(compresslevel=1, nthreads=2))):
+            out_bam = os.path.join(self.tempdir, "test.%s.bam" % level)
+            with open_bam(out_bam, policy, header=HEADER) as out_af:
+                out_af.write(align_seg)
+
+            with pysam.AlignmentFile(out_bam, "rb") as in_af:
+                observed.extend([r.query_name for r in in_af.fetch(until_eof=True)])
+
+        self.assertEqual(["read1", "read1"], observed)
+
+    def test_make_tempdir_scratch(self):
+        """Test that the scratch dir is used when it has enough space."""
+
+        policy = IntermediatePolicy(scratch_dir=self.tempdir)
+        self.assertEqual(self.tempdir, os.path.dirname(policy.make_tempdir(suffix=".test.tmp")))
+
+    def test_make_tempdir_fallback(self):
+        """Test that the temp dir is used when the scratch dir does not exist."""
+
+        policy = IntermediatePolicy(scratch_dir=os.path.join(self.tempdir, "missing"))
+        observed = policy.make_tempdir(suffix=".test.tmp")
+        fu.safe_remove((observed,))
+        self.assertEqual(tempfile.gettempdir(), os.path.dirname(observed))
+
+    def test_handoff(self):
+        """Test that registered inputs are released while unregistered and passed-through inputs are kept."""
+
+        policy = IntermediatePolicy()
+        user_input = self._touch("user.fq")
+        trimmed = self._touch("trimmed.fq")
+        aligned = self._touch("aligned.bam")
+        aligned_index = self._touch("aligned.bam.bai")
+
+        policy.handoff((user_input,), (trimmed,))
+        policy.handoff((trimmed,), (trimmed,))
+        policy.handoff((trimmed,), (aligned,))
+        policy.handoff((user_input, aligned,), ("masked.bam",))
+
+        observed = [os.path.exists(f) for f in (user_input, trimmed, aligned, aligned_index)]
+        self.assertEqual([True, False, False, False], observed)
+
+    def test_keep_intermediates(self):
+        """Test that nothing is released when intermediates are kept."""
+
+        policy = IntermediatePolicy(keep_intermediates=True)
+        kept = self._touch("kept.bam")
+        policy.register(kept)
+        policy.release(kept)
+        self.assertTrue(os.path.exists(kept))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Tests for core_utils.sort_planner."""
+
+import pysam
+import tempfile
+import unittest
+
+import core_utils.file_utils as fu
+import core_utils.sort_planner as sp
+
+
+class TestSortPlanner(unittest.TestCase):
+    """Tests for SortPlanner."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Setup for TestSortPlanner."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.header_sq = [{"SN": "chr1", "LN": 1000}]
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestSortPlanner."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def _write_bam(self, hd):
+        """Writes an empty BAM with the provided @HD header line.
+
+        :param dict hd: @HD header fields
+        :return str: BAM filename
+        """
+
+        bam = tempfile.NamedTemporaryFile(suffix=".test.bam", delete=False, dir=self.tempdir).name
+        header = pysam.AlignmentHeader.from_dict({"HD": hd, "SQ": self.header_sq})
+        with pysam.AlignmentFile(bam, "wb", header=header):
+            pass
+
+        return bam
+
+    def test_get_order_header(self):
+        """Tests that the order of an unregistered BAM is determined from the @HD header."""
+
+        observed = [sp.SortPlanner().get_order(self._write_bam(hd)) for hd in (
+            {"VN": "1.0", "SO": "coordinate"}, {"VN": "1.0", "SO": "queryname"},
+            {"VN": "1.0", "SO": "unsorted", "GO": "query"}, {"VN": "1.0", "SO": "unsorted"})]
+
+        expected = [sp.SortOrder.COORDINATE, sp.SortOrder.QUERYNAME, sp.SortOrder.NAME_GROUPED, sp.SortOrder.UNKNOWN]
+        self.assertEqual(expected, observed)
+
+    def test_require_skip(self):
+        """Tests that a sort is skipped when the BAM already has a satisfying order."""
+
+        planner = sp.SortPlanner()
+        qname_bam = self._write_bam({"VN": "1.0", "SO": "queryname"})
+        grouped_bam = self._write_bam({"VN": "1.0", "SO": "unsorted"})
+        planner.register(grouped_bam, sp.SortOrder.NAME_GROUPED)
+
+        observed = [planner.require(bam, sp.SortOrder.NAME_GROUPED, stage="test") for bam in (qname_bam, grouped_bam)]
+        self.assertEqual(([qname_bam, grouped_bam], 2, 0), (observed, len(planner.skipped), len(planner.performed)))
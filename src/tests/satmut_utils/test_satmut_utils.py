@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Tests for satmut_utils.satmut_utils."""
+
+import pysam
+import tempfile
+import unittest
+
+import core_utils.file_utils as fu
+from satmut_utils.definitions import *
+import satmut_utils.satmut_utils as sm
+
+tempfile.tempdir = DEFAULT_TEMPDIR
+
+
+class TestPreprocessWorkflow(unittest.TestCase):
+    """Tests for preprocess_workflow."""
+
+    CBS_PEZY3_REF = "CBS_pEZY3.fa"
+    CBS_SIM_R1 = "CBS_sim.R1.fq.gz"
+    CBS_SIM_R2 = "CBS_sim.R2.fq.gz"
+    NDUPLICATED = 3
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up for TestPreprocessWorkflow."""
+
+        cls.tempdir = tempfile.mkdtemp()
+        cls.test_dir = os.path.dirname(__file__)
+        cls.test_data_dir = os.path.abspath(os.path.join(cls.test_dir, "..", "test_data"))
+        cls.ref = os.path.join(cls.test_data_dir, cls.CBS_PEZY3_REF)
+
+        # Append a UMI to each read name, and duplicate the first pairs with their UMIs
+        cls.fastqs = []
+        for in_fastq, out_basename in ((cls.CBS_SIM_R1, "umi.R1.fq"), (cls.CBS_SIM_R2, "umi.R2.fq")):
+            with pysam.FastxFile(os.path.join(cls.test_data_dir, in_fastq)) as in_ff:
+                records = ["@%s_ACGTACGT\n%s\n+\n%s\n" % (r.name, r.sequence, r.quality) for r in in_ff]
+
+            out_fastq = os.path.join(cls.tempdir, out_basename)
+            with open(out_fastq, "w") as out_fh:
+                out_fh.write("".join(records + records[:cls.NDUPLICATED]))
+
+            cls.fastqs.append(out_fastq)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Tear down for TestPreprocessWorkflow."""
+
+        fu.safe_remove((cls.tempdir,), force_remove=True)
+
+    def _get_consensus_reads(self, collapse_duplicates):
+        """Runs consensus deduplication and gets the consensus reads.
+
+        :param bool collapse_duplicates: collapse exact duplicates?
+        :return tuple: (list of (qname, flag, sequence, qualities), multiplicity table)
+        """
+
+        outdir = tempfile.mkdtemp(dir=self.tempdir)
+        vc_in_bam, multiplicity_table = sm.preprocess_workflow(
+            fastq1=self.fastqs[0], fastq2=self.fastqs[1], ref_fa=self.ref, outdir=outdir, consensus_dedup=True,
+            omit_trim=True, collapse_duplicates=collapse_duplicates)
+
+        with pysam.AlignmentFile(vc_in_bam, "rb", check_sq=False) as in_af:
+            reads = sorted([(r.query_name, r.flag, r.query_sequence, r.qual) for r in in_af.fetch(until_eof=True)])
+
+        return reads, multiplicity_table
+
+    def test_consensus_dedup_collapse_duplicates(self):
+        """Tests that consensus reads are unchanged when duplicate collapsing is also requested."""
+
+        expected = self._get_consensus_reads(collapse_duplicates=False)
+        observed = self._get_consensus_reads(collapse_duplicates=True)
+        self.assertEqual(expected, observed)